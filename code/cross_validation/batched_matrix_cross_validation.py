@@ -0,0 +1,67 @@
+"""
+Batched version of the MatrixCrossValidation class, where the parameter
+settings that only differ in their hyperparameters are trained together, as
+one batch per fold (see bnmf_vb_batch.py), instead of one model at a time.
+
+We expect the same arguments as for MatrixCrossValidation, except that:
+- method is a batch class, whose constructor takes R, M, the other
+  parameters P1,P2,..., and a list all_hyperparameters, and whose train
+  function fits all of them. After training, batch.models is a list with a
+  trained model per hyperparameter setting, with a predict function.
+- each dictionary in parameter_search contains 'hyperparameters', the
+  dictionary of hyperparameters of that setting. Settings with the same
+  values for all other parameters (e.g. K and ARD) form a batch.
+
+All settings use the same folds, so that each batch shares one training mask.
+"""
+
+from matrix_cross_validation import MatrixCrossValidation
+from mask import compute_folds_stratify_rows_attempts
+from mask import compute_folds_stratify_columns_attempts
+
+attempts_generate_M = 1000
+
+
+class BatchedMatrixCrossValidation(MatrixCrossValidation):
+    def batches(self):
+        ''' Return a list of (parameters, list of parameter settings) for the settings that only differ in their hyperparameters. '''
+        batches, positions = [], {}
+        for parameters in self.parameter_search:
+            shared = dict([(name,value) for (name,value) in parameters.iteritems() if name != 'hyperparameters'])
+            if self.JSON(shared) not in positions:
+                positions[self.JSON(shared)] = len(batches)
+                batches.append((shared,[]))
+            batches[positions[self.JSON(shared)]][1].append(parameters)
+        return batches
+
+    def run(self):
+        ''' Run the cross-validation, training a batch of settings for each fold. '''
+        folds_method = compute_folds_stratify_rows_attempts if self.I < self.J else compute_folds_stratify_columns_attempts
+        folds_training, folds_test = folds_method(I=self.I, J=self.J, no_folds=self.K, attempts=attempts_generate_M, M=self.M)
+
+        succeeded = set()
+        for shared, settings in self.batches():
+            print "Trying parameters %s, with %s hyperparameter settings." % (shared,len(settings))
+            try:
+                for parameters in settings:
+                    self.all_performances[self.JSON(parameters)] = {}
+                for i,(train,test) in enumerate(zip(folds_training,folds_test)):
+                    print "Fold %s (parameters: %s)." % (i+1,shared)
+                    batch = self.method(self.R,train,all_hyperparameters=[parameters['hyperparameters'] for parameters in settings],**shared)
+                    batch.train(**self.train_config)
+                    for parameters,model in zip(settings,batch.models):
+                        self.store_performances(model.predict(test,**self.predict_config),parameters)
+                succeeded.update([self.JSON(parameters) for parameters in settings])
+
+            except Exception as e:
+                self.fout.write("Tried parameters %s but got exception: %s. \n" % (shared,e))
+                self.fout.flush()
+
+        # Log in the order of parameter_search, as find_best_parameters expects
+        for parameters in self.parameter_search:
+            if self.JSON(parameters) in succeeded:
+                self.log(parameters)
+
+    # Undo the function run_model:
+    def run_model(self,train,test,parameters):
+        raise Exception("Using wrong method for BatchedMatrixCrossValidation! Batches are trained in run().")
@@ -46,6 +46,7 @@ Methods:
 
 from mask import compute_folds_stratify_rows_attempts
 from mask import compute_folds_stratify_columns_attempts
+from ..models.dataset import read_only
 
 import numpy
 import json
@@ -55,7 +56,7 @@ attempts_generate_M = 1000
 class MatrixCrossValidation:
     def __init__(self,method,R,M,K,parameter_search,train_config,predict_config,file_performance):
         self.method = method
-        self.R = numpy.array(R,dtype=float)
+        self.R = read_only(R) # shared by the models of all folds, see dataset.py
         self.M = numpy.array(M)
         self.K = K
         self.train_config = train_config
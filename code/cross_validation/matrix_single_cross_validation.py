@@ -14,6 +14,8 @@ We expect the following arguments:
        we with to evaluate the predictions, and returns a dictionary mapping
        performance measure names to their values.
        {'MSE','R2','Rp'} (Mean Square Error, R^2, Pearson correlation coefficient)
+       Extra metrics (e.g. 'MAE') can be requested through predict_config, using
+       {'metrics':['MSE','R^2','Rp','MAE']}, and are stored as well.
 - R, the data matrix.
 - M, a mask matrix with 1 values where entries in X are known, and 0 where they are not.
 - K, the number of folds for cross-validation.
@@ -44,16 +46,17 @@ Methods:
 
 from mask import compute_folds_stratify_rows_attempts
 from mask import compute_folds_stratify_columns_attempts
+from ..models.metrics import ALL_METRICS
+from ..models.dataset import read_only
 
 import numpy
 
 ATTEMPTS_GENERATE_M = 1000
-METRICS = ['MSE', 'R^2', 'Rp']
 
 class MatrixSingleCrossValidation:
     def __init__(self,method,R,M,K,parameters,train_config,predict_config,file_performance):
         self.method = method
-        self.R = numpy.array(R,dtype=float)
+        self.R = read_only(R) # shared by the models of all folds, see dataset.py
         self.M = numpy.array(M)
         self.K = K
         self.parameters = parameters
@@ -65,7 +68,7 @@ class MatrixSingleCrossValidation:
         assert (self.R.shape == self.M.shape), "X and M are of different shapes: %s and %s respectively." % (self.R.shape,self.M.shape)
         
         # Performances across all folds - dictionary from evaluation criteria to a list of performances        
-        self.performances = {metric:[] for metric in METRICS}  
+        self.performances = {metric:[] for metric in ALL_METRICS}  
         
         
     def run(self):
@@ -96,12 +99,12 @@ class MatrixSingleCrossValidation:
         message = "Performances fold %s: %s. \n" % (fold,performance_dict)
         self.fout.write(message)
         self.fout.flush()
-        for metric in METRICS:
-            self.performances[metric].append(performance_dict[metric])
+        for metric in performance_dict:
+            self.performances.setdefault(metric,[]).append(performance_dict[metric])
 
     
     def log_average_performance(self):
-        avr_performance = {metric: numpy.mean(self.performances[metric]) for metric in METRICS}
+        avr_performance = {metric: numpy.mean(values) for (metric,values) in self.performances.iteritems()}
         message = "Average performance: %s. All performances: %s." % (avr_performance, self.performances)
         self.fout.write(message)
         self.fout.flush()
\ No newline at end of file
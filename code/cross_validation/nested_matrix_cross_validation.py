@@ -53,6 +53,7 @@ from matrix_cross_validation import MatrixCrossValidation
 from parallel_matrix_cross_validation import ParallelMatrixCrossValidation
 from mask import compute_folds_stratify_rows_attempts
 from mask import compute_folds_stratify_columns_attempts
+from ..models.dataset import read_only
 
 import numpy
 
@@ -61,7 +62,7 @@ attempts_generate_M = 1000
 class MatrixNestedCrossValidation:
     def __init__(self,method,R,M,K,P,parameter_search,train_config,predict_config,file_performance,files_nested_performances):
         self.method = method
-        self.R = numpy.array(R,dtype=float)
+        self.R = read_only(R) # shared by the models of all folds, see dataset.py
         self.M = numpy.array(M)
         self.K = K
         self.P = P
@@ -28,7 +28,7 @@ def run_fold(params):
 def run_model(method,X,train,test,parameters,train_config,predict_config):
     model = method(X,train,**parameters)
     model.train(**train_config)
-    return model.predict(test)
+    return model.predict(test,**predict_config)
 
 
 # Class, redefining the run function
@@ -54,7 +54,7 @@ class ParallelMatrixCrossValidation(MatrixCrossValidation):
                 all_parameters = [
                     {
                         'parameters' : parameters,
-                        'R' : numpy.copy(self.R),
+                        'R' : self.R,
                         'train' : train,
                         'test' : test,
                         'method' : self.method,
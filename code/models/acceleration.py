@@ -0,0 +1,166 @@
+"""
+Extrapolation acceleration of the fixed-point iterations of the models.
+
+One iteration of the VB coordinate ascent, ICM, or the multiplicative (or
+HALS) updates of NMF/NMTF is a map x <- F(x) of the parameters x, which
+converges linearly and often slowly. Given a function sweep() applying F to
+the parameters of a model in place, we can extrapolate along the sequence of
+iterates instead:
+- SQUAREM (Varadhan and Roland, 2008; scheme S3): from x0 we compute
+  x1 = F(x0) and x2 = F(x1), and with r = x1 - x0, v = x2 - x1 - r, and the
+  step length alpha = - ||r|| / ||v|| (at most -1), jump to
+      x' = x0 - 2 alpha r + alpha**2 v,
+  followed by one stabilising sweep F(x'). Each iteration uses three sweeps.
+- Anderson acceleration (type II, with memory m): from the last m differences
+  of the iterates F(x) and of the residuals f = F(x) - x, we take the
+  combination of the last m iterates with the smallest residual,
+      x' = F(x) - dG gamma,  with gamma = argmin || f - dF gamma ||.
+  Each iteration uses one sweep.
+The extrapolated parameters are projected onto the feasible set, given as a
+list of (name,lower) pairs: the attribute name of the model, and a lower
+bound for its values (e.g. 0 for the factors, or a small positive number for
+precisions and for the factors of the multiplicative updates), or None if it
+is unbounded (e.g. the location parameters of truncated normals).
+
+We also use a monotonicity safeguard on the objective (the ELBO for VB, the
+log posterior for ICM, and minus the I-divergence or Frobenius error for NMF):
+- SQUAREM backtracks the step length towards -1 (i.e. x2) while the
+  objective after the stabilising sweep is below the one at x2.
+- Anderson falls back to F(x) and clears its memory when the objective of
+  the extrapolated parameters is below the one at F(x).
+
+The models use this with run(iterations,accelerate='squarem') or
+accelerate='anderson'. Each iteration is then one step of the accelerator.
+The cumulative number of sweeps after each iteration is stored in
+model.all_sweeps, so the two can be compared to the plain iterations at equal
+cost, and the VB models store the ELBO of each iteration (or None if it was
+not computed) in model.all_elbo. iterations_to_convergence(objectives,tolerance) gives the number of
+iterations after which the relative change in the objective drops below the
+tolerance.
+
+Usage:
+    accelerator = create_accelerator(accelerate,model,parameters,sweep,objective,refresh)
+    accelerator.step()    -> one iteration; refresh() is called after the parameters are set
+"""
+
+import numpy
+
+OPTIONS_ACCELERATION = ['squarem','anderson']
+POSITIVE = 1e-10
+ANDERSON_MEMORY = 5
+SQUAREM_BACKTRACKS = 5
+CONVERGENCE_TOLERANCE = 1e-6
+
+
+def iterations_to_convergence(objectives,tolerance=CONVERGENCE_TOLERANCE):
+    ''' Return the first iteration (counting from 1) at which the relative change in the objective is at most
+        tolerance, or None if it never is. '''
+    for it in range(1,len(objectives)):
+        if abs(objectives[it] - objectives[it-1]) <= tolerance * abs(objectives[it]):
+            return it+1
+    return None
+
+def create_accelerator(accelerate,model,parameters,sweep,objective,refresh=None):
+    ''' Return an accelerator for the sweeps of model, or a NullAccelerator if accelerate is None or False. '''
+    if not accelerate:
+        return NullAccelerator(sweep)
+    assert accelerate in OPTIONS_ACCELERATION, "Unrecognised acceleration: %s. Should be one in %s." % (accelerate,OPTIONS_ACCELERATION)
+    accelerator = SQUAREM if accelerate == 'squarem' else Anderson
+    return accelerator(model,parameters,sweep,objective,refresh)
+
+
+class Accelerator:
+    def __init__(self,model,parameters,sweep,objective,refresh=None):
+        ''' Store the model, its parameters as (name,lower) pairs, and the functions to sweep, evaluate the objective, and
+            update the quantities derived from the parameters. '''
+        self.model, self.parameters = model, parameters
+        self.sweep, self.objective = sweep, objective
+        self.refresh = refresh if refresh is not None else (lambda: None)
+        self.sweeps, self.rejected = 0, 0
+
+    def get(self):
+        ''' Return the parameters of the model as one vector. '''
+        return numpy.concatenate([numpy.ravel(getattr(self.model,name)) for (name,lower) in self.parameters]).astype(float)
+
+    def set(self,x):
+        ''' Set the parameters of the model to the vector x, projected onto their lower bounds, and refresh the model. '''
+        start = 0
+        for (name,lower) in self.parameters:
+            shape = numpy.shape(getattr(self.model,name))
+            size = int(numpy.prod(shape))
+            value = x[start:start+size].reshape(shape) if shape else x[start]
+            setattr(self.model,name,value if lower is None else numpy.maximum(value,lower))
+            start += size
+        self.refresh()
+
+    def sweep_once(self):
+        ''' Apply the fixed-point map once. '''
+        self.sweep()
+        self.sweeps += 1
+
+
+class SQUAREM(Accelerator):
+    def step(self):
+        ''' Do two sweeps, extrapolate, and do a stabilising sweep, backtracking if the objective decreases. '''
+        x0 = self.get()
+        self.sweep_once()
+        x1 = self.get()
+        self.sweep_once()
+        x2, objective2 = self.get(), self.objective()
+        r, v = x1 - x0, x2 - 2*x1 + x0
+        if not numpy.linalg.norm(v) > 0.:
+            return
+        alpha = min(-numpy.linalg.norm(r) / numpy.linalg.norm(v), -1.)
+        for backtrack in range(SQUAREM_BACKTRACKS+1):
+            self.set(x0 - 2*alpha*r + alpha**2*v)
+            self.sweep_once()
+            if alpha == -1. or self.objective() >= objective2:
+                return
+            alpha = (alpha - 1.) / 2. if backtrack < SQUAREM_BACKTRACKS-1 else -1.
+            self.rejected += 1
+
+
+class Anderson(Accelerator):
+    def __init__(self,model,parameters,sweep,objective,refresh=None,memory=ANDERSON_MEMORY):
+        ''' Also keep the last memory differences of the iterates and residuals. '''
+        Accelerator.__init__(self,model,parameters,sweep,objective,refresh)
+        assert memory >= 1, "Memory of Anderson acceleration should be at least 1, not %s." % memory
+        self.memory = memory
+        self.clear()
+
+    def clear(self):
+        ''' Forget the previous iterates. '''
+        self.previous, self.dG, self.dF = None, [], []
+
+    def step(self):
+        ''' Do one sweep and extrapolate, falling back to the sweep if the objective decreases. '''
+        x = self.get()
+        self.sweep_once()
+        g = self.get()
+        f = g - x
+        if self.previous is not None:
+            self.dG.append(g - self.previous[0])
+            self.dF.append(f - self.previous[1])
+            self.dG, self.dF = self.dG[-self.memory:], self.dF[-self.memory:]
+        self.previous = (g,f)
+        if not self.dF:
+            return
+        objective = self.objective()
+        gamma = numpy.linalg.lstsq(numpy.array(self.dF).T,f,rcond=None)[0]
+        self.set(g - numpy.dot(numpy.array(self.dG).T,gamma))
+        if not self.objective() >= objective: # also if it is nan
+            self.set(g)
+            self.rejected += 1
+            self.clear()
+
+
+class NullAccelerator:
+    def __init__(self,sweep):
+        ''' Plain iterations of the sweep. '''
+        self.sweep = sweep
+        self.sweeps, self.rejected = 0, 0
+
+    def step(self):
+        ''' Apply the fixed-point map once. '''
+        self.sweep()
+        self.sweeps += 1
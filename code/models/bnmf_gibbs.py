@@ -2,8 +2,9 @@
 Gibbs sampler for non-negative matrix factorisation, with ARD.
 
 We expect the following arguments:
-- R, the matrix.
-- M, the mask matrix indicating observed values (1) and unobserved ones (0).
+- R, the matrix, or a Dataset shared with other models (see dataset.py).
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or None to use the mask of the Dataset R.
 - K, the number of latent factors.
 - ARD, a boolean indicating whether we use ARD in this model or not.
 - hyperparameters = { 'alphatau', 'betatau', 'alpha0', 'beta0', 'lambdaU', 'lambdaV' },
@@ -12,7 +13,7 @@ We expect the following arguments:
     lambdaU, lambdaV  - if not using the ARD, nonnegative reals defining prior over U and V
     
 The random variables are initialised as follows:
-    U, V: expectation ('exp') or random ('random')
+    U, V: expectation ('exp'), random ('random'), or NNDSVD ('nndsvd' or 'nndsvd-iterative', see nndsvd.py)
     tau: using updates, and then random draw
     lambda: expectation
 We initialise the values of U and V according to the given argument 'init_UV'. 
@@ -35,9 +36,24 @@ We can test the performance of our model on a test dataset, specifying our test
     performance = BNMF.predict(M_pred,burn_in,thinning)
 This gives a dictionary of performances,
     performance = { 'MSE', 'R^2', 'Rp' }    
+and also 'MAE' with predict(...,metrics=['MSE','R^2','Rp','MAE']) (see metrics.py).
     
 The performances of all iterations are stored in BNMF.all_performances, which 
 is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+
+Further features (see the module or method named for the details):
+    BNMF.run(iterations,rao_blackwell=True)   -> average the conditional expectations of the draws instead
+    BNMF.update_data(new_entries)             -> add observations, then continue with refine(iterations,local_sweeps)
+    BNMF.save(path,burn_in,thinning)          -> store the model in a directory, for bnmf_gibbs.load(path) (persistence.py)
+    BNMF.predict_entries(rows,cols,burn_in,thinning,variance) -> predict some entries, or predict_rows(rows,...)
+    BNMF.track_predictive(rows,cols,burn_in,thinning) -> accumulate the predictive for predictive(credible) (predictive.py)
+    BNMF.run(iterations,profile=False)        -> do not time the phases of run() in BNMF.profile (profiler.py)
+    BNMF.run(iterations,time_budget=seconds)  -> stop before exceeding a wall-clock budget (budget.py)
+    BNMF.run(iterations,prune=True)           -> remove the components ARD switches off (pruning.py)
+    BNMF.run(iterations,grow=True)            -> start from a small K and add components (growth.py)
+    BNMF.run(iterations,threads=T)            -> update blocks of rows in parallel threads (parallel.py)
+    BNMF.run_until(ess_target,max_iterations) -> run until converged, with BNMF.convergence (diagnostics.py)
+    BNMF.train_hybrid(init_UV,vb_iterations,iterations) -> start from a bnmf_vb fit, or use initialise(from_vb=BNMF_VB)
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -48,67 +64,80 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 """
 
 from distributions.exponential import exponential_draw
+from nndsvd import nndsvd_factors, OPTIONS_NNDSVD
 from distributions.gamma import gamma_draw
-from distributions.truncated_normal_vector import TN_vector_draw
+from distributions.truncated_normal_vector import TN_vector_draw_rng, TN_vector_expectation
+from persistence import save_model, load_model, restore_model
+from dataset import shared_dataset, prior_matrix
+from fold_in import new_rows
+from metrics import ALL_METRICS, Evaluator, compute_MSE, compute_R2, compute_Rp
+from profiler import Profiler, NullProfiler
+from budget import TimeBudget, trace_length, extend_traces
+from pruning import create_pruner, component_magnitudes, remove_components
+from parallel import create_row_blocks
+from kernels import TN_vector_draw_kernel, masked_residual_products
+from growth import create_grower, residual_component, nonnegative_coefficients, append_components
+from predictive import RunningMoments, predictive_summary
+from diagnostics import ConvergenceMonitor, CHECK_EVERY
+from bnmf_vb import bnmf_vb
 
 import numpy, itertools, math, time
 
-ALL_METRICS = ['MSE','R^2','Rp']
 ALL_QUALITY = ['loglikelihood','BIC','AIC','MSE','ELBO']
-OPTIONS_INIT_UV = ['random', 'exp']
+OPTIONS_INIT_UV = ['random', 'exp'] + OPTIONS_NNDSVD
+SAVE_DIMENSIONS = ['K','ARD']
+SAVE_HYPERPARAMETERS = ['alphatau','betatau','alpha0','beta0','lambdaU','lambdaV']
+SAVE_STATE = ['U','V','tau','lambdak','touched_rows','touched_columns','rao_blackwell']
+SAVE_TRACES = ['all_U','all_V','all_tau','all_lambdak','all_exp_U','all_exp_V','all_exp_tau','all_exp_lambdak','all_times','all_performances','pruned_components','grown_components','all_K']
+COMPONENT_ARRAYS = [('U',1),('V',1),('lambdak',0)]
+RAO_BLACKWELL_ARRAYS = [('exp_U',1),('exp_V',1),('exp_lambdak',0)]
+TRACES = ['all_U','all_V','all_tau','all_lambdak']
+RAO_BLACKWELL_TRACES = ['all_exp_U','all_exp_V','all_exp_tau','all_exp_lambdak']
 
 class bnmf_gibbs:
     def __init__(self,R,M,K,ARD,hyperparameters):
         ''' Set up the class and do some checks on the values passed. '''
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+        self.data = shared_dataset(R,M)
+        (self.R, self.M) = (self.data.R, self.data.M)
         self.K = K
         self.ARD = ARD
         
-        assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
-            "but instead %s-dimensional." % len(self.R.shape)
-        assert self.R.shape == self.M.shape, "Input matrix R is not of the same size as " \
-            "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
-            
-        (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
-        self.check_empty_rows_columns()      
+        (self.I,self.J) = self.data.shape
+        self.size_Omega = self.data.size_Omega
+        self.touched_rows, self.touched_columns = [], []
+        self.evaluator = Evaluator()
+        self.prediction_cache = {}
+        self.predictive_query = None
+        self.predictive_moments, self.noise_moments = RunningMoments(), RunningMoments()
+        self.rao_blackwell = False
         
         self.alphatau, self.betatau = float(hyperparameters['alphatau']), float(hyperparameters['betatau'])
         if self.ARD:
             self.alpha0, self.beta0 = float(hyperparameters['alpha0']), float(hyperparameters['beta0'])
         else:
-            self.lambdaU, self.lambdaV = numpy.array(hyperparameters['lambdaU']), numpy.array(hyperparameters['lambdaV'])
-            # Make lambdaU/V into a numpy array if they are a float
-            if self.lambdaU.shape == ():
-                self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K))
-            if self.lambdaV.shape == ():
-                self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K))
-        
-            assert self.lambdaU.shape == (self.I,self.K), "Prior matrix lambdaU has the wrong shape: %s instead of (%s, %s)." % (self.lambdaU.shape,self.I,self.K)
-            assert self.lambdaV.shape == (self.J,self.K), "Prior matrix lambdaV has the wrong shape: %s instead of (%s, %s)." % (self.lambdaV.shape,self.J,self.K)
+            self.lambdaU = prior_matrix(hyperparameters['lambdaU'],(self.I,self.K),'lambdaU')
+            self.lambdaV = prior_matrix(hyperparameters['lambdaV'],(self.J,self.K),'lambdaV')
                 
             
-    def check_empty_rows_columns(self):
-        ''' Raise an exception if an entire row or column is empty. '''
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
-                    
-        # Assert none of the rows or columns are entirely unknown values
-        for i,c in enumerate(sums_rows):
-            assert c != 0, "Fully unobserved row in R, row %s." % i
-        for j,c in enumerate(sums_columns):
-            assert c != 0, "Fully unobserved column in R, column %s." % j
-
-
-    def train(self,init_UV,iterations):
+    def train(self,init_UV,iterations,prune=False,grow=False,threads=1,rao_blackwell=False,time_budget=None):
         ''' Initialise and run the sampler. '''
         self.initialise(init_UV=init_UV)
-        self.run(iterations)
+        self.run(iterations,prune=prune,grow=grow,threads=threads,rao_blackwell=rao_blackwell,time_budget=time_budget)
+        
+    def train_hybrid(self,init_UV,vb_iterations,iterations,prune=False,grow=False,threads=1,rao_blackwell=False,time_budget=None):
+        ''' Fit a bnmf_vb model with the same hyperparameters for vb_iterations, initialise the sampler with a draw from
+            its variational posterior, and run the sampler with the remaining arguments as in train(). '''
+        hyperparameters = dict([(name,getattr(self,name)) for name in SAVE_HYPERPARAMETERS if hasattr(self,name)])
+        self.vb = bnmf_vb(self.data,None,self.K,self.ARD,hyperparameters)
+        self.vb.train(init_UV,vb_iterations,threads=threads)
+        self.initialise(from_vb=self.vb)
+        self.run(iterations,prune=prune,grow=grow,threads=threads,rao_blackwell=rao_blackwell,time_budget=time_budget)
 
 
-    def initialise(self,init_UV='random'):
-        ''' Initialise U, V, tau, and lambda (if ARD). '''
+    def initialise(self,init_UV='random',from_vb=None):
+        ''' Initialise U, V, tau, and lambda (if ARD), or draw them from the variational posterior of from_vb. '''
+        if from_vb is not None:
+            return self.initialise_from_vb(from_vb)
         assert init_UV in OPTIONS_INIT_UV, "Unknown initialisation option: %s. Should be in %s." % (init_UV, OPTIONS_INIT_UV)
         
         self.U = numpy.zeros((self.I,self.K))
@@ -121,66 +150,189 @@ class bnmf_gibbs:
                 self.lambdak[k] = self.alpha0 / self.beta0
         
         # Initialise U, V
-        for i,k in itertools.product(range(self.I),range(self.K)):    
-            hyperparam = self.lambdak[k] if self.ARD else self.lambdaU[i,k]
-            self.U[i,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
-        for j,k in itertools.product(range(self.J),range(self.K)):
-            hyperparam = self.lambdak[k] if self.ARD else self.lambdaV[j,k]
-            self.V[j,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
+        if init_UV in OPTIONS_NNDSVD:
+            self.U, self.V = nndsvd_factors(self.R,self.M,self.K,init_UV)
+        else:
+            for i,k in itertools.product(range(self.I),range(self.K)):    
+                hyperparam = self.lambdak[k] if self.ARD else self.lambdaU[i,k]
+                self.U[i,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
+            for j,k in itertools.product(range(self.J),range(self.K)):
+                hyperparam = self.lambdak[k] if self.ARD else self.lambdaV[j,k]
+                self.V[j,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
         
         # Initialise tau
         self.tau = gamma_draw(self.alpha_s(),self.beta_s())
+        
+    def initialise_from_vb(self,vb):
+        ''' Draw U, V, tau, and lambda (if ARD) from the variational posterior of a trained bnmf_vb model. '''
+        assert (vb.I,vb.J,vb.K,vb.ARD) == (self.I,self.J,self.K,self.ARD), "The variational model should have the same " \
+            "I, J, K, and ARD as the sampler: %s instead of %s." % ((vb.I,vb.J,vb.K,vb.ARD),(self.I,self.J,self.K,self.ARD))
+        self.U = numpy.reshape(TN_vector_draw_kernel(vb.mu_U.ravel(),vb.tau_U.ravel()),(self.I,self.K))
+        self.V = numpy.reshape(TN_vector_draw_kernel(vb.mu_V.ravel(),vb.tau_V.ravel()),(self.J,self.K))
+        self.lambdak = numpy.array([gamma_draw(vb.alphak_s[k],vb.betak_s[k]) for k in range(self.K)]) if self.ARD else numpy.zeros(self.K)
+        self.tau = gamma_draw(vb.alpha_s,vb.beta_s)
 
 
-    def run(self,iterations):
-        ''' Run the Gibbs sampler. '''
-        self.all_U = numpy.zeros((iterations,self.I,self.K))  
-        self.all_V = numpy.zeros((iterations,self.J,self.K))   
-        self.all_tau = numpy.zeros(iterations) 
-        self.all_lambdak = numpy.zeros((iterations,self.K))
+    def run(self,iterations,profile=True,prune=False,grow=False,threads=1,until=None,rao_blackwell=False,time_budget=None):
+        ''' Run the Gibbs sampler, stopping early if until(iteration) returns True, or at the time_budget (in seconds).
+            If rao_blackwell, also store the expectations of the conditional distributions of the draws, which have a lower
+            Monte Carlo variance, in all_exp_U, all_exp_V, all_exp_tau, all_exp_lambdak. These are kept for
+            every iteration so that burn_in and thinning can be chosen afterwards, which doubles the memory of the traces. '''
+        budget = TimeBudget(time_budget,iterations)
+        assert not prune or self.ARD, "Pruning components is only possible when using ARD."
+        assert not grow or self.ARD, "Growing components is only possible when using ARD."
+        assert not (prune and grow), "Components can either be pruned or grown, not both."
+        self.pruner = create_grower(self.K,grow,min(self.I,self.J)) if grow else create_pruner(self.K,prune)
+        
+        self.all_U = numpy.zeros((trace_length(iterations),self.I,self.pruner.size))  
+        self.all_V = numpy.zeros((trace_length(iterations),self.J,self.pruner.size))   
+        self.all_tau = numpy.zeros(trace_length(iterations)) 
+        self.all_lambdak = numpy.zeros((trace_length(iterations),self.pruner.size))
+        self.rao_blackwell = rao_blackwell
+        self.exp_U, self.exp_V, self.exp_lambdak = (numpy.zeros((self.I,self.K)), numpy.zeros((self.J,self.K)), numpy.zeros(self.K)) \
+                                                   if rao_blackwell else (None, None, None)
+        for name in RAO_BLACKWELL_TRACES:
+            setattr(self,name,numpy.zeros(getattr(self,name.replace('exp_','')).shape) if rao_blackwell else None)
+        self.prediction_cache = {} # predictions for the old factors are no longer valid
+        self.predictive_moments, self.noise_moments = RunningMoments(), RunningMoments()
         self.all_times = [] # to plot performance against time
+        self.monitor = ConvergenceMonitor() # for the convergence diagnostics
+        self.all_K = [] # to plot the rank against time
         
         self.all_performances = {} # for plotting convergence of metrics
         for metric in ALL_METRICS:
             self.all_performances[metric] = []
         
+        self.row_blocks = create_row_blocks((self.I,self.J),threads)
+        self.profiler = Profiler() if profile else NullProfiler()
         time_start = time.time()
-        for it in range(iterations): 
-            # Update lambdak
-            if self.ARD:
-                for k in range(self.K):
-                    self.lambdak[k] = gamma_draw(self.alphak_s(k),self.betak_s(k))
+        try:
+            for it in budget.range():
+                # Update lambdak
+                if self.ARD:
+                    for k in range(self.K):
+                        alphak_s, betak_s = self.alphak_s(k), self.betak_s(k)
+                        self.lambdak[k] = gamma_draw(alphak_s,betak_s)
+                        if rao_blackwell:
+                            self.exp_lambdak[k] = alphak_s / betak_s
+                self.profiler.tick('lambda')
             
-            # Update U
-            for k in range(0,self.K):   
-                tauUk = self.tauU(k)
-                muUk = self.muU(tauUk,k)
-                self.U[:,k] = TN_vector_draw(muUk,tauUk)
+                # Update U
+                for k in range(0,self.K):   
+                    self.row_blocks.map(0,lambda rows,rng: self.draw_U(k,rows,rng))
+                self.profiler.tick('U')
                 
-            # Update V
-            for k in range(0,self.K):
-                tauVk = self.tauV(k)
-                muVk = self.muV(tauVk,k)
-                self.V[:,k] = TN_vector_draw(muVk,tauVk)
+                # Update V
+                for k in range(0,self.K):
+                    self.row_blocks.map(1,lambda columns,rng: self.draw_V(k,columns,rng))
+                self.profiler.tick('V')
                 
-            # Update tau
-            self.tau = gamma_draw(self.alpha_s(),self.beta_s())
+                # Update tau
+                alpha_s, beta_s = self.alpha_s(), self.beta_s()
+                self.tau = gamma_draw(alpha_s,beta_s)
+                self.profiler.tick('tau')
+            
+                # Remove components that ARD has switched off
+                if prune:
+                    self.prune_components(it)
+                    self.profiler.tick('pruning')
+
+                # Add a new component while all of them are in use
+                if grow:
+                    self.grow_components(it)
+                    self.profiler.tick('growth')
             
-            # Store draws
-            self.all_U[it], self.all_V[it], self.all_tau[it] = numpy.copy(self.U), numpy.copy(self.V), self.tau
-            if self.ARD:
-                self.all_lambdak[it] = numpy.copy(self.lambdak)
+                # Store draws
+                extend_traces(self,TRACES + RAO_BLACKWELL_TRACES,it)
+                self.all_U[it], self.all_V[it], self.all_tau[it] = self.pruner.expand(self.U,1), self.pruner.expand(self.V,1), self.tau
+                if self.ARD:
+                    self.all_lambdak[it] = self.pruner.expand(self.lambdak,0)
+                if rao_blackwell:
+                    self.all_exp_U[it], self.all_exp_V[it], self.all_exp_tau[it] = self.pruner.expand(self.exp_U,1), self.pruner.expand(self.exp_V,1), alpha_s / beta_s
+                    if self.ARD:
+                        self.all_exp_lambdak[it] = self.pruner.expand(self.exp_lambdak,0)
+                self.all_K.append(self.K)
+                self.profiler.tick('traces')
             
-            # Store and print performances
-            perf = self.predict_while_running()
-            for metric in ALL_METRICS:
-                self.all_performances[metric].append(perf[metric])
+                # Accumulate the posterior predictive of the tracked entries
+                if self.predictive_query is not None:
+                    self.accumulate_predictive(it)
+                self.profiler.tick('predictive')
+            
+                # Store and print performances
+                perf = self.predict_while_running()
+                self.monitor.record({ 'tau':self.tau, 'MSE':perf['MSE'], 'U':numpy.linalg.norm(self.U), 'V':numpy.linalg.norm(self.V) })
+                self.profiler.tick('performance')
+                for metric in ALL_METRICS:
+                    self.all_performances[metric].append(perf[metric])
                 
-            print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+                print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+                self.profiler.tick('output')
+            
+                # Store time taken for iteration
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)            
             
-            # Store time taken for iteration
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)            
+                # Stop early once the stopping rule is met
+                if until is not None and until(it):
+                    self.truncate_traces(it+1)
+                    break
+            
+                # Stop once another iteration would exceed the time budget
+                if budget.exhausted():
+                    break
+        finally:
+            self.row_blocks.close()
+        self.truncate_traces(len(self.all_times))
+        self.budget = budget.summary(len(self.all_times))
+        budget.report(len(self.all_times))
+        self.pruned_components = list(self.pruner.pruned)
+        self.grown_components = list(self.pruner.added) if grow else []
+        if grow:
+            print "Final rank: K=%s. Total time: %s seconds, for %s component-iterations." % (self.K,self.all_times[-1],sum(self.all_K))
+        self.profile, self.profile_phases = self.profiler.report(), self.profiler.phases
+        self.convergence = self.monitor.summary()
+        
+    def run_until(self,ess_target,max_iterations,check_every=CHECK_EVERY,profile=True,prune=False,grow=False,threads=1):
+        ''' Run the Gibbs sampler until all monitored quantities have at least ess_target effective samples after
+            the estimated burn-in (checked every check_every iterations), or for at most max_iterations. '''
+        assert ess_target > 0, "Target effective sample size should be positive, not %s." % ess_target
+        assert check_every >= 1, "Convergence should be checked at least every iteration, not every %s." % check_every
+        until = lambda it: (it+1) % check_every == 0 and self.monitor.converged(ess_target)
+        self.run(max_iterations,profile=profile,prune=prune,grow=grow,threads=threads,until=until)
+        print "Stopped after %s iterations. Burn-in: %s. Thinning: %s. Effective sample sizes: %s." % (
+            self.convergence['iterations'],self.convergence['burn_in'],self.convergence['thinning'],self.convergence['ess'])
+        
+    def truncate_traces(self,iterations):
+        ''' Keep only the draws of the first iterations iterations, when stopping early. '''
+        for name in TRACES + (RAO_BLACKWELL_TRACES if self.rao_blackwell else []):
+            setattr(self,name,getattr(self,name)[:iterations])
+        
+        
+    def component_arrays(self):
+        ''' Return the arrays with one entry per component, including the conditional expectations if rao_blackwell. '''
+        return COMPONENT_ARRAYS + (RAO_BLACKWELL_ARRAYS if self.rao_blackwell else [])
+        
+    def prune_components(self,iteration):
+        ''' Remove the components whose magnitude has stayed below the threshold (see pruning.py). '''
+        positions = self.pruner.check(component_magnitudes(self.U,self.V),iteration)
+        if positions:
+            remove_components(self,self.component_arrays(),positions)
+            self.K = len(self.pruner.active)
+            self.prediction_cache = {}
+            
+    def grow_components(self,iteration):
+        ''' Add a component seeded from the residual while all of them are in use, or remove the new one if it has been switched off (see growth.py). '''
+        error = self.all_performances['MSE'][-1] if self.all_performances['MSE'] else None
+        (remove,add) = self.pruner.check(component_magnitudes(self.U,self.V),iteration,error)
+        if remove is not None:
+            remove_components(self,self.component_arrays(),[remove])
+        if add:
+            u, v = residual_component(self.R,self.M,numpy.dot(self.U,self.V.T))
+            append_components(self,self.component_arrays(),{ 'U':u, 'V':v, 'lambdak':self.alpha0/self.beta0 })
+        if remove is not None or add:
+            self.K = len(self.pruner.active)
+            self.prediction_cache = {}
         
         
     ''' Compute the parameters for the distributions we sample from. '''
@@ -200,74 +352,200 @@ class bnmf_gibbs:
         ''' betak* for lambdak. '''
         return self.beta0 + self.U[:,k].sum() + self.V[:,k].sum()
         
-    def tauU(self,k):
-        ''' tauUk for Uk. '''
-        return self.tau * ( self.M * self.V[:,k]**2 ).sum(axis=1)
+    def tauU(self,k,rows=slice(None)):
+        ''' tauUk for Uk, for the given rows. '''
+        return self.tau * ( self.M[rows] * self.V[:,k]**2 ).sum(axis=1)
+        
+    def muU(self,tauUk,k,rows=slice(None)):
+        ''' muUk for Uk, for the given rows. '''
+        lamb = self.lambdak[k] if self.ARD else self.lambdaU[rows,k]
+        return 1./tauUk * (-lamb + self.tau*masked_residual_products(self.R[rows],self.M[rows],self.U[rows],self.V,k)) 
         
-    def muU(self,tauUk,k):
-        ''' muUk for Uk. '''
-        lamb = self.lambdak[k] if self.ARD else self.lambdaU[:,k]
-        return 1./tauUk * (-lamb + self.tau*(self.M * ( (self.R-numpy.dot(self.U,self.V.T)+numpy.outer(self.U[:,k],self.V[:,k]))*self.V[:,k] )).sum(axis=1)) 
+    def tauV(self,k,columns=slice(None)):
+        ''' tauVk for Vk, for the given columns. '''
+        return self.tau*(self.M[:,columns].T*self.U[:,k]**2).T.sum(axis=0)
         
-    def tauV(self,k):
-        ''' tauVk for Vk. '''
-        return self.tau*(self.M.T*self.U[:,k]**2).T.sum(axis=0)
+    def muV(self,tauVk,k,columns=slice(None)):
+        ''' muVk for Vk, for the given columns. '''
+        lamb = self.lambdak[k] if self.ARD else self.lambdaV[columns,k]
+        return 1./tauVk * (-lamb + self.tau*masked_residual_products(self.R[:,columns].T,self.M[:,columns].T,self.V[columns],self.U,k)) 
         
-    def muV(self,tauVk,k):
-        ''' muVk for Vk. '''
-        lamb = self.lambdak[k] if self.ARD else self.lambdaV[:,k]
-        return 1./tauVk * (-lamb + self.tau*(self.M.T * ( (self.R-numpy.dot(self.U,self.V.T)+numpy.outer(self.U[:,k],self.V[:,k])).T*self.U[:,k] )).T.sum(axis=0)) 
+    def draw_U(self,k,rows=slice(None),rng=None):
+        ''' Draw Uk for the given rows, using the global random state, or rng if given (see parallel.py). '''
+        tauUk = self.tauU(k,rows)
+        muUk = self.muU(tauUk,k,rows)
+        self.U[rows,k] = TN_vector_draw_kernel(muUk,tauUk) if rng is None else TN_vector_draw_rng(muUk,tauUk,rng)
+        if self.rao_blackwell:
+            self.exp_U[rows,k] = TN_vector_expectation(muUk,tauUk)
+        
+    def draw_V(self,k,columns=slice(None),rng=None):
+        ''' Draw Vk for the given columns, using the global random state, or rng if given (see parallel.py). '''
+        tauVk = self.tauV(k,columns)
+        muVk = self.muV(tauVk,k,columns)
+        self.V[columns,k] = TN_vector_draw_kernel(muVk,tauVk) if rng is None else TN_vector_draw_rng(muVk,tauVk,rng)
+        if self.rao_blackwell:
+            self.exp_V[columns,k] = TN_vector_expectation(muVk,tauVk)
+
 
+    ''' Fold in new rows or columns, keeping the trained factors fixed. '''
+    def fold_in_rows(self,R_new,M_new,iterations,burn_in=0,thinning=1):
+        ''' Sample U for new rows (I_new x J), keeping V, tau and lambdak fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=0)
+        lamb = self.lambdak if self.ARD else self.lambdaU.mean(axis=0)
+        return self.fold_in(R,M,self.V,lamb,iterations,burn_in,thinning)
 
-    def approx_expectation(self,burn_in,thinning):
-        ''' Return our expectation of U, V, tau, lambdak. '''
-        indices = range(burn_in,len(self.all_U),thinning)
-        exp_U = numpy.array([self.all_U[i] for i in indices]).sum(axis=0) / float(len(indices))      
-        exp_V = numpy.array([self.all_V[i] for i in indices]).sum(axis=0) / float(len(indices))  
-        exp_tau = sum([self.all_tau[i] for i in indices]) / float(len(indices))
+    def fold_in_columns(self,R_new,M_new,iterations,burn_in=0,thinning=1):
+        ''' Sample V for new columns (I x J_new), keeping U, tau and lambdak fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=1)
+        lamb = self.lambdak if self.ARD else self.lambdaV.mean(axis=0)
+        return self.fold_in(R,M,self.U,lamb,iterations,burn_in,thinning)
+
+    def fold_in(self,R,M,B,lamb,iterations,burn_in,thinning):
+        ''' Run the sampler for A in R ~ A B.T, and return the average of the draws. '''
+        assert iterations > burn_in, "Number of iterations should be greater than the burn-in, not %s <= %s." % (iterations,burn_in)
+        lamb = numpy.tile(lamb,(R.shape[0],1))
+        A = numpy.random.exponential(scale=1./lamb)
+        draws = []
+        for it in range(iterations):
+            self.draw_rows(R,M,A,B,lamb)
+            if it >= burn_in and (it - burn_in) % thinning == 0:
+                draws.append(numpy.copy(A))
+        return numpy.array(draws).sum(axis=0) / float(len(draws))
+
+    def draw_rows(self,R,M,A,B,lamb):
+        ''' Draw each column of A in R ~ A B.T, for all rows at once. lamb is the prior for A. '''
+        for k in range(A.shape[1]):
+            tauAk = self.tau * ( M * B[:,k]**2 ).sum(axis=1)
+            muAk = 1./tauAk * (-lamb[:,k] + self.tau*masked_residual_products(R,M,A,B,k))
+            A[:,k] = TN_vector_draw_kernel(muAk,tauAk)
+
+
+    ''' Add new observations to R, and continue from the current state. '''
+    def update_data(self,new_entries):
+        ''' Add a list of new observations (i,j,Rij) to R and M, and store which rows and columns they touch. '''
+        for (i,j,value) in new_entries:
+            assert 0 <= i < self.I and 0 <= j < self.J, "New entry (%s,%s) lies outside of R, which has shape %s." % (i,j,self.R.shape)
+        self.data = self.data.with_entries(new_entries)
+        (self.R, self.M) = (self.data.R, self.data.M)
+        self.size_Omega = self.data.size_Omega
+        self.touched_rows = sorted(set(self.touched_rows) | set([i for (i,_,_) in new_entries]))
+        self.touched_columns = sorted(set(self.touched_columns) | set([j for (_,j,_) in new_entries]))
+        self.evaluator.clear() # R and M have changed
+
+    def refine(self,iterations,local_sweeps=0):
+        ''' Continue the sampler from the current state, after first doing local_sweeps over only the touched rows and columns. '''
+        for sweep in range(local_sweeps):
+            self.sweep_touched()
+        self.touched_rows, self.touched_columns = [], []
+        self.run(iterations)
+
+    def sweep_touched(self):
+        ''' Draw U for the touched rows and V for the touched columns, and then tau. '''
+        rows, columns = self.touched_rows, self.touched_columns
+        if rows:
+            U_rows = self.U[rows]
+            lamb = numpy.tile(self.lambdak,(len(rows),1)) if self.ARD else self.lambdaU[rows]
+            self.draw_rows(self.R[rows],self.M[rows],U_rows,self.V,lamb)
+            self.U[rows] = U_rows
+        if columns:
+            V_columns = self.V[columns]
+            lamb = numpy.tile(self.lambdak,(len(columns),1)) if self.ARD else self.lambdaV[columns]
+            self.draw_rows(self.R[:,columns].T,self.M[:,columns].T,V_columns,self.U,lamb)
+            self.V[columns] = V_columns
+        self.tau = gamma_draw(self.alpha_s(),self.beta_s())
+
+
+    def approx_expectation(self,burn_in,thinning,rao_blackwell=None):
+        ''' Return our expectation of U, V, tau, lambdak, averaging the conditional expectations if the sampler stored
+            them (or if rao_blackwell is True), and the draws otherwise (or if rao_blackwell is False). '''
+        rao_blackwell = self.rao_blackwell if rao_blackwell is None else rao_blackwell
+        assert not rao_blackwell or self.rao_blackwell, "No conditional expectations stored - please use run(...,rao_blackwell=True)."
+        (all_U,all_V,all_tau,all_lambdak) = [getattr(self,name,None) for name in (RAO_BLACKWELL_TRACES if rao_blackwell else TRACES)]
+        indices = range(burn_in,len(all_U),thinning)
+        exp_U = numpy.array([all_U[i] for i in indices]).sum(axis=0) / float(len(indices))      
+        exp_V = numpy.array([all_V[i] for i in indices]).sum(axis=0) / float(len(indices))  
+        exp_tau = sum([all_tau[i] for i in indices]) / float(len(indices))
         exp_lambdak = None if not self.ARD else sum(
-            [self.all_lambdak[i] for i in indices]) / float(len(indices))
+            [all_lambdak[i] for i in indices]) / float(len(indices))
         return (exp_U, exp_V, exp_tau, exp_lambdak)
 
 
-    def predict(self,M_pred,burn_in,thinning):
+    def predict(self,M_pred,burn_in,thinning,metrics=ALL_METRICS):
         ''' Compute the expectation of U and V, and use it to predict missing values. '''
-        (exp_U,exp_V,_,_) = self.approx_expectation(burn_in,thinning)
-        R_pred = numpy.dot(exp_U, exp_V.T)
-        MSE = self.compute_MSE(M_pred, self.R, R_pred)
-        R2 = self.compute_R2(M_pred, self.R, R_pred)    
-        Rp = self.compute_Rp(M_pred, self.R, R_pred)        
-        return { 'MSE': MSE, 'R^2': R2, 'Rp': Rp }
+        return self.evaluator.evaluate(M_pred,self.R,lambda rows,cols: self.predict_entries(rows,cols,burn_in,thinning),metrics)
         
     def predict_while_running(self):
         ''' Predict the training error while running. '''
-        R_pred = numpy.dot(self.U, self.V.T)
-        MSE = self.compute_MSE(self.M, self.R, R_pred)
-        R2 = self.compute_R2(self.M, self.R, R_pred)    
-        Rp = self.compute_Rp(self.M, self.R, R_pred)        
-        return {'MSE': MSE, 'R^2': R2, 'Rp': Rp}
+        return self.evaluator.evaluate(self.M,self.R,lambda rows,cols: (self.U[rows] * self.V[cols]).sum(axis=1))
         
         
+    ''' Predict individual entries or rows, without computing the full matrix. '''
+    def predict_entries(self,rows,cols,burn_in,thinning,variance=False):
+        ''' Return the predictions for the entries (rows[n],cols[n]), using the expectations of U and V.
+            If variance is True, also return the variance of the predictions of the individual draws. '''
+        rows, cols = numpy.array(rows,dtype=int), numpy.array(cols,dtype=int)
+        (exp_U,exp_V) = self.cached_expectation(burn_in,thinning)
+        R_pred = (exp_U[rows] * exp_V[cols]).sum(axis=1)
+        if not variance:
+            return R_pred
+        return R_pred, self.variance_draws(lambda U,V: (U[rows] * V[cols]).sum(axis=1),burn_in,thinning)
+
+    def predict_rows(self,rows,burn_in,thinning,variance=False):
+        ''' Return the predictions for all columns of the given rows, using the expectations of U and V.
+            If variance is True, also return the variance of the predictions of the individual draws. '''
+        rows = numpy.array(rows,dtype=int)
+        (exp_U,exp_V) = self.cached_expectation(burn_in,thinning)
+        R_pred = numpy.dot(exp_U[rows],exp_V.T)
+        if not variance:
+            return R_pred
+        return R_pred, self.variance_draws(lambda U,V: numpy.dot(U[rows],V.T),burn_in,thinning)
+
+    def cached_expectation(self,burn_in,thinning):
+        ''' Return (exp_U, exp_V) for the given burn-in and thinning, cached until the sampler is run again. '''
+        if (burn_in,thinning) not in self.prediction_cache:
+            (exp_U,exp_V,_,_) = self.approx_expectation(burn_in,thinning)
+            self.prediction_cache[(burn_in,thinning)] = (exp_U,exp_V)
+        return self.prediction_cache[(burn_in,thinning)]
+
+    def variance_draws(self,predict_draw,burn_in,thinning):
+        ''' Return the variance of predict_draw(U,V) over the draws, computed one draw at a time. '''
+        moments = RunningMoments()
+        for it in range(burn_in,len(self.all_U),thinning):
+            moments.add(predict_draw(self.all_U[it],self.all_V[it]))
+        return moments.variance()
+
+    def track_predictive(self,rows,cols,burn_in=0,thinning=1):
+        ''' Accumulate the posterior predictive of the entries (rows[n],cols[n]) during the next run(), using 
+            the draws after burn_in with the given thinning. For a mask M_pred, use rows, cols = numpy.nonzero(M_pred). '''
+        self.predictive_query = (numpy.array(rows,dtype=int),numpy.array(cols,dtype=int),burn_in,thinning)
+
+    def accumulate_predictive(self,it):
+        ''' Add the predictions for the tracked entries and the noise variance of draw it to the running moments. '''
+        (rows,cols,burn_in,thinning) = self.predictive_query
+        if it >= burn_in and (it - burn_in) % thinning == 0:
+            self.predictive_moments.add((self.U[rows] * self.V[cols]).sum(axis=1))
+            self.noise_moments.add(1. / self.tau)
+
+    def predictive(self,credible=None):
+        ''' Return the posterior predictive 'mean' and 'variance' (including the noise 1/tau) of the tracked entries,
+            and the 'lower' and 'upper' bounds of the credible interval if credible (e.g. 0.95) is given. '''
+        assert self.predictive_moments.n > 0, "No draws for the tracked entries - please call track_predictive() before run()."
+        variance = self.predictive_moments.variance() + self.noise_moments.mean
+        return predictive_summary(self.predictive_moments.mean,variance,credible)
+
+
     ''' Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation) '''
     def compute_MSE(self,M,R,R_pred):
         ''' Return the MSE of predictions in R_pred, expected values in R, for the entries in M. '''
-        return (M * (R-R_pred)**2).sum() / float(M.sum())
+        return compute_MSE(M,R,R_pred)
         
     def compute_R2(self,M,R,R_pred):
         ''' Return the R^2 of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean = (M*R).sum() / float(M.sum())
-        SS_total = float((M*(R-mean)**2).sum())
-        SS_res = float((M*(R-R_pred)**2).sum())
-        return 1. - SS_res / SS_total if SS_total != 0. else numpy.inf
+        return compute_R2(M,R,R_pred)
         
     def compute_Rp(self,M,R,R_pred):
         ''' Return the Rp of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean_real = (M*R).sum() / float(M.sum())
-        mean_pred = (M*R_pred).sum() / float(M.sum())
-        covariance = (M*(R-mean_real)*(R_pred-mean_pred)).sum()
-        variance_real = (M*(R-mean_real)**2).sum()
-        variance_pred = (M*(R_pred-mean_pred)**2).sum()
-        return covariance / float(math.sqrt(variance_real)*math.sqrt(variance_pred))
+        return compute_Rp(M,R,R_pred)
         
     
     def quality(self,metric,burn_in,thinning):
@@ -299,4 +577,20 @@ class bnmf_gibbs:
              
     def number_parameters(self):
         ''' Return the number of free variables in the model. '''
-        return (self.I*self.K + self.J*self.K + 1) + (self.K if self.ARD else 0)
\ No newline at end of file
+        return (self.I*self.K + self.J*self.K + 1) + (self.K if self.ARD else 0)
+        
+        
+    ''' Save and load the model. '''
+    def save(self,path,burn_in=None,thinning=None,traces=True):
+        ''' Store the model in the directory path. If burn_in and thinning are given, also store the expectations. '''
+        summaries = {} if burn_in is None else dict(zip(['exp_U','exp_V','exp_tau','exp_lambdak'],self.approx_expectation(burn_in,thinning)))
+        save_model(self,path,SAVE_DIMENSIONS,SAVE_HYPERPARAMETERS,SAVE_STATE,SAVE_TRACES if traces else [],summaries)
+
+    @classmethod
+    def load(cls,path,mmap_traces=True):
+        ''' Load a model stored using save(path). The traces are memory-mapped, unless mmap_traces is False. '''
+        metadata, values = load_model(path,cls.__name__,mmap_traces)
+        dimensions = metadata['dimensions']
+        model = cls(values['data']['R'],values['data']['M'],dimensions['K'],dimensions['ARD'],values['hyperparameters'])
+        restore_model(model,values)
+        return model
\ No newline at end of file
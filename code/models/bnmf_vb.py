@@ -2,8 +2,9 @@
 Variational Bayesian inference for non-negative matrix factorisation, with ARD.
 
 We expect the following arguments:
-- R, the matrix.
-- M, the mask matrix indicating observed values (1) and unobserved ones (0).
+- R, the matrix, or a Dataset shared with other models (see dataset.py).
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or None to use the mask of the Dataset R.
 - K, the number of latent factors.
 - ARD, a boolean indicating whether we use ARD in this model or not.
 - hyperparameters = { 'alphatau', 'betatau', 'alpha0', 'beta0', 'lambdaU', 'lambdaV' },
@@ -13,7 +14,7 @@ We expect the following arguments:
     
 The random variables are initialised as follows:
     (lambdak) alphak_s, betak_s - set to alpha0, beta0
-    (U,V) muU, muV - expectation ('exp') or random ('random')
+    (U,V) muU, muV - expectation ('exp'), random ('random'), or NNDSVD ('nndsvd' or 'nndsvd-iterative', see nndsvd.py)
     (U,V) tauU, tauV - set to 1
     (tau) alpha_s, beta_s - using updates
 We initialise the values of U and V according to the given argument 'init_UV'. 
@@ -30,9 +31,26 @@ We can test the performance of our model on a test dataset, specifying our test
     performance = BNMF.predict(M_pred)
 This gives a dictionary of performances,
     performance = { 'MSE', 'R^2', 'Rp' }
+and also 'MAE' with predict(M_pred,metrics=['MSE','R^2','Rp','MAE']) (see metrics.py).
     
 The performances of all iterations are stored in BNMF.all_performances, which 
 is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+
+Further features (see the module or method named for the details):
+    BNMF.run(iterations,elbo_every=n)         -> only compute the ELBO every n iterations
+    BNMF.update_data(new_entries)             -> add observations, then continue with refine(iterations,local_sweeps)
+    BNMF.save(path)                           -> store the model in a directory, for bnmf_vb.load(path) (persistence.py)
+    BNMF.predict_entries(rows,cols,variance)  -> predict some entries, or predict_rows(rows,variance)
+    BNMF.predictive(rows,cols,credible)       -> posterior predictive of some entries (predictive.py)
+    BNMF.run(iterations,profile=False)        -> do not time the phases of run() in BNMF.profile (profiler.py)
+    BNMF.run(iterations,time_budget=seconds)  -> stop before exceeding a wall-clock budget (budget.py)
+    BNMF.run(iterations,prune=True)           -> remove the components ARD switches off (pruning.py)
+    BNMF.run(iterations,grow=True)            -> start from a small K and add components (growth.py)
+    BNMF.run(iterations,threads=T)            -> update blocks of rows in parallel threads (parallel.py)
+    BNMF.run(iterations,accelerate='squarem') -> or 'anderson', extrapolate the updates (acceleration.py)
+    BNMF.run(iterations,active_set=True)      -> skip the columns that hardly change (active_set.py)
+    BNMF.run(iterations,empirical_bayes=True) -> learn the prior rates from the ELBO (empirical_bayes.py)
+    bnmf_vb_batch(R,M,K,ARD,all_hyperparameters) -> fit a grid of settings together (bnmf_vb_batch.py)
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -45,66 +63,69 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 from distributions.gamma import gamma_expectation, gamma_expectation_log
 from distributions.truncated_normal_vector import TN_vector_expectation, TN_vector_variance
 from distributions.exponential import exponential_draw
+from nndsvd import nndsvd_factors, nndsvd_precision, OPTIONS_NNDSVD
+from persistence import save_model, load_model, restore_model
+from dataset import shared_dataset, prior_matrix
+from fold_in import new_rows
+from metrics import ALL_METRICS, Evaluator, compute_MSE, compute_R2, compute_Rp
+from profiler import Profiler, NullProfiler
+from budget import TimeBudget
+from pruning import create_pruner, component_magnitudes, remove_components
+from parallel import create_row_blocks
+from kernels import masked_residual_products
+from growth import create_grower, residual_component, nonnegative_coefficients, append_components
+from predictive import noise_variance, predictive_summary
+from acceleration import create_accelerator, POSITIVE
+from active_set import create_scheduler
+from empirical_bayes import learned_hyperparameters, exponential_rate, gamma_rate
 
 import numpy, itertools, math, scipy, time
 
-ALL_METRICS = ['MSE','R^2','Rp']
 ALL_QUALITY = ['loglikelihood','BIC','AIC','MSE','ELBO']
-OPTIONS_INIT_UV = ['random', 'exp']
+OPTIONS_INIT_UV = ['random', 'exp'] + OPTIONS_NNDSVD
+SAVE_DIMENSIONS = ['K','ARD']
+SAVE_HYPERPARAMETERS = ['alphatau','betatau','alpha0','beta0','lambdaU','lambdaV']
+SAVE_STATE = ['alphak_s','betak_s','exp_lambdak','exp_loglambdak','mu_U','tau_U','mu_V','tau_V','exp_U','var_U','exp_V','var_V','alpha_s','beta_s','exp_tau','exp_logtau','touched_rows','touched_columns']
+SAVE_TRACES = ['all_exp_tau','all_times','all_performances','pruned_components','grown_components','all_K','all_elbo','all_sweeps','all_hyperparameters']
+ACCELERATED_PARAMETERS = [('mu_U',None),('tau_U',POSITIVE),('mu_V',None),('tau_V',POSITIVE),('beta_s',POSITIVE)]
+ACCELERATED_PARAMETERS_ARD = ACCELERATED_PARAMETERS + [('betak_s',POSITIVE)]
+ACTIVE_SET_AXES = { 'U':('K',), 'V':('K',) }
+COMPONENT_ARRAYS = [('alphak_s',0),('betak_s',0),('exp_lambdak',0),('exp_loglambdak',0),('mu_U',1),('tau_U',1),('exp_U',1),('var_U',1),('mu_V',1),('tau_V',1),('exp_V',1),('var_V',1)]
 
 class bnmf_vb:
     def __init__(self,R,M,K,ARD,hyperparameters):
         ''' Set up the class and do some checks on the values passed. '''
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+        self.data = shared_dataset(R,M)
+        (self.R, self.M) = (self.data.R, self.data.M)
         self.K = K
         self.ARD = ARD
         
-        assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
-            "but instead %s-dimensional." % len(self.R.shape)
-        assert self.R.shape == self.M.shape, "Input matrix R is not of the same size as " \
-            "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
-            
-        (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
-        self.check_empty_rows_columns()      
+        (self.I,self.J) = self.data.shape
+        self.size_Omega = self.data.size_Omega
+        self.touched_rows, self.touched_columns = [], []
+        self.evaluator = Evaluator()
         
         self.alphatau, self.betatau = float(hyperparameters['alphatau']), float(hyperparameters['betatau'])
         if self.ARD:
             self.alpha0, self.beta0 = float(hyperparameters['alpha0']), float(hyperparameters['beta0'])
         else:
-            self.lambdaU, self.lambdaV = numpy.array(hyperparameters['lambdaU']), numpy.array(hyperparameters['lambdaV'])
-            # Make lambdaU/V into a numpy array if they are an integer
-            if self.lambdaU.shape == ():
-                self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K))
-            if self.lambdaV.shape == ():
-                self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K))
-        
-            assert self.lambdaU.shape == (self.I,self.K), "Prior matrix lambdaU has the wrong shape: %s instead of (%s, %s)." % (self.lambdaU.shape,self.I,self.K)
-            assert self.lambdaV.shape == (self.J,self.K), "Prior matrix lambdaV has the wrong shape: %s instead of (%s, %s)." % (self.lambdaV.shape,self.J,self.K)
+            self.lambdaU = prior_matrix(hyperparameters['lambdaU'],(self.I,self.K),'lambdaU')
+            self.lambdaV = prior_matrix(hyperparameters['lambdaV'],(self.J,self.K),'lambdaV')
+            
+        self.compute_elbo_constants()
+        self.reset_elbo_cache()
                 
             
-    def check_empty_rows_columns(self):
-        ''' Raise an exception if an entire row or column is empty. '''
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
-                    
-        # Assert none of the rows or columns are entirely unknown values
-        for i,c in enumerate(sums_rows):
-            assert c != 0, "Fully unobserved row in R, row %s." % i
-        for j,c in enumerate(sums_columns):
-            assert c != 0, "Fully unobserved column in R, column %s." % j
-
-
-    def train(self,init_UV,iterations):
+    def train(self,init_UV,iterations,elbo_every=1,prune=False,grow=False,threads=1,accelerate=None,empirical_bayes=False,time_budget=None,active_set=False):
         ''' Initialise and run the algorithm. '''
         self.initialise(init_UV=init_UV)
-        self.run(iterations)
+        self.run(iterations,elbo_every,prune=prune,grow=grow,threads=threads,accelerate=accelerate,empirical_bayes=empirical_bayes,time_budget=time_budget,active_set=active_set)
 
 
     def initialise(self,init_UV='exp'):
         ''' Initialise U, V, tau, and lambda (if ARD). '''
         assert init_UV in OPTIONS_INIT_UV, "Unknown initialisation option: %s. Should be in %s." % (init_UV, OPTIONS_INIT_UV)
+        self.reset_elbo_cache()
         
         # Initialise lambdak, and compute expectation
         if self.ARD:
@@ -119,14 +140,18 @@ class bnmf_vb:
         self.mu_U, self.tau_U = numpy.zeros((self.I,self.K)), numpy.zeros((self.I,self.K))
         self.mu_V, self.tau_V = numpy.zeros((self.J,self.K)), numpy.zeros((self.J,self.K))
         
-        for i,k in itertools.product(range(self.I),range(self.K)):  
-            self.tau_U[i,k] = 1.
-            hyperparam = self.exp_lambdak[k] if self.ARD else self.lambdaU[i,k]
-            self.mu_U[i,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
-        for j,k in itertools.product(range(self.J),range(self.K)):
-            self.tau_V[j,k] = 1.
-            hyperparam = self.exp_lambdak[k] if self.ARD else self.lambdaV[j,k]
-            self.mu_V[j,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
+        if init_UV in OPTIONS_NNDSVD:
+            self.mu_U, self.mu_V = nndsvd_factors(self.R,self.M,self.K,init_UV)
+            self.tau_U[:,:], self.tau_V[:,:] = nndsvd_precision(self.mu_U), nndsvd_precision(self.mu_V)
+        else:
+            for i,k in itertools.product(range(self.I),range(self.K)):  
+                self.tau_U[i,k] = 1.
+                hyperparam = self.exp_lambdak[k] if self.ARD else self.lambdaU[i,k]
+                self.mu_U[i,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
+            for j,k in itertools.product(range(self.J),range(self.K)):
+                self.tau_V[j,k] = 1.
+                hyperparam = self.exp_lambdak[k] if self.ARD else self.lambdaV[j,k]
+                self.mu_V[j,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
         
         # Compute expectations and variances U, V
         self.exp_U, self.var_U = numpy.zeros((self.I,self.K)), numpy.zeros((self.I,self.K))
@@ -142,88 +167,218 @@ class bnmf_vb:
         self.update_exp_tau()
         
 
-    def run(self,iterations):
-        ''' Run the Gibbs sampler. '''
+    def run(self,iterations,elbo_every=1,profile=True,prune=False,grow=False,threads=1,accelerate=None,empirical_bayes=False,time_budget=None,active_set=False):
+        ''' Run the Gibbs sampler. Compute the ELBO every elbo_every iterations (and in the last one).
+            Stop at the time_budget (in seconds), if given. Skip converged columns of U and V if active_set. '''
+        budget = TimeBudget(time_budget,iterations)
         self.all_exp_tau = []  # to check for convergence 
+        self.all_elbo = [] # to check for convergence
         self.all_times = [] # to plot performance against time
+        self.all_K = [] # to plot the rank against time
+        self.all_sweeps = [] # to compare accelerated and plain iterations
         
         self.all_performances = {} # for plotting convergence of metrics
         for metric in ALL_METRICS:
             self.all_performances[metric] = []
         
+        assert not prune or self.ARD, "Pruning components is only possible when using ARD."
+        assert not grow or self.ARD, "Growing components is only possible when using ARD."
+        assert not (prune and grow), "Components can either be pruned or grown, not both."
+        assert not ((prune or grow) and accelerate), "Components can not be pruned or grown when accelerating the iterations."
+        assert not (active_set and (prune or grow or accelerate)), "Active-set scheduling can not be combined with pruning, growing, or acceleration."
+        learned = learned_hyperparameters(empirical_bayes)
+        assert 'lambda' not in learned or not self.ARD, "With ARD, the prior rates of U and V are learned by ARD, not by empirical Bayes."
+        self.all_hyperparameters = dict([(name,[]) for name in self.hyperparameter_names(learned)])
+        self.pruner = create_grower(self.K,grow,min(self.I,self.J)) if grow else create_pruner(self.K,prune)
+        parameters = ACCELERATED_PARAMETERS_ARD if self.ARD else ACCELERATED_PARAMETERS
+        self.accelerator = create_accelerator(accelerate,self,parameters,self.sweep,self.elbo,self.update_expectations)
+        self.scheduler = create_scheduler(ACTIVE_SET_AXES,{'K':self.K},active_set)
+        self.row_blocks = create_row_blocks((self.I,self.J),threads)
+        self.profiler = Profiler() if profile else NullProfiler()
         time_start = time.time()
-        for it in range(iterations):
-            # Update lambdak
-            if self.ARD:
-                for k in range(self.K):
-                    self.update_lambdak(k)
-                    self.update_exp_lambdak(k)
+        try:
+            for it in budget.range():
+                # Update lambdak, U, V, and tau
+                self.accelerator.step()
+                self.all_sweeps.append(self.accelerator.sweeps)
             
-            # Update U
-            for k in range(self.K):
-                self.update_U(k)
-                self.update_exp_U(k)    
+                # Update the hyperparameters, maximising the ELBO
+                if learned:
+                    self.update_hyperparameters(learned)
+                    self.profiler.tick('empirical Bayes')
+            
+                # Remove components that ARD has switched off
+                if prune:
+                    self.prune_components(it)
+                    self.profiler.tick('pruning')
+
+                # Add a new component while all of them are in use
+                if grow:
+                    self.grow_components(it)
+                    self.profiler.tick('growth')
+            
+                # Store expectations
+                self.all_exp_tau.append(self.exp_tau)
+                self.all_K.append(self.K)
+                self.profiler.tick('traces')
+            
+                # Store and print performances
+                perf = self.predict(self.M)
+                self.profiler.tick('performance')
+                elbo = self.elbo() if (it+1) % elbo_every == 0 or it+1 == iterations else None
+                self.all_elbo.append(elbo)
+                self.profiler.tick('ELBO')
+                for metric in ALL_METRICS:
+                    self.all_performances[metric].append(perf[metric])
                 
-            # Update V
+                print "Iteration %s. ELBO: %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,elbo,perf['MSE'],perf['R^2'],perf['Rp'])
+                self.profiler.tick('output')
+            
+                # Store time taken for iteration
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)            
+            
+                # Stop once another iteration would exceed the time budget
+                if budget.exhausted():
+                    break
+        finally:
+            self.row_blocks.close()
+        if self.all_elbo and self.all_elbo[-1] is None:
+            self.all_elbo[-1] = self.elbo() # stopped by the time budget
+        self.budget = budget.summary(len(self.all_times))
+        budget.report(len(self.all_times))
+        self.active_updates = self.scheduler.summary()
+        self.pruned_components = list(self.pruner.pruned)
+        self.grown_components = list(self.pruner.added) if grow else []
+        if grow:
+            print "Final rank: K=%s. Total time: %s seconds, for %s component-iterations." % (self.K,self.all_times[-1],sum(self.all_K))
+        if accelerate:
+            print "Accelerated with %s: %s sweeps in %s iterations, %s rejected extrapolations. Total time: %s seconds." % (
+                accelerate,self.accelerator.sweeps,len(self.all_times),self.accelerator.rejected,self.all_times[-1])
+        self.profile, self.profile_phases = self.profiler.report(), self.profiler.phases
+        
+    def sweep(self):
+        ''' Update the parameters and expectations of q(lambdak) (if ARD), q(U), q(V), and q(tau) once. '''
+        self.scheduler.start_sweep()
+        
+        # Update lambdak
+        if self.ARD:
             for k in range(self.K):
-                self.update_V(k)
-                self.update_exp_V(k)
-                
-            # Update tau
-            self.update_tau()
-            self.update_exp_tau()
+                self.update_lambdak(k)
+                self.update_exp_lambdak(k)
+        self.profiler.tick('lambda')
+        
+        # Update U
+        for k in range(self.K):
+            if not self.scheduler.active('U',k):
+                continue
+            old = numpy.copy(self.exp_U[:,k])
+            self.row_blocks.map(0,lambda rows,rng: self.update_U(k,rows))
+            self.profiler.tick('U')
+            self.row_blocks.map(0,lambda rows,rng: self.update_exp_U(k,rows))
+            self.scheduler.record('U',k,old,self.exp_U[:,k])
+            self.profiler.tick('TN moments')
             
-            # Store expectations
-            self.all_exp_tau.append(self.exp_tau)
+        # Update V
+        for k in range(self.K):
+            if not self.scheduler.active('V',k):
+                continue
+            old = numpy.copy(self.exp_V[:,k])
+            self.row_blocks.map(1,lambda columns,rng: self.update_V(k,columns))
+            self.profiler.tick('V')
+            self.row_blocks.map(1,lambda columns,rng: self.update_exp_V(k,columns))
+            self.scheduler.record('V',k,old,self.exp_V[:,k])
+            self.profiler.tick('TN moments')
             
-            # Store and print performances
-            perf, elbo = self.predict(self.M), self.elbo()
-            for metric in ALL_METRICS:
-                self.all_performances[metric].append(perf[metric])
-                
-            print "Iteration %s. ELBO: %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,elbo,perf['MSE'],perf['R^2'],perf['Rp'])
+        # Update tau
+        self.update_tau()
+        self.update_exp_tau()
+        self.profiler.tick('tau')
+        
+    def update_expectations(self):
+        ''' Recompute all expectations from the parameters of q, after they were set by the accelerator. '''
+        for k in range(self.K):
+            if self.ARD:
+                self.update_exp_lambdak(k)
+            self.update_exp_U(k)
+            self.update_exp_V(k)
+        self.update_exp_tau()
+        
+    def hyperparameter_names(self,learned):
+        ''' Return the names of the hyperparameters learned for learned ('lambda', 'tau'). '''
+        return (['lambdaU','lambdaV'] if 'lambda' in learned else []) + (['betatau'] if 'tau' in learned else [])
+        
+    def update_hyperparameters(self,learned):
+        ''' Set the hyperparameters in learned ('lambda', 'tau') to the values maximising the ELBO (see empirical_bayes.py), and store them. '''
+        if 'lambda' in learned:
+            self.lambdaU = prior_matrix(exponential_rate(self.exp_U),(self.I,self.K),'lambdaU')
+            self.lambdaV = prior_matrix(exponential_rate(self.exp_V),(self.J,self.K),'lambdaV')
+        if 'tau' in learned:
+            self.betatau = gamma_rate(self.alphatau,self.exp_tau)
+        self.compute_elbo_constants()
+        for name in self.all_hyperparameters:
+            self.all_hyperparameters[name].append(float(numpy.mean(getattr(self,name))))
+        
+    def prune_components(self,iteration):
+        ''' Remove the components whose magnitude has stayed below the threshold (see pruning.py). '''
+        positions = self.pruner.check(component_magnitudes(self.exp_U,self.exp_V),iteration)
+        if positions:
+            remove_components(self,COMPONENT_ARRAYS,positions)
+            self.K = len(self.pruner.active)
+            self.reset_elbo_cache()
             
-            # Store time taken for iteration
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)            
+    def grow_components(self,iteration):
+        ''' Add a component seeded from the residual while all of them are in use, or remove the new one if it has been switched off (see growth.py). '''
+        error = self.all_performances['MSE'][-1] if self.all_performances['MSE'] else None
+        (remove,add) = self.pruner.check(component_magnitudes(self.exp_U,self.exp_V),iteration,error)
+        if remove is not None:
+            remove_components(self,COMPONENT_ARRAYS,[remove])
+        if add:
+            u, v = residual_component(self.R,self.M,numpy.dot(self.exp_U,self.exp_V.T))
+            append_components(self,COMPONENT_ARRAYS,{ 'alphak_s':self.alpha0, 'betak_s':self.beta0, 'mu_U':u, 'tau_U':1., 'mu_V':v, 'tau_V':1. })
+        if remove is not None or add:
+            self.K = len(self.pruner.active)
+            self.reset_elbo_cache()
+        if add:
+            self.update_exp_lambdak(self.K-1)
+            self.update_exp_U(self.K-1)
+            self.update_exp_V(self.K-1)
         
         
     def elbo(self):
-        ''' Compute the ELBO. '''
+        ''' Compute the ELBO. Constant prior terms are precomputed, the entropy of each column of the factor matrices
+            is cached until that column changes, and the expected square error is reused from the tau update. '''
         total_elbo = 0.
         
         # Log likelihood               
-        total_elbo += self.size_Omega / 2. * ( self.exp_logtau - math.log(2*math.pi) ) \
-                      - self.exp_tau / 2. * self.exp_square_diff()
+        square_diff = self.square_diff if self.square_diff is not None else self.exp_square_diff()
+        total_elbo += self.size_Omega / 2. * ( self.exp_logtau - self.elbo_constants['log_2pi'] ) \
+                      - self.exp_tau / 2. * square_diff
                       
         # Prior lambdak, if using ARD, and prior U, V
         if self.ARD:
-            total_elbo += self.alpha0 * math.log(self.beta0) - scipy.special.gammaln(self.alpha0) \
+            total_elbo += self.elbo_constants['prior_lambdak'] \
                           + (self.alpha0 - 1.)*self.exp_loglambdak.sum() - self.beta0 * self.exp_lambdak.sum()
             
             total_elbo += self.I * numpy.log(self.exp_lambdak).sum() - ( self.exp_lambdak * self.exp_U ).sum()
             total_elbo += self.J * numpy.log(self.exp_lambdak).sum() - ( self.exp_lambdak * self.exp_V ).sum()
             
         else:
-            total_elbo += numpy.log(self.lambdaU).sum() - ( self.lambdaU * self.exp_U ).sum()
-            total_elbo += numpy.log(self.lambdaV).sum() - ( self.lambdaV * self.exp_V ).sum()
+            total_elbo += self.elbo_constants['prior_U'] - ( self.lambdaU * self.exp_U ).sum()
+            total_elbo += self.elbo_constants['prior_V'] - ( self.lambdaV * self.exp_V ).sum()
         
         # Prior tau
-        total_elbo += self.alphatau * math.log(self.betatau) - scipy.special.gammaln(self.alphatau) \
+        total_elbo += self.elbo_constants['prior_tau'] \
                       + (self.alphatau - 1.)*self.exp_logtau - self.betatau * self.exp_tau
         
         # q for lambdak, if using ARD
         if self.ARD:
-            total_elbo += - sum([v1*math.log(v2) for v1,v2 in zip(self.alphak_s,self.betak_s)]) + sum([scipy.special.gammaln(v) for v in self.alphak_s]) \
+            total_elbo += - (self.alphak_s*numpy.log(self.betak_s)).sum() + scipy.special.gammaln(self.alphak_s).sum() \
                           - ((self.alphak_s - 1.)*self.exp_loglambdak).sum() + (self.betak_s * self.exp_lambdak).sum()
             
         # q for U, V
-        total_elbo += - .5*numpy.log(self.tau_U).sum() + self.I*self.K/2.*math.log(2*math.pi) \
-                      + numpy.log(0.5*scipy.special.erfc(-self.mu_U*numpy.sqrt(self.tau_U)/math.sqrt(2))).sum() \
-                      + ( self.tau_U / 2. * ( self.var_U + (self.exp_U - self.mu_U)**2 ) ).sum()
-        total_elbo += - .5*numpy.log(self.tau_V).sum() + self.J*self.K/2.*math.log(2*math.pi) \
-                      + numpy.log(0.5*scipy.special.erfc(-self.mu_V*numpy.sqrt(self.tau_V)/math.sqrt(2))).sum() \
-                      + ( self.tau_V / 2. * ( self.var_V + (self.exp_V - self.mu_V)**2 ) ).sum()
+        self.update_entropies()
+        total_elbo += self.entropy_U.sum() + self.entropy_V.sum()
         
         # q for tau
         total_elbo += - self.alpha_s * math.log(self.beta_s) + scipy.special.gammaln(self.alpha_s) \
@@ -231,12 +386,48 @@ class bnmf_vb:
         
         return total_elbo
         
+    def compute_elbo_constants(self):
+        ''' Precompute the terms of the ELBO that only depend on the hyperparameters. '''
+        self.elbo_constants = {
+            'log_2pi' : math.log(2*math.pi),
+            'prior_tau' : self.alphatau * math.log(self.betatau) - scipy.special.gammaln(self.alphatau),
+        }
+        if self.ARD:
+            self.elbo_constants['prior_lambdak'] = self.alpha0 * math.log(self.beta0) - scipy.special.gammaln(self.alpha0)
+        else:
+            self.elbo_constants['prior_U'] = numpy.log(self.lambdaU).sum()
+            self.elbo_constants['prior_V'] = numpy.log(self.lambdaV).sum()
+            
+    def reset_elbo_cache(self):
+        ''' Mark the entropies of all columns of q(U) and q(V), and the expected square error, as out of date. '''
+        self.entropy_U, self.entropy_V = numpy.zeros(self.K), numpy.zeros(self.K)
+        self.stale_U, self.stale_V = set(range(self.K)), set(range(self.K))
+        self.square_diff = None
+        
+    def update_entropies(self):
+        ''' Recompute the entropies of the columns of q(U) and q(V) that changed since the last ELBO. '''
+        if self.stale_U:
+            ks = sorted(self.stale_U)
+            self.entropy_U[ks] = self.entropy_columns(self.mu_U[:,ks],self.tau_U[:,ks],self.exp_U[:,ks],self.var_U[:,ks])
+            self.stale_U = set()
+        if self.stale_V:
+            ks = sorted(self.stale_V)
+            self.entropy_V[ks] = self.entropy_columns(self.mu_V[:,ks],self.tau_V[:,ks],self.exp_V[:,ks],self.var_V[:,ks])
+            self.stale_V = set()
+        
+    def entropy_columns(self,mu,tau,exp,var):
+        ''' Return the entropy of each column of a truncated normal q with parameters mu, tau, and moments exp, var. '''
+        return ( - .5*numpy.log(tau) + .5*self.elbo_constants['log_2pi'] \
+                 + numpy.log(0.5*scipy.special.erfc(-mu*numpy.sqrt(tau)/math.sqrt(2))) \
+                 + tau / 2. * ( var + (exp - mu)**2 ) ).sum(axis=0)
+        
         
     ''' Update the parameters for the distributions. '''
     def update_tau(self):   
         ''' Parameter updates tau. '''
         self.alpha_s = self.alphatau + self.size_Omega/2.0
-        self.beta_s = self.betatau + 0.5*self.exp_square_diff()
+        self.square_diff = self.exp_square_diff()
+        self.beta_s = self.betatau + 0.5*self.square_diff
         
     def exp_square_diff(self): 
         ''' Compute: sum_Omega E_q(U,V) [ ( Rij - Ui Vj )^2 ]. '''
@@ -248,17 +439,17 @@ class bnmf_vb:
         self.alphak_s[k] = self.alpha0 + self.I + self.J
         self.betak_s[k] = self.beta0 + self.exp_U[:,k].sum() + self.exp_V[:,k].sum()
         
-    def update_U(self,k):   
-        ''' Parameter updates U. '''   
-        lamb = self.exp_lambdak[k] if self.ARD else self.lambdaU[:,k]
-        self.tau_U[:,k] = self.exp_tau*(self.M*( self.var_V[:,k] + self.exp_V[:,k]**2 )).sum(axis=1) #sum over j, so rows
-        self.mu_U[:,k] = 1./self.tau_U[:,k] * (-lamb + self.exp_tau*(self.M * ( (self.R-numpy.dot(self.exp_U,self.exp_V.T)+numpy.outer(self.exp_U[:,k],self.exp_V[:,k]))*self.exp_V[:,k] )).sum(axis=1)) 
+    def update_U(self,k,rows=slice(None)):   
+        ''' Parameter updates U, for the given rows. '''   
+        lamb = self.exp_lambdak[k] if self.ARD else self.lambdaU[rows,k]
+        self.tau_U[rows,k] = self.exp_tau*(self.M[rows]*( self.var_V[:,k] + self.exp_V[:,k]**2 )).sum(axis=1) #sum over j, so rows
+        self.mu_U[rows,k] = 1./self.tau_U[rows,k] * (-lamb + self.exp_tau*masked_residual_products(self.R[rows],self.M[rows],self.exp_U[rows],self.exp_V,k)) 
         
-    def update_V(self,k):
-        ''' Parameter updates V. '''
-        lamb = self.exp_lambdak[k] if self.ARD else self.lambdaV[:,k]
-        self.tau_V[:,k] = self.exp_tau*(self.M.T*( self.var_U[:,k] + self.exp_U[:,k]**2 )).T.sum(axis=0) #sum over i, so columns
-        self.mu_V[:,k] = 1./self.tau_V[:,k] * (-lamb + self.exp_tau*(self.M.T * ( (self.R-numpy.dot(self.exp_U,self.exp_V.T)+numpy.outer(self.exp_U[:,k],self.exp_V[:,k])).T*self.exp_U[:,k] )).T.sum(axis=0)) 
+    def update_V(self,k,columns=slice(None)):
+        ''' Parameter updates V, for the given columns. '''
+        lamb = self.exp_lambdak[k] if self.ARD else self.lambdaV[columns,k]
+        self.tau_V[columns,k] = self.exp_tau*(self.M[:,columns].T*( self.var_U[:,k] + self.exp_U[:,k]**2 )).T.sum(axis=0) #sum over i, so columns
+        self.mu_V[columns,k] = 1./self.tau_V[columns,k] * (-lamb + self.exp_tau*masked_residual_products(self.R[:,columns].T,self.M[:,columns].T,self.exp_V[columns],self.exp_U,k)) 
         
         
     ''' Update the expectations and variances. '''
@@ -272,46 +463,144 @@ class bnmf_vb:
         self.exp_lambdak[k] = gamma_expectation(self.alphak_s[k],self.betak_s[k])
         self.exp_loglambdak[k] = gamma_expectation_log(self.alphak_s[k],self.betak_s[k])
     
-    def update_exp_U(self,k):
-        ''' Update expectation U. '''
-        self.exp_U[:,k] = TN_vector_expectation(self.mu_U[:,k],self.tau_U[:,k])
-        self.var_U[:,k] = TN_vector_variance(self.mu_U[:,k],self.tau_U[:,k])
-        
-    def update_exp_V(self,k):
-        ''' Update expectation V. '''
-        self.exp_V[:,k] = TN_vector_expectation(self.mu_V[:,k],self.tau_V[:,k])
-        self.var_V[:,k] = TN_vector_variance(self.mu_V[:,k],self.tau_V[:,k])
+    def update_exp_U(self,k,rows=slice(None)):
+        ''' Update expectation U, for the given rows. '''
+        self.exp_U[rows,k] = TN_vector_expectation(self.mu_U[rows,k],self.tau_U[rows,k])
+        self.var_U[rows,k] = TN_vector_variance(self.mu_U[rows,k],self.tau_U[rows,k])
+        self.stale_U.add(k)
+        self.square_diff = None
+        
+    def update_exp_V(self,k,columns=slice(None)):
+        ''' Update expectation V, for the given columns. '''
+        self.exp_V[columns,k] = TN_vector_expectation(self.mu_V[columns,k],self.tau_V[columns,k])
+        self.var_V[columns,k] = TN_vector_variance(self.mu_V[columns,k],self.tau_V[columns,k])
+        self.stale_V.add(k)
+        self.square_diff = None
+
 
+    ''' Fold in new rows or columns, keeping the trained factors fixed. '''
+    def fold_in_rows(self,R_new,M_new,iterations):
+        ''' Infer q(U) for new rows (I_new x J), keeping q(V), q(tau) and q(lambdak) fixed. Returns E[U]. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=0)
+        lamb = self.exp_lambdak if self.ARD else self.lambdaU.mean(axis=0)
+        return self.fold_in(R,M,self.exp_V,self.var_V,lamb,iterations)
+
+    def fold_in_columns(self,R_new,M_new,iterations):
+        ''' Infer q(V) for new columns (I x J_new), keeping q(U), q(tau) and q(lambdak) fixed. Returns E[V]. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=1)
+        lamb = self.exp_lambdak if self.ARD else self.lambdaV.mean(axis=0)
+        return self.fold_in(R,M,self.exp_U,self.var_U,lamb,iterations)
+
+    def fold_in(self,R,M,exp_B,var_B,lamb,iterations):
+        ''' Run the updates for q(A) in R ~ A B.T, initialised to the prior expectation. '''
+        lamb = numpy.tile(lamb,(R.shape[0],1))
+        mu_A, tau_A = 1./lamb, numpy.ones(lamb.shape)
+        exp_A, var_A = numpy.zeros(lamb.shape), numpy.zeros(lamb.shape)
+        for k in range(lamb.shape[1]):
+            exp_A[:,k] = TN_vector_expectation(mu_A[:,k],tau_A[:,k])
+            var_A[:,k] = TN_vector_variance(mu_A[:,k],tau_A[:,k])
+        for it in range(iterations):
+            self.update_rows(R,M,mu_A,tau_A,exp_A,var_A,exp_B,var_B,lamb)
+        return exp_A
+
+    def update_rows(self,R,M,mu_A,tau_A,exp_A,var_A,exp_B,var_B,lamb):
+        ''' Update q(A) column by column in R ~ A B.T, for all rows at once. lamb is the prior for A. '''
+        for k in range(exp_A.shape[1]):
+            tau_A[:,k] = self.exp_tau*(M*( var_B[:,k] + exp_B[:,k]**2 )).sum(axis=1)
+            mu_A[:,k] = 1./tau_A[:,k] * (-lamb[:,k] + self.exp_tau*(M * ( (R-numpy.dot(exp_A,exp_B.T)+numpy.outer(exp_A[:,k],exp_B[:,k]))*exp_B[:,k] )).sum(axis=1))
+            exp_A[:,k] = TN_vector_expectation(mu_A[:,k],tau_A[:,k])
+            var_A[:,k] = TN_vector_variance(mu_A[:,k],tau_A[:,k])
+
+
+    ''' Add new observations to R, and continue from the current state. '''
+    def update_data(self,new_entries):
+        ''' Add a list of new observations (i,j,Rij) to R and M, and store which rows and columns they touch. '''
+        for (i,j,value) in new_entries:
+            assert 0 <= i < self.I and 0 <= j < self.J, "New entry (%s,%s) lies outside of R, which has shape %s." % (i,j,self.R.shape)
+        self.data = self.data.with_entries(new_entries)
+        (self.R, self.M) = (self.data.R, self.data.M)
+        self.size_Omega = self.data.size_Omega
+        self.square_diff = None
+        if hasattr(self,'exp_tau'):
+            # q(tau) depends on the observed entries, so keep it consistent with the new data
+            self.update_tau()
+            self.update_exp_tau()
+        self.touched_rows = sorted(set(self.touched_rows) | set([i for (i,_,_) in new_entries]))
+        self.touched_columns = sorted(set(self.touched_columns) | set([j for (_,j,_) in new_entries]))
+        self.evaluator.clear() # R and M have changed
 
-    def predict(self, M_pred):
+    def refine(self,iterations,local_sweeps=0):
+        ''' Continue the updates from the current state, after first doing local_sweeps over only the touched rows and columns. '''
+        for sweep in range(local_sweeps):
+            self.sweep_touched()
+        self.touched_rows, self.touched_columns = [], []
+        self.run(iterations)
+
+    def sweep_touched(self):
+        ''' Update q(U) for the touched rows and q(V) for the touched columns, and then q(tau). '''
+        rows, columns = self.touched_rows, self.touched_columns
+        if rows:
+            mu, tau, exp, var = self.mu_U[rows], self.tau_U[rows], self.exp_U[rows], self.var_U[rows]
+            lamb = numpy.tile(self.exp_lambdak,(len(rows),1)) if self.ARD else self.lambdaU[rows]
+            self.update_rows(self.R[rows],self.M[rows],mu,tau,exp,var,self.exp_V,self.var_V,lamb)
+            self.mu_U[rows], self.tau_U[rows], self.exp_U[rows], self.var_U[rows] = mu, tau, exp, var
+        if columns:
+            mu, tau, exp, var = self.mu_V[columns], self.tau_V[columns], self.exp_V[columns], self.var_V[columns]
+            lamb = numpy.tile(self.exp_lambdak,(len(columns),1)) if self.ARD else self.lambdaV[columns]
+            self.update_rows(self.R[:,columns].T,self.M[:,columns].T,mu,tau,exp,var,self.exp_U,self.var_U,lamb)
+            self.mu_V[columns], self.tau_V[columns], self.exp_V[columns], self.var_V[columns] = mu, tau, exp, var
+        self.reset_elbo_cache()
+        self.update_tau()
+        self.update_exp_tau()
+
+
+    def predict(self,M_pred,metrics=ALL_METRICS):
         ''' Predict missing values in R. '''
-        R_pred = numpy.dot(self.exp_U, self.exp_V.T)
-        MSE = self.compute_MSE(M_pred, self.R, R_pred)
-        R2 = self.compute_R2(M_pred, self.R, R_pred)    
-        Rp = self.compute_Rp(M_pred, self.R, R_pred)        
-        return {'MSE': MSE, 'R^2': R2, 'Rp': Rp}
-        
-        
+        return self.evaluator.evaluate(M_pred,self.R,self.predict_entries,metrics)
+        
+        
+    ''' Predict individual entries or rows, without computing the full matrix. '''
+    def predict_entries(self,rows,cols,variance=False):
+        ''' Return E_q[Ui Vj] for the entries (rows[n],cols[n]), and also Var_q[Ui Vj] if variance is True. '''
+        rows, cols = numpy.array(rows,dtype=int), numpy.array(cols,dtype=int)
+        exp_U, exp_V = self.exp_U[rows], self.exp_V[cols]
+        exp_R = (exp_U * exp_V).sum(axis=1)
+        if not variance:
+            return exp_R
+        var_U, var_V = self.var_U[rows], self.var_V[cols]
+        var_R = ( (var_U+exp_U**2) * (var_V+exp_V**2) ).sum(axis=1) - ( exp_U**2 * exp_V**2 ).sum(axis=1)
+        return exp_R, var_R
+
+    def predict_rows(self,rows,variance=False):
+        ''' Return E_q[Ui Vj] for all columns of the given rows, and also Var_q[Ui Vj] if variance is True. '''
+        rows = numpy.array(rows,dtype=int)
+        exp_U, var_U = self.exp_U[rows], self.var_U[rows]
+        exp_R = numpy.dot(exp_U,self.exp_V.T)
+        if not variance:
+            return exp_R
+        var_R = numpy.dot(var_U+exp_U**2, (self.var_V+self.exp_V**2).T) - numpy.dot(exp_U**2,(self.exp_V**2).T)
+        return exp_R, var_R
+
+    def predictive(self,rows,cols,credible=None):
+        ''' Return the posterior predictive 'mean' and 'variance' (including the noise E[1/tau]) of the entries (rows[n],cols[n]),
+            and the 'lower' and 'upper' bounds of the credible interval if credible (e.g. 0.95) is given. 
+            For a mask M_pred, use rows, cols = numpy.nonzero(M_pred). '''
+        (exp_R,var_R) = self.predict_entries(rows,cols,variance=True)
+        return predictive_summary(exp_R,var_R+noise_variance(self.alpha_s,self.beta_s),credible)
+
+
     ''' Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation) '''
     def compute_MSE(self,M,R,R_pred):
         ''' Return the MSE of predictions in R_pred, expected values in R, for the entries in M. '''
-        return (M * (R-R_pred)**2).sum() / float(M.sum())
+        return compute_MSE(M,R,R_pred)
         
     def compute_R2(self,M,R,R_pred):
         ''' Return the R^2 of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean = (M*R).sum() / float(M.sum())
-        SS_total = float((M*(R-mean)**2).sum())
-        SS_res = float((M*(R-R_pred)**2).sum())
-        return 1. - SS_res / SS_total if SS_total != 0. else numpy.inf
+        return compute_R2(M,R,R_pred)
         
     def compute_Rp(self,M,R,R_pred):
         ''' Return the Rp of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean_real = (M*R).sum() / float(M.sum())
-        mean_pred = (M*R_pred).sum() / float(M.sum())
-        covariance = (M*(R-mean_real)*(R_pred-mean_pred)).sum()
-        variance_real = (M*(R-mean_real)**2).sum()
-        variance_pred = (M*(R_pred-mean_pred)**2).sum()
-        return covariance / float(math.sqrt(variance_real)*math.sqrt(variance_pred))
+        return compute_Rp(M,R,R_pred)
         
         
     def quality(self,metric):        
@@ -340,4 +629,19 @@ class bnmf_vb:
              
     def number_parameters(self):
         ''' Return the number of free variables in the model. '''
-        return (self.I*self.K + self.J*self.K + 1) + (self.K if self.ARD else 0)
\ No newline at end of file
+        return (self.I*self.K + self.J*self.K + 1) + (self.K if self.ARD else 0)
+        
+        
+    ''' Save and load the model. '''
+    def save(self,path,traces=True):
+        ''' Store the model in the directory path. '''
+        save_model(self,path,SAVE_DIMENSIONS,SAVE_HYPERPARAMETERS,SAVE_STATE,SAVE_TRACES if traces else [])
+
+    @classmethod
+    def load(cls,path,mmap_traces=True):
+        ''' Load a model stored using save(path). The traces are memory-mapped, unless mmap_traces is False. '''
+        metadata, values = load_model(path,cls.__name__,mmap_traces)
+        dimensions = metadata['dimensions']
+        model = cls(values['data']['R'],values['data']['M'],dimensions['K'],dimensions['ARD'],values['hyperparameters'])
+        restore_model(model,values)
+        return model
\ No newline at end of file
@@ -0,0 +1,269 @@
+"""
+Variational Bayesian inference for a batch of non-negative matrix
+factorisation models (see bnmf_vb.py) on the same data, fitted together.
+
+Grid searches train many small models on the same R and mask M, with the
+same K but different hyperparameters or random seeds, and the matrix products
+of a single small model use BLAS poorly. Here we stack the parameters of q of
+B configurations along a first axis, so that each update is one large matrix
+product for the whole batch. For column k of U,
+    tau_U[b,:,k] = E[tau_b] M (Var[V_b,k] + E[V_b,k]^2)
+    mu_U[b,:,k]  = ( -lambda_b + E[tau_b] (E_b E[V_b,k] + E[U_b,k] * M E[V_b,k]^2) ) / tau_U[b,:,k]
+where the products with M are a single (I x J) x (J x B) product, and
+E_b = M * (R - E[U_b] E[V_b].T) is the masked residual of configuration b.
+We recompute the residuals at the start of each sweep (one batched product),
+and update them after each column (a rank one change), so a sweep costs
+O(B I J K), as for B separate models, but in a few large products.
+
+We expect the following arguments:
+- R, M, K, ARD, as for bnmf_vb (R can be a Dataset, see dataset.py).
+- all_hyperparameters, a list of B dictionaries of hyperparameters, as for
+  bnmf_vb, one per configuration.
+- seeds, an optional list of B seeds for numpy.random, used when initialising
+  each configuration (e.g. to fit the same hyperparameters from several
+  random initialisations).
+
+Each configuration has its own bnmf_vb model (all sharing the Dataset), in
+BATCH.models, which initialises it, so all initialisations of bnmf_vb can be
+used. After each iteration we compute the ELBO of every configuration, and a
+configuration has converged when the relative change in its ELBO is at most
+tolerance (as in acceleration.iterations_to_convergence). Converged
+configurations drop out of the batch, and the remaining ones continue on
+smaller stacks. The final q of each configuration is written back to its
+bnmf_vb model, which can then be used as usual, e.g. for predictions.
+
+Usage:
+    BATCH = bnmf_vb_batch(R,M,K,ARD,all_hyperparameters,seeds)
+    BATCH.train(init_UV,iterations,tolerance)
+    performances = [model.predict(M_test) for model in BATCH.models]
+The ELBO, training MSE, and time of each iteration of configuration b are
+stored in BATCH.models[b].all_elbo, all_performances['MSE'], and all_times,
+and the number of iterations it ran in BATCH.iterations[b]. Use
+tolerance=None to run all configurations for all iterations. With
+train(...,time_budget=seconds), all configurations that are still running
+stop once another iteration would exceed the budget (see budget.py).
+"""
+
+from bnmf_vb import bnmf_vb
+from dataset import shared_dataset
+from distributions.truncated_normal_vector import TN_vector_expectation, TN_vector_variance
+from acceleration import CONVERGENCE_TOLERANCE
+from budget import TimeBudget
+
+import numpy, math, scipy.special, time
+
+STATE = ['mu_U','tau_U','exp_U','var_U','mu_V','tau_V','exp_V','var_V','alpha_s','beta_s','exp_tau','exp_logtau']
+STATE_ARD = STATE + ['alphak_s','betak_s','exp_lambdak','exp_loglambdak']
+HYPERPARAMETERS = ['alphatau','betatau','lambdaU','lambdaV']
+HYPERPARAMETERS_ARD = ['alphatau','betatau','alpha0','beta0']
+
+class bnmf_vb_batch:
+    def __init__(self,R,M,K,ARD,all_hyperparameters,seeds=None):
+        ''' Set up a bnmf_vb model for each configuration, all sharing the data. '''
+        seeds = [None] * len(all_hyperparameters) if seeds is None else list(seeds)
+        assert len(all_hyperparameters) > 0, "The batch should contain at least one configuration."
+        assert len(seeds) == len(all_hyperparameters), "Got %s seeds for %s configurations." % (len(seeds),len(all_hyperparameters))
+        self.data = shared_dataset(R,M)
+        (self.R, self.M) = (self.data.R, self.data.M)
+        (self.I,self.J) = self.data.shape
+        self.size_Omega = self.data.size_Omega
+        self.K = K
+        self.ARD = ARD
+        self.seeds = seeds
+        self.models = [bnmf_vb(self.data,None,K,ARD,hyperparameters) for hyperparameters in all_hyperparameters]
+        self.B = len(self.models)
+        self.state_names = STATE_ARD if ARD else STATE
+        self.stacked_names = self.state_names + (HYPERPARAMETERS_ARD if ARD else HYPERPARAMETERS)
+        self.log_2pi = math.log(2*math.pi)
+
+
+    def train(self,init_UV,iterations,tolerance=CONVERGENCE_TOLERANCE,time_budget=None):
+        ''' Initialise and run the algorithm. '''
+        self.initialise(init_UV=init_UV)
+        self.run(iterations,tolerance,time_budget)
+
+
+    def initialise(self,init_UV='exp'):
+        ''' Initialise each configuration with its bnmf_vb model (after seeding numpy.random), and stack their parameters. '''
+        for model,seed in zip(self.models,self.seeds):
+            if seed is not None:
+                numpy.random.seed(seed)
+            model.initialise(init_UV)
+        for name in self.stacked_names:
+            setattr(self,name,numpy.array([getattr(model,name) for model in self.models],dtype=float))
+        self.active = numpy.arange(self.B)
+        self.iterations = numpy.zeros(self.B,dtype=int)
+
+
+    def run(self,iterations,tolerance=CONVERGENCE_TOLERANCE,time_budget=None):
+        ''' Run the updates for all configurations, until they have converged, for iterations, or for time_budget seconds. '''
+        budget = TimeBudget(time_budget,iterations)
+        all_elbo, all_MSE, all_times = [[] for b in range(self.B)], [[] for b in range(self.B)], [[] for b in range(self.B)]
+        time_start = time.time()
+        for it in budget.range():
+            self.sweep()
+            elbos, MSEs = self.elbo(), (self.residual**2).sum(axis=(1,2)) / self.size_Omega
+            time_iteration = time.time() - time_start
+
+            converged = []
+            for position,b in enumerate(self.active):
+                previous = all_elbo[b][-1] if all_elbo[b] else None
+                all_elbo[b].append(elbos[position])
+                all_MSE[b].append(MSEs[position])
+                all_times[b].append(time_iteration)
+                self.iterations[b] += 1
+                if tolerance is not None and previous is not None and abs(elbos[position] - previous) <= tolerance * abs(elbos[position]):
+                    converged.append(position)
+
+            print "Iteration %s. Active configurations: %s. Converged: %s. Best ELBO: %s. Best MSE: %s." % (
+                it+1,len(self.active),len(converged),elbos.max(),MSEs.min())
+            last = it+1 == iterations or budget.exhausted()
+            self.finish(range(len(self.active)) if last else converged,all_elbo,all_MSE,all_times)
+            if len(self.active) == 0:
+                break
+        self.budget = budget.summary(int(self.iterations.max()))
+        budget.report(self.budget['iterations'])
+
+    def finish(self,positions,all_elbo,all_MSE,all_times):
+        ''' Write the parameters of q and the traces of the configurations at the given positions in the batch back to their
+            models, and remove them from the batch. '''
+        if len(positions) == 0:
+            return
+        for position in positions:
+            b = self.active[position]
+            model = self.models[b]
+            for name in self.state_names:
+                value = getattr(self,name)[position]
+                setattr(model,name,numpy.array(value) if numpy.ndim(value) > 0 else float(value))
+            model.reset_elbo_cache()
+            model.all_elbo, model.all_times = all_elbo[b], all_times[b]
+            model.all_performances = { 'MSE': all_MSE[b] }
+        keep = numpy.ones(len(self.active),dtype=bool)
+        keep[list(positions)] = False
+        for name in self.stacked_names + ['residual']:
+            setattr(self,name,getattr(self,name)[keep])
+        self.active = self.active[keep]
+
+
+    def sweep(self):
+        ''' Update the parameters and expectations of q(lambdak) (if ARD), q(U), q(V), and q(tau) once, for all
+            configurations in the batch. '''
+        self.residual = self.M * (self.R - numpy.matmul(self.exp_U,self.exp_V.transpose(0,2,1)))
+        if self.ARD:
+            self.update_lambdak()
+            self.update_exp_lambdak()
+        for k in range(self.K):
+            self.update_U(k)
+            self.update_exp_U(k)
+        for k in range(self.K):
+            self.update_V(k)
+            self.update_exp_V(k)
+        self.update_tau()
+        self.update_exp_tau()
+
+    def masked_products(self,A,axis):
+        ''' Return M A[b] (axis=0, A is B x J) or M.T A[b] (axis=1, A is B x I) for each b, as one matrix product. '''
+        M = self.M if axis == 0 else self.M.T
+        return numpy.dot(M,A.T).T
+
+    def masked_inner_products(self,A,C):
+        ''' Return sum_ijk M_ij A[b,i,k] C[b,j,k] for each b, with one matrix product for the whole batch. '''
+        (B,J,K) = C.shape
+        MC = numpy.dot(self.M,C.transpose(1,0,2).reshape(J,B*K)).reshape(self.I,B,K).transpose(1,0,2)
+        return (A * MC).sum(axis=(1,2))
+
+
+    ''' Update the parameters for the distributions. '''
+    def update_lambdak(self):
+        ''' Parameter updates lambdak. '''
+        self.alphak_s = numpy.tile(self.alpha0 + self.I + self.J,(self.K,1)).T
+        self.betak_s = self.beta0[:,None] + self.exp_U.sum(axis=1) + self.exp_V.sum(axis=1)
+
+    def update_U(self,k):
+        ''' Parameter updates U. '''
+        lamb = self.exp_lambdak[:,k,None] if self.ARD else self.lambdaU[:,:,k]
+        self.tau_U[:,:,k] = self.exp_tau[:,None] * self.masked_products(self.var_V[:,:,k] + self.exp_V[:,:,k]**2,0)
+        products = numpy.matmul(self.residual,self.exp_V[:,:,k,None])[:,:,0] + self.exp_U[:,:,k] * self.masked_products(self.exp_V[:,:,k]**2,0)
+        self.mu_U[:,:,k] = 1./self.tau_U[:,:,k] * (-lamb + self.exp_tau[:,None] * products)
+
+    def update_V(self,k):
+        ''' Parameter updates V. '''
+        lamb = self.exp_lambdak[:,k,None] if self.ARD else self.lambdaV[:,:,k]
+        self.tau_V[:,:,k] = self.exp_tau[:,None] * self.masked_products(self.var_U[:,:,k] + self.exp_U[:,:,k]**2,1)
+        products = numpy.matmul(self.residual.transpose(0,2,1),self.exp_U[:,:,k,None])[:,:,0] + self.exp_V[:,:,k] * self.masked_products(self.exp_U[:,:,k]**2,1)
+        self.mu_V[:,:,k] = 1./self.tau_V[:,:,k] * (-lamb + self.exp_tau[:,None] * products)
+
+    def update_tau(self):
+        ''' Parameter updates tau. '''
+        self.alpha_s = self.alphatau + self.size_Omega/2.0
+        self.square_diff = (self.residual**2).sum(axis=(1,2)) \
+            + self.masked_inner_products(self.var_U+self.exp_U**2,self.var_V+self.exp_V**2) \
+            - self.masked_inner_products(self.exp_U**2,self.exp_V**2)
+        self.beta_s = self.betatau + 0.5*self.square_diff
+
+
+    ''' Update the expectations and variances. '''
+    def update_exp_tau(self):
+        ''' Update expectation tau. '''
+        self.exp_tau = self.alpha_s / self.beta_s
+        self.exp_logtau = scipy.special.psi(self.alpha_s) - numpy.log(self.beta_s)
+
+    def update_exp_lambdak(self):
+        ''' Update expectation lambdak. '''
+        self.exp_lambdak = self.alphak_s / self.betak_s
+        self.exp_loglambdak = scipy.special.psi(self.alphak_s) - numpy.log(self.betak_s)
+
+    def update_exp_U(self,k):
+        ''' Update expectation U, and the residuals. '''
+        previous = self.exp_U[:,:,k].copy()
+        self.exp_U[:,:,k] = TN_vector_expectation(self.mu_U[:,:,k],self.tau_U[:,:,k])
+        self.var_U[:,:,k] = TN_vector_variance(self.mu_U[:,:,k],self.tau_U[:,:,k])
+        self.residual -= self.M * (self.exp_U[:,:,k] - previous)[:,:,None] * self.exp_V[:,None,:,k]
+
+    def update_exp_V(self,k):
+        ''' Update expectation V, and the residuals. '''
+        previous = self.exp_V[:,:,k].copy()
+        self.exp_V[:,:,k] = TN_vector_expectation(self.mu_V[:,:,k],self.tau_V[:,:,k])
+        self.var_V[:,:,k] = TN_vector_variance(self.mu_V[:,:,k],self.tau_V[:,:,k])
+        self.residual -= self.M * self.exp_U[:,:,k,None] * (self.exp_V[:,:,k] - previous)[:,None,:]
+
+
+    def elbo(self):
+        ''' Compute the ELBO of each configuration in the batch, as in bnmf_vb. '''
+        gammaln = scipy.special.gammaln
+
+        # Log likelihood
+        total_elbo = self.size_Omega / 2. * ( self.exp_logtau - self.log_2pi ) - self.exp_tau / 2. * self.square_diff
+
+        # Prior lambdak, if using ARD, and prior U, V
+        if self.ARD:
+            total_elbo += self.alpha0 * numpy.log(self.beta0) - gammaln(self.alpha0) \
+                          + (self.alpha0 - 1.)*self.exp_loglambdak.sum(axis=1) - self.beta0 * self.exp_lambdak.sum(axis=1)
+            total_elbo += (self.I + self.J) * numpy.log(self.exp_lambdak).sum(axis=1) \
+                          - ( self.exp_lambdak[:,None,:] * self.exp_U ).sum(axis=(1,2)) - ( self.exp_lambdak[:,None,:] * self.exp_V ).sum(axis=(1,2))
+        else:
+            total_elbo += numpy.log(self.lambdaU).sum(axis=(1,2)) - ( self.lambdaU * self.exp_U ).sum(axis=(1,2))
+            total_elbo += numpy.log(self.lambdaV).sum(axis=(1,2)) - ( self.lambdaV * self.exp_V ).sum(axis=(1,2))
+
+        # Prior tau
+        total_elbo += self.alphatau * numpy.log(self.betatau) - gammaln(self.alphatau) \
+                      + (self.alphatau - 1.)*self.exp_logtau - self.betatau * self.exp_tau
+
+        # q for lambdak, if using ARD
+        if self.ARD:
+            total_elbo += ( - self.alphak_s*numpy.log(self.betak_s) + gammaln(self.alphak_s) \
+                            - (self.alphak_s - 1.)*self.exp_loglambdak + self.betak_s * self.exp_lambdak ).sum(axis=1)
+
+        # q for U, V
+        total_elbo += self.entropy(self.mu_U,self.tau_U,self.exp_U,self.var_U) + self.entropy(self.mu_V,self.tau_V,self.exp_V,self.var_V)
+
+        # q for tau
+        total_elbo += - self.alpha_s * numpy.log(self.beta_s) + gammaln(self.alpha_s) \
+                      - (self.alpha_s - 1.)*self.exp_logtau + self.beta_s * self.exp_tau
+        return total_elbo
+
+    def entropy(self,mu,tau,exp,var):
+        ''' Return the entropy of a truncated normal q with parameters mu, tau, and moments exp, var, for each configuration. '''
+        return ( - .5*numpy.log(tau) + .5*self.log_2pi \
+                 + numpy.log(0.5*scipy.special.erfc(-mu*numpy.sqrt(tau)/math.sqrt(2))) \
+                 + tau / 2. * ( var + (exp - mu)**2 ) ).sum(axis=(1,2))
@@ -2,8 +2,9 @@
 Gibbs sampler for non-negative matrix tri-factorisation, with ARD.
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix, or a Dataset shared with other models (see dataset.py)
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or None to use the mask of the Dataset R
 - K, the number of row clusters
 - L, the number of column clusters
 - hyperparameters = { 'alphatau', 'betatau', 'alpha0', 'beta0', 'lambdaS', 'lambdaF', 'lambdaG' },
@@ -14,8 +15,10 @@ We expect the following arguments:
     
 The random variables are initialised as follows:
     lambdaFk, lambdaGl: expectation
-    F,G: K-means ('kmeans'), expectation ('exp'), or random ('random')
-    S:   expectation ('exp') or random ('random')
+    F,G: K-means ('kmeans'), expectation ('exp'), random ('random'), or
+         NNDSVD ('nndsvd' or 'nndsvd-iterative', see nndsvd.py)
+    S:   expectation ('exp'), random ('random'), or NNDSVD ('nndsvd', only
+         if F and G are initialised with NNDSVD as well)
     tau: using updates, and then random draw
 We initialise the values of F and G according to the given argument 'init_FG',
 and S according to 'init_S'. 
@@ -38,9 +41,24 @@ We can test the performance of our model on a test dataset, specifying our test
     performance = BNMTF.predict(M_pred,burn_in,thinning)
 This gives a dictionary of performances,
     performance = { 'MSE', 'R^2', 'Rp' }
+and also 'MAE' with predict(...,metrics=['MSE','R^2','Rp','MAE']) (see metrics.py).
     
 The performances of all iterations are stored in BNMTF.all_performances, which 
 is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+
+Further features (see the module or method named for the details):
+    BNMTF.run(iterations,rao_blackwell=True)   -> average the conditional expectations of the draws instead
+    BNMTF.update_data(new_entries)             -> add observations, then continue with refine(iterations,local_sweeps)
+    BNMTF.save(path,burn_in,thinning)          -> store the model in a directory, for bnmtf_gibbs.load(path) (persistence.py)
+    BNMTF.predict_entries(rows,cols,burn_in,thinning,variance) -> predict some entries, or predict_rows(rows,...)
+    BNMTF.track_predictive(rows,cols,burn_in,thinning) -> accumulate the predictive for predictive(credible) (predictive.py)
+    BNMTF.run(iterations,profile=False)        -> do not time the phases of run() in BNMTF.profile (profiler.py)
+    BNMTF.run(iterations,time_budget=seconds)  -> stop before exceeding a wall-clock budget (budget.py)
+    BNMTF.run(iterations,prune=True)           -> remove the components ARD switches off (pruning.py)
+    BNMTF.run(iterations,grow=True)            -> start from a small K and L and add components (growth.py)
+    BNMTF.run(iterations,threads=T)            -> update blocks of rows in parallel threads (parallel.py)
+    BNMTF.run_until(ess_target,max_iterations) -> run until converged, with BNMTF.convergence (diagnostics.py)
+    BNMTF.train_hybrid(init_FG,init_S,vb_iterations,iterations) -> start from a bnmtf_vb fit, or use initialise(from_vb=BNMTF_VB)
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -51,77 +69,90 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 """
 
 from kmeans.kmeans import KMeans
+from nndsvd import nndsvd_tri_factors, OPTIONS_NNDSVD
 from distributions.exponential import exponential_draw
 from distributions.gamma import gamma_draw
-from distributions.truncated_normal import TN_draw
-from distributions.truncated_normal_vector import TN_vector_draw
+from distributions.truncated_normal import TN_expectation
+from distributions.truncated_normal_vector import TN_vector_draw_rng, TN_vector_expectation
+from persistence import save_model, load_model, restore_model
+from dataset import shared_dataset, prior_matrix
+from fold_in import new_rows
+from metrics import ALL_METRICS, Evaluator, compute_MSE, compute_R2, compute_Rp
+from profiler import Profiler, NullProfiler
+from budget import TimeBudget, trace_length, extend_traces
+from pruning import create_pruner, component_magnitudes, remove_components
+from parallel import create_row_blocks
+from kernels import TN_draw_kernel, TN_vector_draw_kernel, masked_residual_products
+from growth import GROW_IMPROVEMENT, create_grower, residual_component, nonnegative_coefficients, append_components
+from predictive import RunningMoments, predictive_summary
+from diagnostics import ConvergenceMonitor, CHECK_EVERY
+from bnmtf_vb import bnmtf_vb
 
 import numpy, itertools, math, time
 
-ALL_METRICS = ['MSE','R^2','Rp']
 ALL_QUALITY = ['loglikelihood','BIC','AIC','MSE','ELBO']
-OPTIONS_INIT_FG = ['kmeans', 'random', 'exp']
-OPTIONS_INIT_S = ['random', 'exp']
+OPTIONS_INIT_FG = ['kmeans', 'random', 'exp'] + OPTIONS_NNDSVD
+SAVE_DIMENSIONS = ['K','L','ARD']
+SAVE_HYPERPARAMETERS = ['alphatau','betatau','alpha0','beta0','lambdaF','lambdaS','lambdaG']
+SAVE_STATE = ['F','S','G','tau','lambdaFk','lambdaGl','touched_rows','touched_columns','rao_blackwell']
+SAVE_TRACES = ['all_F','all_S','all_G','all_tau','all_lambdaFk','all_lambdaGl','all_exp_F','all_exp_S','all_exp_G','all_exp_tau','all_exp_lambdaFk','all_exp_lambdaGl','all_times','all_performances','pruned_components','grown_components','all_K','all_L']
+ROW_COMPONENT_ARRAYS = [('F',1),('S',0),('lambdaFk',0),('lambdaS',0)]
+COLUMN_COMPONENT_ARRAYS = [('G',1),('S',1),('lambdaGl',0),('lambdaS',1)]
+RAO_BLACKWELL_ROW_ARRAYS = [('exp_F',1),('exp_S',0),('exp_lambdaFk',0)]
+RAO_BLACKWELL_COLUMN_ARRAYS = [('exp_G',1),('exp_S',1),('exp_lambdaGl',0)]
+TRACES = ['all_F','all_S','all_G','all_tau','all_lambdaFk','all_lambdaGl']
+RAO_BLACKWELL_TRACES = ['all_exp_F','all_exp_S','all_exp_G','all_exp_tau','all_exp_lambdaFk','all_exp_lambdaGl']
+OPTIONS_INIT_S = ['random', 'exp', 'nndsvd']
 
 class bnmtf_gibbs:
     def __init__(self,R,M,K,L,ARD,hyperparameters):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+        self.data = shared_dataset(R,M)
+        (self.R, self.M) = (self.data.R, self.data.M)
         self.K = K
         self.L = L
         self.ARD = ARD
         
-        assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
-            "but instead %s-dimensional." % len(self.R.shape)
-        assert self.R.shape == self.M.shape, "Input matrix R is not of the same size as " \
-            "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
-            
-        (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
-        self.check_empty_rows_columns()      
+        (self.I,self.J) = self.data.shape
+        self.size_Omega = self.data.size_Omega
+        self.touched_rows, self.touched_columns = [], []
+        self.evaluator = Evaluator()
+        self.prediction_cache = {}
+        self.predictive_query = None
+        self.predictive_moments, self.noise_moments = RunningMoments(), RunningMoments()
+        self.rao_blackwell = False
         
         self.alphatau, self.betatau = float(hyperparameters['alphatau']), float(hyperparameters['betatau'])
-        self.lambdaS = numpy.array(hyperparameters['lambdaS'])
-        if self.lambdaS.shape == ():
-            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L))
-        assert self.lambdaS.shape == (self.K,self.L), "Prior matrix lambdaS has the wrong shape: %s instead of (%s, %s)." % (self.lambdaS.shape,self.K,self.L)
+        self.lambdaS = prior_matrix(hyperparameters['lambdaS'],(self.K,self.L),'lambdaS')
             
         if self.ARD:
             self.alpha0, self.beta0 = float(hyperparameters['alpha0']), float(hyperparameters['beta0'])
         else:
-            self.lambdaF, self.lambdaG = numpy.array(hyperparameters['lambdaF']), numpy.array(hyperparameters['lambdaG'])
-            # Make lambdaF/G into a numpy array if they are a float
-            if self.lambdaF.shape == ():
-                self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K))
-            if self.lambdaG.shape == ():
-                self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L))
-        
-            assert self.lambdaF.shape == (self.I,self.K), "Prior matrix lambdaF has the wrong shape: %s instead of (%s, %s)." % (self.lambdaF.shape,self.I,self.K)
-            assert self.lambdaG.shape == (self.J,self.L), "Prior matrix lambdaG has the wrong shape: %s instead of (%s, %s)." % (self.lambdaG.shape,self.J,self.L)
+            self.lambdaF = prior_matrix(hyperparameters['lambdaF'],(self.I,self.K),'lambdaF')
+            self.lambdaG = prior_matrix(hyperparameters['lambdaG'],(self.J,self.L),'lambdaG')
              
              
-    def check_empty_rows_columns(self):
-        ''' Raise an exception if an entire row or column is empty. '''
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
-                    
-        # Assert none of the rows or columns are entirely unknown values
-        for i,c in enumerate(sums_rows):
-            assert c != 0, "Fully unobserved row in R, row %s." % i
-        for j,c in enumerate(sums_columns):
-            assert c != 0, "Fully unobserved column in R, column %s." % j
-
-
-    def train(self,init_FG,init_S,iterations):
+    def train(self,init_FG,init_S,iterations,prune=False,grow=False,threads=1,rao_blackwell=False,time_budget=None):
         ''' Initialise and run the sampler. '''
         self.initialise(init_FG=init_FG, init_S=init_S)
-        self.run(iterations)
+        self.run(iterations,prune=prune,grow=grow,threads=threads,rao_blackwell=rao_blackwell,time_budget=time_budget)
+        
+    def train_hybrid(self,init_FG,init_S,vb_iterations,iterations,prune=False,grow=False,threads=1,rao_blackwell=False,time_budget=None):
+        ''' Fit a bnmtf_vb model with the same hyperparameters for vb_iterations, initialise the sampler with a draw from
+            its variational posterior, and run the sampler with the remaining arguments as in train(). '''
+        hyperparameters = dict([(name,getattr(self,name)) for name in SAVE_HYPERPARAMETERS if hasattr(self,name)])
+        self.vb = bnmtf_vb(self.data,None,self.K,self.L,self.ARD,hyperparameters)
+        self.vb.train(init_FG,init_S,vb_iterations,threads=threads)
+        self.initialise(from_vb=self.vb)
+        self.run(iterations,prune=prune,grow=grow,threads=threads,rao_blackwell=rao_blackwell,time_budget=time_budget)
 
 
-    def initialise(self,init_FG='random',init_S='random'):
-        ''' Initialise F, S, G, tau, and lambdaFk, lambdaGl (if ARD). '''
+    def initialise(self,init_FG='random',init_S='random',from_vb=None):
+        ''' Initialise F, S, G, tau, and lambdaFk, lambdaGl (if ARD), or draw them from the variational posterior of from_vb. '''
+        if from_vb is not None:
+            return self.initialise_from_vb(from_vb)
         assert init_FG in OPTIONS_INIT_FG, "Unknown initialisation option for F and G: %s. Should be in %s." % (init_FG, OPTIONS_INIT_FG)
         assert init_S in OPTIONS_INIT_S, "Unknown initialisation option for S: %s. Should be in %s." % (init_S, OPTIONS_INIT_S)
+        assert init_S != 'nndsvd' or init_FG in OPTIONS_NNDSVD, "S can only be initialised with NNDSVD if F and G are as well."
         
         self.F = numpy.zeros((self.I,self.K))
         self.S = numpy.zeros((self.K,self.L))
@@ -149,6 +180,8 @@ class bnmtf_gibbs:
             kmeans_G.initialise()
             kmeans_G.cluster()
             self.G = kmeans_G.clustering_results + 0.2
+        elif init_FG in OPTIONS_NNDSVD:
+            self.F, S_nndsvd, self.G = nndsvd_tri_factors(self.R,self.M,self.K,self.L,init_FG)
         else:
             # 'random' or 'exp'
             for i,k in itertools.product(range(self.I),range(self.K)):    
@@ -159,74 +192,185 @@ class bnmtf_gibbs:
                 self.G[j,l] = exponential_draw(hyperparam) if init_FG == 'random' else 1.0/hyperparam
             
         # Initialise S
-        for k,l in itertools.product(range(self.K),range(self.L)):
-            hyperparam = self.lambdaS[k,l] 
-            self.S[k,l] = exponential_draw(hyperparam) if init_S == 'random' else 1.0/hyperparam
+        if init_S == 'nndsvd':
+            self.S = S_nndsvd
+        else:
+            for k,l in itertools.product(range(self.K),range(self.L)):
+                hyperparam = self.lambdaS[k,l] 
+                self.S[k,l] = exponential_draw(hyperparam) if init_S == 'random' else 1.0/hyperparam
         
         # Initialise tau
         self.tau = gamma_draw(self.alpha_s(),self.beta_s())
+        
+    def initialise_from_vb(self,vb):
+        ''' Draw F, S, G, tau, and lambdaFk, lambdaGl (if ARD) from the variational posterior of a trained bnmtf_vb model. '''
+        assert (vb.I,vb.J,vb.K,vb.L,vb.ARD) == (self.I,self.J,self.K,self.L,self.ARD), "The variational model should have " \
+            "the same I, J, K, L, and ARD as the sampler: %s instead of %s." % ((vb.I,vb.J,vb.K,vb.L,vb.ARD),(self.I,self.J,self.K,self.L,self.ARD))
+        self.F = numpy.reshape(TN_vector_draw_kernel(vb.mu_F.ravel(),vb.tau_F.ravel()),(self.I,self.K))
+        self.S = numpy.reshape(TN_vector_draw_kernel(vb.mu_S.ravel(),vb.tau_S.ravel()),(self.K,self.L))
+        self.G = numpy.reshape(TN_vector_draw_kernel(vb.mu_G.ravel(),vb.tau_G.ravel()),(self.J,self.L))
+        self.lambdaFk = numpy.array([gamma_draw(vb.alphaFk_s[k],vb.betaFk_s[k]) for k in range(self.K)]) if self.ARD else numpy.zeros(self.K)
+        self.lambdaGl = numpy.array([gamma_draw(vb.alphaGl_s[l],vb.betaGl_s[l]) for l in range(self.L)]) if self.ARD else numpy.zeros(self.L)
+        self.tau = gamma_draw(vb.alpha_s,vb.beta_s)
 
 
-    def run(self,iterations):
-        ''' Run the Gibbs sampler. '''
-        self.all_F = numpy.zeros((iterations,self.I,self.K))  
-        self.all_S = numpy.zeros((iterations,self.K,self.L))   
-        self.all_G = numpy.zeros((iterations,self.J,self.L))  
-        self.all_tau = numpy.zeros(iterations)
-        self.all_lambdaFk = numpy.zeros((iterations,self.K))
-        self.all_lambdaGl = numpy.zeros((iterations,self.L))
+    def run(self,iterations,profile=True,prune=False,grow=False,threads=1,until=None,rao_blackwell=False,time_budget=None):
+        ''' Run the Gibbs sampler, stopping early if until(iteration) returns True, or at the time_budget (in seconds).
+            If rao_blackwell, also store the expectations of the conditional distributions of the draws, which have a lower
+            Monte Carlo variance, in all_exp_F, all_exp_S, all_exp_G, all_exp_tau, all_exp_lambdaFk, all_exp_lambdaGl.
+            These are kept for every iteration so that burn_in and thinning can be chosen afterwards, which doubles the
+            memory of the traces. '''
+        budget = TimeBudget(time_budget,iterations)
+        assert not prune or self.ARD, "Pruning components is only possible when using ARD."
+        assert not grow or self.ARD, "Growing components is only possible when using ARD."
+        assert not (prune and grow), "Components can either be pruned or grown, not both."
+        self.pruner_F, self.pruner_G = (create_grower(self.K,grow,min(self.I,self.J),GROW_IMPROVEMENT), create_grower(self.L,grow,min(self.I,self.J),GROW_IMPROVEMENT)) if grow \
+                                       else (create_pruner(self.K,prune), create_pruner(self.L,prune))
+        
+        self.all_F = numpy.zeros((trace_length(iterations),self.I,self.pruner_F.size))  
+        self.all_S = numpy.zeros((trace_length(iterations),self.pruner_F.size,self.pruner_G.size))   
+        self.all_G = numpy.zeros((trace_length(iterations),self.J,self.pruner_G.size))  
+        self.all_tau = numpy.zeros(trace_length(iterations))
+        self.all_lambdaFk = numpy.zeros((trace_length(iterations),self.pruner_F.size))
+        self.all_lambdaGl = numpy.zeros((trace_length(iterations),self.pruner_G.size))
+        self.rao_blackwell = rao_blackwell
+        self.exp_F, self.exp_S, self.exp_G, self.exp_lambdaFk, self.exp_lambdaGl = (numpy.zeros((self.I,self.K)), numpy.zeros((self.K,self.L)),
+            numpy.zeros((self.J,self.L)), numpy.zeros(self.K), numpy.zeros(self.L)) if rao_blackwell else (None, None, None, None, None)
+        for name in RAO_BLACKWELL_TRACES:
+            setattr(self,name,numpy.zeros(getattr(self,name.replace('exp_','')).shape) if rao_blackwell else None)
+        self.prediction_cache = {} # predictions for the old factors are no longer valid
+        self.predictive_moments, self.noise_moments = RunningMoments(), RunningMoments()
         self.all_times = [] # to plot performance against time
+        self.monitor = ConvergenceMonitor() # for the convergence diagnostics
+        self.all_K, self.all_L = [], [] # to plot the rank against time
         
         self.all_performances = {} # for plotting convergence of metrics
         for metric in ALL_METRICS:
             self.all_performances[metric] = []
         
+        self.row_blocks = create_row_blocks((self.I,self.J),threads)
+        self.profiler = Profiler() if profile else NullProfiler()
         time_start = time.time()
-        for it in range(0,iterations):   
-            # Update lambdaFk, lambdaGl
-            if self.ARD:
-                for k in range(self.K):
-                    self.lambdaFk[k] = gamma_draw(self.alphaFk_s(k),self.betaFk_s(k))
-                for l in range(self.L):
-                    self.lambdaGl[l] = gamma_draw(self.alphaGl_s(l),self.betaGl_s(l))
+        try:
+            for it in budget.range():
+                # Update lambdaFk, lambdaGl
+                if self.ARD:
+                    for k in range(self.K):
+                        alphaFk_s, betaFk_s = self.alphaFk_s(k), self.betaFk_s(k)
+                        self.lambdaFk[k] = gamma_draw(alphaFk_s,betaFk_s)
+                        if rao_blackwell:
+                            self.exp_lambdaFk[k] = alphaFk_s / betaFk_s
+                    for l in range(self.L):
+                        alphaGl_s, betaGl_s = self.alphaGl_s(l), self.betaGl_s(l)
+                        self.lambdaGl[l] = gamma_draw(alphaGl_s,betaGl_s)
+                        if rao_blackwell:
+                            self.exp_lambdaGl[l] = alphaGl_s / betaGl_s
+                self.profiler.tick('lambda')
             
-            # Update F
-            for k in range(0,self.K):
-                tauFk = self.tauF(k)
-                muFk = self.muF(tauFk,k)
-                self.F[:,k] = TN_vector_draw(muFk,tauFk)
+                # Update F
+                for k in range(0,self.K):
+                    self.row_blocks.map(0,lambda rows,rng: self.draw_F(k,rows,rng))
+                self.profiler.tick('F')
                 
-            # Update S
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
-                tauSkl = self.tauS(k,l)
-                muSkl = self.muS(tauSkl,k,l)
-                self.S[k,l] = TN_draw(muSkl,tauSkl)
+                # Update S
+                for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
+                    tauSkl = self.tauS(k,l)
+                    muSkl = self.muS(tauSkl,k,l)
+                    self.S[k,l] = TN_draw_kernel(muSkl,tauSkl)
+                    if rao_blackwell:
+                        self.exp_S[k,l] = TN_expectation(muSkl,tauSkl)
+                self.profiler.tick('S')
                 
-            # Update G
-            for l in range(0,self.L):
-                tauGl = self.tauG(l)
-                muGl = self.muG(tauGl,l)
-                self.G[:,l] = TN_vector_draw(muGl,tauGl)
+                # Update G
+                for l in range(0,self.L):
+                    self.row_blocks.map(1,lambda columns,rng: self.draw_G(l,columns,rng))
+                self.profiler.tick('G')
                 
-            # Update tau
-            self.tau = gamma_draw(self.alpha_s(),self.beta_s())
+                # Update tau
+                alpha_s, beta_s = self.alpha_s(), self.beta_s()
+                self.tau = gamma_draw(alpha_s,beta_s)
+                self.profiler.tick('tau')
             
-            # Store draws
-            self.all_F[it], self.all_S[it], self.all_G[it], self.all_tau[it] = numpy.copy(self.F), numpy.copy(self.S), numpy.copy(self.G), self.tau
-            if self.ARD:
-                self.all_lambdaFk[it] = numpy.copy(self.lambdaFk)
-                self.all_lambdaGl[it] = numpy.copy(self.lambdaGl)
+                # Remove components that ARD has switched off
+                if prune:
+                    self.prune_components(it)
+                    self.profiler.tick('pruning')
+
+                # Add a new component while all of them are in use
+                if grow:
+                    self.grow_components(it)
+                    self.profiler.tick('growth')
+            
+                # Store draws
+                extend_traces(self,TRACES + RAO_BLACKWELL_TRACES,it)
+                self.all_F[it], self.all_G[it], self.all_tau[it] = self.pruner_F.expand(self.F,1), self.pruner_G.expand(self.G,1), self.tau
+                self.all_S[it] = self.pruner_F.expand(self.pruner_G.expand(self.S,1),0)
+                if self.ARD:
+                    self.all_lambdaFk[it] = self.pruner_F.expand(self.lambdaFk,0)
+                    self.all_lambdaGl[it] = self.pruner_G.expand(self.lambdaGl,0)
+                if rao_blackwell:
+                    self.all_exp_F[it], self.all_exp_G[it], self.all_exp_tau[it] = self.pruner_F.expand(self.exp_F,1), self.pruner_G.expand(self.exp_G,1), alpha_s / beta_s
+                    self.all_exp_S[it] = self.pruner_F.expand(self.pruner_G.expand(self.exp_S,1),0)
+                    if self.ARD:
+                        self.all_exp_lambdaFk[it] = self.pruner_F.expand(self.exp_lambdaFk,0)
+                        self.all_exp_lambdaGl[it] = self.pruner_G.expand(self.exp_lambdaGl,0)
+                self.all_K.append(self.K)
+                self.all_L.append(self.L)
+                self.profiler.tick('traces')
+            
+                # Accumulate the posterior predictive of the tracked entries
+                if self.predictive_query is not None:
+                    self.accumulate_predictive(it)
+                self.profiler.tick('predictive')
             
-            # Store and print performances
-            perf = self.predict_while_running()
-            for metric in ALL_METRICS:
-                self.all_performances[metric].append(perf[metric])
+                # Store and print performances
+                perf = self.predict_while_running()
+                self.monitor.record({ 'tau':self.tau, 'MSE':perf['MSE'], 'F':numpy.linalg.norm(self.F), 'S':numpy.linalg.norm(self.S), 'G':numpy.linalg.norm(self.G) })
+                self.profiler.tick('performance')
+                for metric in ALL_METRICS:
+                    self.all_performances[metric].append(perf[metric])
                 
-            print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+                print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+                self.profiler.tick('output')
         
-            # Store time taken for iteration
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)            
+                # Store time taken for iteration
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)            
+            
+                # Stop early once the stopping rule is met
+                if until is not None and until(it):
+                    self.truncate_traces(it+1)
+                    break
+            
+                # Stop once another iteration would exceed the time budget
+                if budget.exhausted():
+                    break
+        finally:
+            self.row_blocks.close()
+        self.truncate_traces(len(self.all_times))
+        self.budget = budget.summary(len(self.all_times))
+        budget.report(len(self.all_times))
+        self.pruned_components = { 'F':list(self.pruner_F.pruned), 'G':list(self.pruner_G.pruned) }
+        self.grown_components = { 'F':list(self.pruner_F.added), 'G':list(self.pruner_G.added) } if grow else { 'F':[], 'G':[] }
+        if grow:
+            print "Final rank: K=%s, L=%s. Total time: %s seconds, for %s row and %s column component-iterations." % (self.K,self.L,self.all_times[-1],sum(self.all_K),sum(self.all_L))
+        self.profile, self.profile_phases = self.profiler.report(), self.profiler.phases
+        self.convergence = self.monitor.summary()
+        
+    def run_until(self,ess_target,max_iterations,check_every=CHECK_EVERY,profile=True,prune=False,grow=False,threads=1):
+        ''' Run the Gibbs sampler until all monitored quantities have at least ess_target effective samples after
+            the estimated burn-in (checked every check_every iterations), or for at most max_iterations. '''
+        assert ess_target > 0, "Target effective sample size should be positive, not %s." % ess_target
+        assert check_every >= 1, "Convergence should be checked at least every iteration, not every %s." % check_every
+        until = lambda it: (it+1) % check_every == 0 and self.monitor.converged(ess_target)
+        self.run(max_iterations,profile=profile,prune=prune,grow=grow,threads=threads,until=until)
+        print "Stopped after %s iterations. Burn-in: %s. Thinning: %s. Effective sample sizes: %s." % (
+            self.convergence['iterations'],self.convergence['burn_in'],self.convergence['thinning'],self.convergence['ess'])
+        
+    def truncate_traces(self,iterations):
+        ''' Keep only the draws of the first iterations iterations, when stopping early. '''
+        for name in TRACES + (RAO_BLACKWELL_TRACES if self.rao_blackwell else []):
+            setattr(self,name,getattr(self,name)[:iterations])
             
 
     def triple_dot(self,M1,M2,M3):
@@ -240,6 +384,50 @@ class bnmtf_gibbs:
             return numpy.dot(numpy.dot(M1,M2),M3)
         
         
+    def row_component_arrays(self):
+        ''' Return the arrays with one entry per row cluster, including the conditional expectations if rao_blackwell. '''
+        return ROW_COMPONENT_ARRAYS + (RAO_BLACKWELL_ROW_ARRAYS if self.rao_blackwell else [])
+        
+    def column_component_arrays(self):
+        ''' Return the arrays with one entry per column cluster, including the conditional expectations if rao_blackwell. '''
+        return COLUMN_COMPONENT_ARRAYS + (RAO_BLACKWELL_COLUMN_ARRAYS if self.rao_blackwell else [])
+        
+    def prune_components(self,iteration):
+        ''' Remove the components of F and G whose magnitude has stayed below the threshold (see pruning.py). '''
+        positions_F = self.pruner_F.check(component_magnitudes(self.F,numpy.dot(self.G,self.S.T)),iteration)
+        positions_G = self.pruner_G.check(component_magnitudes(self.G,numpy.dot(self.F,self.S)),iteration)
+        if positions_F:
+            remove_components(self,self.row_component_arrays(),positions_F)
+        if positions_G:
+            remove_components(self,self.column_component_arrays(),positions_G)
+        if positions_F or positions_G:
+            self.K, self.L = len(self.pruner_F.active), len(self.pruner_G.active)
+            self.prediction_cache = {}
+            
+    def grow_components(self,iteration):
+        ''' Add a component to F and G seeded from the residual while all of them are in use, or remove the new one if it has been switched off (see growth.py). '''
+        error = self.all_performances['MSE'][-1] if self.all_performances['MSE'] else None
+        (remove_F,add_F) = self.pruner_F.check(component_magnitudes(self.F,numpy.dot(self.G,self.S.T)),iteration,error)
+        (remove_G,add_G) = self.pruner_G.check(component_magnitudes(self.G,numpy.dot(self.F,self.S)),iteration,error)
+        if remove_F is not None:
+            remove_components(self,self.row_component_arrays(),[remove_F])
+        if remove_G is not None:
+            remove_components(self,self.column_component_arrays(),[remove_G])
+        if add_F or add_G:
+            u, v = residual_component(self.R,self.M,self.triple_dot(self.F,self.S,self.G.T))
+        if add_F:
+            # New column u of F, with the row of S that best maps G onto v (or 0, if G gets the new column v)
+            s = numpy.zeros(self.G.shape[1]) if add_G else nonnegative_coefficients(self.G,v)
+            append_components(self,self.row_component_arrays(),{ 'F':u, 'S':s, 'lambdaFk':self.alpha0/self.beta0, 'lambdaS':self.lambdaS.mean() })
+        if add_G:
+            # New column v of G, with the column of S that best maps F onto u (or 1 for the new column u of F)
+            s = numpy.eye(self.F.shape[1])[-1] if add_F else nonnegative_coefficients(self.F,u)
+            append_components(self,self.column_component_arrays(),{ 'G':v, 'S':s, 'lambdaGl':self.alpha0/self.beta0, 'lambdaS':self.lambdaS.mean() })
+        if remove_F is not None or remove_G is not None or add_F or add_G:
+            self.K, self.L = len(self.pruner_F.active), len(self.pruner_G.active)
+            self.prediction_cache = {}
+        
+        
     ''' Compute the parameters for the distributions we sample from. '''
     def alpha_s(self):   
         ''' alpha* for tau. '''
@@ -265,14 +453,14 @@ class bnmtf_gibbs:
         ''' betak* for lambdaFk. '''
         return self.beta0 + self.G[:,l].sum()
         
-    def tauF(self,k):      
-        ''' tauFk for Fk. ''' 
-        return self.tau * ( self.M * numpy.dot(self.S[k],self.G.T)**2 ).sum(axis=1)
+    def tauF(self,k,rows=slice(None)):      
+        ''' tauFk for Fk, for the given rows. ''' 
+        return self.tau * ( self.M[rows] * numpy.dot(self.S[k],self.G.T)**2 ).sum(axis=1)
         
-    def muF(self,tauFk,k):
-        ''' muFk for Fk. '''
-        lamb = self.lambdaFk[k] if self.ARD else self.lambdaF[:,k]
-        return 1./tauFk * (-lamb + self.tau*(self.M * ( (self.R-self.triple_dot(self.F,self.S,self.G.T)+numpy.outer(self.F[:,k],numpy.dot(self.S[k],self.G.T)))*numpy.dot(self.S[k],self.G.T) )).sum(axis=1)) 
+    def muF(self,tauFk,k,rows=slice(None)):
+        ''' muFk for Fk, for the given rows. '''
+        lamb = self.lambdaFk[k] if self.ARD else self.lambdaF[rows,k]
+        return 1./tauFk * (-lamb + self.tau*masked_residual_products(self.R[rows],self.M[rows],self.F[rows],numpy.dot(self.G,self.S.T),k)) 
         
     def tauS(self,k,l):  
         ''' tauSkl for Skl. '''     
@@ -282,69 +470,194 @@ class bnmtf_gibbs:
         ''' muSkl for Skl. '''
         return 1./tauSkl * (-self.lambdaS[k,l] + self.tau*(self.M * ( (self.R-self.triple_dot(self.F,self.S,self.G.T)+self.S[k,l]*numpy.outer(self.F[:,k],self.G[:,l]))*numpy.outer(self.F[:,k],self.G[:,l]) )).sum()) 
         
-    def tauG(self,l):  
-        ''' tauGl for Gl. '''     
-        return self.tau * ( self.M.T * numpy.dot(self.F,self.S[:,l])**2 ).T.sum(axis=0)
-        
-    def muG(self,tauGl,l):
-        ''' muGl for Gl. '''
-        lamb = self.lambdaGl[l] if self.ARD else self.lambdaG[:,l]
-        return 1./tauGl * (-lamb + self.tau*(self.M * ( (self.R-self.triple_dot(self.F,self.S,self.G.T)+numpy.outer(numpy.dot(self.F,self.S[:,l]),self.G[:,l])).T * numpy.dot(self.F,self.S[:,l]) ).T).sum(axis=0)) 
+    def tauG(self,l,columns=slice(None)):  
+        ''' tauGl for Gl, for the given columns. '''     
+        return self.tau * ( self.M[:,columns].T * numpy.dot(self.F,self.S[:,l])**2 ).T.sum(axis=0)
+        
+    def muG(self,tauGl,l,columns=slice(None)):
+        ''' muGl for Gl, for the given columns. '''
+        lamb = self.lambdaGl[l] if self.ARD else self.lambdaG[columns,l]
+        return 1./tauGl * (-lamb + self.tau*masked_residual_products(self.R[:,columns].T,self.M[:,columns].T,self.G[columns],numpy.dot(self.F,self.S),l)) 
+        
+    def draw_F(self,k,rows=slice(None),rng=None):
+        ''' Draw Fk for the given rows, using the global random state, or rng if given (see parallel.py). '''
+        tauFk = self.tauF(k,rows)
+        muFk = self.muF(tauFk,k,rows)
+        self.F[rows,k] = TN_vector_draw_kernel(muFk,tauFk) if rng is None else TN_vector_draw_rng(muFk,tauFk,rng)
+        if self.rao_blackwell:
+            self.exp_F[rows,k] = TN_vector_expectation(muFk,tauFk)
+        
+    def draw_G(self,l,columns=slice(None),rng=None):
+        ''' Draw Gl for the given columns, using the global random state, or rng if given (see parallel.py). '''
+        tauGl = self.tauG(l,columns)
+        muGl = self.muG(tauGl,l,columns)
+        self.G[columns,l] = TN_vector_draw_kernel(muGl,tauGl) if rng is None else TN_vector_draw_rng(muGl,tauGl,rng)
+        if self.rao_blackwell:
+            self.exp_G[columns,l] = TN_vector_expectation(muGl,tauGl)
         
 
-    def approx_expectation(self,burn_in,thinning):
-        ''' Return our expectation of F, S, G, tau, lambdaFk, lambdaGl. '''
-        indices = range(burn_in,len(self.all_F),thinning)
-        exp_F = numpy.array([self.all_F[i] for i in indices]).sum(axis=0) / float(len(indices))      
-        exp_S = numpy.array([self.all_S[i] for i in indices]).sum(axis=0) / float(len(indices))     
-        exp_G = numpy.array([self.all_G[i] for i in indices]).sum(axis=0) / float(len(indices))  
-        exp_tau = sum([self.all_tau[i] for i in indices]) / float(len(indices))
+    ''' Fold in new rows or columns, keeping the trained factors fixed. '''
+    def fold_in_rows(self,R_new,M_new,iterations,burn_in=0,thinning=1):
+        ''' Sample F for new rows (I_new x J), keeping S, G, tau and lambdaFk fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=0)
+        lamb = self.lambdaFk if self.ARD else self.lambdaF.mean(axis=0)
+        return self.fold_in(R,M,numpy.dot(self.G,self.S.T),lamb,iterations,burn_in,thinning)
+
+    def fold_in_columns(self,R_new,M_new,iterations,burn_in=0,thinning=1):
+        ''' Sample G for new columns (I x J_new), keeping F, S, tau and lambdaGl fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=1)
+        lamb = self.lambdaGl if self.ARD else self.lambdaG.mean(axis=0)
+        return self.fold_in(R,M,numpy.dot(self.F,self.S),lamb,iterations,burn_in,thinning)
+
+    def fold_in(self,R,M,B,lamb,iterations,burn_in,thinning):
+        ''' Run the sampler for A in R ~ A B.T (with B = G S.T or F S), and return the average of the draws. '''
+        assert iterations > burn_in, "Number of iterations should be greater than the burn-in, not %s <= %s." % (iterations,burn_in)
+        lamb = numpy.tile(lamb,(R.shape[0],1))
+        A = numpy.random.exponential(scale=1./lamb)
+        draws = []
+        for it in range(iterations):
+            self.draw_rows(R,M,A,B,lamb)
+            if it >= burn_in and (it - burn_in) % thinning == 0:
+                draws.append(numpy.copy(A))
+        return numpy.array(draws).sum(axis=0) / float(len(draws))
+
+    def draw_rows(self,R,M,A,B,lamb):
+        ''' Draw each column of A in R ~ A B.T, for all rows at once. lamb is the prior for A. '''
+        for k in range(A.shape[1]):
+            tauAk = self.tau * ( M * B[:,k]**2 ).sum(axis=1)
+            muAk = 1./tauAk * (-lamb[:,k] + self.tau*masked_residual_products(R,M,A,B,k))
+            A[:,k] = TN_vector_draw_kernel(muAk,tauAk)
+
+
+    ''' Add new observations to R, and continue from the current state. '''
+    def update_data(self,new_entries):
+        ''' Add a list of new observations (i,j,Rij) to R and M, and store which rows and columns they touch. '''
+        for (i,j,value) in new_entries:
+            assert 0 <= i < self.I and 0 <= j < self.J, "New entry (%s,%s) lies outside of R, which has shape %s." % (i,j,self.R.shape)
+        self.data = self.data.with_entries(new_entries)
+        (self.R, self.M) = (self.data.R, self.data.M)
+        self.size_Omega = self.data.size_Omega
+        self.touched_rows = sorted(set(self.touched_rows) | set([i for (i,_,_) in new_entries]))
+        self.touched_columns = sorted(set(self.touched_columns) | set([j for (_,j,_) in new_entries]))
+        self.evaluator.clear() # R and M have changed
+
+    def refine(self,iterations,local_sweeps=0):
+        ''' Continue the sampler from the current state, after first doing local_sweeps over only the touched rows and columns. '''
+        for sweep in range(local_sweeps):
+            self.sweep_touched()
+        self.touched_rows, self.touched_columns = [], []
+        self.run(iterations)
+
+    def sweep_touched(self):
+        ''' Draw F for the touched rows and G for the touched columns, and then tau. '''
+        rows, columns = self.touched_rows, self.touched_columns
+        if rows:
+            F_rows = self.F[rows]
+            lamb = numpy.tile(self.lambdaFk,(len(rows),1)) if self.ARD else self.lambdaF[rows]
+            self.draw_rows(self.R[rows],self.M[rows],F_rows,numpy.dot(self.G,self.S.T),lamb)
+            self.F[rows] = F_rows
+        if columns:
+            G_columns = self.G[columns]
+            lamb = numpy.tile(self.lambdaGl,(len(columns),1)) if self.ARD else self.lambdaG[columns]
+            self.draw_rows(self.R[:,columns].T,self.M[:,columns].T,G_columns,numpy.dot(self.F,self.S),lamb)
+            self.G[columns] = G_columns
+        self.tau = gamma_draw(self.alpha_s(),self.beta_s())
+
+
+    def approx_expectation(self,burn_in,thinning,rao_blackwell=None):
+        ''' Return our expectation of F, S, G, tau, lambdaFk, lambdaGl, averaging the conditional expectations if the
+            sampler stored them (or if rao_blackwell is True), and the draws otherwise (or if rao_blackwell is False). '''
+        rao_blackwell = self.rao_blackwell if rao_blackwell is None else rao_blackwell
+        assert not rao_blackwell or self.rao_blackwell, "No conditional expectations stored - please use run(...,rao_blackwell=True)."
+        (all_F,all_S,all_G,all_tau,all_lambdaFk,all_lambdaGl) = [getattr(self,name,None) for name in (RAO_BLACKWELL_TRACES if rao_blackwell else TRACES)]
+        indices = range(burn_in,len(all_F),thinning)
+        exp_F = numpy.array([all_F[i] for i in indices]).sum(axis=0) / float(len(indices))      
+        exp_S = numpy.array([all_S[i] for i in indices]).sum(axis=0) / float(len(indices))     
+        exp_G = numpy.array([all_G[i] for i in indices]).sum(axis=0) / float(len(indices))  
+        exp_tau = sum([all_tau[i] for i in indices]) / float(len(indices))
         exp_lambdaFk = None if not self.ARD else sum(
-            [self.all_lambdaFk[i] for i in indices]) / float(len(indices))
+            [all_lambdaFk[i] for i in indices]) / float(len(indices))
         exp_lambdaGl = None if not self.ARD else sum(
-            [self.all_lambdaGl[i] for i in indices]) / float(len(indices))
+            [all_lambdaGl[i] for i in indices]) / float(len(indices))
         return (exp_F, exp_S, exp_G, exp_tau, exp_lambdaFk, exp_lambdaGl)
 
 
-    def predict(self,M_pred,burn_in,thinning):
-        ''' Compute the expectation of U and V, and use it to predict missing values. '''
-        (exp_F,exp_S,exp_G,_,_,_) = self.approx_expectation(burn_in,thinning)
-        R_pred = self.triple_dot(exp_F,exp_S,exp_G.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
-        return {'MSE':MSE,'R^2':R2,'Rp':Rp}
-        
+    def predict(self,M_pred,burn_in,thinning,metrics=ALL_METRICS):
+        ''' Compute the expectation of F, S and G, and use it to predict missing values. '''
+        return self.evaluator.evaluate(M_pred,self.R,lambda rows,cols: self.predict_entries(rows,cols,burn_in,thinning),metrics)
         
     def predict_while_running(self):
         ''' Predict the training error while running. '''
-        R_pred = self.triple_dot(self.F,self.S,self.G.T)
-        MSE = self.compute_MSE(self.M,self.R,R_pred)
-        R2 = self.compute_R2(self.M,self.R,R_pred)    
-        Rp = self.compute_Rp(self.M,self.R,R_pred)        
-        return {'MSE':MSE,'R^2':R2,'Rp':Rp}
-        
-        
+        return self.evaluator.evaluate(self.M,self.R,lambda rows,cols: (self.F[rows] * numpy.dot(self.G,self.S.T)[cols]).sum(axis=1))
+        
+        
+    ''' Predict individual entries or rows, without computing the full matrix. '''
+    def predict_entries(self,rows,cols,burn_in,thinning,variance=False):
+        ''' Return the predictions for the entries (rows[n],cols[n]), using the expectations of F, S and G.
+            If variance is True, also return the variance of the predictions of the individual draws. '''
+        rows, cols = numpy.array(rows,dtype=int), numpy.array(cols,dtype=int)
+        (exp_F,exp_GS) = self.cached_expectation(burn_in,thinning)
+        R_pred = (exp_F[rows] * exp_GS[cols]).sum(axis=1)
+        if not variance:
+            return R_pred
+        return R_pred, self.variance_draws(lambda F,S,G: (F[rows] * numpy.dot(G[cols],S.T)).sum(axis=1),burn_in,thinning)
+
+    def predict_rows(self,rows,burn_in,thinning,variance=False):
+        ''' Return the predictions for all columns of the given rows, using the expectations of F, S and G.
+            If variance is True, also return the variance of the predictions of the individual draws. '''
+        rows = numpy.array(rows,dtype=int)
+        (exp_F,exp_GS) = self.cached_expectation(burn_in,thinning)
+        R_pred = numpy.dot(exp_F[rows],exp_GS.T)
+        if not variance:
+            return R_pred
+        return R_pred, self.variance_draws(lambda F,S,G: numpy.dot(F[rows],numpy.dot(S,G.T)),burn_in,thinning)
+
+    def cached_expectation(self,burn_in,thinning):
+        ''' Return (exp_F, exp_G exp_S.T) for the given burn-in and thinning, cached until the sampler is run again. '''
+        if (burn_in,thinning) not in self.prediction_cache:
+            (exp_F,exp_S,exp_G,_,_,_) = self.approx_expectation(burn_in,thinning)
+            self.prediction_cache[(burn_in,thinning)] = (exp_F,numpy.dot(exp_G,exp_S.T))
+        return self.prediction_cache[(burn_in,thinning)]
+
+    def variance_draws(self,predict_draw,burn_in,thinning):
+        ''' Return the variance of predict_draw(F,S,G) over the draws, computed one draw at a time. '''
+        moments = RunningMoments()
+        for it in range(burn_in,len(self.all_F),thinning):
+            moments.add(predict_draw(self.all_F[it],self.all_S[it],self.all_G[it]))
+        return moments.variance()
+
+    def track_predictive(self,rows,cols,burn_in=0,thinning=1):
+        ''' Accumulate the posterior predictive of the entries (rows[n],cols[n]) during the next run(), using 
+            the draws after burn_in with the given thinning. For a mask M_pred, use rows, cols = numpy.nonzero(M_pred). '''
+        self.predictive_query = (numpy.array(rows,dtype=int),numpy.array(cols,dtype=int),burn_in,thinning)
+
+    def accumulate_predictive(self,it):
+        ''' Add the predictions for the tracked entries and the noise variance of draw it to the running moments. '''
+        (rows,cols,burn_in,thinning) = self.predictive_query
+        if it >= burn_in and (it - burn_in) % thinning == 0:
+            self.predictive_moments.add((self.F[rows] * numpy.dot(self.G[cols],self.S.T)).sum(axis=1))
+            self.noise_moments.add(1. / self.tau)
+
+    def predictive(self,credible=None):
+        ''' Return the posterior predictive 'mean' and 'variance' (including the noise 1/tau) of the tracked entries,
+            and the 'lower' and 'upper' bounds of the credible interval if credible (e.g. 0.95) is given. '''
+        assert self.predictive_moments.n > 0, "No draws for the tracked entries - please call track_predictive() before run()."
+        variance = self.predictive_moments.variance() + self.noise_moments.mean
+        return predictive_summary(self.predictive_moments.mean,variance,credible)
+
+
     ''' Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation) '''
     def compute_MSE(self,M,R,R_pred):
         ''' Return the MSE of predictions in R_pred, expected values in R, for the entries in M. '''
-        return (M * (R-R_pred)**2).sum() / float(M.sum())
+        return compute_MSE(M,R,R_pred)
         
     def compute_R2(self,M,R,R_pred):
         ''' Return the R^2 of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean = (M*R).sum() / float(M.sum())
-        SS_total = float((M*(R-mean)**2).sum())
-        SS_res = float((M*(R-R_pred)**2).sum())
-        return 1. - SS_res / SS_total if SS_total != 0. else numpy.inf
+        return compute_R2(M,R,R_pred)
         
     def compute_Rp(self,M,R,R_pred):
         ''' Return the Rp of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean_real = (M*R).sum() / float(M.sum())
-        mean_pred = (M*R_pred).sum() / float(M.sum())
-        covariance = (M*(R-mean_real)*(R_pred-mean_pred)).sum()
-        variance_real = (M*(R-mean_real)**2).sum()
-        variance_pred = (M*(R_pred-mean_pred)**2).sum()
-        return covariance / float(math.sqrt(variance_real)*math.sqrt(variance_pred))
+        return compute_Rp(M,R,R_pred)
         
         
     def quality(self,metric,burn_in,thinning):
@@ -376,4 +689,20 @@ class bnmtf_gibbs:
              
     def number_parameters(self):
         ''' Return the number of free variables in the model. '''
-        return (self.I*self.K + self.K*self.L + self.J*self.L + 1) + (self.K+self.L if self.ARD else 0)
\ No newline at end of file
+        return (self.I*self.K + self.K*self.L + self.J*self.L + 1) + (self.K+self.L if self.ARD else 0)
+        
+        
+    ''' Save and load the model. '''
+    def save(self,path,burn_in=None,thinning=None,traces=True):
+        ''' Store the model in the directory path. If burn_in and thinning are given, also store the expectations. '''
+        summaries = {} if burn_in is None else dict(zip(['exp_F','exp_S','exp_G','exp_tau','exp_lambdaFk','exp_lambdaGl'],self.approx_expectation(burn_in,thinning)))
+        save_model(self,path,SAVE_DIMENSIONS,SAVE_HYPERPARAMETERS,SAVE_STATE,SAVE_TRACES if traces else [],summaries)
+
+    @classmethod
+    def load(cls,path,mmap_traces=True):
+        ''' Load a model stored using save(path). The traces are memory-mapped, unless mmap_traces is False. '''
+        metadata, values = load_model(path,cls.__name__,mmap_traces)
+        dimensions = metadata['dimensions']
+        model = cls(values['data']['R'],values['data']['M'],dimensions['K'],dimensions['L'],dimensions['ARD'],values['hyperparameters'])
+        restore_model(model,values)
+        return model
\ No newline at end of file
@@ -2,8 +2,9 @@
 Variational Bayesian inference for non-negative matrix tri-factorisation, with ARD.
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix, or a Dataset shared with other models (see dataset.py)
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or None to use the mask of the Dataset R
 - K, the number of row clusters
 - L, the number of column clusters
 - hyperparameters = { 'alphatau', 'betatau', 'alpha0', 'beta0', 'lambdaS', 'lambdaF', 'lambdaG' },
@@ -14,8 +15,10 @@ We expect the following arguments:
    
 The random variables are initialised as follows:
     (lambdaFk, lambdaGl) alphaFk_s, betaFk_s, alphaGl_s, betaGl_s - set to alpha0, beta0
-    (F,G) muF, muF - K-means ('kmeans'), expectation ('exp'), or random ('random')
-    (S) muS - expectation ('exp') or random ('random')
+    (F,G) muF, muF - K-means ('kmeans'), expectation ('exp'), random ('random'),
+                     or NNDSVD ('nndsvd' or 'nndsvd-iterative', see nndsvd.py)
+    (S) muS - expectation ('exp'), random ('random'), or NNDSVD ('nndsvd', only
+              if F and G are initialised with NNDSVD as well)
     (F,G,S) tauF, tauG, tauS - set to 1
     (tau) alpha_s, beta_s - using updates
 We initialise the values of F and G according to the given argument 'init_FG',
@@ -33,9 +36,25 @@ We can test the performance of our model on a test dataset, specifying our test
     performance = BNMTF.predict(M_pred)
 This gives a dictionary of performances,
     performance = { 'MSE', 'R^2', 'Rp' }
+and also 'MAE' with predict(M_pred,metrics=['MSE','R^2','Rp','MAE']) (see metrics.py).
     
 The performances of all iterations are stored in BNMF.all_performances, which 
 is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+
+Further features (see the module or method named for the details):
+    BNMTF.run(iterations,elbo_every=n)         -> only compute the ELBO every n iterations
+    BNMTF.update_data(new_entries)             -> add observations, then continue with refine(iterations,local_sweeps)
+    BNMTF.save(path)                           -> store the model in a directory, for bnmtf_vb.load(path) (persistence.py)
+    BNMTF.predict_entries(rows,cols,variance)  -> predict some entries, or predict_rows(rows,variance)
+    BNMTF.predictive(rows,cols,credible)       -> posterior predictive of some entries (predictive.py)
+    BNMTF.run(iterations,profile=False)        -> do not time the phases of run() in BNMTF.profile (profiler.py)
+    BNMTF.run(iterations,time_budget=seconds)  -> stop before exceeding a wall-clock budget (budget.py)
+    BNMTF.run(iterations,prune=True)           -> remove the components ARD switches off (pruning.py)
+    BNMTF.run(iterations,grow=True)            -> start from a small K and L and add components (growth.py)
+    BNMTF.run(iterations,threads=T)            -> update blocks of rows in parallel threads (parallel.py)
+    BNMTF.run(iterations,accelerate='squarem') -> or 'anderson', extrapolate the updates (acceleration.py)
+    BNMTF.run(iterations,active_set=True)      -> skip the columns and entries of S that hardly change (active_set.py)
+    BNMTF.run(iterations,empirical_bayes=True) -> learn the prior rates from the ELBO (empirical_bayes.py)
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -46,78 +65,82 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 """
 
 from kmeans.kmeans import KMeans
+from nndsvd import nndsvd_tri_factors, nndsvd_precision, OPTIONS_NNDSVD
 from distributions.gamma import gamma_expectation, gamma_expectation_log
 from distributions.truncated_normal import TN_expectation, TN_variance
 from distributions.truncated_normal_vector import TN_vector_expectation, TN_vector_variance
 from distributions.exponential import exponential_draw
+from persistence import save_model, load_model, restore_model
+from dataset import shared_dataset, prior_matrix
+from fold_in import new_rows
+from metrics import ALL_METRICS, Evaluator, compute_MSE, compute_R2, compute_Rp
+from profiler import Profiler, NullProfiler
+from budget import TimeBudget
+from pruning import create_pruner, component_magnitudes, remove_components
+from parallel import create_row_blocks
+from kernels import masked_residual_products
+from growth import GROW_IMPROVEMENT, create_grower, residual_component, nonnegative_coefficients, append_components
+from predictive import noise_variance, predictive_summary
+from acceleration import create_accelerator, POSITIVE
+from active_set import create_scheduler
+from empirical_bayes import learned_hyperparameters, exponential_rate, gamma_rate
 
 import numpy, itertools, math, scipy, time
 
-ALL_METRICS = ['MSE','R^2','Rp']
 ALL_QUALITY = ['loglikelihood','BIC','AIC','MSE','ELBO']
-OPTIONS_INIT_FG = ['kmeans', 'random', 'exp']
-OPTIONS_INIT_S = ['random', 'exp']
+OPTIONS_INIT_FG = ['kmeans', 'random', 'exp'] + OPTIONS_NNDSVD
+SAVE_DIMENSIONS = ['K','L','ARD']
+SAVE_HYPERPARAMETERS = ['alphatau','betatau','alpha0','beta0','lambdaF','lambdaS','lambdaG']
+SAVE_STATE = ['alphaFk_s','betaFk_s','exp_lambdaFk','exp_loglambdaFk','alphaGl_s','betaGl_s','exp_lambdaGl','exp_loglambdaGl','mu_F','tau_F','mu_S','tau_S','mu_G','tau_G','exp_F','var_F','exp_S','var_S','exp_G','var_G','alpha_s','beta_s','exp_tau','exp_logtau','touched_rows','touched_columns']
+SAVE_TRACES = ['all_exp_tau','all_times','all_performances','pruned_components','grown_components','all_K','all_L','all_elbo','all_sweeps','all_hyperparameters']
+ACCELERATED_PARAMETERS = [('mu_F',None),('tau_F',POSITIVE),('mu_S',None),('tau_S',POSITIVE),('mu_G',None),('tau_G',POSITIVE),('beta_s',POSITIVE)]
+ACCELERATED_PARAMETERS_ARD = ACCELERATED_PARAMETERS + [('betaFk_s',POSITIVE),('betaGl_s',POSITIVE)]
+ACTIVE_SET_AXES = { 'F':('K',), 'S':('K','L'), 'G':('L',) }
+ROW_COMPONENT_ARRAYS = [('alphaFk_s',0),('betaFk_s',0),('exp_lambdaFk',0),('exp_loglambdaFk',0),('mu_F',1),('tau_F',1),('exp_F',1),('var_F',1),('mu_S',0),('tau_S',0),('exp_S',0),('var_S',0),('lambdaS',0)]
+COLUMN_COMPONENT_ARRAYS = [('alphaGl_s',0),('betaGl_s',0),('exp_lambdaGl',0),('exp_loglambdaGl',0),('mu_G',1),('tau_G',1),('exp_G',1),('var_G',1),('mu_S',1),('tau_S',1),('exp_S',1),('var_S',1),('lambdaS',1)]
+OPTIONS_INIT_S = ['random', 'exp', 'nndsvd']
 ELEMENT_WISE_SPARSITY = True # If True, use element wise sparsity (ARD) for Skl
 
 class bnmtf_vb:
     def __init__(self,R,M,K,L,ARD,hyperparameters):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+        self.data = shared_dataset(R,M)
+        (self.R, self.M) = (self.data.R, self.data.M)
         self.K = K
         self.L = L
         self.ARD = ARD
         
-        assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
-            "but instead %s-dimensional." % len(self.R.shape)
-        assert self.R.shape == self.M.shape, "Input matrix R is not of the same size as " \
-            "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
-            
-        (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
-        self.check_empty_rows_columns()      
+        (self.I,self.J) = self.data.shape
+        self.size_Omega = self.data.size_Omega
+        self.touched_rows, self.touched_columns = [], []
+        self.evaluator = Evaluator()
+        self.prediction_cache = {}
         
         self.alphatau, self.betatau = float(hyperparameters['alphatau']), float(hyperparameters['betatau'])
-        self.lambdaS = numpy.array(hyperparameters['lambdaS'])
-        if self.lambdaS.shape == ():
-            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L))
-        assert self.lambdaS.shape == (self.K,self.L), "Prior matrix lambdaS has the wrong shape: %s instead of (%s, %s)." % (self.lambdaS.shape,self.K,self.L)
+        self.lambdaS = prior_matrix(hyperparameters['lambdaS'],(self.K,self.L),'lambdaS')
             
         if self.ARD:
             self.alpha0, self.beta0 = float(hyperparameters['alpha0']), float(hyperparameters['beta0'])
         else:
-            self.lambdaF, self.lambdaG = numpy.array(hyperparameters['lambdaF']), numpy.array(hyperparameters['lambdaG'])
-            # Make lambdaF/G into a numpy array if they are a float
-            if self.lambdaF.shape == ():
-                self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K))
-            if self.lambdaG.shape == ():
-                self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L))
-        
-            assert self.lambdaF.shape == (self.I,self.K), "Prior matrix lambdaF has the wrong shape: %s instead of (%s, %s)." % (self.lambdaF.shape,self.I,self.K)
-            assert self.lambdaG.shape == (self.J,self.L), "Prior matrix lambdaG has the wrong shape: %s instead of (%s, %s)." % (self.lambdaG.shape,self.J,self.L)
+            self.lambdaF = prior_matrix(hyperparameters['lambdaF'],(self.I,self.K),'lambdaF')
+            self.lambdaG = prior_matrix(hyperparameters['lambdaG'],(self.J,self.L),'lambdaG')
+            
+        self.compute_elbo_constants()
+        self.reset_elbo_cache()
                 
             
-    def check_empty_rows_columns(self):
-        ''' Raise an exception if an entire row or column is empty. '''
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
-                    
-        # Assert none of the rows or columns are entirely unknown values
-        for i,c in enumerate(sums_rows):
-            assert c != 0, "Fully unobserved row in R, row %s." % i
-        for j,c in enumerate(sums_columns):
-            assert c != 0, "Fully unobserved column in R, column %s." % j
-
-
-    def train(self,init_FG,init_S,iterations):
+    def train(self,init_FG,init_S,iterations,elbo_every=1,prune=False,grow=False,threads=1,accelerate=None,empirical_bayes=False,time_budget=None,active_set=False):
         ''' Initialise and run the sampler. '''
         self.initialise(init_FG=init_FG, init_S=init_S)
-        self.run(iterations)
+        self.run(iterations,elbo_every,prune=prune,grow=grow,threads=threads,accelerate=accelerate,empirical_bayes=empirical_bayes,time_budget=time_budget,active_set=active_set)
 
 
     def initialise(self,init_FG='random',init_S='random'):
         ''' Initialise F, S, G, tau, and lambdaFk, lambdaGl (if ARD). '''
         assert init_FG in OPTIONS_INIT_FG, "Unknown initialisation option for F and G: %s. Should be in %s." % (init_FG, OPTIONS_INIT_FG)
+        self.reset_elbo_cache()
         assert init_S in OPTIONS_INIT_S, "Unknown initialisation option for S: %s. Should be in %s." % (init_S, OPTIONS_INIT_S)
+        assert init_S != 'nndsvd' or init_FG in OPTIONS_NNDSVD, "S can only be initialised with NNDSVD if F and G are as well."
+        self.prediction_cache = {}
         
         # Initialise lambdaFk, lambdaGl, and compute expectations
         if self.ARD:
@@ -157,6 +180,9 @@ class bnmtf_vb:
             
             for j,l in itertools.product(range(self.J),range(self.L)):
                 self.tau_G[j,l] = 1.
+        elif init_FG in OPTIONS_NNDSVD:
+            self.mu_F, S_nndsvd, self.mu_G = nndsvd_tri_factors(self.R,self.M,self.K,self.L,init_FG)
+            self.tau_F[:,:], self.tau_G[:,:] = nndsvd_precision(self.mu_F), nndsvd_precision(self.mu_G)
         else:
             # 'random' or 'exp'
             for i,k in itertools.product(range(self.I),range(self.K)):  
@@ -169,10 +195,13 @@ class bnmtf_vb:
                 self.mu_G[j,l] = exponential_draw(hyperparam) if init_FG == 'random' else 1.0/hyperparam
             
         # Initialise parameters S
-        for k,l in itertools.product(range(self.K),range(self.L)):
-            self.tau_S[k,l] = 1.
-            hyperparam = self.lambdaS[k,l]
-            self.mu_S[k,l] = exponential_draw(hyperparam) if init_S == 'random' else 1.0/hyperparam
+        if init_S == 'nndsvd':
+            self.mu_S, self.tau_S[:,:] = S_nndsvd, nndsvd_precision(S_nndsvd)
+        else:
+            for k,l in itertools.product(range(self.K),range(self.L)):
+                self.tau_S[k,l] = 1.
+                hyperparam = self.lambdaS[k,l]
+                self.mu_S[k,l] = exponential_draw(hyperparam) if init_S == 'random' else 1.0/hyperparam
         
         # Compute expectations and variances F, G, S
         self.exp_F, self.var_F = numpy.zeros((self.I,self.K)), numpy.zeros((self.I,self.K))
@@ -191,106 +220,283 @@ class bnmtf_vb:
         self.update_exp_tau()
 
 
-    def run(self,iterations):
-        ''' Run the Gibbs sampler. '''
+    def run(self,iterations,elbo_every=1,profile=True,prune=False,grow=False,threads=1,accelerate=None,empirical_bayes=False,time_budget=None,active_set=False):
+        ''' Run the Gibbs sampler. Compute the ELBO every elbo_every iterations (and in the last one).
+            Stop at the time_budget (in seconds), if given. Skip converged columns of F and G, and entries of S, if active_set. '''
+        budget = TimeBudget(time_budget,iterations)
         self.all_exp_tau = []  # to check for convergence 
+        self.all_elbo = [] # to check for convergence
         self.all_times = [] # to plot performance against time    
+        self.all_K, self.all_L = [], [] # to plot the rank against time
+        self.all_sweeps = [] # to compare accelerated and plain iterations
         
         self.all_performances = {} # for plotting convergence of metrics
         for metric in ALL_METRICS:
             self.all_performances[metric] = []
         
+        assert not prune or self.ARD, "Pruning components is only possible when using ARD."
+        assert not grow or self.ARD, "Growing components is only possible when using ARD."
+        assert not (prune and grow), "Components can either be pruned or grown, not both."
+        self.pruner_F, self.pruner_G = (create_grower(self.K,grow,min(self.I,self.J),GROW_IMPROVEMENT), create_grower(self.L,grow,min(self.I,self.J),GROW_IMPROVEMENT)) if grow \
+                                       else (create_pruner(self.K,prune), create_pruner(self.L,prune))
+        assert not ((prune or grow) and accelerate), "Components can not be pruned or grown when accelerating the iterations."
+        assert not (active_set and (prune or grow or accelerate)), "Active-set scheduling can not be combined with pruning, growing, or acceleration."
+        learned = learned_hyperparameters(empirical_bayes)
+        self.all_hyperparameters = dict([(name,[]) for name in self.hyperparameter_names(learned)])
+        parameters = ACCELERATED_PARAMETERS_ARD if self.ARD else ACCELERATED_PARAMETERS
+        self.accelerator = create_accelerator(accelerate,self,parameters,self.sweep,self.elbo,self.update_expectations)
+        self.scheduler = create_scheduler(ACTIVE_SET_AXES,{'K':self.K,'L':self.L},active_set)
+        self.row_blocks = create_row_blocks((self.I,self.J),threads)
+        self.profiler = Profiler() if profile else NullProfiler()
         time_start = time.time()
-        for it in range(iterations): 
-            # Update lambdaFk and lambdaGl
-            if self.ARD:
-                for k in range(self.K):
-                    self.update_lambdaFk(k)
-                    self.update_exp_lambdaFk(k)
-                for l in range(self.L):
-                    self.update_lambdaGl(l)
-                    self.update_exp_lambdaGl(l)
+        try:
+            for it in budget.range():
+                # Update lambdaFk, lambdaGl, F, S, G, and tau
+                self.accelerator.step()
+                self.all_sweeps.append(self.accelerator.sweeps)
             
-            # Update F
-            for k in range(self.K):
-                self.update_F(k)
-                self.update_exp_F(k)
-                
-            # Update S
-            for k,l in itertools.product(range(self.K),range(self.L)):
-                self.update_S(k,l)
-                self.update_exp_S(k,l)
-                
-            # Update G
-            for l in range(0,self.L):
-                self.update_G(l)
-                self.update_exp_G(l)
+                # Update the hyperparameters, maximising the ELBO
+                if learned:
+                    self.update_hyperparameters(learned)
+                    self.profiler.tick('empirical Bayes')
             
-            # Update tau
-            self.update_tau()
-            self.update_exp_tau()
+                # Remove components that ARD has switched off
+                if prune:
+                    self.prune_components(it)
+                    self.profiler.tick('pruning')
+
+                # Add a new component while all of them are in use
+                if grow:
+                    self.grow_components(it)
+                    self.profiler.tick('growth')
             
-            # Store expectations
-            self.all_exp_tau.append(self.exp_tau)
+                # Store expectations
+                self.all_exp_tau.append(self.exp_tau)
+                self.all_K.append(self.K)
+                self.all_L.append(self.L)
+                self.profiler.tick('traces')
             
-            # Store and print performances
-            perf, elbo = self.predict(self.M), self.elbo()
-            for metric in ALL_METRICS:
-                self.all_performances[metric].append(perf[metric])
+                # Store and print performances
+                perf = self.predict(self.M)
+                self.profiler.tick('performance')
+                elbo = self.elbo() if (it+1) % elbo_every == 0 or it+1 == iterations else None
+                self.all_elbo.append(elbo)
+                self.profiler.tick('ELBO')
+                for metric in ALL_METRICS:
+                    self.all_performances[metric].append(perf[metric])
                 
-            print "Iteration %s. ELBO: %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,elbo,perf['MSE'],perf['R^2'],perf['Rp'])
+                print "Iteration %s. ELBO: %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,elbo,perf['MSE'],perf['R^2'],perf['Rp'])
+                self.profiler.tick('output')
                        
-            # Store time taken for iteration 
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)            
+                # Store time taken for iteration 
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)            
+            
+                # Stop once another iteration would exceed the time budget
+                if budget.exhausted():
+                    break
+        finally:
+            self.row_blocks.close()
+        if self.all_elbo and self.all_elbo[-1] is None:
+            self.all_elbo[-1] = self.elbo() # stopped by the time budget
+        self.budget = budget.summary(len(self.all_times))
+        budget.report(len(self.all_times))
+        self.active_updates = self.scheduler.summary()
+        self.pruned_components = { 'F':list(self.pruner_F.pruned), 'G':list(self.pruner_G.pruned) }
+        self.grown_components = { 'F':list(self.pruner_F.added), 'G':list(self.pruner_G.added) } if grow else { 'F':[], 'G':[] }
+        if grow:
+            print "Final rank: K=%s, L=%s. Total time: %s seconds, for %s row and %s column component-iterations." % (self.K,self.L,self.all_times[-1],sum(self.all_K),sum(self.all_L))
+        if accelerate:
+            print "Accelerated with %s: %s sweeps in %s iterations, %s rejected extrapolations. Total time: %s seconds." % (
+                accelerate,self.accelerator.sweeps,len(self.all_times),self.accelerator.rejected,self.all_times[-1])
+        self.profile, self.profile_phases = self.profiler.report(), self.profiler.phases
+        
+    def sweep(self):
+        ''' Update the parameters and expectations of q(lambdaFk) and q(lambdaGl) (if ARD), q(F), q(S), q(G), and q(tau) once. '''
+        self.prediction_cache = {} # predictions for the old factors are no longer valid
+        self.scheduler.start_sweep()
+        
+        # Update lambdaFk and lambdaGl
+        if self.ARD:
+            for k in range(self.K):
+                self.update_lambdaFk(k)
+                self.update_exp_lambdaFk(k)
+            for l in range(self.L):
+                self.update_lambdaGl(l)
+                self.update_exp_lambdaGl(l)
+        self.profiler.tick('lambda')
+        
+        # Update F
+        for k in range(self.K):
+            if not self.scheduler.active('F',k):
+                continue
+            old = numpy.copy(self.exp_F[:,k])
+            self.row_blocks.map(0,lambda rows,rng: self.update_F(k,rows))
+            self.profiler.tick('F')
+            self.row_blocks.map(0,lambda rows,rng: self.update_exp_F(k,rows))
+            self.scheduler.record('F',k,old,self.exp_F[:,k])
+            self.profiler.tick('TN moments')
+            
+        # Update S
+        for k,l in itertools.product(range(self.K),range(self.L)):
+            if not self.scheduler.active('S',(k,l)):
+                continue
+            old = self.exp_S[k,l]
+            self.update_S(k,l)
+            self.profiler.tick('S')
+            self.update_exp_S(k,l)
+            self.scheduler.record('S',(k,l),old,self.exp_S[k,l])
+            self.profiler.tick('TN moments')
+            
+        # Update G
+        for l in range(0,self.L):
+            if not self.scheduler.active('G',l):
+                continue
+            old = numpy.copy(self.exp_G[:,l])
+            self.row_blocks.map(1,lambda columns,rng: self.update_G(l,columns))
+            self.profiler.tick('G')
+            self.row_blocks.map(1,lambda columns,rng: self.update_exp_G(l,columns))
+            self.scheduler.record('G',l,old,self.exp_G[:,l])
+            self.profiler.tick('TN moments')
+        
+        # Update tau
+        self.update_tau()
+        self.update_exp_tau()
+        self.profiler.tick('tau')
+        
+    def update_expectations(self):
+        ''' Recompute all expectations from the parameters of q, after they were set by the accelerator. '''
+        self.prediction_cache = {}
+        for k in range(self.K):
+            if self.ARD:
+                self.update_exp_lambdaFk(k)
+            self.update_exp_F(k)
+        for k,l in itertools.product(range(self.K),range(self.L)):
+            self.update_exp_S(k,l)
+        for l in range(self.L):
+            if self.ARD:
+                self.update_exp_lambdaGl(l)
+            self.update_exp_G(l)
+        self.update_exp_tau()
+        
+    def hyperparameter_names(self,learned):
+        ''' Return the names of the hyperparameters learned for learned ('lambda', 'tau'). '''
+        names = []
+        if 'lambda' in learned:
+            names += ['lambdaS'] if self.ARD else ['lambdaF','lambdaS','lambdaG']
+        if 'tau' in learned:
+            names += ['betatau']
+        return names
+        
+    def update_hyperparameters(self,learned):
+        ''' Set the hyperparameters in learned ('lambda', 'tau') to the values maximising the ELBO (see empirical_bayes.py), and store them. '''
+        if 'lambda' in learned:
+            self.lambdaS = prior_matrix(exponential_rate(self.exp_S),(self.K,self.L),'lambdaS')
+            if not self.ARD:
+                self.lambdaF = prior_matrix(exponential_rate(self.exp_F),(self.I,self.K),'lambdaF')
+                self.lambdaG = prior_matrix(exponential_rate(self.exp_G),(self.J,self.L),'lambdaG')
+        if 'tau' in learned:
+            self.betatau = gamma_rate(self.alphatau,self.exp_tau)
+        self.compute_elbo_constants()
+        for name in self.all_hyperparameters:
+            self.all_hyperparameters[name].append(float(numpy.mean(getattr(self,name))))
             
 
+    def prune_components(self,iteration):
+        ''' Remove the components of F and G whose magnitude has stayed below the threshold (see pruning.py). '''
+        positions_F = self.pruner_F.check(component_magnitudes(self.exp_F,numpy.dot(self.exp_G,self.exp_S.T)),iteration)
+        positions_G = self.pruner_G.check(component_magnitudes(self.exp_G,numpy.dot(self.exp_F,self.exp_S)),iteration)
+        if positions_F:
+            remove_components(self,ROW_COMPONENT_ARRAYS,positions_F)
+        if positions_G:
+            remove_components(self,COLUMN_COMPONENT_ARRAYS,positions_G)
+        if positions_F or positions_G:
+            self.K, self.L = len(self.pruner_F.active), len(self.pruner_G.active)
+            self.prediction_cache = {}
+            self.compute_elbo_constants() # lambdaS has changed
+            self.reset_elbo_cache()
+            
+    def grow_components(self,iteration):
+        ''' Add a component to F and G seeded from the residual while all of them are in use, or remove the new one if it has been switched off (see growth.py). '''
+        error = self.all_performances['MSE'][-1] if self.all_performances['MSE'] else None
+        (remove_F,add_F) = self.pruner_F.check(component_magnitudes(self.exp_F,numpy.dot(self.exp_G,self.exp_S.T)),iteration,error)
+        (remove_G,add_G) = self.pruner_G.check(component_magnitudes(self.exp_G,numpy.dot(self.exp_F,self.exp_S)),iteration,error)
+        if remove_F is not None:
+            remove_components(self,ROW_COMPONENT_ARRAYS,[remove_F])
+            self.K -= 1
+        if remove_G is not None:
+            remove_components(self,COLUMN_COMPONENT_ARRAYS,[remove_G])
+            self.L -= 1
+        if add_F or add_G:
+            u, v = residual_component(self.R,self.M,numpy.dot(self.exp_F,numpy.dot(self.exp_S,self.exp_G.T)))
+        if add_F:
+            # New column u of F, with the row of S that best maps G onto v (or 0, if G gets the new column v)
+            s = numpy.zeros(self.L) if add_G else nonnegative_coefficients(self.exp_G,v)
+            append_components(self,ROW_COMPONENT_ARRAYS,{ 'alphaFk_s':self.alpha0, 'betaFk_s':self.beta0, 'mu_F':u, 'tau_F':1.,
+                                                           'mu_S':s, 'tau_S':1., 'lambdaS':self.lambdaS.mean() })
+            self.K += 1
+            self.update_exp_lambdaFk(self.K-1)
+            self.update_exp_F(self.K-1)
+            for l in range(self.L):
+                self.update_exp_S(self.K-1,l)
+        if add_G:
+            # New column v of G, with the column of S that best maps F onto u (or 1 for the new column u of F)
+            s = numpy.eye(self.K)[-1] if add_F else nonnegative_coefficients(self.exp_F,u)
+            append_components(self,COLUMN_COMPONENT_ARRAYS,{ 'alphaGl_s':self.alpha0, 'betaGl_s':self.beta0, 'mu_G':v, 'tau_G':1.,
+                                                              'mu_S':s, 'tau_S':1., 'lambdaS':self.lambdaS.mean() })
+            self.L += 1
+            self.update_exp_lambdaGl(self.L-1)
+            self.update_exp_G(self.L-1)
+            for k in range(self.K):
+                self.update_exp_S(k,self.L-1)
+        if remove_F is not None or remove_G is not None or add_F or add_G:
+            self.prediction_cache = {}
+            self.compute_elbo_constants() # lambdaS has changed
+            self.reset_elbo_cache()
+        
+        
     def elbo(self):
-        ''' Compute the ELBO. '''
+        ''' Compute the ELBO. Constant prior terms are precomputed, the entropy of each column of the factor matrices
+            is cached until that column changes, and the expected square error is reused from the tau update. '''
         total_elbo = 0.
         
         # Log likelihood               
-        total_elbo += self.size_Omega / 2. * ( self.exp_logtau - math.log(2*math.pi) ) \
-                      - self.exp_tau / 2. * self.exp_square_diff()
+        square_diff = self.square_diff if self.square_diff is not None else self.exp_square_diff()
+        total_elbo += self.size_Omega / 2. * ( self.exp_logtau - self.elbo_constants['log_2pi'] ) \
+                      - self.exp_tau / 2. * square_diff
                       
         # Prior lambdaFk and lambdaGl, if using ARD, and prior F,G
         if self.ARD:
-            total_elbo += self.alpha0 * math.log(self.beta0) - scipy.special.gammaln(self.alpha0) \
+            total_elbo += self.elbo_constants['prior_lambda'] \
                           + (self.alpha0 - 1.)*self.exp_loglambdaFk.sum() - self.beta0 * self.exp_lambdaFk.sum()
-            total_elbo += self.alpha0 * math.log(self.beta0) - scipy.special.gammaln(self.alpha0) \
+            total_elbo += self.elbo_constants['prior_lambda'] \
                           + (self.alpha0 - 1.)*self.exp_loglambdaGl.sum() - self.beta0 * self.exp_lambdaGl.sum()
             
             total_elbo += self.I * numpy.log(self.exp_lambdaFk).sum() - ( self.exp_lambdaFk * self.exp_F ).sum()
             total_elbo += self.J * numpy.log(self.exp_lambdaGl).sum() - ( self.exp_lambdaGl * self.exp_G ).sum()
             
         else:
-            total_elbo += numpy.log(self.lambdaF).sum() - ( self.lambdaF * self.exp_F ).sum()
-            total_elbo += numpy.log(self.lambdaG).sum() - ( self.lambdaG * self.exp_G ).sum()
+            total_elbo += self.elbo_constants['prior_F'] - ( self.lambdaF * self.exp_F ).sum()
+            total_elbo += self.elbo_constants['prior_G'] - ( self.lambdaG * self.exp_G ).sum()
         
         # Prior S
-        total_elbo += numpy.log(self.lambdaS).sum() - ( self.lambdaS * self.exp_S ).sum()
+        total_elbo += self.elbo_constants['prior_S'] - ( self.lambdaS * self.exp_S ).sum()
         
         # Prior tau
-        total_elbo += self.alphatau * math.log(self.betatau) - scipy.special.gammaln(self.alphatau) \
+        total_elbo += self.elbo_constants['prior_tau'] \
                       + (self.alphatau - 1.)*self.exp_logtau - self.betatau * self.exp_tau
         
         # q for lambdaFk and lambdaGl, if using ARD
         if self.ARD:
-            total_elbo += - sum([v1*math.log(v2) for v1,v2 in zip(self.alphaFk_s,self.betaFk_s)]) + sum([scipy.special.gammaln(v) for v in self.alphaFk_s]) \
+            total_elbo += - (self.alphaFk_s*numpy.log(self.betaFk_s)).sum() + scipy.special.gammaln(self.alphaFk_s).sum() \
                           - ((self.alphaFk_s - 1.)*self.exp_loglambdaFk).sum() + (self.betaFk_s * self.exp_lambdaFk).sum()
-            total_elbo += - sum([v1*math.log(v2) for v1,v2 in zip(self.alphaGl_s,self.betaGl_s)]) + sum([scipy.special.gammaln(v) for v in self.alphaGl_s]) \
+            total_elbo += - (self.alphaGl_s*numpy.log(self.betaGl_s)).sum() + scipy.special.gammaln(self.alphaGl_s).sum() \
                           - ((self.alphaGl_s - 1.)*self.exp_loglambdaGl).sum() + (self.betaGl_s * self.exp_lambdaGl).sum()
             
         # q for F, G, S
-        total_elbo += - .5*numpy.log(self.tau_F).sum() + self.I*self.K/2.*math.log(2*math.pi) \
-                      + numpy.log(0.5*scipy.special.erfc(-self.mu_F*numpy.sqrt(self.tau_F)/math.sqrt(2))).sum() \
-                      + ( self.tau_F / 2. * ( self.var_F + (self.exp_F - self.mu_F)**2 ) ).sum()
-        total_elbo += - .5*numpy.log(self.tau_G).sum() + self.J*self.L/2.*math.log(2*math.pi) \
-                      + numpy.log(0.5*scipy.special.erfc(-self.mu_G*numpy.sqrt(self.tau_G)/math.sqrt(2))).sum() \
-                      + ( self.tau_G / 2. * ( self.var_G + (self.exp_G - self.mu_G)**2 ) ).sum()
-        total_elbo += - .5*numpy.log(self.tau_S).sum() + self.K*self.L/2.*math.log(2*math.pi) \
-                      + numpy.log(0.5*scipy.special.erfc(-self.mu_S*numpy.sqrt(self.tau_S)/math.sqrt(2))).sum() \
-                      + ( self.tau_S / 2. * ( self.var_S + (self.exp_S - self.mu_S)**2 ) ).sum()
+        self.update_entropies()
+        total_elbo += self.entropy_F.sum() + self.entropy_G.sum() \
+                      + self.entropy_columns(self.mu_S,self.tau_S,self.exp_S,self.var_S).sum()
         
         # q for tau
         total_elbo += - self.alpha_s * math.log(self.beta_s) + scipy.special.gammaln(self.alpha_s) \
@@ -298,6 +504,42 @@ class bnmtf_vb:
         
         return total_elbo        
         
+    def compute_elbo_constants(self):
+        ''' Precompute the terms of the ELBO that only depend on the hyperparameters. '''
+        self.elbo_constants = {
+            'log_2pi' : math.log(2*math.pi),
+            'prior_tau' : self.alphatau * math.log(self.betatau) - scipy.special.gammaln(self.alphatau),
+            'prior_S' : numpy.log(self.lambdaS).sum(),
+        }
+        if self.ARD:
+            self.elbo_constants['prior_lambda'] = self.alpha0 * math.log(self.beta0) - scipy.special.gammaln(self.alpha0)
+        else:
+            self.elbo_constants['prior_F'] = numpy.log(self.lambdaF).sum()
+            self.elbo_constants['prior_G'] = numpy.log(self.lambdaG).sum()
+            
+    def reset_elbo_cache(self):
+        ''' Mark the entropies of all columns of q(F) and q(G), and the expected square error, as out of date. '''
+        self.entropy_F, self.entropy_G = numpy.zeros(self.K), numpy.zeros(self.L)
+        self.stale_F, self.stale_G = set(range(self.K)), set(range(self.L))
+        self.square_diff = None
+        
+    def update_entropies(self):
+        ''' Recompute the entropies of the columns of q(F) and q(G) that changed since the last ELBO. '''
+        if self.stale_F:
+            ks = sorted(self.stale_F)
+            self.entropy_F[ks] = self.entropy_columns(self.mu_F[:,ks],self.tau_F[:,ks],self.exp_F[:,ks],self.var_F[:,ks])
+            self.stale_F = set()
+        if self.stale_G:
+            ls = sorted(self.stale_G)
+            self.entropy_G[ls] = self.entropy_columns(self.mu_G[:,ls],self.tau_G[:,ls],self.exp_G[:,ls],self.var_G[:,ls])
+            self.stale_G = set()
+        
+    def entropy_columns(self,mu,tau,exp,var):
+        ''' Return the entropy of each column of a truncated normal q with parameters mu, tau, and moments exp, var. '''
+        return ( - .5*numpy.log(tau) + .5*self.elbo_constants['log_2pi'] \
+                 + numpy.log(0.5*scipy.special.erfc(-mu*numpy.sqrt(tau)/math.sqrt(2))) \
+                 + tau / 2. * ( var + (exp - mu)**2 ) ).sum(axis=0)
+        
         
     def triple_dot(self,M1,M2,M3):
         ''' Triple matrix multiplication: M1*M2*M3. 
@@ -314,7 +556,8 @@ class bnmtf_vb:
     def update_tau(self):   
         ''' Parameter updates tau. '''
         self.alpha_s = self.alphatau + self.size_Omega/2.0
-        self.beta_s = self.betatau + 0.5*self.exp_square_diff()
+        self.square_diff = self.exp_square_diff()
+        self.beta_s = self.betatau + 0.5*self.square_diff
         
     def exp_square_diff(self): 
         ''' Compute: sum_Omega E_q(F,S,G) [ ( Rij - Fi S Gj )^2 ]. '''
@@ -333,15 +576,15 @@ class bnmtf_vb:
         self.alphaGl_s[l] = self.alpha0 + self.J
         self.betaGl_s[l] = self.beta0 + self.exp_G[:,l].sum()
         
-    def update_F(self,k):  
-        ''' Parameter updates F. ''' 
+    def update_F(self,k,rows=slice(None)):  
+        ''' Parameter updates F, for the given rows. ''' 
         var_SkG = numpy.dot( self.var_S[k]+self.exp_S[k]**2 , (self.var_G+self.exp_G**2).T ) - numpy.dot( self.exp_S[k]**2 , (self.exp_G**2).T ) # Vector of size J
-        self.tau_F[:,k] = self.exp_tau * numpy.dot( var_SkG + ( numpy.dot(self.exp_S[k],self.exp_G.T) )**2 , self.M.T ) 
+        self.tau_F[rows,k] = self.exp_tau * numpy.dot( var_SkG + ( numpy.dot(self.exp_S[k],self.exp_G.T) )**2 , self.M[rows].T ) 
         
-        lamb = self.exp_lambdaFk[k] if self.ARD else self.lambdaF[:,k]
-        diff_term = (self.M * ( (self.R-self.triple_dot(self.exp_F,self.exp_S,self.exp_G.T)+numpy.outer(self.exp_F[:,k],numpy.dot(self.exp_S[k],self.exp_G.T)) ) * numpy.dot(self.exp_S[k],self.exp_G.T) )).sum(axis=1)        
-        cov_term = ( self.M * ( ( numpy.dot(self.exp_S[k]*numpy.dot(self.exp_F,self.exp_S), self.var_G.T) - numpy.outer(self.exp_F[:,k], numpy.dot( self.exp_S[k]**2, self.var_G.T )) ) ) ).sum(axis=1)
-        self.mu_F[:,k] = 1./self.tau_F[:,k] * (
+        lamb = self.exp_lambdaFk[k] if self.ARD else self.lambdaF[rows,k]
+        diff_term = masked_residual_products(self.R[rows],self.M[rows],self.exp_F[rows],numpy.dot(self.exp_G,self.exp_S.T),k)
+        cov_term = ( self.M[rows] * ( ( numpy.dot(self.exp_S[k]*numpy.dot(self.exp_F[rows],self.exp_S), self.var_G.T) - numpy.outer(self.exp_F[rows,k], numpy.dot( self.exp_S[k]**2, self.var_G.T )) ) ) ).sum(axis=1)
+        self.mu_F[rows,k] = 1./self.tau_F[rows,k] * (
             - lamb
             + self.exp_tau * diff_term
             - self.exp_tau * cov_term
@@ -361,14 +604,15 @@ class bnmtf_vb:
             - self.exp_tau * cov_term_F
         ) 
         
-    def update_G(self,l):  
+    def update_G(self,l,columns=slice(None)):  
+        ''' Parameter updates G, for the given columns. '''
         var_FSl = numpy.dot( self.var_F+self.exp_F**2 , self.var_S[:,l]+self.exp_S[:,l]**2 ) - numpy.dot( self.exp_F**2 , self.exp_S[:,l]**2 ) # Vector of size I
-        self.tau_G[:,l] = self.exp_tau * numpy.dot( ( var_FSl + ( numpy.dot(self.exp_F,self.exp_S[:,l]) )**2 ).T, self.M) #sum over i, so columns        
+        self.tau_G[columns,l] = self.exp_tau * numpy.dot( ( var_FSl + ( numpy.dot(self.exp_F,self.exp_S[:,l]) )**2 ).T, self.M[:,columns]) #sum over i, so columns        
         
-        lamb = self.exp_lambdaGl[l] if self.ARD else self.lambdaG[:,l]
-        diff_term = (self.M * ( (self.R-self.triple_dot(self.exp_F,self.exp_S,self.exp_G.T)+numpy.outer(numpy.dot(self.exp_F,self.exp_S[:,l]), self.exp_G[:,l]) ).T * numpy.dot(self.exp_F,self.exp_S[:,l]) ).T ).sum(axis=0)
-        cov_term = (self.M * ( numpy.dot(self.var_F, (self.exp_S[:,l]*numpy.dot(self.exp_S,self.exp_G.T).T).T) - numpy.outer(numpy.dot(self.var_F,self.exp_S[:,l]**2), self.exp_G[:,l]) )).sum(axis=0)
-        self.mu_G[:,l] = 1./self.tau_G[:,l] * (
+        lamb = self.exp_lambdaGl[l] if self.ARD else self.lambdaG[columns,l]
+        diff_term = masked_residual_products(self.R[:,columns].T,self.M[:,columns].T,self.exp_G[columns],numpy.dot(self.exp_F,self.exp_S),l)
+        cov_term = (self.M[:,columns] * ( numpy.dot(self.var_F, (self.exp_S[:,l]*numpy.dot(self.exp_S,self.exp_G[columns].T).T).T) - numpy.outer(numpy.dot(self.var_F,self.exp_S[:,l]**2), self.exp_G[columns,l]) )).sum(axis=0)
+        self.mu_G[columns,l] = 1./self.tau_G[columns,l] * (
             - lamb
             + self.exp_tau * diff_term
             - self.exp_tau * cov_term
@@ -391,51 +635,165 @@ class bnmtf_vb:
         self.exp_lambdaGl[l] = gamma_expectation(self.alphaGl_s[l],self.betaGl_s[l])
         self.exp_loglambdaGl[l] = gamma_expectation_log(self.alphaGl_s[l],self.betaGl_s[l])
         
-    def update_exp_F(self,k):
-        ''' Update expectation F. '''
-        self.exp_F[:,k] = TN_vector_expectation(self.mu_F[:,k],self.tau_F[:,k])
-        self.var_F[:,k] = TN_vector_variance(self.mu_F[:,k],self.tau_F[:,k])
+    def update_exp_F(self,k,rows=slice(None)):
+        ''' Update expectation F, for the given rows. '''
+        self.exp_F[rows,k] = TN_vector_expectation(self.mu_F[rows,k],self.tau_F[rows,k])
+        self.var_F[rows,k] = TN_vector_variance(self.mu_F[rows,k],self.tau_F[rows,k])
+        self.stale_F.add(k)
+        self.square_diff = None
         
     def update_exp_S(self,k,l):
         ''' Update expectation S. '''
         self.exp_S[k,l] = TN_expectation(self.mu_S[k,l],self.tau_S[k,l])
         self.var_S[k,l] = TN_variance(self.mu_S[k,l],self.tau_S[k,l])
-        
-    def update_exp_G(self,l):
-        ''' Update expectation G. '''
-        self.exp_G[:,l] = TN_vector_expectation(self.mu_G[:,l],self.tau_G[:,l])
-        self.var_G[:,l] = TN_vector_variance(self.mu_G[:,l],self.tau_G[:,l])
+        self.square_diff = None
+        
+    def update_exp_G(self,l,columns=slice(None)):
+        ''' Update expectation G, for the given columns. '''
+        self.exp_G[columns,l] = TN_vector_expectation(self.mu_G[columns,l],self.tau_G[columns,l])
+        self.var_G[columns,l] = TN_vector_variance(self.mu_G[columns,l],self.tau_G[columns,l])
+        self.stale_G.add(l)
+        self.square_diff = None
+
+
+    ''' Fold in new rows or columns, keeping the trained factors fixed. '''
+    def fold_in_rows(self,R_new,M_new,iterations):
+        ''' Infer q(F) for new rows (I_new x J), keeping q(S), q(G), q(tau) and q(lambdaFk) fixed. Returns E[F]. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=0)
+        lamb = self.exp_lambdaFk if self.ARD else self.lambdaF.mean(axis=0)
+        return self.fold_in(R,M,self.exp_S,self.var_S,self.exp_G,self.var_G,lamb,iterations)
+
+    def fold_in_columns(self,R_new,M_new,iterations):
+        ''' Infer q(G) for new columns (I x J_new), keeping q(F), q(S), q(tau) and q(lambdaGl) fixed. Returns E[G]. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=1)
+        lamb = self.exp_lambdaGl if self.ARD else self.lambdaG.mean(axis=0)
+        return self.fold_in(R,M,self.exp_S.T,self.var_S.T,self.exp_F,self.var_F,lamb,iterations)
+
+    def fold_in(self,R,M,exp_S,var_S,exp_B,var_B,lamb,iterations):
+        ''' Run the updates for q(A) in R ~ A S B.T (or its transpose), initialised to the prior expectation. '''
+        lamb = numpy.tile(lamb,(R.shape[0],1))
+        mu_A, tau_A = 1./lamb, numpy.ones(lamb.shape)
+        exp_A, var_A = numpy.zeros(lamb.shape), numpy.zeros(lamb.shape)
+        for k in range(lamb.shape[1]):
+            exp_A[:,k] = TN_vector_expectation(mu_A[:,k],tau_A[:,k])
+            var_A[:,k] = TN_vector_variance(mu_A[:,k],tau_A[:,k])
+        for it in range(iterations):
+            self.update_rows(R,M,mu_A,tau_A,exp_A,var_A,exp_S,var_S,exp_B,var_B,lamb)
+        return exp_A
+
+    def update_rows(self,R,M,mu_A,tau_A,exp_A,var_A,exp_S,var_S,exp_B,var_B,lamb):
+        ''' Update q(A) column by column in R ~ A S B.T, for all rows at once. lamb is the prior for A. '''
+        SB = numpy.dot(exp_S,exp_B.T)
+        for k in range(exp_A.shape[1]):
+            var_SkB = numpy.dot( var_S[k]+exp_S[k]**2 , (var_B+exp_B**2).T ) - numpy.dot( exp_S[k]**2 , (exp_B**2).T )
+            tau_A[:,k] = self.exp_tau * numpy.dot( var_SkB + SB[k]**2 , M.T )
+            diff_term = (M * ( (R-numpy.dot(exp_A,SB)+numpy.outer(exp_A[:,k],SB[k]) ) * SB[k] )).sum(axis=1)
+            cov_term = ( M * ( numpy.dot(exp_S[k]*numpy.dot(exp_A,exp_S), var_B.T) - numpy.outer(exp_A[:,k], numpy.dot( exp_S[k]**2, var_B.T )) ) ).sum(axis=1)
+            mu_A[:,k] = 1./tau_A[:,k] * ( - lamb[:,k] + self.exp_tau * diff_term - self.exp_tau * cov_term )
+            exp_A[:,k] = TN_vector_expectation(mu_A[:,k],tau_A[:,k])
+            var_A[:,k] = TN_vector_variance(mu_A[:,k],tau_A[:,k])
 
 
-    def predict(self,M_pred):
+    ''' Add new observations to R, and continue from the current state. '''
+    def update_data(self,new_entries):
+        ''' Add a list of new observations (i,j,Rij) to R and M, and store which rows and columns they touch. '''
+        for (i,j,value) in new_entries:
+            assert 0 <= i < self.I and 0 <= j < self.J, "New entry (%s,%s) lies outside of R, which has shape %s." % (i,j,self.R.shape)
+        self.data = self.data.with_entries(new_entries)
+        (self.R, self.M) = (self.data.R, self.data.M)
+        self.size_Omega = self.data.size_Omega
+        self.square_diff = None
+        if hasattr(self,'exp_tau'):
+            # q(tau) depends on the observed entries, so keep it consistent with the new data
+            self.update_tau()
+            self.update_exp_tau()
+        self.touched_rows = sorted(set(self.touched_rows) | set([i for (i,_,_) in new_entries]))
+        self.touched_columns = sorted(set(self.touched_columns) | set([j for (_,j,_) in new_entries]))
+        self.evaluator.clear() # R and M have changed
+
+    def refine(self,iterations,local_sweeps=0):
+        ''' Continue the updates from the current state, after first doing local_sweeps over only the touched rows and columns. '''
+        for sweep in range(local_sweeps):
+            self.sweep_touched()
+        self.touched_rows, self.touched_columns = [], []
+        self.run(iterations)
+
+    def sweep_touched(self):
+        ''' Update q(F) for the touched rows and q(G) for the touched columns, and then q(tau). '''
+        rows, columns = self.touched_rows, self.touched_columns
+        if rows:
+            mu, tau, exp, var = self.mu_F[rows], self.tau_F[rows], self.exp_F[rows], self.var_F[rows]
+            lamb = numpy.tile(self.exp_lambdaFk,(len(rows),1)) if self.ARD else self.lambdaF[rows]
+            self.update_rows(self.R[rows],self.M[rows],mu,tau,exp,var,self.exp_S,self.var_S,self.exp_G,self.var_G,lamb)
+            self.mu_F[rows], self.tau_F[rows], self.exp_F[rows], self.var_F[rows] = mu, tau, exp, var
+        if columns:
+            mu, tau, exp, var = self.mu_G[columns], self.tau_G[columns], self.exp_G[columns], self.var_G[columns]
+            lamb = numpy.tile(self.exp_lambdaGl,(len(columns),1)) if self.ARD else self.lambdaG[columns]
+            self.update_rows(self.R[:,columns].T,self.M[:,columns].T,mu,tau,exp,var,self.exp_S.T,self.var_S.T,self.exp_F,self.var_F,lamb)
+            self.mu_G[columns], self.tau_G[columns], self.exp_G[columns], self.var_G[columns] = mu, tau, exp, var
+        self.reset_elbo_cache()
+        self.update_tau()
+        self.update_exp_tau()
+
+
+    def predict(self,M_pred,metrics=ALL_METRICS):
         ''' Predict missing values in R. '''
-        R_pred = self.triple_dot(self.exp_F,self.exp_S,self.exp_G.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
-        return {'MSE':MSE,'R^2':R2,'Rp':Rp}
-        
-        
+        return self.evaluator.evaluate(M_pred,self.R,self.predict_entries,metrics)
+        
+        
+    ''' Predict individual entries or rows, without computing the full matrix. '''
+    def predict_entries(self,rows,cols,variance=False):
+        ''' Return E_q[Fi S Gj] for the entries (rows[n],cols[n]), and also Var_q[Fi S Gj] if variance is True. '''
+        rows, cols = numpy.array(rows,dtype=int), numpy.array(cols,dtype=int)
+        exp_R = (self.exp_F[rows] * self.cached_GS()[cols]).sum(axis=1)
+        if not variance:
+            return exp_R
+        exp_F, var_F, exp_G, var_G = self.exp_F[rows], self.var_F[rows], self.exp_G[cols], self.var_G[cols]
+        var_R = ( numpy.dot(var_F+exp_F**2, self.var_S+self.exp_S**2) * (var_G+exp_G**2) ).sum(axis=1) \
+              - ( numpy.dot(exp_F**2, self.exp_S**2) * exp_G**2 ).sum(axis=1) \
+              + ( var_F * ( numpy.dot(exp_G,self.exp_S.T)**2 - numpy.dot(exp_G**2,(self.exp_S**2).T) ) ).sum(axis=1) \
+              + ( ( numpy.dot(exp_F,self.exp_S)**2 - numpy.dot(exp_F**2,self.exp_S**2) ) * var_G ).sum(axis=1)
+        return exp_R, var_R
+
+    def predict_rows(self,rows,variance=False):
+        ''' Return E_q[Fi S Gj] for all columns of the given rows, and also Var_q[Fi S Gj] if variance is True. '''
+        rows = numpy.array(rows,dtype=int)
+        exp_R = numpy.dot(self.exp_F[rows],self.cached_GS().T)
+        if not variance:
+            return exp_R
+        exp_F, var_F = self.exp_F[rows], self.var_F[rows]
+        var_R = numpy.dot( numpy.dot(var_F+exp_F**2, self.var_S+self.exp_S**2), (self.var_G+self.exp_G**2).T ) \
+              - numpy.dot( numpy.dot(exp_F**2, self.exp_S**2), (self.exp_G**2).T ) \
+              + numpy.dot( var_F, numpy.dot(self.exp_S,self.exp_G.T)**2 - numpy.dot(self.exp_S**2,(self.exp_G**2).T) ) \
+              + numpy.dot( numpy.dot(exp_F,self.exp_S)**2 - numpy.dot(exp_F**2,self.exp_S**2), self.var_G.T )
+        return exp_R, var_R
+
+    def cached_GS(self):
+        ''' Return E[G] E[S].T, cached until the factors are updated again. '''
+        if 'GS' not in self.prediction_cache:
+            self.prediction_cache['GS'] = numpy.dot(self.exp_G,self.exp_S.T)
+        return self.prediction_cache['GS']
+
+    def predictive(self,rows,cols,credible=None):
+        ''' Return the posterior predictive 'mean' and 'variance' (including the noise E[1/tau]) of the entries (rows[n],cols[n]),
+            and the 'lower' and 'upper' bounds of the credible interval if credible (e.g. 0.95) is given. 
+            For a mask M_pred, use rows, cols = numpy.nonzero(M_pred). '''
+        (exp_R,var_R) = self.predict_entries(rows,cols,variance=True)
+        return predictive_summary(exp_R,var_R+noise_variance(self.alpha_s,self.beta_s),credible)
+
+
     ''' Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation) '''
     def compute_MSE(self,M,R,R_pred):
         ''' Return the MSE of predictions in R_pred, expected values in R, for the entries in M. '''
-        return (M * (R-R_pred)**2).sum() / float(M.sum())
+        return compute_MSE(M,R,R_pred)
         
     def compute_R2(self,M,R,R_pred):
         ''' Return the R^2 of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean = (M*R).sum() / float(M.sum())
-        SS_total = float((M*(R-mean)**2).sum())
-        SS_res = float((M*(R-R_pred)**2).sum())
-        return 1. - SS_res / SS_total if SS_total != 0. else numpy.inf
+        return compute_R2(M,R,R_pred)
         
     def compute_Rp(self,M,R,R_pred):
         ''' Return the Rp of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean_real = (M*R).sum() / float(M.sum())
-        mean_pred = (M*R_pred).sum() / float(M.sum())
-        covariance = (M*(R-mean_real)*(R_pred-mean_pred)).sum()
-        variance_real = (M*(R-mean_real)**2).sum()
-        variance_pred = (M*(R_pred-mean_pred)**2).sum()
-        return covariance / float(math.sqrt(variance_real)*math.sqrt(variance_pred))
+        return compute_Rp(M,R,R_pred)
         
         
     def quality(self,metric):
@@ -463,4 +821,19 @@ class bnmtf_vb:
              
     def number_parameters(self):
         ''' Return the number of free variables in the model. '''
-        return (self.I*self.K + self.K*self.L + self.J*self.L + 1) + (self.K+self.L if self.ARD else 0)
\ No newline at end of file
+        return (self.I*self.K + self.K*self.L + self.J*self.L + 1) + (self.K+self.L if self.ARD else 0)
+        
+        
+    ''' Save and load the model. '''
+    def save(self,path,traces=True):
+        ''' Store the model in the directory path. '''
+        save_model(self,path,SAVE_DIMENSIONS,SAVE_HYPERPARAMETERS,SAVE_STATE,SAVE_TRACES if traces else [])
+
+    @classmethod
+    def load(cls,path,mmap_traces=True):
+        ''' Load a model stored using save(path). The traces are memory-mapped, unless mmap_traces is False. '''
+        metadata, values = load_model(path,cls.__name__,mmap_traces)
+        dimensions = metadata['dimensions']
+        model = cls(values['data']['R'],values['data']['M'],dimensions['K'],dimensions['L'],dimensions['ARD'],values['hyperparameters'])
+        restore_model(model,values)
+        return model
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""
+Wall-clock budgets for the run() loops of the models ("anytime" training).
+
+The cost of an iteration varies a lot with K, L, and the dataset, so instead of
+(or as well as) a number of iterations, run() and train() accept a
+time_budget in seconds. At the end of each iteration the loop asks
+budget.exhausted(), which is True when the time used so far plus the duration
+of the iteration that just finished would exceed the budget, i.e. when another
+iteration of the same length would not fit. Iterations are never interrupted,
+so the models always stop in a consistent state: the Gibbs traces hold only
+completed iterations, and VB, ICM, and NP stop at their last full sweep. The
+first iteration always runs, so a very small budget can be exceeded once.
+
+With a time budget the number of iterations can be None, to run until the
+budget has been used. The models with trace arrays (Gibbs and ICM) then
+allocate them for INITIAL_TRACE_LENGTH iterations, and double their length
+whenever they are full (extend_traces), truncating them after running.
+
+After running, model.budget is a dictionary
+    { 'iterations', 'time_budget', 'time_used', 'exhausted' }
+with the number of completed iterations, the budget (None if not given), the
+seconds used, and whether the run stopped because of the budget.
+"""
+
+from timeit import default_timer
+
+import numpy, itertools
+
+INITIAL_TRACE_LENGTH = 100
+
+
+class TimeBudget:
+    def __init__(self,time_budget,iterations):
+        ''' Start the clock for a run of at most iterations iterations (or None) and time_budget seconds (or None). '''
+        assert iterations is not None or time_budget is not None, "Please give the number of iterations, a time budget, or both."
+        assert time_budget is None or time_budget > 0, "Time budget should be positive, not %s." % time_budget
+        assert iterations is None or iterations >= 0, "Number of iterations should be non-negative, not %s." % iterations
+        self.time_budget, self.iterations = time_budget, iterations
+        self.stopped = False
+        self.time_start = self.time_last = default_timer()
+
+    def range(self,start=0):
+        ''' Return the iteration numbers, starting at start: iterations of them, or unbounded if iterations is None. '''
+        return itertools.count(start) if self.iterations is None else xrange(start,start+self.iterations)
+
+    def exhausted(self):
+        ''' Return True if another iteration, as long as the one that just finished, would exceed the budget.
+            Call this once at the end of each iteration. '''
+        now = default_timer()
+        duration, self.time_last = now - self.time_last, now
+        self.stopped = self.time_budget is not None and (now - self.time_start) + duration > self.time_budget
+        return self.stopped
+
+    def summary(self,iterations):
+        ''' Return { 'iterations', 'time_budget', 'time_used', 'exhausted' } for a run that completed iterations iterations. '''
+        return { 'iterations':iterations, 'time_budget':self.time_budget, 'time_used':default_timer() - self.time_start, 'exhausted':self.stopped }
+
+    def report(self,iterations):
+        ''' Print the number of completed iterations and the time used, if there was a time budget. '''
+        if self.time_budget is not None:
+            print "Stopped after %s iterations, using %.2f of the %.2f seconds budget." % (iterations,default_timer() - self.time_start,self.time_budget)
+
+
+def trace_length(iterations):
+    ''' Return the number of iterations to allocate the traces for: iterations, or INITIAL_TRACE_LENGTH if it is None. '''
+    return INITIAL_TRACE_LENGTH if iterations is None else iterations
+
+def extend_traces(model,names,iteration):
+    ''' Double the length of the trace arrays of model with the given names (if they are set) when iteration does not fit. '''
+    for name in names:
+        trace = getattr(model,name,None)
+        if trace is not None and iteration >= len(trace):
+            setattr(model,name,numpy.concatenate([trace,numpy.zeros(trace.shape)]))
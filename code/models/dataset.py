@@ -0,0 +1,85 @@
+"""
+A dataset shared by several models: the matrix R and mask M, stored once as
+read-only float arrays, with the number of observed entries in each row and
+column.
+
+The models used to copy R and M in their constructor, so during
+cross-validation and the experiments R was copied for every fold, parameter
+setting, and repeat. They now build a Dataset from their arguments (R,M) with
+shared_dataset(R,M), which accepts:
+- R and M as arrays, as before. Arrays that are already read-only float arrays
+  (see read_only) are not copied, so passing data.R shares it.
+- a Dataset and M = None, sharing both R and M.
+- a Dataset and a new mask M (e.g. a training fold), sharing R and only
+  storing the new mask.
+For example:
+    data = Dataset(R,M)
+    BNMF = bnmf_gibbs(data,None,K,ARD,hyperparameters)
+    BNMF = bnmf_gibbs(data,M_train,K,ARD,hyperparameters)
+The models keep R and M as attributes (model.R is model.data.R). Since these
+are read-only, update_data() replaces the model's Dataset by a private copy
+with the new observations, with_entries(new_entries), leaving the shared
+arrays untouched.
+
+Scalar prior rates (lambdaU, lambdaV, or lambdaF, lambdaS, lambdaG) stay
+scalars: prior_matrix() returns a read-only broadcast of the scalar to the
+full shape, which indexes like the full matrix without storing it.
+"""
+
+import numpy
+
+
+def read_only(array):
+    ''' Return array as a read-only float array, without copying it if it already is one. '''
+    if isinstance(array,numpy.ndarray) and array.dtype == float and not array.flags.writeable:
+        return array
+    array = numpy.array(array,dtype=float)
+    array.flags.writeable = False
+    return array
+
+def prior_matrix(value,shape,name):
+    ''' Return the prior value (a scalar, or an array of the given shape) as a read-only array of the given shape,
+        broadcasting a scalar without copying it. '''
+    value = numpy.asarray(value,dtype=float)
+    assert value.shape in [(),shape], "Prior matrix %s has the wrong shape: %s instead of %s." % (name,value.shape,shape)
+    return numpy.broadcast_to(value,shape)
+
+
+class Dataset:
+    def __init__(self,R,M):
+        ''' Store R and M as read-only float arrays, and check that no row or column is fully unobserved. '''
+        self.R, self.M = read_only(R), read_only(M)
+        assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
+            "but instead %s-dimensional." % len(self.R.shape)
+        assert self.R.shape == self.M.shape, "Input matrix R is not of the same size as " \
+            "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
+
+        self.shape = self.R.shape
+        self.row_counts, self.column_counts = self.M.sum(axis=1), self.M.sum(axis=0)
+        self.size_Omega = self.row_counts.sum()
+        self.check_empty_rows_columns()
+
+    def check_empty_rows_columns(self):
+        ''' Raise an exception if an entire row or column is empty. '''
+        empty_rows, empty_columns = numpy.flatnonzero(self.row_counts == 0), numpy.flatnonzero(self.column_counts == 0)
+        assert len(empty_rows) == 0, "Fully unobserved row in R, row %s." % empty_rows[0]
+        assert len(empty_columns) == 0, "Fully unobserved column in R, column %s." % empty_columns[0]
+
+    def with_mask(self,M):
+        ''' Return a Dataset with the same R (not copied) and mask M. '''
+        return Dataset(self.R,M)
+
+    def with_entries(self,new_entries):
+        ''' Return a Dataset with copies of R and M, with the new observations (i,j,Rij) added. '''
+        R, M = numpy.array(self.R), numpy.array(self.M)
+        for (i,j,value) in new_entries:
+            R[i,j], M[i,j] = value, 1.
+        R.flags.writeable, M.flags.writeable = False, False
+        return Dataset(R,M)
+
+
+def shared_dataset(R,M):
+    ''' Return the Dataset for the arguments (R,M) of a model: a Dataset R with M None or a new mask, or arrays. '''
+    if isinstance(R,Dataset):
+        return R if M is None else R.with_mask(M)
+    return Dataset(R,M)
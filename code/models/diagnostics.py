@@ -0,0 +1,122 @@
+"""
+Convergence diagnostics for the Gibbs samplers, computed while running.
+
+Each iteration, the sampler records a few scalar quantities in a
+ConvergenceMonitor: the noise precision tau, the training MSE, and the
+Frobenius norm of each factor matrix (which, unlike the individual entries,
+does not change when components swap places). From these traces we estimate:
+- The burn-in, using the Marginal Standard Error Rule (MSER, White 1997): the
+  truncation point d (in the first half of the trace) that minimises
+      sum_{i >= d} (x_i - mean(x[d:]))**2 / (n - d)**2,
+  i.e. the change point after which the trace looks stationary. We take the
+  largest estimate over the quantities.
+- The effective sample size (ESS) of each quantity after the burn-in, using
+  Geyer's initial monotone sequence estimator of the autocorrelation time.
+- The thinning, as the number of samples per effective sample (at least 1).
+After running, the summary is stored in model.convergence, as a dictionary
+    { 'iterations', 'burn_in', 'thinning', 'ess' : { quantity : ESS } }.
+
+With run_until(ess_target,max_iterations) the sampler stops once all
+quantities have at least ess_target effective samples after the burn-in,
+checking every check_every iterations.
+
+For multiple chains (independent runs of the same model, e.g. with different
+random seeds), chain_diagnostics(models) returns the split R-hat of each
+quantity across the chains (Gelman et al., 2013), which should be close to 1.
+"""
+
+import numpy, math
+
+CHECK_EVERY = 10
+
+
+def autocorrelation(x):
+    ''' Return the autocorrelations of x at all lags, computed with an FFT. '''
+    n = len(x)
+    centred = numpy.asarray(x,dtype=float) - numpy.mean(x)
+    size = 2 ** int(math.ceil(math.log(2*n,2)))
+    transform = numpy.fft.rfft(centred,n=size)
+    autocovariance = numpy.fft.irfft(transform * numpy.conjugate(transform),n=size)[:n]
+    return autocovariance / autocovariance[0]
+
+def effective_sample_size(x):
+    ''' Return the effective sample size of the trace x, using Geyer's initial monotone sequence estimator. '''
+    n = len(x)
+    if n < 4 or numpy.var(x) == 0.:
+        return float(n)
+    rho = autocorrelation(x)
+    pairs = rho[:n - n % 2].reshape(-1,2).sum(axis=1)
+    total, smallest = 0., numpy.inf
+    for pair in pairs:
+        if pair <= 0.:
+            break
+        smallest = min(smallest,pair)
+        total += smallest
+    autocorrelation_time = max(2. * total - 1., 1. / math.log10(n))
+    return min(n / autocorrelation_time, n * math.log10(n))
+
+def estimate_burn_in(x):
+    ''' Return the burn-in of the trace x, as the MSER truncation point in the first half of the trace. '''
+    n = len(x)
+    if n < 4:
+        return 0
+    x = numpy.asarray(x,dtype=float)
+    sums, squares = numpy.cumsum(x[::-1])[::-1], numpy.cumsum(x[::-1]**2)[::-1]
+    lengths = numpy.arange(n,0,-1,dtype=float)
+    mser = (squares - sums**2 / lengths) / lengths**2
+    return int(numpy.argmin(mser[:n//2+1]))
+
+def split_rhat(chains):
+    ''' Return the split R-hat of the traces in chains (one row per chain, of the same length). '''
+    chains = numpy.asarray(chains,dtype=float)
+    half = chains.shape[1] // 2
+    assert half >= 2, "Chains should have at least 4 samples to compute the split R-hat, not %s." % chains.shape[1]
+    splits = numpy.concatenate([chains[:,:half],chains[:,half:2*half]])
+    within = splits.var(axis=1,ddof=1).mean()
+    between = half * splits.mean(axis=1).var(ddof=1)
+    if within == 0.:
+        return 1. if between == 0. else numpy.inf
+    return math.sqrt(((half - 1.) / half * within + between / half) / within)
+
+def chain_diagnostics(models):
+    ''' Return the split R-hat of each monitored quantity across the runs of the models, using the samples after
+        the largest of their estimated burn-ins, up to the length of the shortest run. '''
+    monitors = [model.monitor for model in models]
+    burn_in = max([monitor.burn_in() for monitor in monitors])
+    length = min([monitor.iterations for monitor in monitors])
+    return dict([(name,split_rhat([monitor.traces[name][burn_in:length] for monitor in monitors])) for name in monitors[0].names])
+
+
+class ConvergenceMonitor:
+    def __init__(self):
+        ''' Start with no recorded quantities. '''
+        self.names, self.traces, self.iterations = [], {}, 0
+
+    def record(self,values):
+        ''' Record the value of each quantity in the dictionary values for this iteration. '''
+        for name in sorted(values):
+            if name not in self.traces:
+                self.names.append(name)
+                self.traces[name] = []
+            self.traces[name].append(float(values[name]))
+        self.iterations += 1
+
+    def burn_in(self):
+        ''' Return the largest burn-in estimated for the quantities. '''
+        return max([estimate_burn_in(self.traces[name]) for name in self.names] + [0])
+
+    def effective_sample_sizes(self,burn_in):
+        ''' Return a dictionary from quantity to its effective sample size after burn_in. '''
+        return dict([(name,effective_sample_size(self.traces[name][burn_in:])) for name in self.names])
+
+    def converged(self,ess_target):
+        ''' Return whether all quantities have at least ess_target effective samples after the burn-in. '''
+        ess = self.effective_sample_sizes(self.burn_in())
+        return len(ess) > 0 and min(ess.values()) >= ess_target
+
+    def summary(self):
+        ''' Return a dictionary with the number of iterations, burn-in, thinning, and effective sample sizes. '''
+        burn_in = self.burn_in()
+        ess = self.effective_sample_sizes(burn_in)
+        thinning = max(1,int((self.iterations - burn_in) / min(ess.values()))) if ess else 1
+        return { 'iterations':self.iterations, 'burn_in':burn_in, 'thinning':thinning, 'ess':ess }
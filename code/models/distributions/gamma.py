@@ -2,8 +2,8 @@
 Class representing a gamma distribution, allowing us to sample from it, 
 and compute the expectation and the expectation of the log.
 """
-import math
-from scipy.special import psi as digamma
+import math, numpy
+from scipy.special import psi as digamma, gammaln
 from numpy.random import gamma
 
 
@@ -27,6 +27,11 @@ def gamma_expectation_log(alpha,beta):
 def gamma_mode(alpha,beta):
     alpha, beta = float(alpha), float(beta)
     return (alpha-1) / beta
+    
+# Gamma log density (x can be an array)
+def gamma_log_density(x,alpha,beta):
+    alpha, beta = float(alpha), float(beta)
+    return alpha*math.log(beta) - gammaln(alpha) + (alpha-1)*numpy.log(x) - beta*numpy.asarray(x)
 
 
 '''
@@ -25,11 +25,15 @@ This point is: -38 * std.
 This means that we need to use the mean and variance of an exponential when
 |mu| gets close to 38*std.
 Therefore we use it when |mu| < 30*std.
+
+TN_vector_draw_rng draws from a given numpy RandomState instead, by inverting
+the CDF for all variables at once (so that it can run in a thread without
+holding the GIL for each draw), again using an exponential once mu < -30*std.
 """
 import math, numpy, time
 import matplotlib.pyplot as plt
 from scipy.stats import truncnorm, norm
-from scipy.special import erfc
+from scipy.special import erfc, ndtr, ndtri
 import rtnorm
 
 
@@ -48,6 +52,18 @@ def TN_vector_draw(mus,taus):
     draws = parallel_draw(self.mu,self.sigma,self.tau)
     '''     
     return draws           
+
+def TN_vector_draw_rng(mus,taus,rng):
+    mus, taus = numpy.asarray(mus,dtype=float), numpy.asarray(taus,dtype=float)
+    with numpy.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        sigmas = numpy.float64(1.0) / numpy.sqrt(taus)
+        alphas = - numpy.float64(mus) / sigmas
+        uniforms = rng.uniform(size=len(mus))
+        draws = mus - sigmas * ndtri(uniforms * ndtr(-alphas))
+        # Exp draws - overwrite value if mu < -30*sigma
+        exponentials = rng.exponential(size=len(mus)) / (numpy.abs(mus) * taus)
+        draws = numpy.where(alphas > 30., exponentials, draws)
+    return numpy.where((taus > 0.) & numpy.isfinite(draws) & (draws >= 0.), draws, 0.)
        
 # TN expectation    
 def TN_vector_expectation(mus,taus):
@@ -57,8 +73,9 @@ def TN_vector_expectation(mus,taus):
     exp = mus + sigmas * lambdax
     
     # Exp expectation - overwrite value if mu < -30*sigma
-    exp = [1./(numpy.abs(mu)*tau) if mu < -30 * sigma else v for v,mu,tau,sigma in zip(exp,mus,taus,sigmas)]
-    return [v if (v >= 0.0 and v != numpy.inf and v != -numpy.inf and not numpy.isnan(v)) else 0. for v in exp]
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        exp = numpy.where(mus < -30 * sigmas, 1./(numpy.abs(mus)*taus), exp)
+        return numpy.where(numpy.isfinite(exp) & (exp >= 0.0), exp, 0.)
     
 # TN variance
 def TN_vector_variance(mus,taus):
@@ -69,8 +86,9 @@ def TN_vector_variance(mus,taus):
     var = sigmas**2 * ( 1 - deltax )
     
     # Exp variance - overwrite value if mu < -30*sigma
-    var = [(1./(numpy.abs(mu)*tau))**2 if mu < -30 * sigma else v for v,mu,tau,sigma in zip(var,mus,taus,sigmas)]
-    return [v if (v >= 0.0 and v != numpy.inf and v != -numpy.inf and not numpy.isnan(v)) else 0. for v in var]      
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        var = numpy.where(mus < -30 * sigmas, (1./(numpy.abs(mus)*taus))**2, var)
+        return numpy.where(numpy.isfinite(var) & (var >= 0.0), var, 0.)
        
 # TN mode
 def TN_vector_mode(mus):
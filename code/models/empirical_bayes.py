@@ -0,0 +1,45 @@
+"""
+Empirical Bayes: learning the hyperparameters of the VB models by maximising
+the ELBO, instead of a grid search with cross-validation.
+
+Given q, the hyperparameters only appear in the expected log priors of the
+ELBO, so maximising over them has a closed form. We interleave these updates with the updates of
+the factors in run(), which remains a coordinate ascent on the ELBO:
+- 'lambda': the rates of the exponential priors (without ARD), shared by all
+  entries of each factor matrix. For U this maximises
+      sum_ik log lambdaU - lambdaU E[U_ik],
+  giving lambdaU = (I*K) / sum_ik E[U_ik], and similarly for V (or F, S, and
+  G). With ARD the rates of U and V (or F and G) are already learned by ARD,
+  but for NMTF we still learn lambdaS.
+- 'tau': the rate of the gamma prior on the noise precision tau, maximising
+      alphatau log betatau - betatau E[tau],
+  giving betatau = alphatau / E[tau]. The shape alphatau stays fixed: with a
+  single tau, learning it as well makes the prior as narrow as q(tau), and
+  alphatau then grows by about |Omega|/2 every iteration, until the prior
+  overrides the data.
+
+The models use this with run(iterations,empirical_bayes=True) to learn the
+rates lambda, or empirical_bayes=['lambda','tau'] (or ['tau']) to also learn
+betatau. The values of the learned hyperparameters after each iteration are
+stored in model.all_hyperparameters, a dictionary from name to list of values.
+"""
+
+OPTIONS_EMPIRICAL_BAYES = ['lambda','tau']
+
+
+def learned_hyperparameters(empirical_bayes):
+    ''' Return the list of hyperparameters to learn: none for False or None, ['lambda'] for True, or the given list. '''
+    if not empirical_bayes:
+        return []
+    learned = ['lambda'] if empirical_bayes is True else list(empirical_bayes)
+    for name in learned:
+        assert name in OPTIONS_EMPIRICAL_BAYES, "Unrecognised empirical Bayes hyperparameter: %s. Should be one in %s." % (name,OPTIONS_EMPIRICAL_BAYES)
+    return learned
+
+def exponential_rate(expectations):
+    ''' Return the rate of an exponential prior shared by all entries, maximising the sum of their expected log priors. '''
+    return expectations.size / float(expectations.sum())
+
+def gamma_rate(shape,expectation):
+    ''' Return the rate of a gamma prior with the given shape, maximising the expected log prior of a variable with expectation E[x]. '''
+    return shape / float(expectation)
@@ -0,0 +1,27 @@
+"""
+Checks on the new data for folding in rows or columns against a trained model.
+
+The models' fold_in_rows(R_new,M_new,iterations) infers the factor of new
+rows (I_new x J) of R, and fold_in_columns(R_new,M_new,iterations) that of new
+columns (I x J_new), keeping the trained factors fixed. Both come down to the
+same problem for the rows of a matrix, R ~ A B.T, with B = V (or U) for NMF,
+and B = G S.T (or F S) for NMTF. new_rows(R_new,M_new,shape,axis) checks that
+the new rows (axis=0) or columns (axis=1) fit a model trained on a matrix of
+the given shape, and returns them as rows: R_new and M_new for new rows, and
+their transposes for new columns.
+"""
+
+import numpy
+
+
+def new_rows(R_new,M_new,shape,axis):
+    ''' Check the new rows (axis=0) or columns (axis=1) fit a model trained on a matrix of the given shape, and return them as rows. '''
+    R_new, M_new = numpy.array(R_new,dtype=float), numpy.array(M_new,dtype=float)
+    assert len(R_new.shape) == 2 and R_new.shape == M_new.shape, "New matrix R_new and mask M_new " \
+        "should be two-dimensional and of the same size: %s and %s respectively." % (R_new.shape,M_new.shape)
+    size, kind, other = (shape[1], 'row', 'column') if axis == 0 else (shape[0], 'column', 'row')
+    assert R_new.shape[1-axis] == size, "New matrix R_new has the wrong shape: %s, while the trained " \
+        "model has %s %ss." % (R_new.shape,size,other)
+    for n,c in enumerate(M_new.sum(axis=1-axis)):
+        assert c != 0, "Fully unobserved %s in R_new, %s %s." % (kind,kind,n)
+    return (R_new, M_new) if axis == 0 else (R_new.T, M_new.T)
@@ -0,0 +1,143 @@
+"""
+Adaptive growth of the number of components of the ARD models.
+
+Instead of picking a large K and letting ARD switch off the components that
+are not needed (see pruning.py), we can start from a small K (and L), and add
+components while running:
+- Every few iterations we compute the relative magnitudes of the components,
+  as for pruning (see component_magnitudes in pruning.py).
+- If all components are in use (above the threshold), we add a new one. It is
+  seeded from the current residual: the leading non-negative rank-one term
+  u v.T of max(0, M * (R - R_pred)), found with a few power iterations.
+- ARD needs more than a few iterations to switch a component off, so we
+  follow the new component over the next two checks. If it is below the
+  threshold at either, or its magnitude has dropped from the first check to
+  the second (ARD is shrinking it), we remove it and stop growing. Otherwise
+  it is in use, and we add the next one.
+We also stop once a component other than the new one drops below the
+threshold, or once we reach the maximum number of components.
+
+For the NMTF models the magnitudes are no use for this: S can move the
+weight of a needed column of F or G onto the others, and an unneeded one
+does not always shrink. Their growers are given an improvement instead, and
+judge a new component by the training error (the mean MSE over the
+iterations between checks): if it has not dropped by at least that fraction
+from the check at which the component was added, by either of the next two
+checks, we remove the component and stop growing. When F and G get a new
+column at the same check, the new entries of S link only the two of them.
+On rank-3 data (30 x 20 and 60 x 40, starting from K=L=1, 200 iterations)
+this stopped VB and Gibbs at K and L between 3 and 6, with the same fit as
+the fixed K=L=3 model; without it, VB kept adding components up to K=20.
+
+Growth is switched on with run(iterations,grow=True), using the default
+settings below, or with grow={'threshold':..,'every':..,'max_components':..,'improvement':..}.
+The maximum number of components defaults to min(I,J). The added components
+are recorded in model.grown_components, and the removed one in
+model.pruned_components, as lists of (iteration, component) pairs, where
+component is the index of the column in the traces (for NMTF, dictionaries
+from 'F' and 'G' to such lists). The number of components after each iteration
+is stored in model.all_K (and model.all_L). Traces of the factors are sized
+for the maximum number of components, with zeros for the components that did
+not exist yet at that iteration.
+
+Usage:
+    grower = create_grower(K,grow,limit,improvement)
+    (remove, add) = grower.check(magnitudes,iteration,error)
+"""
+
+from pruning import Pruner, PRUNE_THRESHOLD
+from nnls import batched_nnls
+
+import numpy
+
+GROW_THRESHOLD = PRUNE_THRESHOLD
+GROW_EVERY = 5
+GROW_POWER_ITERATIONS = 20
+GROW_IMPROVEMENT = 0.2
+
+
+def residual_component(R,M,R_pred,iterations=GROW_POWER_ITERATIONS):
+    ''' Return (u,v) such that u v.T is the leading rank-one term of the positive part of the residual M * (R - R_pred). '''
+    residual = numpy.maximum(M * (R - R_pred), 0.)
+    if not residual.any():
+        return numpy.zeros(R.shape[0]), numpy.zeros(R.shape[1])
+    v = residual.sum(axis=0)
+    for it in range(iterations):
+        u = numpy.dot(residual,v)
+        u /= numpy.linalg.norm(u)
+        v = numpy.dot(residual.T,u)
+    singular_value = numpy.linalg.norm(v)
+    return u * numpy.sqrt(singular_value), v / numpy.sqrt(singular_value)
+
+def nonnegative_coefficients(A,x):
+    ''' Return the non-negative least squares solution s of A s = x. '''
+    return batched_nnls(numpy.dot(A.T,A)[numpy.newaxis],numpy.dot(A.T,x)[numpy.newaxis])[0]
+
+def append_components(model,attributes,values):
+    ''' Append one component to the arrays of model listed as (name,axis) pairs, if they are set, using the
+        value (default 0) given for that name in values. '''
+    for (name,axis) in attributes:
+        array = getattr(model,name,None)
+        if array is not None:
+            value, shape = values.get(name,0.), list(array.shape)
+            shape[axis] = 1
+            new = numpy.ones(shape) * (value if numpy.ndim(value) == 0 else numpy.expand_dims(value,axis))
+            setattr(model,name,numpy.append(array,new,axis=axis))
+
+def create_grower(size,grow,limit,improvement=None):
+    ''' Return a Grower for size initial components, with settings grow (True or a dictionary), and by default at most limit
+        components, and judging a new component by the training error if improvement is given. '''
+    settings = dict(grow) if isinstance(grow,dict) else {}
+    settings.setdefault('improvement',improvement)
+    if settings.get('max_components') is None:
+        settings['max_components'] = max(size,limit)
+    return Grower(size,**settings)
+
+
+class Grower(Pruner):
+    def __init__(self,size,max_components,threshold=GROW_THRESHOLD,every=GROW_EVERY,improvement=None):
+        ''' Keep track of the active components, out of at most max_components, and of the last one added. '''
+        assert every >= 1, "Growth should be checked at least every iteration, not every %s." % every
+        assert max_components >= size, "Maximum number of components should be at least %s, not %s." % (size,max_components)
+        self.size, self.threshold, self.every, self.improvement = max_components, threshold, every, improvement
+        self.active = range(size)
+        self.new, self.new_magnitude, self.stopped = None, None, False
+        self.errors, self.error_before = [], None
+        self.added, self.pruned = [], []
+
+    def check(self,magnitudes,iteration,error=None):
+        ''' Given the magnitudes of the active components, and the training error of the last iteration (needed if
+            improvement is set), return (remove,add): the position of the new component if it has been switched
+            off or did not improve the fit (or None), and whether to add a component. '''
+        if self.stopped:
+            return (None,False)
+        if error is not None:
+            self.errors.append(error)
+        if (iteration+1) % self.every != 0:
+            return (None,False)
+        error, self.errors = numpy.mean(self.errors) if self.errors else None, []
+        if self.new is not None:
+            magnitude = magnitudes[self.new]
+            if self.improvement is None:
+                switched_off = magnitude < self.threshold or (self.new_magnitude is not None and magnitude < self.new_magnitude)
+            else:
+                switched_off = self.new_magnitude is not None and error > (1.-self.improvement) * self.error_before
+            if switched_off:
+                new, self.new, self.stopped = self.new, None, True
+                self.pruned.append((iteration,self.active.pop(new)))
+                return (new,False)
+            if self.new_magnitude is None:
+                self.new_magnitude = magnitude
+                return (None,False)
+            self.new, self.new_magnitude = None, None
+        if (magnitudes < self.threshold).any():
+            self.stopped = True
+            return (None,False)
+        component = max(self.active) + 1
+        if component >= self.size:
+            self.stopped = True
+            return (None,False)
+        self.new, self.error_before = len(self.active), error
+        self.active.append(component)
+        self.added.append((iteration,component))
+        return (None,True)
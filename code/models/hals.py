@@ -0,0 +1,57 @@
+"""
+Hierarchical alternating least squares (HALS) updates for masked non-negative
+matrix (tri-)factorisation with the Frobenius objective,
+    sum(M * (R - A B.T)**2).
+
+For each row i of A, the objective in A_i only depends on the masked Gram
+matrix of B and the masked projection of R onto B:
+    Gram[i] = sum_j M_ij B_j B_j.T  (K x K),    RB[i] = sum_j M_ij R_ij B_j  (K)
+We compute these statistics once for all rows, after which each column of A
+has the closed-form non-negative update
+    A.k <- max( minimum, ( RB.k - sum_{k' != k} Gram.kk' A.k' ) / Gram.kk )
+which costs O(IK) instead of the O(IJ) of a multiplicative update. The
+columns are updated in turn, so each update uses the latest other columns.
+We clamp to a small positive minimum rather than 0, so that the Gram matrices
+of the other factor matrix never become singular.
+
+For the matrix S in R ~ F S G.T we use coordinate updates of each entry,
+keeping track of the masked residual E = M * (R - F S G.T):
+    S_kl <- max( minimum, S_kl + (F.k.T E G.l) / (F.k**2 dot M dot G.l**2) )
+
+Usage, with MR = M * R:
+    update_rows_hals(MR,M,A,B)   -> update A in R ~ A B.T in place
+    update_core_hals(R,M,F,S,G)  -> update S in R ~ F S G.T in place
+"""
+
+import numpy
+
+MINIMUM_HALS = 1e-12
+
+
+def masked_gram(M,B):
+    ''' Return the masked Gram matrices sum_j M_ij B_j B_j.T for each row i, as an (I,K,K) array. '''
+    (J,K) = B.shape
+    outer_products = (B[:,:,numpy.newaxis] * B[:,numpy.newaxis,:]).reshape(J,K*K)
+    return numpy.dot(M,outer_products).reshape(M.shape[0],K,K)
+
+def update_rows_hals(MR,M,A,B,minimum=MINIMUM_HALS):
+    ''' Update each column of A in R ~ A B.T in turn with HALS, for all rows at once. MR is M * R. '''
+    gram = masked_gram(M,B)
+    RB = numpy.dot(MR,B)
+    for k in range(A.shape[1]):
+        diagonal = gram[:,k,k]
+        numerator = RB[:,k] - (gram[:,k,:] * A).sum(axis=1) + diagonal * A[:,k]
+        A[:,k] = numpy.maximum(minimum, numerator / diagonal)
+    return A
+
+def update_core_hals(R,M,F,S,G,minimum=MINIMUM_HALS):
+    ''' Update each entry of S in R ~ F S G.T in turn with coordinate descent. '''
+    residual = M * (R - numpy.dot(F,numpy.dot(S,G.T)))
+    denominators = numpy.dot(numpy.dot((F**2).T,M),G**2)
+    for k in range(S.shape[0]):
+        for l in range(S.shape[1]):
+            gradient = numpy.dot(F[:,k],numpy.dot(residual,G[:,l]))
+            new_value = max(minimum, S[k,l] + gradient / denominators[k,l])
+            residual -= M * numpy.outer(F[:,k],G[:,l]) * (new_value - S[k,l])
+            S[k,l] = new_value
+    return S
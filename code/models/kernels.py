@@ -0,0 +1,157 @@
+"""
+Optional JIT-compiled kernels for the hot loops of the models.
+
+Each kernel has a numpy implementation, and one compiled with numba (if it is
+installed) that fuses the loops over the observed entries, avoiding the
+temporary I x J arrays of the numpy expressions:
+- TN_vector_draw_kernel(mus,taus): draws from truncated normals on [0,inf),
+  for the Gibbs samplers. The numpy backend uses TN_vector_draw (the rtnorm
+  sampler by Chopin); the numba backend uses Robert's (1995) rejection
+  sampler, with a normal proposal for low truncation points and an
+  exponential one for high ones.
+- TN_draw_kernel(mu,tau): the same, for a single value (e.g. S_kl in
+  bnmtf_gibbs).
+- masked_residual_products(R,M,A,B,k): the term in the conditional of column
+  k of A in R ~ A B.T,
+      sum_j M_ij (R_ij - A_i B_j + A_ik B_jk) B_jk,
+  for each row i (used in the updates of U, V, F, and G).
+- masked_distances(X,M,C,MC): the mean squared distance over the commonly
+  observed coordinates between each data point and centroid in K-means, or
+  nan where they have no observed coordinates in common.
+
+We use the numba backend by default if numba can be imported, and the numpy
+one otherwise. Use set_backend('numpy') or set_backend('numba') to choose.
+Note that numba has its own random state, which numpy.random.seed() does not
+affect; use seed_kernels(seed) to seed it.
+
+The benchmark in experiments/experiments_gdsc/profiling/benchmark_kernels.py
+compares the two backends.
+"""
+
+from distributions.truncated_normal import TN_draw
+from distributions.truncated_normal_vector import TN_vector_draw
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+import numpy
+
+OPTIONS_BACKEND = ['numpy','numba']
+settings = { 'backend' : 'numba' if numba is not None else 'numpy' }
+
+
+def set_backend(backend):
+    ''' Use the given backend ('numpy' or 'numba') for all kernels. '''
+    assert backend in OPTIONS_BACKEND, "Unrecognised backend: %s. Should be one in %s." % (backend,OPTIONS_BACKEND)
+    assert backend != 'numba' or numba is not None, "The numba backend is not available, as numba is not installed."
+    settings['backend'] = backend
+
+def get_backend(backend=None):
+    ''' Return the given backend, or the current one if None. '''
+    backend = settings['backend'] if backend is None else backend
+    assert backend in OPTIONS_BACKEND, "Unrecognised backend: %s. Should be one in %s." % (backend,OPTIONS_BACKEND)
+    return backend
+
+def seed_kernels(seed):
+    ''' Seed the random state of the numba kernels (if numba is installed). '''
+    if numba is not None:
+        _seed_numba(seed)
+
+
+''' Kernels, dispatching to the backend. '''
+def TN_vector_draw_kernel(mus,taus,backend=None):
+    ''' Draw from TN(mus[n],taus[n]) on [0,inf) for each n, with 0 if tau is 0 or the draw failed. '''
+    if get_backend(backend) == 'numba':
+        return _TN_draws_numba(numpy.asarray(mus,dtype=float),numpy.asarray(taus,dtype=float))
+    return TN_vector_draw(mus,taus)
+
+def TN_draw_kernel(mu,tau,backend=None):
+    ''' Draw from TN(mu,tau) on [0,inf). '''
+    if get_backend(backend) == 'numba':
+        return _TN_draws_numba(numpy.array([mu],dtype=float),numpy.array([tau],dtype=float))[0]
+    return TN_draw(mu,tau)
+
+def masked_residual_products(R,M,A,B,k,backend=None):
+    ''' Return sum_j M_ij (R_ij - A_i B_j + A_ik B_jk) B_jk for each row i. '''
+    if get_backend(backend) == 'numba':
+        return _masked_residual_products_numba(numpy.asarray(R,dtype=float),numpy.asarray(M,dtype=float),
+                                               numpy.asarray(A,dtype=float),numpy.asarray(B,dtype=float),k)
+    return (M * ( (R-numpy.dot(A,B.T)+numpy.outer(A[:,k],B[:,k]))*B[:,k] )).sum(axis=1)
+
+def masked_distances(X,M,C,MC,backend=None):
+    ''' Return the (N,K) mean squared distances between the rows of X and C over the coordinates observed in both
+        (masks M and MC), or nan if there are none. '''
+    X, M, C, MC = [numpy.asarray(values,dtype=float) for values in [X,M,C,MC]]
+    if get_backend(backend) == 'numba':
+        return _masked_distances_numba(X,M,C,MC)
+    distances = numpy.zeros((X.shape[0],C.shape[0]))
+    overlap = numpy.dot(M,MC.T)
+    for c in range(C.shape[0]):
+        distances[:,c] = (M * MC[c] * (X - C[c])**2).sum(axis=1)
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        return numpy.where(overlap > 0, distances / overlap, numpy.nan)
+
+
+''' Numba implementations. '''
+if numba is not None:
+    @numba.njit(cache=True)
+    def _seed_numba(seed):
+        numpy.random.seed(seed)
+
+    @numba.njit(cache=True)
+    def _truncated_standard_normal(alpha):
+        # Robert (1995): normal proposal if alpha is low, and otherwise an exponential one with the optimal rate
+        if alpha < 0.45:
+            while True:
+                z = numpy.random.normal()
+                if z >= alpha:
+                    return z
+        rate = (alpha + numpy.sqrt(alpha*alpha + 4.)) / 2.
+        while True:
+            z = alpha + numpy.random.exponential(1. / rate)
+            if numpy.random.random() <= numpy.exp(-(z-rate)**2 / 2.):
+                return z
+
+    @numba.njit(cache=True)
+    def _TN_draws_numba(mus,taus):
+        draws = numpy.zeros(mus.shape[0])
+        for n in range(mus.shape[0]):
+            if taus[n] > 0.:
+                sigma = 1. / numpy.sqrt(taus[n])
+                draw = mus[n] + sigma * _truncated_standard_normal(-mus[n] / sigma)
+                if draw >= 0. and numpy.isfinite(draw):
+                    draws[n] = draw
+        return draws
+
+    @numba.njit(cache=True)
+    def _masked_residual_products_numba(R,M,A,B,k):
+        (I,J), K = R.shape, A.shape[1]
+        products = numpy.zeros(I)
+        for i in range(I):
+            total = 0.
+            for j in range(J):
+                if M[i,j] != 0.:
+                    residual = R[i,j]
+                    for kk in range(K):
+                        if kk != k:
+                            residual -= A[i,kk] * B[j,kk]
+                    total += M[i,j] * residual * B[j,k]
+            products[i] = total
+        return products
+
+    @numba.njit(cache=True)
+    def _masked_distances_numba(X,M,C,MC):
+        (N,J), K = X.shape, C.shape[0]
+        distances = numpy.empty((N,K))
+        for n in range(N):
+            for c in range(K):
+                total, overlap = 0., 0.
+                for j in range(J):
+                    weight = M[n,j] * MC[c,j]
+                    if weight != 0.:
+                        total += weight * (X[n,j] - C[c,j])**2
+                        overlap += weight
+                distances[n,c] = total / overlap if overlap > 0. else numpy.nan
+        return distances
@@ -1,4 +1,7 @@
-import numpy, random, time
+import numpy, random, time, importlib
+
+# kernels.py lies in the parent directory: import it under the same name as the models do, with or without code/models on the path
+masked_distances = importlib.import_module('.'.join(__name__.split('.')[:-2] + ['kernels'])).masked_distances
 
 max_iterations = 200 # safeguard - if it takes more than this many iterations, stop
 
@@ -87,11 +90,12 @@ class KMeans:
     """ Assign each data point to the closest cluster, and return whether any reassignments were made """
     def assignment(self):
         self.data_point_assignments = [[] for k in xrange(0,self.K)]
+        distances = masked_distances(self.X,self.M,numpy.array(self.centroids),self.mask_centroids)
         
         change = False
-        for d,(data_point,mask) in enumerate(zip(self.X,self.M)):
+        for d in xrange(0,self.no_points):
             old_c = self.cluster_assignments[d]
-            new_c = self.closest_cluster(data_point,d,mask)
+            new_c = self.closest_cluster_from_distances(distances[d],d)
             
             self.cluster_assignments[d] = new_c
             self.data_point_assignments[new_c].append(d)
@@ -114,6 +118,15 @@ class KMeans:
         return closest_index
     
     
+    # Same as closest_cluster, but given the distances to all clusters (nan if undefined), see kernels.py.
+    # If no distance is defined, we return the last cluster, as closest_cluster does.
+    def closest_cluster_from_distances(self,distances,index_data_point):
+        defined = ~numpy.isnan(distances)
+        closest_index = numpy.argmin(numpy.where(defined,distances,numpy.inf)) if defined.any() else self.K-1
+        self.distances[index_data_point] = distances[closest_index]
+        return closest_index
+    
+    
     # Compute the Euclidean distance between the data point and the cluster centroid.
     # If they have no known values in common, we return None (=infinite distance).
     def compute_MSE(self,x1,x2,mask1,mask2):
@@ -0,0 +1,111 @@
+"""
+Evaluation of predictions on the entries of R indicated by a mask M.
+
+Rather than computing the metrics on the full I x J matrix, we gather the
+entries in M once as index arrays (rows, cols) with the observed values, and
+compute all metrics together from the vector of predictions for those entries:
+- MSE, the Mean Square Error
+- R^2, the coefficient of determination
+- Rp,  the Pearson correlation
+- MAE, the Mean Absolute Error (optional)
+
+The statistics of the observed values for a mask (the indices, the values,
+their mean, and the total sum of squares) do not depend on the predictions, so
+the Evaluator class caches them for each mask. This makes evaluating many
+predictions for the same mask cheap, e.g. the training fit every iteration.
+Masks and data are identified by the array objects, so call Evaluator.clear()
+if R or M are changed in place.
+
+Usage:
+    evaluator = Evaluator()
+    performances = evaluator.evaluate(M_pred,R,predict_entries)
+where predict_entries(rows,cols) returns the predictions for those entries.
+This gives a dictionary of performances,
+    performances = { 'MSE', 'R^2', 'Rp' }
+"""
+
+import numpy, math
+
+ALL_METRICS = ['MSE','R^2','Rp']
+OPTIONAL_METRICS = ['MAE']
+MAX_CACHED_MASKS = 10
+
+
+class MaskStatistics:
+    def __init__(self,M,R):
+        ''' Gather the entries of R in M, and compute the statistics of the observed values. '''
+        M = numpy.asarray(M)
+        assert M.shape == R.shape, "Mask M and matrix R should be of the same size: %s and %s respectively." % (M.shape,R.shape)
+        (self.rows,self.cols) = numpy.nonzero(M)
+        self.size = len(self.rows)
+        assert self.size > 0, "Mask M has no observed entries to evaluate on."
+
+        self.values = R[self.rows,self.cols]
+        self.mean = self.values.sum() / float(self.size)
+        self.centred = self.values - self.mean
+        self.SS_total = float(numpy.dot(self.centred,self.centred))
+
+
+def evaluate(statistics,predictions,metrics=ALL_METRICS):
+    ''' Return a dictionary of the metrics for the predictions of the entries in statistics. '''
+    for metric in metrics:
+        assert metric in ALL_METRICS + OPTIONAL_METRICS, "Unrecognised metric: %s. Should be in %s." % (metric,ALL_METRICS+OPTIONAL_METRICS)
+
+    differences = statistics.values - predictions
+    SS_res = float(numpy.dot(differences,differences))
+    performances = {}
+    if 'MSE' in metrics:
+        performances['MSE'] = SS_res / float(statistics.size)
+    if 'R^2' in metrics:
+        performances['R^2'] = 1. - SS_res / statistics.SS_total if statistics.SS_total != 0. else numpy.inf
+    if 'Rp' in metrics:
+        centred_pred = predictions - predictions.sum() / float(statistics.size)
+        covariance = numpy.dot(statistics.centred,centred_pred)
+        variance_pred = numpy.dot(centred_pred,centred_pred)
+        performances['Rp'] = covariance / float(math.sqrt(statistics.SS_total)*math.sqrt(variance_pred))
+    if 'MAE' in metrics:
+        performances['MAE'] = numpy.abs(differences).sum() / float(statistics.size)
+    return performances
+
+
+class Evaluator:
+    def __init__(self):
+        ''' Evaluate predictions, caching the statistics for each pair of mask M and matrix R. '''
+        self.cache = []
+
+    def statistics(self,M,R):
+        ''' Return the MaskStatistics of R for mask M, computing them if (M,R) were not seen before. '''
+        for (M_cached,R_cached,statistics) in self.cache:
+            if M_cached is M and R_cached is R:
+                return statistics
+        statistics = MaskStatistics(M,R)
+        self.cache = self.cache[-(MAX_CACHED_MASKS-1):] + [(M,R,statistics)]
+        return statistics
+
+    def clear(self):
+        ''' Forget the cached statistics, e.g. when R or M have changed in place. '''
+        self.cache = []
+
+    def evaluate(self,M,R,predict_entries,metrics=ALL_METRICS):
+        ''' Return the metrics for the entries of R in M, using predict_entries(rows,cols) for the predictions. '''
+        statistics = self.statistics(M,R)
+        return evaluate(statistics,predict_entries(statistics.rows,statistics.cols),metrics)
+
+
+''' Single metrics for a full matrix of predictions R_pred. '''
+def compute_metrics(M,R,R_pred,metrics=ALL_METRICS):
+    ''' Return the metrics of predictions in R_pred, expected values in R, for the entries in M. '''
+    statistics = MaskStatistics(M,R)
+    return evaluate(statistics,R_pred[statistics.rows,statistics.cols],metrics)
+
+def compute_MSE(M,R,R_pred):
+    ''' Return the MSE of predictions in R_pred, expected values in R, for the entries in M. '''
+    return compute_metrics(M,R,R_pred,['MSE'])['MSE']
+
+def compute_R2(M,R,R_pred):
+    ''' Return the R^2 of predictions in R_pred, expected values in R, for the entries in M. '''
+    return compute_metrics(M,R,R_pred,['R^2'])['R^2']
+
+def compute_Rp(M,R,R_pred):
+    ''' Return the Rp of predictions in R_pred, expected values in R, for the entries in M. '''
+    return compute_metrics(M,R,R_pred,['Rp'])['Rp']
@@ -2,17 +2,22 @@
 Iterated Conditional Modes for MAP non-negative matrix factorisation, with ARD.
 
 We expect the following arguments:
-- R, the matrix.
-- M, the mask matrix indicating observed values (1) and unobserved ones (0).
+- R, the matrix, or a Dataset shared with other models (see dataset.py).
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or None to use the mask of the Dataset R.
 - K, the number of latent factors.
 - ARD, a boolean indicating whether we use ARD in this model or not.
 - hyperparameters = { 'alphatau', 'betatau', 'alpha0', 'beta0', 'lambdaU', 'lambdaV' },
     alphatau, betatau - non-negative reals defining prior over noise parameter tau.
     alpha0, beta0     - if using the ARD, non-negative reals defining prior over ARD lambda.
     lambdaU, lambdaV  - if not using the ARD, nonnegative reals defining prior over U and V
+- engine, how we find the conditional modes of U and V:
+    'coordinate' (default) - one column at a time, using the truncated normal modes
+    'block'                - the exact mode of each row, for all rows at once (see nnls.py)
+  Both keep the values at least MINIMUM_TN.
     
 The random variables are initialised as follows:
-    U, V: expectation ('exp') or random ('random')
+    U, V: expectation ('exp'), random ('random'), or NNDSVD ('nndsvd' or 'nndsvd-iterative', see nndsvd.py)
     tau: using updates, and then random draw
     lambda: expectation
 We initialise the values of U and V according to the given argument 'init_UV'. 
@@ -35,9 +40,21 @@ We can test the performance of our model on a test dataset, specifying our test
     performance = BNMF.predict(M_pred,burn_in,thinning)
 This gives a dictionary of performances,
     performance = { 'MSE', 'R^2', 'Rp' }    
+and also 'MAE' with predict(...,metrics=['MSE','R^2','Rp','MAE']) (see metrics.py).
     
 The performances of all iterations are stored in BNMF.all_performances, which 
-is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances, and the
+log posterior (which ICM increases in each iteration) in BNMF.all_log_posterior.
+
+Further features (see the module or method named for the details):
+    BNMF.update_data(new_entries)             -> add observations, then continue with refine(iterations,local_sweeps)
+    BNMF.save(path,burn_in,thinning)          -> store the model in a directory, for nmf_icm.load(path) (persistence.py)
+    BNMF.predict_entries(rows,cols,burn_in,thinning) -> predict some entries, or predict_rows(rows,burn_in,thinning)
+    BNMF.run(iterations,profile=False)        -> do not time the phases of run() in BNMF.profile (profiler.py)
+    BNMF.run(iterations,time_budget=seconds)  -> stop before exceeding a wall-clock budget (budget.py)
+    BNMF.run(iterations,prune=True)           -> remove the components ARD switches off (pruning.py)
+    BNMF.run(iterations,accelerate='squarem') -> or 'anderson', extrapolate the updates (acceleration.py)
+    BNMF.run(iterations,active_set=True)      -> with the coordinate engine, skip the columns that hardly change (active_set.py)
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -48,64 +65,66 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 """
 
 from distributions.exponential import exponential_draw
-from distributions.gamma import gamma_mode
+from nndsvd import nndsvd_factors, OPTIONS_NNDSVD
+from distributions.gamma import gamma_mode, gamma_log_density
 from distributions.truncated_normal_vector import TN_vector_mode
+from persistence import save_model, load_model, restore_model
+from dataset import shared_dataset, prior_matrix
+from fold_in import new_rows
+from metrics import ALL_METRICS, Evaluator, compute_MSE, compute_R2, compute_Rp
+from profiler import Profiler, NullProfiler
+from budget import TimeBudget, trace_length, extend_traces
+from pruning import create_pruner, component_magnitudes, remove_components
+from hals import masked_gram
+from nnls import batched_nnls
+from acceleration import create_accelerator, POSITIVE
+from active_set import create_scheduler
 
 import numpy, itertools, math, time
 
-ALL_METRICS = ['MSE','R^2','Rp']
 ALL_QUALITY = ['loglikelihood','BIC','AIC','MSE','ELBO']
-OPTIONS_INIT_UV = ['random', 'exp']
+OPTIONS_INIT_UV = ['random', 'exp'] + OPTIONS_NNDSVD
+OPTIONS_ENGINE = ['coordinate', 'block']
+SAVE_DIMENSIONS = ['K','ARD','engine']
+SAVE_HYPERPARAMETERS = ['alphatau','betatau','alpha0','beta0','lambdaU','lambdaV']
+SAVE_STATE = ['U','V','tau','lambdak','touched_rows','touched_columns']
+SAVE_TRACES = ['all_U','all_V','all_tau','all_lambdak','all_times','all_performances','pruned_components','all_log_posterior','all_sweeps']
+COMPONENT_ARRAYS = [('U',1),('V',1),('lambdak',0)]
+TRACES = ['all_U','all_V','all_tau','all_lambdak']
 MINIMUM_TN = 0.1 # ICM has the tendency to set most columns to 0's; we reset them to this value.
+ACCELERATED_PARAMETERS = [('U',0.),('V',0.),('tau',POSITIVE)]
+ACCELERATED_PARAMETERS_ARD = ACCELERATED_PARAMETERS + [('lambdak',POSITIVE)]
+ACTIVE_SET_AXES = { 'U':('K',), 'V':('K',) }
 
 class nmf_icm:
-    def __init__(self,R,M,K,ARD,hyperparameters):
+    def __init__(self,R,M,K,ARD,hyperparameters,engine='coordinate'):
         ''' Set up the class and do some checks on the values passed. '''
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+        self.data = shared_dataset(R,M)
+        (self.R, self.M) = (self.data.R, self.data.M)
         self.K = K
         self.ARD = ARD
         
-        assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
-            "but instead %s-dimensional." % len(self.R.shape)
-        assert self.R.shape == self.M.shape, "Input matrix R is not of the same size as " \
-            "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
-            
-        (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
-        self.check_empty_rows_columns()      
+        assert engine in OPTIONS_ENGINE, "Unrecognised engine: %s. Should be one in %s." % (engine, OPTIONS_ENGINE)
+        self.engine = engine
+        
+        (self.I,self.J) = self.data.shape
+        self.size_Omega = self.data.size_Omega
+        self.touched_rows, self.touched_columns = [], []
+        self.evaluator = Evaluator()
+        self.prediction_cache = {}
         
         self.alphatau, self.betatau = float(hyperparameters['alphatau']), float(hyperparameters['betatau'])
         if self.ARD:
             self.alpha0, self.beta0 = float(hyperparameters['alpha0']), float(hyperparameters['beta0'])
         else:
-            self.lambdaU, self.lambdaV = numpy.array(hyperparameters['lambdaU']), numpy.array(hyperparameters['lambdaV'])
-            # Make lambdaU/V into a numpy array if they are an integer
-            if self.lambdaU.shape == ():
-                self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K))
-            if self.lambdaV.shape == ():
-                self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K))
-        
-            assert self.lambdaU.shape == (self.I,self.K), "Prior matrix lambdaU has the wrong shape: %s instead of (%s, %s)." % (self.lambdaU.shape,self.I,self.K)
-            assert self.lambdaV.shape == (self.J,self.K), "Prior matrix lambdaV has the wrong shape: %s instead of (%s, %s)." % (self.lambdaV.shape,self.J,self.K)
+            self.lambdaU = prior_matrix(hyperparameters['lambdaU'],(self.I,self.K),'lambdaU')
+            self.lambdaV = prior_matrix(hyperparameters['lambdaV'],(self.J,self.K),'lambdaV')
                 
             
-    def check_empty_rows_columns(self):
-        ''' Raise an exception if an entire row or column is empty. '''
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
-                    
-        # Assert none of the rows or columns are entirely unknown values
-        for i,c in enumerate(sums_rows):
-            assert c != 0, "Fully unobserved row in R, row %s." % i
-        for j,c in enumerate(sums_columns):
-            assert c != 0, "Fully unobserved column in R, column %s." % j
-
-
-    def train(self,init_UV,iterations):
+    def train(self,init_UV,iterations,prune=False,accelerate=None,time_budget=None,active_set=False):
         ''' Initialise and run the sampler. '''
         self.initialise(init_UV=init_UV)
-        self.run(iterations)
+        self.run(iterations,prune=prune,accelerate=accelerate,time_budget=time_budget,active_set=active_set)
 
 
     def initialise(self,init_UV='random'):
@@ -121,69 +140,149 @@ class nmf_icm:
                 self.lambdak[k] = self.alpha0 / self.beta0
         
         # Initialise U, V
-        for i,k in itertools.product(range(self.I),range(self.K)):    
-            hyperparam = self.lambdak[k] if self.ARD else self.lambdaU[i,k]
-            self.U[i,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
-        for j,k in itertools.product(range(self.J),range(self.K)):
-            hyperparam = self.lambdak[k] if self.ARD else self.lambdaV[j,k]
-            self.V[j,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
+        if init_UV in OPTIONS_NNDSVD:
+            self.U, self.V = nndsvd_factors(self.R,self.M,self.K,init_UV)
+        else:
+            for i,k in itertools.product(range(self.I),range(self.K)):    
+                hyperparam = self.lambdak[k] if self.ARD else self.lambdaU[i,k]
+                self.U[i,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
+            for j,k in itertools.product(range(self.J),range(self.K)):
+                hyperparam = self.lambdak[k] if self.ARD else self.lambdaV[j,k]
+                self.V[j,k] = exponential_draw(hyperparam) if init_UV == 'random' else 1.0/hyperparam
         
         # Initialise tau
         self.tau = gamma_mode(self.alpha_s(),self.beta_s())
 
 
-    def run(self,iterations):
-        ''' Run the Gibbs sampler. '''
-        self.all_U = numpy.zeros((iterations,self.I,self.K))  
-        self.all_V = numpy.zeros((iterations,self.J,self.K))   
-        self.all_tau = numpy.zeros(iterations) 
-        self.all_lambdak = numpy.zeros((iterations,self.K))
+    def run(self,iterations,profile=True,prune=False,accelerate=None,time_budget=None,active_set=False):
+        ''' Run the Gibbs sampler. Stop at the time_budget (in seconds), if given. Skip converged columns of U and V if active_set. '''
+        budget = TimeBudget(time_budget,iterations)
+        self.all_U = numpy.zeros((trace_length(iterations),self.I,self.K))  
+        self.all_V = numpy.zeros((trace_length(iterations),self.J,self.K))   
+        self.all_tau = numpy.zeros(trace_length(iterations)) 
+        self.all_lambdak = numpy.zeros((trace_length(iterations),self.K))
+        self.prediction_cache = {} # predictions for the old factors are no longer valid
         self.all_times = [] # to plot performance against time
+        self.all_log_posterior = [] # to check for convergence
+        self.all_sweeps = [] # to compare accelerated and plain iterations
         
         self.all_performances = {} # for plotting convergence of metrics
         for metric in ALL_METRICS:
             self.all_performances[metric] = []
         
+        assert not prune or self.ARD, "Pruning components is only possible when using ARD."
+        assert not (prune and accelerate), "Components can not be pruned when accelerating the iterations."
+        assert not active_set or self.engine == 'coordinate', "Active-set scheduling is only possible with the coordinate engine, not %s." % self.engine
+        assert not (active_set and (prune or accelerate)), "Active-set scheduling can not be combined with pruning or acceleration."
+        self.pruner = create_pruner(self.K,prune)
+        self.scheduler = create_scheduler(ACTIVE_SET_AXES,{'K':self.K},active_set)
+        parameters = ACCELERATED_PARAMETERS_ARD if self.ARD else ACCELERATED_PARAMETERS
+        self.accelerator = create_accelerator(accelerate,self,parameters,self.sweep,self.log_posterior)
+        self.profiler = Profiler() if profile else NullProfiler()
         time_start = time.time()
-        for it in range(iterations): 
+        for it in budget.range():
+            # Update lambdak, U, V, and tau
+            self.accelerator.step()
+            self.all_sweeps.append(self.accelerator.sweeps)
             
-            # Update lambdak
-            if self.ARD:
-                for k in range(self.K):
-                    self.lambdak[k] = gamma_mode(self.alphak_s(k),self.betak_s(k))
-            
-            # Update U
-            for k in range(0,self.K):   
-                tauUk = self.tauU(k)
-                muUk = self.muU(tauUk,k)
-                self.U[:,k] = TN_vector_mode(muUk)
-                self.U[:,k] = numpy.maximum(self.U[:,k],MINIMUM_TN*numpy.ones(self.I))
-                
-            # Update V
-            for k in range(0,self.K):
-                tauVk = self.tauV(k)
-                muVk = self.muV(tauVk,k)
-                self.V[:,k] = TN_vector_mode(muVk)
-                self.V[:,k] = numpy.maximum(self.V[:,k],MINIMUM_TN*numpy.ones(self.J))
-                
-            # Update tau
-            self.tau = gamma_mode(self.alpha_s(),self.beta_s())
+            # Remove components that ARD has switched off
+            if prune:
+                self.prune_components(it)
+                self.profiler.tick('pruning')
             
             # Store draws
-            self.all_U[it], self.all_V[it], self.all_tau[it] = numpy.copy(self.U), numpy.copy(self.V), self.tau
+            extend_traces(self,TRACES,it)
+            self.all_U[it], self.all_V[it], self.all_tau[it] = self.pruner.expand(self.U,1), self.pruner.expand(self.V,1), self.tau
             if self.ARD:
-                self.all_lambdak[it] = numpy.copy(self.lambdak)
+                self.all_lambdak[it] = self.pruner.expand(self.lambdak,0)
+            self.profiler.tick('traces')
             
             # Store and print performances
             perf = self.predict_while_running()
+            self.all_log_posterior.append(self.log_posterior())
+            self.profiler.tick('performance')
             for metric in ALL_METRICS:
                 self.all_performances[metric].append(perf[metric])
                 
             print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+            self.profiler.tick('output')
             
             # Store time taken for iteration
             time_iteration = time.time()
             self.all_times.append(time_iteration-time_start)            
+            
+            # Stop once another iteration would exceed the time budget
+            if budget.exhausted():
+                break
+        self.truncate_traces(len(self.all_times))
+        self.budget = budget.summary(len(self.all_times))
+        budget.report(len(self.all_times))
+        self.active_updates = self.scheduler.summary()
+        self.pruned_components = list(self.pruner.pruned)
+        if accelerate:
+            print "Accelerated with %s: %s sweeps in %s iterations, %s rejected extrapolations. Total time: %s seconds." % (
+                accelerate,self.accelerator.sweeps,len(self.all_times),self.accelerator.rejected,self.all_times[-1])
+        self.profile, self.profile_phases = self.profiler.report(), self.profiler.phases
+        
+    def sweep(self):
+        ''' Update lambdak (if ARD), U, V, and tau once. '''
+        self.scheduler.start_sweep()
+        
+        # Update lambdak
+        if self.ARD:
+            for k in range(self.K):
+                self.lambdak[k] = gamma_mode(self.alphak_s(k),self.betak_s(k))
+        self.profiler.tick('lambda')
+        
+        # Update U
+        if self.engine == 'block':
+            lamb = numpy.tile(self.lambdak,(self.I,1)) if self.ARD else self.lambdaU
+            self.mode_rows_block(self.R,self.M,self.U,self.V,lamb)
+        else:
+            for k in range(0,self.K):   
+                if not self.scheduler.active('U',k):
+                    continue
+                old = numpy.copy(self.U[:,k])
+                tauUk = self.tauU(k)
+                muUk = self.muU(tauUk,k)
+                self.U[:,k] = TN_vector_mode(muUk)
+                self.U[:,k] = numpy.maximum(self.U[:,k],MINIMUM_TN*numpy.ones(self.I))
+                self.scheduler.record('U',k,old,self.U[:,k])
+        self.profiler.tick('U')
+            
+        # Update V
+        if self.engine == 'block':
+            lamb = numpy.tile(self.lambdak,(self.J,1)) if self.ARD else self.lambdaV
+            self.mode_rows_block(self.R.T,self.M.T,self.V,self.U,lamb)
+        else:
+            for k in range(0,self.K):
+                if not self.scheduler.active('V',k):
+                    continue
+                old = numpy.copy(self.V[:,k])
+                tauVk = self.tauV(k)
+                muVk = self.muV(tauVk,k)
+                self.V[:,k] = TN_vector_mode(muVk)
+                self.V[:,k] = numpy.maximum(self.V[:,k],MINIMUM_TN*numpy.ones(self.J))
+                self.scheduler.record('V',k,old,self.V[:,k])
+        self.profiler.tick('V')
+            
+        # Update tau
+        self.tau = gamma_mode(self.alpha_s(),self.beta_s())
+        self.profiler.tick('tau')
+        
+    def truncate_traces(self,iterations):
+        ''' Keep only the values of the first iterations iterations, when stopping early. '''
+        for name in TRACES:
+            setattr(self,name,getattr(self,name)[:iterations])
+        
+        
+    def prune_components(self,iteration):
+        ''' Remove the components whose magnitude has stayed below the threshold (see pruning.py). '''
+        positions = self.pruner.check(component_magnitudes(self.U,self.V),iteration)
+        if positions:
+            remove_components(self,COMPONENT_ARRAYS,positions)
+            self.K = len(self.pruner.active)
+            self.prediction_cache = {}
         
         
     ''' Compute the parameters for the distributions we sample from. '''
@@ -222,6 +321,78 @@ class nmf_icm:
         return 1./tauVk * (-lamb + self.tau*(self.M.T * ( (self.R-numpy.dot(self.U,self.V.T)+numpy.outer(self.U[:,k],self.V[:,k])).T*self.U[:,k] )).T.sum(axis=0)) 
 
 
+    ''' Fold in new rows or columns, keeping the trained factors fixed. '''
+    def fold_in_rows(self,R_new,M_new,iterations):
+        ''' Find the MAP of U for new rows (I_new x J), keeping V, tau and lambdak fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=0)
+        lamb = self.lambdak if self.ARD else self.lambdaU.mean(axis=0)
+        return self.fold_in(R,M,self.V,lamb,iterations)
+
+    def fold_in_columns(self,R_new,M_new,iterations):
+        ''' Find the MAP of V for new columns (I x J_new), keeping U, tau and lambdak fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=1)
+        lamb = self.lambdak if self.ARD else self.lambdaV.mean(axis=0)
+        return self.fold_in(R,M,self.U,lamb,iterations)
+
+    def fold_in(self,R,M,B,lamb,iterations):
+        ''' Run ICM for A in R ~ A B.T, and return the final modes. '''
+        lamb = numpy.tile(lamb,(R.shape[0],1))
+        A = numpy.random.exponential(scale=1./lamb)
+        for it in range(iterations):
+            self.mode_rows(R,M,A,B,lamb)
+        return A
+
+    def mode_rows(self,R,M,A,B,lamb):
+        ''' Set each column of A in R ~ A B.T to its mode, for all rows at once. lamb is the prior for A. '''
+        if self.engine == 'block':
+            return self.mode_rows_block(R,M,A,B,lamb)
+        for k in range(A.shape[1]):
+            tauAk = self.tau * ( M * B[:,k]**2 ).sum(axis=1)
+            muAk = 1./tauAk * (-lamb[:,k] + self.tau*(M * ( (R-numpy.dot(A,B.T)+numpy.outer(A[:,k],B[:,k]))*B[:,k] )).sum(axis=1))
+            A[:,k] = numpy.maximum(TN_vector_mode(muAk),MINIMUM_TN)
+
+    def mode_rows_block(self,R,M,A,B,lamb):
+        ''' Set each row of A in R ~ A B.T to its exact conditional mode (at least MINIMUM_TN), solving the NNLS problems for all rows at once. '''
+        gram = self.tau * masked_gram(M,B)
+        linear = self.tau * numpy.dot(M*R,B) - lamb
+        A[:] = batched_nnls(gram,linear,A,lower=MINIMUM_TN)
+
+
+    ''' Add new observations to R, and continue from the current state. '''
+    def update_data(self,new_entries):
+        ''' Add a list of new observations (i,j,Rij) to R and M, and store which rows and columns they touch. '''
+        for (i,j,value) in new_entries:
+            assert 0 <= i < self.I and 0 <= j < self.J, "New entry (%s,%s) lies outside of R, which has shape %s." % (i,j,self.R.shape)
+        self.data = self.data.with_entries(new_entries)
+        (self.R, self.M) = (self.data.R, self.data.M)
+        self.size_Omega = self.data.size_Omega
+        self.touched_rows = sorted(set(self.touched_rows) | set([i for (i,_,_) in new_entries]))
+        self.touched_columns = sorted(set(self.touched_columns) | set([j for (_,j,_) in new_entries]))
+        self.evaluator.clear() # R and M have changed
+
+    def refine(self,iterations,local_sweeps=0):
+        ''' Continue ICM from the current state, after first doing local_sweeps over only the touched rows and columns. '''
+        for sweep in range(local_sweeps):
+            self.sweep_touched()
+        self.touched_rows, self.touched_columns = [], []
+        self.run(iterations)
+
+    def sweep_touched(self):
+        ''' Set U for the touched rows and V for the touched columns to their modes, and then tau. '''
+        rows, columns = self.touched_rows, self.touched_columns
+        if rows:
+            U_rows = self.U[rows]
+            lamb = numpy.tile(self.lambdak,(len(rows),1)) if self.ARD else self.lambdaU[rows]
+            self.mode_rows(self.R[rows],self.M[rows],U_rows,self.V,lamb)
+            self.U[rows] = U_rows
+        if columns:
+            V_columns = self.V[columns]
+            lamb = numpy.tile(self.lambdak,(len(columns),1)) if self.ARD else self.lambdaV[columns]
+            self.mode_rows(self.R[:,columns].T,self.M[:,columns].T,V_columns,self.U,lamb)
+            self.V[columns] = V_columns
+        self.tau = gamma_mode(self.alpha_s(),self.beta_s())
+
+
     def approx_expectation(self,burn_in,thinning):
         ''' Return our expectation of U, V, tau, lambdak. '''
         indices = range(burn_in,len(self.all_U),thinning)
@@ -233,44 +404,50 @@ class nmf_icm:
         return (exp_U, exp_V, exp_tau, exp_lambdak)
 
 
-    def predict(self,M_pred,burn_in,thinning):
+    def predict(self,M_pred,burn_in,thinning,metrics=ALL_METRICS):
         ''' Compute the expectation of U and V, and use it to predict missing values. '''
-        (exp_U,exp_V,_,_) = self.approx_expectation(burn_in,thinning)
-        R_pred = numpy.dot(exp_U, exp_V.T)
-        MSE = self.compute_MSE(M_pred, self.R, R_pred)
-        R2 = self.compute_R2(M_pred, self.R, R_pred)    
-        Rp = self.compute_Rp(M_pred, self.R, R_pred)        
-        return { 'MSE': MSE, 'R^2': R2, 'Rp': Rp }
+        return self.evaluator.evaluate(M_pred,self.R,lambda rows,cols: self.predict_entries(rows,cols,burn_in,thinning),metrics)
         
     def predict_while_running(self):
         ''' Predict the training error while running. '''
-        R_pred = numpy.dot(self.U, self.V.T)
-        MSE = self.compute_MSE(self.M, self.R, R_pred)
-        R2 = self.compute_R2(self.M, self.R, R_pred)    
-        Rp = self.compute_Rp(self.M, self.R, R_pred)        
-        return {'MSE': MSE, 'R^2': R2, 'Rp': Rp}
+        return self.evaluator.evaluate(self.M,self.R,lambda rows,cols: (self.U[rows] * self.V[cols]).sum(axis=1))
         
         
+    ''' Predict individual entries or rows, without computing the full matrix. '''
+    def predict_entries(self,rows,cols,burn_in,thinning):
+        ''' Return the predictions for the entries (rows[n],cols[n]), using the expectations of U and V. '''
+        rows, cols = numpy.array(rows,dtype=int), numpy.array(cols,dtype=int)
+        (exp_U,exp_V) = self.cached_expectation(burn_in,thinning)
+        R_pred = (exp_U[rows] * exp_V[cols]).sum(axis=1)
+        return R_pred
+
+    def predict_rows(self,rows,burn_in,thinning):
+        ''' Return the predictions for all columns of the given rows, using the expectations of U and V. '''
+        rows = numpy.array(rows,dtype=int)
+        (exp_U,exp_V) = self.cached_expectation(burn_in,thinning)
+        R_pred = numpy.dot(exp_U[rows],exp_V.T)
+        return R_pred
+
+    def cached_expectation(self,burn_in,thinning):
+        ''' Return (exp_U, exp_V) for the given burn-in and thinning, cached until the algorithm is run again. '''
+        if (burn_in,thinning) not in self.prediction_cache:
+            (exp_U,exp_V,_,_) = self.approx_expectation(burn_in,thinning)
+            self.prediction_cache[(burn_in,thinning)] = (exp_U,exp_V)
+        return self.prediction_cache[(burn_in,thinning)]
+
+
     ''' Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation) '''
     def compute_MSE(self,M,R,R_pred):
         ''' Return the MSE of predictions in R_pred, expected values in R, for the entries in M. '''
-        return (M * (R-R_pred)**2).sum() / float(M.sum())
+        return compute_MSE(M,R,R_pred)
         
     def compute_R2(self,M,R,R_pred):
         ''' Return the R^2 of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean = (M*R).sum() / float(M.sum())
-        SS_total = float((M*(R-mean)**2).sum())
-        SS_res = float((M*(R-R_pred)**2).sum())
-        return 1. - SS_res / SS_total if SS_total != 0. else numpy.inf
+        return compute_R2(M,R,R_pred)
         
     def compute_Rp(self,M,R,R_pred):
         ''' Return the Rp of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean_real = (M*R).sum() / float(M.sum())
-        mean_pred = (M*R_pred).sum() / float(M.sum())
-        covariance = (M*(R-mean_real)*(R_pred-mean_pred)).sum()
-        variance_real = (M*(R-mean_real)**2).sum()
-        variance_pred = (M*(R_pred-mean_pred)**2).sum()
-        return covariance / float(math.sqrt(variance_real)*math.sqrt(variance_pred))
+        return compute_Rp(M,R,R_pred)
         
     
     def quality(self,metric,burn_in,thinning):
@@ -300,6 +477,34 @@ class nmf_icm:
         return self.size_Omega / 2. * ( exp_logtau - math.log(2*math.pi) ) \
             - exp_tau / 2. * (self.M*( self.R - numpy.dot(exp_U,exp_V.T))**2).sum()
              
+    def log_posterior(self):
+        ''' Return the log of the joint density of R, U, V, tau, and lambdak (if ARD) at the current values. '''
+        lambdaU = self.lambdak if self.ARD else self.lambdaU
+        lambdaV = self.lambdak if self.ARD else self.lambdaV
+        log_posterior = self.log_likelihood(self.U,self.V,self.tau) \
+                        + (numpy.log(lambdaU) - lambdaU * self.U).sum() + (numpy.log(lambdaV) - lambdaV * self.V).sum() \
+                        + gamma_log_density(self.tau,self.alphatau,self.betatau)
+        if self.ARD:
+            log_posterior += gamma_log_density(self.lambdak,self.alpha0,self.beta0).sum()
+        return log_posterior
+             
     def number_parameters(self):
         ''' Return the number of free variables in the model. '''
         return (self.I*self.K + self.J*self.K + 1) + (self.K if self.ARD else 0)
+        
+        
+    ''' Save and load the model. '''
+    def save(self,path,burn_in=None,thinning=None,traces=True):
+        ''' Store the model in the directory path. If burn_in and thinning are given, also store the expectations. '''
+        summaries = {} if burn_in is None else dict(zip(['exp_U','exp_V','exp_tau','exp_lambdak'],self.approx_expectation(burn_in,thinning)))
+        save_model(self,path,SAVE_DIMENSIONS,SAVE_HYPERPARAMETERS,SAVE_STATE,SAVE_TRACES if traces else [],summaries)
+
+    @classmethod
+    def load(cls,path,mmap_traces=True):
+        ''' Load a model stored using save(path). The traces are memory-mapped, unless mmap_traces is False. '''
+        metadata, values = load_model(path,cls.__name__,mmap_traces)
+        dimensions = metadata['dimensions']
+        model = cls(values['data']['R'],values['data']['M'],dimensions['K'],dimensions['ARD'],values['hyperparameters'],
+                    str(dimensions.get('engine','coordinate')))
+        restore_model(model,values)
+        return model
\ No newline at end of file
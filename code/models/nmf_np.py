@@ -13,66 +13,93 @@ Or more efficiently using matrix operations:
 And realising that elements in each column in U and V are independent:
 - U.k <- U.k * sum(M * [V.k * (R / (U dot V.T))], axis=1) / sum(M dot V.k, axis=1)
 - V.k <- V.k * sum(M * [U.k * (R / (U dot V.T))], axis=0) / sum(M dot U.k, axis=0)
+With solver='matrix' we instead update all columns of U (and then V) at once,
+using masked matrix products, and reuse U dot V.T for the objective:
+- U <- U * ( [M * R / (U dot V.T)] dot V ) / ( M dot V )
+- V <- V * ( [M * R / (U dot V.T)].T dot U ) / ( M.T dot U )
+With objective='Frobenius' we minimise sum(M * (R - U dot V.T)**2) instead of 
+the I-divergence, using the updates:
+- U <- U * ( [M * R] dot V ) / ( [M * (U dot V.T)] dot V )
+- V <- V * ( [M * R].T dot U ) / ( [M * (U dot V.T)].T dot U )
+With solver='hals' (only for objective='Frobenius') we use hierarchical 
+alternating least squares: exact non-negative updates of each column, using 
+the masked Gram matrices of the other factor matrix (see hals.py). This 
+typically needs far fewer iterations than the multiplicative updates.
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix, or a Dataset shared with other models (see dataset.py)
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or None to use the mask of the Dataset R
 - K, the number of latent factors
+- solver, either 'columns' (default, one column at a time), 'matrix', or 'hals'
+- objective, either 'I-div' (default) or 'Frobenius'
+The value of the objective in each iteration is stored in NMF.all_objective.
     
 Initialisation can be done by running the initialise(init,tauUV) function. We initialise as follows:
 - init_UV = 'ones'        -> U[i,k] = V[j,k] = 1
           = 'random'      -> U[i,k] ~ U(0,1), V[j,k] ~ U(0,1), 
           = 'exponential' -> U[i,k] ~ Exp(expo_prior), V[j,k] ~ Exp(expo_prior) 
+          = 'nndsvd'      -> U, V = NNDSVD of R, with mean imputation (see nndsvd.py)
+          = 'nndsvd-iterative' -> the same, with iterative imputation
   where expo_prior is an additional parameter (default 1).
+
+Further features (see the module named for the details):
+    NMF.run(iterations,profile=False)        -> do not time the phases of run() in NMF.profile (profiler.py)
+    NMF.run(iterations,time_budget=seconds)  -> stop before exceeding a wall-clock budget (budget.py)
+    NMF.run(iterations,accelerate='squarem') -> or 'anderson', extrapolate the updates (acceleration.py)
+    NMF.run(iterations,active_set=True)      -> with the columns solver, skip the columns that hardly change (active_set.py)
 """
 
 from distributions.exponential import exponential_draw
+from nndsvd import nndsvd_factors, OPTIONS_NNDSVD
+from persistence import save_model, load_model, restore_model
+from dataset import shared_dataset
+from fold_in import new_rows
+from metrics import ALL_METRICS, Evaluator, compute_MSE, compute_R2, compute_Rp
+from profiler import Profiler, NullProfiler
+from budget import TimeBudget
+from hals import update_rows_hals
+from acceleration import create_accelerator, POSITIVE
+from active_set import create_scheduler
 
 import numpy, math, itertools, time
 
-ALL_METRICS = ['MSE','R^2','Rp']
-OPTIONS_INIT_UV = ['ones', 'random', 'exponential']
+OPTIONS_INIT_UV = ['ones', 'random', 'exponential'] + OPTIONS_NNDSVD
+OPTIONS_SOLVER = ['columns', 'matrix', 'hals']
+OPTIONS_OBJECTIVE = ['I-div', 'Frobenius']
+SAVE_DIMENSIONS = ['K','solver','objective']
+SAVE_HYPERPARAMETERS = []
+SAVE_STATE = ['U','V','touched_rows','touched_columns']
+SAVE_TRACES = ['all_times','all_performances','all_objective','all_sweeps']
+ACCELERATED_PARAMETERS = [('U',POSITIVE),('V',POSITIVE)]
+ACTIVE_SET_AXES = { 'U':('K',), 'V':('K',) }
 
 class nmf_np:
-    def __init__(self,R,M,K):
+    def __init__(self,R,M,K,solver='columns',objective='I-div'):
         ''' Set up the class and do some checks on the values passed. '''
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+        self.data = shared_dataset(R,M)
+        (self.R, self.M) = (self.data.R, self.data.M)
         self.K = K                     
         
+        assert solver in OPTIONS_SOLVER, "Unrecognised solver: %s. Should be one in %s." % (solver, OPTIONS_SOLVER)
+        assert objective in OPTIONS_OBJECTIVE, "Unrecognised objective: %s. Should be one in %s." % (objective, OPTIONS_OBJECTIVE)
+        assert objective == 'Frobenius' or solver != 'hals', "The HALS solver minimises the Frobenius objective, not the %s." % objective
+        self.solver, self.objective = solver, objective
+        
         self.metrics = ['MSE','R^2','Rp']
                 
-        assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
-            "but instead %s-dimensional." % len(self.R.shape)
-        assert self.R.shape == self.M.shape, "Input matrix R is not of the same size as " \
-            "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
-            
-        (self.I,self.J) = self.R.shape
-        
-        self.check_empty_rows_columns() 
+        (self.I,self.J) = self.data.shape
+        self.touched_rows, self.touched_columns = [], []
+        self.evaluator = Evaluator()
         
         # For computing the I-div it is easier if unknown values are 1's, not 0's, to avoid numerical issues
-        self.R_excl_unknown = numpy.empty((self.I,self.J))
-        for i,j in itertools.product(range(0,self.I),range(0,self.J)):
-            self.R_excl_unknown[i,j] = self.R[i,j] if self.M[i,j] else 1.
+        self.R_excl_unknown = numpy.where(self.M,self.R,1.)
                  
       
-    def check_empty_rows_columns(self):
-        ''' Raise an exception if an entire row or column is empty. '''
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
-                    
-        # Assert none of the rows or columns are entirely unknown values
-        for i,c in enumerate(sums_rows):
-            assert c != 0, "Fully unobserved row in R, row %s." % i
-        for j,c in enumerate(sums_columns):
-            assert c != 0, "Fully unobserved column in R, column %s." % j
-        
-        
-    def train(self,iterations,init_UV='random',expo_prior=1.):
+    def train(self,iterations,init_UV='random',expo_prior=1.,accelerate=None,time_budget=None,active_set=False):
         ''' Initialise and run the algorithm. '''
         self.initialise(init_UV=init_UV,expo_prior=expo_prior) 
-        self.run(iterations=iterations)     
+        self.run(iterations=iterations,accelerate=accelerate,time_budget=time_budget,active_set=active_set)     
 
 
     def initialise(self,init_UV='random',expo_prior=1.):
@@ -92,83 +119,260 @@ class nmf_np:
                 self.U[i,k] = exponential_draw(expo_prior)
             for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
                 self.V[j,k] = exponential_draw(expo_prior)
+        elif init_UV in OPTIONS_NNDSVD:
+            self.U, self.V = nndsvd_factors(self.R,self.M,self.K,init_UV)
     
     
-    def run(self,iterations):
-        ''' Run the algorithm. '''
+    def run(self,iterations,profile=True,accelerate=None,time_budget=None,active_set=False):
+        ''' Run the algorithm. Stop at the time_budget (in seconds), if given. Skip converged columns of U and V if active_set. '''
+        budget = TimeBudget(time_budget,iterations)
         assert hasattr(self,'U') and hasattr(self,'V'), "U and V have not been initialised - please run NMF.initialise() first."        
         
         self.all_times = [] # to plot performance against time
+        self.all_objective = [] # to plot the I-divergence or Frobenius objective
+        self.all_sweeps = [] # to compare accelerated and plain iterations
         self.all_performances = {} # for plotting convergence of metrics
         for metric in ALL_METRICS:
             self.all_performances[metric] = []
             
+        assert not active_set or self.solver == 'columns', "Active-set scheduling is only possible with the columns solver, not %s." % self.solver
+        assert not (active_set and accelerate), "Active-set scheduling can not be combined with acceleration."
+        self.accelerator = create_accelerator(accelerate,self,ACCELERATED_PARAMETERS,self.sweep,self.objective_value,self.reset_prediction)
+        self.scheduler = create_scheduler(ACTIVE_SET_AXES,{'K':self.K},active_set)
+        self.profiler = Profiler() if profile else NullProfiler()
         time_start = time.time()
-        for it in range(1,iterations+1):
-            for k in range(self.K):
-                self.update_U(k)
-            for k in range(self.K):
-                self.update_V(k)
+        self.R_pred = None
+        for it in budget.range(start=1):
+            self.accelerator.step()
+            self.all_sweeps.append(self.accelerator.sweeps)
             
-            self.give_update(it)
+            self.give_update(it,self.R_pred)
+            self.profiler.tick('performance')
             
             time_iteration = time.time()
             self.all_times.append(time_iteration-time_start)       
             
+            # Stop once another iteration would exceed the time budget
+            if budget.exhausted():
+                break
+        self.budget = budget.summary(len(self.all_times))
+        budget.report(len(self.all_times))
+        self.active_updates = self.scheduler.summary()
+        if accelerate:
+            print "Accelerated with %s: %s sweeps in %s iterations, %s rejected extrapolations. Total time: %s seconds." % (
+                accelerate,self.accelerator.sweeps,len(self.all_times),self.accelerator.rejected,self.all_times[-1])
+        self.profile, self.profile_phases = self.profiler.report(), self.profiler.phases
+        
+    def sweep(self):
+        ''' Update U and V once. With the matrix solver, store U V.T in R_pred. '''
+        if self.solver == 'matrix':
+            self.R_pred = self.update_U_matrix(self.R_pred)
+            self.profiler.tick('U')
+            self.R_pred = self.update_V_matrix(self.R_pred)
+            self.profiler.tick('V')
+        elif self.solver == 'hals':
+            self.update_U_hals()
+            self.profiler.tick('U')
+            self.update_V_hals()
+            self.profiler.tick('V')
+        else:
+            self.scheduler.start_sweep()
+            for k in range(self.K):
+                if self.scheduler.active('U',k):
+                    old = numpy.copy(self.U[:,k])
+                    self.update_U(k)
+                    self.scheduler.record('U',k,old,self.U[:,k])
+            self.profiler.tick('U')
+            for k in range(self.K):
+                if self.scheduler.active('V',k):
+                    old = numpy.copy(self.V[:,k])
+                    self.update_V(k)
+                    self.scheduler.record('V',k,old,self.V[:,k])
+            self.profiler.tick('V')
+            
+    def reset_prediction(self):
+        ''' Mark U V.T as out of date, after U and V were set by the accelerator. '''
+        self.R_pred = None
+        
+    def objective_value(self):
+        ''' Return minus the I-divergence or Frobenius error, for the safeguard of the accelerator. '''
+        R_pred = numpy.dot(self.U,self.V.T)
+        return - (self.compute_I_div(R_pred) if self.objective == 'I-div' else self.compute_frobenius(R_pred))
+            
 
     ''' Updates for U and V. '''
     def update_U(self,k):
         ''' Update values for U. '''
+        if self.objective == 'Frobenius':
+            self.U[:,k] = self.U[:,k] * numpy.dot(self.M * self.R, self.V[:,k]) / numpy.dot(self.M * numpy.dot(self.U,self.V.T), self.V[:,k])
+            return
         self.U[:,k] = self.U[:,k] * (self.M * (self.V[:,k] * ( self.R / numpy.dot(self.U,self.V.T) ) )).sum(axis=1) / (self.M * self.V[:,k]).sum(axis=1)
         
     def update_V(self,k):
         ''' Update values for V. '''
+        if self.objective == 'Frobenius':
+            self.V[:,k] = self.V[:,k] * numpy.dot((self.M * self.R).T, self.U[:,k]) / numpy.dot((self.M * numpy.dot(self.U,self.V.T)).T, self.U[:,k])
+            return
         self.V[:,k] = self.V[:,k] * ( (self.U[:,k] * ( self.R / numpy.dot(self.U,self.V.T) ).T ).T * self.M ).sum(axis=0) / (self.U[:,k] * self.M.T).T.sum(axis=0)
         
+    def update_U_matrix(self,R_pred=None):
+        ''' Update all columns of U at once, given R_pred = U V.T (computed if None). Return the new U V.T. '''
+        R_pred = numpy.dot(self.U,self.V.T) if R_pred is None else R_pred
+        if self.objective == 'Frobenius':
+            self.U *= numpy.dot(self.M * self.R, self.V) / numpy.dot(self.M * R_pred, self.V)
+        else:
+            self.U *= numpy.dot(self.M * self.R / R_pred, self.V) / numpy.dot(self.M, self.V)
+        return numpy.dot(self.U,self.V.T)
+        
+    def update_U_hals(self):
+        ''' Update all columns of U in turn with HALS. '''
+        update_rows_hals(self.M * self.R, self.M, self.U, self.V)
+        
+    def update_V_hals(self):
+        ''' Update all columns of V in turn with HALS. '''
+        update_rows_hals((self.M * self.R).T, self.M.T, self.V, self.U)
+        
+    def update_V_matrix(self,R_pred=None):
+        ''' Update all columns of V at once, given R_pred = U V.T (computed if None). Return the new U V.T. '''
+        R_pred = numpy.dot(self.U,self.V.T) if R_pred is None else R_pred
+        if self.objective == 'Frobenius':
+            self.V *= numpy.dot((self.M * self.R).T, self.U) / numpy.dot((self.M * R_pred).T, self.U)
+        else:
+            self.V *= numpy.dot((self.M * self.R / R_pred).T, self.U) / numpy.dot(self.M.T, self.U)
+        return numpy.dot(self.U,self.V.T)
+        
         
-    def predict(self,M_pred):
+    ''' Fold in new rows or columns, keeping the trained factors fixed. '''
+    def fold_in_rows(self,R_new,M_new,iterations):
+        ''' Find U for new rows (I_new x J), keeping V fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=0)
+        return self.fold_in(R,M,self.V,iterations)
+
+    def fold_in_columns(self,R_new,M_new,iterations):
+        ''' Find V for new columns (I x J_new), keeping U fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=1)
+        return self.fold_in(R,M,self.U,iterations)
+
+    def fold_in(self,R,M,B,iterations):
+        ''' Run the updates of the solver and objective for A in R ~ A B.T, with A initialised randomly. '''
+        A = numpy.random.rand(R.shape[0],B.shape[1])
+        for it in range(iterations):
+            self.update_rows(R,M,A,B)
+        return A
+
+    def update_rows(self,R,M,A,B):
+        ''' Update A in R ~ A B.T in place, for all rows at once, in the same way as U in training. '''
+        if self.solver == 'hals':
+            update_rows_hals(M * R, M, A, B)
+        elif self.solver == 'matrix':
+            if self.objective == 'Frobenius':
+                A *= numpy.dot(M * R, B) / numpy.dot(M * numpy.dot(A,B.T), B)
+            else:
+                A *= numpy.dot(M * R / numpy.dot(A,B.T), B) / numpy.dot(M, B)
+        else:
+            for k in range(A.shape[1]):
+                if self.objective == 'Frobenius':
+                    A[:,k] = A[:,k] * numpy.dot(M * R, B[:,k]) / numpy.dot(M * numpy.dot(A,B.T), B[:,k])
+                else:
+                    A[:,k] = A[:,k] * (M * (B[:,k] * ( R / numpy.dot(A,B.T) ) )).sum(axis=1) / (M * B[:,k]).sum(axis=1)
+
+
+    ''' Add new observations to R, and continue from the current state. '''
+    def update_data(self,new_entries):
+        ''' Add a list of new observations (i,j,Rij) to R and M, and store which rows and columns they touch. '''
+        for (i,j,value) in new_entries:
+            assert 0 <= i < self.I and 0 <= j < self.J, "New entry (%s,%s) lies outside of R, which has shape %s." % (i,j,self.R.shape)
+            self.R_excl_unknown[i,j] = value
+        self.data = self.data.with_entries(new_entries)
+        (self.R, self.M) = (self.data.R, self.data.M)
+        self.touched_rows = sorted(set(self.touched_rows) | set([i for (i,_,_) in new_entries]))
+        self.touched_columns = sorted(set(self.touched_columns) | set([j for (_,j,_) in new_entries]))
+        self.evaluator.clear() # R and M have changed
+
+    def refine(self,iterations,local_sweeps=0):
+        ''' Continue the algorithm from the current state, after first doing local_sweeps over only the touched rows and columns. '''
+        for sweep in range(local_sweeps):
+            self.sweep_touched()
+        self.touched_rows, self.touched_columns = [], []
+        self.run(iterations)
+
+    def sweep_touched(self):
+        ''' Update U for the touched rows and V for the touched columns. '''
+        rows, columns = self.touched_rows, self.touched_columns
+        if rows:
+            U_rows = self.U[rows]
+            self.update_rows(self.R[rows],self.M[rows],U_rows,self.V)
+            self.U[rows] = U_rows
+        if columns:
+            V_columns = self.V[columns]
+            self.update_rows(self.R[:,columns].T,self.M[:,columns].T,V_columns,self.U)
+            self.V[columns] = V_columns
+
+
+    def predict(self,M_pred,metrics=ALL_METRICS):
         ''' Predict missing values in R. '''
-        R_pred = numpy.dot(self.U,self.V.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
-        return {'MSE':MSE,'R^2':R2,'Rp':Rp}        
+        return self.evaluator.evaluate(M_pred,self.R,self.predict_entries,metrics)
         
         
+    ''' Predict individual entries or rows, without computing the full matrix. '''
+    def predict_entries(self,rows,cols):
+        ''' Return the predictions for the entries (rows[n],cols[n]). '''
+        rows, cols = numpy.array(rows,dtype=int), numpy.array(cols,dtype=int)
+        return (self.U[rows] * self.V[cols]).sum(axis=1)
+
+    def predict_rows(self,rows):
+        ''' Return the predictions for all columns of the given rows, as a (len(rows),J) array. '''
+        return numpy.dot(self.U[numpy.array(rows,dtype=int)],self.V.T)
+
+
     ''' Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation) '''
     def compute_MSE(self,M,R,R_pred):
         ''' Return the MSE of predictions in R_pred, expected values in R, for the entries in M. '''
-        return (M * (R-R_pred)**2).sum() / float(M.sum())
+        return compute_MSE(M,R,R_pred)
         
     def compute_R2(self,M,R,R_pred):
         ''' Return the R^2 of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean = (M*R).sum() / float(M.sum())
-        SS_total = float((M*(R-mean)**2).sum())
-        SS_res = float((M*(R-R_pred)**2).sum())
-        return 1. - SS_res / SS_total if SS_total != 0. else numpy.inf
+        return compute_R2(M,R,R_pred)
         
     def compute_Rp(self,M,R,R_pred):
         ''' Return the Rp of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean_real = (M*R).sum() / float(M.sum())
-        mean_pred = (M*R_pred).sum() / float(M.sum())
-        covariance = (M*(R-mean_real)*(R_pred-mean_pred)).sum()
-        variance_real = (M*(R-mean_real)**2).sum()
-        variance_pred = (M*(R_pred-mean_pred)**2).sum()
-        return covariance / float(math.sqrt(variance_real)*math.sqrt(variance_pred))   
+        return compute_Rp(M,R,R_pred)
         
         
-    def compute_I_div(self):  
-        ''' Return the I-divergence. '''  
-        R_pred = numpy.dot(self.U, self.V.T)
+    def compute_I_div(self,R_pred=None):  
+        ''' Return the I-divergence. If given, use R_pred = U V.T. '''  
+        R_pred = numpy.dot(self.U, self.V.T) if R_pred is None else R_pred
         return (self.M * ( self.R_excl_unknown * numpy.log( self.R_excl_unknown / R_pred ) - self.R_excl_unknown + R_pred ) ).sum()        
         
+    def compute_frobenius(self,R_pred=None):  
+        ''' Return the squared Frobenius norm of the error on the observed entries. If given, use R_pred = U V.T. '''  
+        R_pred = numpy.dot(self.U, self.V.T) if R_pred is None else R_pred
+        return (self.M * ( self.R - R_pred )**2 ).sum()
         
-    def give_update(self,iteration):    
-        ''' Print and store the I-divergence and performances. '''
+        
+    def give_update(self,iteration,R_pred=None):    
+        ''' Print and store the objective and performances. If given, use R_pred = U V.T for the objective. '''
         perf = self.predict(self.M)
-        i_div = self.compute_I_div()
+        objective = self.compute_I_div(R_pred) if self.objective == 'I-div' else self.compute_frobenius(R_pred)
         
+        self.all_objective.append(objective)
         for metric in ALL_METRICS:
             self.all_performances[metric].append(perf[metric])
                
-        print "Iteration %s. I-divergence: %s. MSE: %s. R^2: %s. Rp: %s." % (iteration,i_div,perf['MSE'],perf['R^2'],perf['Rp'])
+        print "Iteration %s. %s: %s. MSE: %s. R^2: %s. Rp: %s." % (iteration,self.objective,objective,perf['MSE'],perf['R^2'],perf['Rp'])
+        
+        
+    ''' Save and load the model. '''
+    def save(self,path,traces=True):
+        ''' Store the model in the directory path. '''
+        save_model(self,path,SAVE_DIMENSIONS,SAVE_HYPERPARAMETERS,SAVE_STATE,SAVE_TRACES if traces else [])
+
+    @classmethod
+    def load(cls,path,mmap_traces=True):
+        ''' Load a model stored using save(path). The traces are memory-mapped, unless mmap_traces is False. '''
+        metadata, values = load_model(path,cls.__name__,mmap_traces)
+        dimensions = metadata['dimensions']
+        model = cls(values['data']['R'],values['data']['M'],dimensions['K'],
+                    str(dimensions.get('solver','columns')),str(dimensions.get('objective','I-div')))
+        restore_model(model,values)
+        return model
\ No newline at end of file
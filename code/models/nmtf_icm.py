@@ -2,8 +2,9 @@
 Iterated Conditional Modes for MAP non-negative matrix tri-factorisation, with ARD.
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix, or a Dataset shared with other models (see dataset.py)
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or None to use the mask of the Dataset R
 - K, the number of row clusters
 - L, the number of column clusters
 - hyperparameters = { 'alphatau', 'betatau', 'alpha0', 'beta0', 'lambdaS', 'lambdaF', 'lambdaG' },
@@ -11,10 +12,16 @@ We expect the following arguments:
     alpha0, beta0     - if using the ARD, non-negative reals defining prior over ARD lambdaFk and lambdaGl.
     lambdaS           - nonnegative reals defining prior over S
     lambdaF, lambdaG  - if not using the ARD, nonnegative reals defining prior over U and V
+- engine, how we find the conditional modes of F, S and G:
+    'coordinate' (default) - one column of F and G, or entry of S, at a time
+    'block'                - the exact mode of each row of F (and G), and of S (see nnls.py)
+  Both keep the values at least MINIMUM_TN.
     
 The random variables are initialised as follows:
-    F,G: K-means ('kmeans'), expectation ('exp'), or random ('random')
-    S:   expectation ('exp') or random ('random')
+    F,G: K-means ('kmeans'), expectation ('exp'), random ('random'), or
+         NNDSVD ('nndsvd' or 'nndsvd-iterative', see nndsvd.py)
+    S:   expectation ('exp'), random ('random'), or NNDSVD ('nndsvd', only
+         if F and G are initialised with NNDSVD as well)
     tau: using updates, and then random draw
     lambdaFk, lambdaGl: expectation
 We initialise the values of F and G according to the given argument 'init_FG',
@@ -38,9 +45,21 @@ We can test the performance of our model on a test dataset, specifying our test
     performance = BNMTF.predict(M_pred,burn_in,thinning)
 This gives a dictionary of performances,
     performance = { 'MSE', 'R^2', 'Rp' }
+and also 'MAE' with predict(...,metrics=['MSE','R^2','Rp','MAE']) (see metrics.py).
     
 The performances of all iterations are stored in BNMTF.all_performances, which 
-is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances, and the
+log posterior (which ICM increases in each iteration) in BNMTF.all_log_posterior.
+
+Further features (see the module or method named for the details):
+    BNMTF.update_data(new_entries)             -> add observations, then continue with refine(iterations,local_sweeps)
+    BNMTF.save(path,burn_in,thinning)          -> store the model in a directory, for nmtf_icm.load(path) (persistence.py)
+    BNMTF.predict_entries(rows,cols,burn_in,thinning) -> predict some entries, or predict_rows(rows,burn_in,thinning)
+    BNMTF.run(iterations,profile=False)        -> do not time the phases of run() in BNMTF.profile (profiler.py)
+    BNMTF.run(iterations,time_budget=seconds)  -> stop before exceeding a wall-clock budget (budget.py)
+    BNMTF.run(iterations,prune=True)           -> remove the components ARD switches off (pruning.py)
+    BNMTF.run(iterations,accelerate='squarem') -> or 'anderson', extrapolate the updates (acceleration.py)
+    BNMTF.run(iterations,active_set=True)      -> with the coordinate engine, skip what hardly changes (active_set.py)
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -51,79 +70,80 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 """
 
 from kmeans.kmeans import KMeans
+from nndsvd import nndsvd_tri_factors, OPTIONS_NNDSVD
 from distributions.exponential import exponential_draw
-from distributions.gamma import gamma_mode
+from distributions.gamma import gamma_mode, gamma_log_density
 from distributions.truncated_normal import TN_mode
 from distributions.truncated_normal_vector import TN_vector_mode
+from persistence import save_model, load_model, restore_model
+from dataset import shared_dataset, prior_matrix
+from fold_in import new_rows
+from metrics import ALL_METRICS, Evaluator, compute_MSE, compute_R2, compute_Rp
+from profiler import Profiler, NullProfiler
+from budget import TimeBudget, trace_length, extend_traces
+from pruning import create_pruner, component_magnitudes, remove_components
+from hals import masked_gram
+from nnls import batched_nnls
+from acceleration import create_accelerator, POSITIVE
+from active_set import create_scheduler
 
 import numpy, itertools, math, time
 
-ALL_METRICS = ['MSE','R^2','Rp']
 ALL_QUALITY = ['loglikelihood','BIC','AIC','MSE','ELBO']
-OPTIONS_INIT_FG = ['kmeans', 'random', 'exp']
-OPTIONS_INIT_S = ['random', 'exp']
+OPTIONS_INIT_FG = ['kmeans', 'random', 'exp'] + OPTIONS_NNDSVD
+OPTIONS_ENGINE = ['coordinate', 'block']
+SAVE_DIMENSIONS = ['K','L','ARD','engine']
+SAVE_HYPERPARAMETERS = ['alphatau','betatau','alpha0','beta0','lambdaF','lambdaS','lambdaG']
+SAVE_STATE = ['F','S','G','tau','lambdaFk','lambdaGl','touched_rows','touched_columns']
+SAVE_TRACES = ['all_F','all_S','all_G','all_tau','all_lambdaFk','all_lambdaGl','all_times','all_performances','pruned_components','all_log_posterior','all_sweeps']
+ROW_COMPONENT_ARRAYS = [('F',1),('S',0),('lambdaFk',0),('lambdaS',0)]
+COLUMN_COMPONENT_ARRAYS = [('G',1),('S',1),('lambdaGl',0),('lambdaS',1)]
+TRACES = ['all_F','all_S','all_G','all_tau','all_lambdaFk','all_lambdaGl']
+OPTIONS_INIT_S = ['random', 'exp', 'nndsvd']
 MINIMUM_TN = 0.1 # ICM has the tendency to set most columns to 0's; we reset them to this value.
+ACCELERATED_PARAMETERS = [('F',0.),('S',0.),('G',0.),('tau',POSITIVE)]
+ACCELERATED_PARAMETERS_ARD = ACCELERATED_PARAMETERS + [('lambdaFk',POSITIVE),('lambdaGl',POSITIVE)]
+ACTIVE_SET_AXES = { 'F':('K',), 'S':('K','L'), 'G':('L',) }
 ELEMENT_WISE_SPARSITY = True # If True, use element wise sparsity (ARD) for Skl
 
 class nmtf_icm:
-    def __init__(self,R,M,K,L,ARD,hyperparameters):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,L,ARD,hyperparameters,engine='coordinate'):
+        self.data = shared_dataset(R,M)
+        (self.R, self.M) = (self.data.R, self.data.M)
         self.K = K
         self.L = L
         self.ARD = ARD
         
-        assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
-            "but instead %s-dimensional." % len(self.R.shape)
-        assert self.R.shape == self.M.shape, "Input matrix R is not of the same size as " \
-            "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
-            
-        (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
-        self.check_empty_rows_columns()      
+        assert engine in OPTIONS_ENGINE, "Unrecognised engine: %s. Should be one in %s." % (engine, OPTIONS_ENGINE)
+        self.engine = engine
+        
+        (self.I,self.J) = self.data.shape
+        self.size_Omega = self.data.size_Omega
+        self.touched_rows, self.touched_columns = [], []
+        self.evaluator = Evaluator()
+        self.prediction_cache = {}
         
         self.alphatau, self.betatau = float(hyperparameters['alphatau']), float(hyperparameters['betatau'])
-        self.lambdaS = numpy.array(hyperparameters['lambdaS'])
-        if self.lambdaS.shape == ():
-            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L))
-        assert self.lambdaS.shape == (self.K,self.L), "Prior matrix lambdaS has the wrong shape: %s instead of (%s, %s)." % (self.lambdaS.shape,self.K,self.L)
+        self.lambdaS = prior_matrix(hyperparameters['lambdaS'],(self.K,self.L),'lambdaS')
             
         if self.ARD:
             self.alpha0, self.beta0 = float(hyperparameters['alpha0']), float(hyperparameters['beta0'])
         else:
-            self.lambdaF, self.lambdaG = numpy.array(hyperparameters['lambdaF']), numpy.array(hyperparameters['lambdaG'])
-            # Make lambdaF/G into a numpy array if they are a float
-            if self.lambdaF.shape == ():
-                self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K))
-            if self.lambdaG.shape == ():
-                self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L))
-        
-            assert self.lambdaF.shape == (self.I,self.K), "Prior matrix lambdaF has the wrong shape: %s instead of (%s, %s)." % (self.lambdaF.shape,self.I,self.K)
-            assert self.lambdaG.shape == (self.J,self.L), "Prior matrix lambdaG has the wrong shape: %s instead of (%s, %s)." % (self.lambdaG.shape,self.J,self.L)
+            self.lambdaF = prior_matrix(hyperparameters['lambdaF'],(self.I,self.K),'lambdaF')
+            self.lambdaG = prior_matrix(hyperparameters['lambdaG'],(self.J,self.L),'lambdaG')
              
              
-    def check_empty_rows_columns(self):
-        ''' Raise an exception if an entire row or column is empty. '''
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
-                    
-        # Assert none of the rows or columns are entirely unknown values
-        for i,c in enumerate(sums_rows):
-            assert c != 0, "Fully unobserved row in R, row %s." % i
-        for j,c in enumerate(sums_columns):
-            assert c != 0, "Fully unobserved column in R, column %s." % j
-
-
-    def train(self,init_FG,init_S,iterations):
+    def train(self,init_FG,init_S,iterations,prune=False,accelerate=None,time_budget=None,active_set=False):
         ''' Initialise and run the sampler. '''
         self.initialise(init_FG=init_FG, init_S=init_S)
-        self.run(iterations)
+        self.run(iterations,prune=prune,accelerate=accelerate,time_budget=time_budget,active_set=active_set)
 
 
     def initialise(self,init_FG='random',init_S='random'):
         ''' Initialise F, S, G, tau, and lambdaFk, lambdaGl (if ARD). '''
         assert init_FG in OPTIONS_INIT_FG, "Unknown initialisation option for F and G: %s. Should be in %s." % (init_FG, OPTIONS_INIT_FG)
         assert init_S in OPTIONS_INIT_S, "Unknown initialisation option for S: %s. Should be in %s." % (init_S, OPTIONS_INIT_S)
+        assert init_S != 'nndsvd' or init_FG in OPTIONS_NNDSVD, "S can only be initialised with NNDSVD if F and G are as well."
         
         self.F = numpy.zeros((self.I,self.K))
         self.S = numpy.zeros((self.K,self.L))
@@ -151,6 +171,8 @@ class nmtf_icm:
             kmeans_G.initialise()
             kmeans_G.cluster()
             self.G = kmeans_G.clustering_results + 0.2
+        elif init_FG in OPTIONS_NNDSVD:
+            self.F, S_nndsvd, self.G = nndsvd_tri_factors(self.R,self.M,self.K,self.L,init_FG)
         else:
             # 'random' or 'exp'
             for i,k in itertools.product(range(self.I),range(self.K)):    
@@ -161,77 +183,154 @@ class nmtf_icm:
                 self.G[j,l] = exponential_draw(hyperparam) if init_FG == 'random' else 1.0/hyperparam
             
         # Initialise S
-        for k,l in itertools.product(range(self.K),range(self.L)):
-            hyperparam = self.lambdaS[k,l] 
-            self.S[k,l] = exponential_draw(hyperparam) if init_S == 'random' else 1.0/hyperparam
+        if init_S == 'nndsvd':
+            self.S = S_nndsvd
+        else:
+            for k,l in itertools.product(range(self.K),range(self.L)):
+                hyperparam = self.lambdaS[k,l] 
+                self.S[k,l] = exponential_draw(hyperparam) if init_S == 'random' else 1.0/hyperparam
         
         # Initialise tau
         self.tau = gamma_mode(self.alpha_s(),self.beta_s())
 
 
-    def run(self,iterations):
-        ''' Run the Gibbs sampler. '''
-        self.all_F = numpy.zeros((iterations,self.I,self.K))  
-        self.all_S = numpy.zeros((iterations,self.K,self.L))   
-        self.all_G = numpy.zeros((iterations,self.J,self.L))  
-        self.all_tau = numpy.zeros(iterations)
-        self.all_lambdaFk = numpy.zeros((iterations,self.K))
-        self.all_lambdaGl = numpy.zeros((iterations,self.L))
+    def run(self,iterations,profile=True,prune=False,accelerate=None,time_budget=None,active_set=False):
+        ''' Run the Gibbs sampler. Stop at the time_budget (in seconds), if given.
+            Skip converged columns of F and G, and entries of S, if active_set. '''
+        budget = TimeBudget(time_budget,iterations)
+        self.all_F = numpy.zeros((trace_length(iterations),self.I,self.K))  
+        self.all_S = numpy.zeros((trace_length(iterations),self.K,self.L))   
+        self.all_G = numpy.zeros((trace_length(iterations),self.J,self.L))  
+        self.all_tau = numpy.zeros(trace_length(iterations))
+        self.all_lambdaFk = numpy.zeros((trace_length(iterations),self.K))
+        self.all_lambdaGl = numpy.zeros((trace_length(iterations),self.L))
+        self.prediction_cache = {} # predictions for the old factors are no longer valid
         self.all_times = [] # to plot performance against time
+        self.all_log_posterior = [] # to check for convergence
+        self.all_sweeps = [] # to compare accelerated and plain iterations
         
         self.all_performances = {} # for plotting convergence of metrics
         for metric in ALL_METRICS:
             self.all_performances[metric] = []
         
+        assert not prune or self.ARD, "Pruning components is only possible when using ARD."
+        assert not (prune and accelerate), "Components can not be pruned when accelerating the iterations."
+        assert not active_set or self.engine == 'coordinate', "Active-set scheduling is only possible with the coordinate engine, not %s." % self.engine
+        assert not (active_set and (prune or accelerate)), "Active-set scheduling can not be combined with pruning or acceleration."
+        self.pruner_F, self.pruner_G = create_pruner(self.K,prune), create_pruner(self.L,prune)
+        self.scheduler = create_scheduler(ACTIVE_SET_AXES,{'K':self.K,'L':self.L},active_set)
+        parameters = ACCELERATED_PARAMETERS_ARD if self.ARD else ACCELERATED_PARAMETERS
+        self.accelerator = create_accelerator(accelerate,self,parameters,self.sweep,self.log_posterior)
+        self.profiler = Profiler() if profile else NullProfiler()
         time_start = time.time()
-        for it in range(0,iterations):   
-            # Update lambdaFk, lambdaGl
+        for it in budget.range():
+            # Update lambdaFk, lambdaGl, F, S, G, and tau
+            self.accelerator.step()
+            self.all_sweeps.append(self.accelerator.sweeps)
+            
+            # Remove components that ARD has switched off
+            if prune:
+                self.prune_components(it)
+                self.profiler.tick('pruning')
+            
+            # Store draws
+            extend_traces(self,TRACES,it)
+            self.all_F[it], self.all_G[it], self.all_tau[it] = self.pruner_F.expand(self.F,1), self.pruner_G.expand(self.G,1), self.tau
+            self.all_S[it] = self.pruner_F.expand(self.pruner_G.expand(self.S,1),0)
             if self.ARD:
-                for k in range(self.K):
-                    self.lambdaFk[k] = gamma_mode(self.alphaFk_s(k),self.betaFk_s(k))
-                for l in range(self.L):
-                    self.lambdaGl[l] = gamma_mode(self.alphaGl_s(l),self.betaGl_s(l))
+                self.all_lambdaFk[it] = self.pruner_F.expand(self.lambdaFk,0)
+                self.all_lambdaGl[it] = self.pruner_G.expand(self.lambdaGl,0)
+            self.profiler.tick('traces')
+            
+            # Store and print performances
+            perf = self.predict_while_running()
+            self.all_log_posterior.append(self.log_posterior())
+            self.profiler.tick('performance')
+            for metric in ALL_METRICS:
+                self.all_performances[metric].append(perf[metric])
+                
+            print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+            self.profiler.tick('output')
+        
+            # Store time taken for iteration
+            time_iteration = time.time()
+            self.all_times.append(time_iteration-time_start)            
             
-            # Update F
+            # Stop once another iteration would exceed the time budget
+            if budget.exhausted():
+                break
+        self.truncate_traces(len(self.all_times))
+        self.budget = budget.summary(len(self.all_times))
+        budget.report(len(self.all_times))
+        self.active_updates = self.scheduler.summary()
+        self.pruned_components = { 'F':list(self.pruner_F.pruned), 'G':list(self.pruner_G.pruned) }
+        if accelerate:
+            print "Accelerated with %s: %s sweeps in %s iterations, %s rejected extrapolations. Total time: %s seconds." % (
+                accelerate,self.accelerator.sweeps,len(self.all_times),self.accelerator.rejected,self.all_times[-1])
+        self.profile, self.profile_phases = self.profiler.report(), self.profiler.phases
+        
+    def sweep(self):
+        ''' Update lambdaFk and lambdaGl (if ARD), F, S, G, and tau once. '''
+        self.scheduler.start_sweep()
+        
+        # Update lambdaFk, lambdaGl
+        if self.ARD:
+            for k in range(self.K):
+                self.lambdaFk[k] = gamma_mode(self.alphaFk_s(k),self.betaFk_s(k))
+            for l in range(self.L):
+                self.lambdaGl[l] = gamma_mode(self.alphaGl_s(l),self.betaGl_s(l))
+        self.profiler.tick('lambda')
+        
+        # Update F
+        if self.engine == 'block':
+            lamb = numpy.tile(self.lambdaFk,(self.I,1)) if self.ARD else self.lambdaF
+            self.mode_rows_block(self.R,self.M,self.F,numpy.dot(self.G,self.S.T),lamb)
+        else:
             for k in range(0,self.K):
+                if not self.scheduler.active('F',k):
+                    continue
+                old = numpy.copy(self.F[:,k])
                 tauFk = self.tauF(k)
                 muFk = self.muF(tauFk,k)
                 self.F[:,k] = TN_vector_mode(muFk)
                 self.F[:,k] = numpy.maximum(self.F[:,k],MINIMUM_TN*numpy.ones(self.I))
-                
-            # Update S
+                self.scheduler.record('F',k,old,self.F[:,k])
+        self.profiler.tick('F')
+            
+        # Update S
+        if self.engine == 'block':
+            self.mode_S_block()
+        else:
             for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
+                if not self.scheduler.active('S',(k,l)):
+                    continue
+                old = self.S[k,l]
                 tauSkl = self.tauS(k,l)
                 muSkl = self.muS(tauSkl,k,l)
                 self.S[k,l] = TN_mode(muSkl)
                 self.S[k,l] = max(self.S[k,l],MINIMUM_TN)
-                
-            # Update G
+                self.scheduler.record('S',(k,l),old,self.S[k,l])
+        self.profiler.tick('S')
+            
+        # Update G
+        if self.engine == 'block':
+            lamb = numpy.tile(self.lambdaGl,(self.J,1)) if self.ARD else self.lambdaG
+            self.mode_rows_block(self.R.T,self.M.T,self.G,numpy.dot(self.F,self.S),lamb)
+        else:
             for l in range(0,self.L):
+                if not self.scheduler.active('G',l):
+                    continue
+                old = numpy.copy(self.G[:,l])
                 tauGl = self.tauG(l)
                 muGl = self.muG(tauGl,l)
                 self.G[:,l] = TN_vector_mode(muGl)
                 self.G[:,l] = numpy.maximum(self.G[:,l],MINIMUM_TN*numpy.ones(self.J))
-                
-            # Update tau
-            self.tau = gamma_mode(self.alpha_s(),self.beta_s())
+                self.scheduler.record('G',l,old,self.G[:,l])
+        self.profiler.tick('G')
             
-            # Store draws
-            self.all_F[it], self.all_S[it], self.all_G[it], self.all_tau[it] = numpy.copy(self.F), numpy.copy(self.S), numpy.copy(self.G), self.tau
-            if self.ARD:
-                self.all_lambdaFk[it] = numpy.copy(self.lambdaFk)
-                self.all_lambdaGl[it] = numpy.copy(self.lambdaGl)
-            
-            # Store and print performances
-            perf = self.predict_while_running()
-            for metric in ALL_METRICS:
-                self.all_performances[metric].append(perf[metric])
-                
-            print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
-        
-            # Store time taken for iteration
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)            
+        # Update tau
+        self.tau = gamma_mode(self.alpha_s(),self.beta_s())
+        self.profiler.tick('tau')
             
 
     def triple_dot(self,M1,M2,M3):
@@ -244,6 +343,24 @@ class nmtf_icm:
         else:
             return numpy.dot(numpy.dot(M1,M2),M3)
         
+    def truncate_traces(self,iterations):
+        ''' Keep only the values of the first iterations iterations, when stopping early. '''
+        for name in TRACES:
+            setattr(self,name,getattr(self,name)[:iterations])
+        
+        
+    def prune_components(self,iteration):
+        ''' Remove the components of F and G whose magnitude has stayed below the threshold (see pruning.py). '''
+        positions_F = self.pruner_F.check(component_magnitudes(self.F,numpy.dot(self.G,self.S.T)),iteration)
+        positions_G = self.pruner_G.check(component_magnitudes(self.G,numpy.dot(self.F,self.S)),iteration)
+        if positions_F:
+            remove_components(self,ROW_COMPONENT_ARRAYS,positions_F)
+        if positions_G:
+            remove_components(self,COLUMN_COMPONENT_ARRAYS,positions_G)
+        if positions_F or positions_G:
+            self.K, self.L = len(self.pruner_F.active), len(self.pruner_G.active)
+            self.prediction_cache = {}
+        
         
     ''' Compute the parameters for the distributions we sample from. '''
     def alpha_s(self):   
@@ -297,6 +414,89 @@ class nmtf_icm:
         return 1./tauGl * (-lamb + self.tau*(self.M * ( (self.R-self.triple_dot(self.F,self.S,self.G.T)+numpy.outer(numpy.dot(self.F,self.S[:,l]),self.G[:,l])).T * numpy.dot(self.F,self.S[:,l]) ).T).sum(axis=0)) 
         
 
+    ''' Fold in new rows or columns, keeping the trained factors fixed. '''
+    def fold_in_rows(self,R_new,M_new,iterations):
+        ''' Find the MAP of F for new rows (I_new x J), keeping S, G, tau and lambdaFk fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=0)
+        lamb = self.lambdaFk if self.ARD else self.lambdaF.mean(axis=0)
+        return self.fold_in(R,M,numpy.dot(self.G,self.S.T),lamb,iterations)
+
+    def fold_in_columns(self,R_new,M_new,iterations):
+        ''' Find the MAP of G for new columns (I x J_new), keeping F, S, tau and lambdaGl fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=1)
+        lamb = self.lambdaGl if self.ARD else self.lambdaG.mean(axis=0)
+        return self.fold_in(R,M,numpy.dot(self.F,self.S),lamb,iterations)
+
+    def fold_in(self,R,M,B,lamb,iterations):
+        ''' Run ICM for A in R ~ A B.T (with B = G S.T or F S), and return the final modes. '''
+        lamb = numpy.tile(lamb,(R.shape[0],1))
+        A = numpy.random.exponential(scale=1./lamb)
+        for it in range(iterations):
+            self.mode_rows(R,M,A,B,lamb)
+        return A
+
+    def mode_rows(self,R,M,A,B,lamb):
+        ''' Set each column of A in R ~ A B.T to its mode, for all rows at once. lamb is the prior for A. '''
+        if self.engine == 'block':
+            return self.mode_rows_block(R,M,A,B,lamb)
+        for k in range(A.shape[1]):
+            tauAk = self.tau * ( M * B[:,k]**2 ).sum(axis=1)
+            muAk = 1./tauAk * (-lamb[:,k] + self.tau*(M * ( (R-numpy.dot(A,B.T)+numpy.outer(A[:,k],B[:,k]))*B[:,k] )).sum(axis=1))
+            A[:,k] = numpy.maximum(TN_vector_mode(muAk),MINIMUM_TN)
+
+    def mode_rows_block(self,R,M,A,B,lamb):
+        ''' Set each row of A in R ~ A B.T to its exact conditional mode (at least MINIMUM_TN), solving the NNLS problems for all rows at once. '''
+        gram = self.tau * masked_gram(M,B)
+        linear = self.tau * numpy.dot(M*R,B) - lamb
+        A[:] = batched_nnls(gram,linear,A,lower=MINIMUM_TN)
+
+    def mode_S_block(self):
+        ''' Set S to its exact conditional mode (at least MINIMUM_TN), solving one NNLS problem over all K*L entries. 
+            The Gram matrix has entries sum_ij M_ij F_ik F_ik' G_jl G_jl', for (k,l) and (k',l'). '''
+        FF = (self.F[:,:,numpy.newaxis] * self.F[:,numpy.newaxis,:]).reshape(self.I,self.K*self.K)
+        GG = (self.G[:,:,numpy.newaxis] * self.G[:,numpy.newaxis,:]).reshape(self.J,self.L*self.L)
+        gram = numpy.dot(FF.T,numpy.dot(self.M,GG)).reshape(self.K,self.K,self.L,self.L)
+        gram = gram.transpose(0,2,1,3).reshape(self.K*self.L,self.K*self.L)
+        linear = self.tau * numpy.dot(self.F.T,numpy.dot(self.M*self.R,self.G)) - self.lambdaS
+        S = batched_nnls(self.tau * gram[numpy.newaxis],linear.reshape(1,self.K*self.L),self.S.reshape(1,self.K*self.L),lower=MINIMUM_TN)
+        self.S = S.reshape(self.K,self.L)
+
+
+    ''' Add new observations to R, and continue from the current state. '''
+    def update_data(self,new_entries):
+        ''' Add a list of new observations (i,j,Rij) to R and M, and store which rows and columns they touch. '''
+        for (i,j,value) in new_entries:
+            assert 0 <= i < self.I and 0 <= j < self.J, "New entry (%s,%s) lies outside of R, which has shape %s." % (i,j,self.R.shape)
+        self.data = self.data.with_entries(new_entries)
+        (self.R, self.M) = (self.data.R, self.data.M)
+        self.size_Omega = self.data.size_Omega
+        self.touched_rows = sorted(set(self.touched_rows) | set([i for (i,_,_) in new_entries]))
+        self.touched_columns = sorted(set(self.touched_columns) | set([j for (_,j,_) in new_entries]))
+        self.evaluator.clear() # R and M have changed
+
+    def refine(self,iterations,local_sweeps=0):
+        ''' Continue ICM from the current state, after first doing local_sweeps over only the touched rows and columns. '''
+        for sweep in range(local_sweeps):
+            self.sweep_touched()
+        self.touched_rows, self.touched_columns = [], []
+        self.run(iterations)
+
+    def sweep_touched(self):
+        ''' Set F for the touched rows and G for the touched columns to their modes, and then tau. '''
+        rows, columns = self.touched_rows, self.touched_columns
+        if rows:
+            F_rows = self.F[rows]
+            lamb = numpy.tile(self.lambdaFk,(len(rows),1)) if self.ARD else self.lambdaF[rows]
+            self.mode_rows(self.R[rows],self.M[rows],F_rows,numpy.dot(self.G,self.S.T),lamb)
+            self.F[rows] = F_rows
+        if columns:
+            G_columns = self.G[columns]
+            lamb = numpy.tile(self.lambdaGl,(len(columns),1)) if self.ARD else self.lambdaG[columns]
+            self.mode_rows(self.R[:,columns].T,self.M[:,columns].T,G_columns,numpy.dot(self.F,self.S),lamb)
+            self.G[columns] = G_columns
+        self.tau = gamma_mode(self.alpha_s(),self.beta_s())
+
+
     def approx_expectation(self,burn_in,thinning):
         ''' Return our expectation of F, S, G, tau, lambdaFk, lambdaGl. '''
         indices = range(burn_in,len(self.all_F),thinning)
@@ -311,45 +511,50 @@ class nmtf_icm:
         return (exp_F, exp_S, exp_G, exp_tau, exp_lambdaFk, exp_lambdaGl)
 
 
-    def predict(self,M_pred,burn_in,thinning):
-        ''' Compute the expectation of U and V, and use it to predict missing values. '''
-        (exp_F,exp_S,exp_G,_,_,_) = self.approx_expectation(burn_in,thinning)
-        R_pred = self.triple_dot(exp_F,exp_S,exp_G.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
-        return {'MSE':MSE,'R^2':R2,'Rp':Rp}
-        
+    def predict(self,M_pred,burn_in,thinning,metrics=ALL_METRICS):
+        ''' Compute the expectation of F, S and G, and use it to predict missing values. '''
+        return self.evaluator.evaluate(M_pred,self.R,lambda rows,cols: self.predict_entries(rows,cols,burn_in,thinning),metrics)
         
     def predict_while_running(self):
         ''' Predict the training error while running. '''
-        R_pred = self.triple_dot(self.F,self.S,self.G.T)
-        MSE = self.compute_MSE(self.M,self.R,R_pred)
-        R2 = self.compute_R2(self.M,self.R,R_pred)    
-        Rp = self.compute_Rp(self.M,self.R,R_pred)        
-        return {'MSE':MSE,'R^2':R2,'Rp':Rp}
+        return self.evaluator.evaluate(self.M,self.R,lambda rows,cols: (self.F[rows] * numpy.dot(self.G,self.S.T)[cols]).sum(axis=1))
         
         
+    ''' Predict individual entries or rows, without computing the full matrix. '''
+    def predict_entries(self,rows,cols,burn_in,thinning):
+        ''' Return the predictions for the entries (rows[n],cols[n]), using the expectations of F, S and G. '''
+        rows, cols = numpy.array(rows,dtype=int), numpy.array(cols,dtype=int)
+        (exp_F,exp_GS) = self.cached_expectation(burn_in,thinning)
+        R_pred = (exp_F[rows] * exp_GS[cols]).sum(axis=1)
+        return R_pred
+
+    def predict_rows(self,rows,burn_in,thinning):
+        ''' Return the predictions for all columns of the given rows, using the expectations of F, S and G. '''
+        rows = numpy.array(rows,dtype=int)
+        (exp_F,exp_GS) = self.cached_expectation(burn_in,thinning)
+        R_pred = numpy.dot(exp_F[rows],exp_GS.T)
+        return R_pred
+
+    def cached_expectation(self,burn_in,thinning):
+        ''' Return (exp_F, exp_G exp_S.T) for the given burn-in and thinning, cached until the algorithm is run again. '''
+        if (burn_in,thinning) not in self.prediction_cache:
+            (exp_F,exp_S,exp_G,_,_,_) = self.approx_expectation(burn_in,thinning)
+            self.prediction_cache[(burn_in,thinning)] = (exp_F,numpy.dot(exp_G,exp_S.T))
+        return self.prediction_cache[(burn_in,thinning)]
+
+
     ''' Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation) '''
     def compute_MSE(self,M,R,R_pred):
         ''' Return the MSE of predictions in R_pred, expected values in R, for the entries in M. '''
-        return (M * (R-R_pred)**2).sum() / float(M.sum())
+        return compute_MSE(M,R,R_pred)
         
     def compute_R2(self,M,R,R_pred):
         ''' Return the R^2 of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean = (M*R).sum() / float(M.sum())
-        SS_total = float((M*(R-mean)**2).sum())
-        SS_res = float((M*(R-R_pred)**2).sum())
-        return 1. - SS_res / SS_total if SS_total != 0. else numpy.inf
+        return compute_R2(M,R,R_pred)
         
     def compute_Rp(self,M,R,R_pred):
         ''' Return the Rp of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean_real = (M*R).sum() / float(M.sum())
-        mean_pred = (M*R_pred).sum() / float(M.sum())
-        covariance = (M*(R-mean_real)*(R_pred-mean_pred)).sum()
-        variance_real = (M*(R-mean_real)**2).sum()
-        variance_pred = (M*(R_pred-mean_pred)**2).sum()
-        return covariance / float(math.sqrt(variance_real)*math.sqrt(variance_pred))
+        return compute_Rp(M,R,R_pred)
         
         
     def quality(self,metric,burn_in,thinning):
@@ -379,7 +584,34 @@ class nmtf_icm:
         return self.size_Omega / 2. * ( explogtau - math.log(2*math.pi) ) \
              - exp_tau / 2. * (self.M*( self.R - self.triple_dot(exp_F,exp_S,exp_G.T) )**2).sum()
              
+    def log_posterior(self):
+        ''' Return the log of the joint density of R, F, S, G, tau, and lambdaFk and lambdaGl (if ARD) at the current values. '''
+        lambdaF = self.lambdaFk if self.ARD else self.lambdaF
+        lambdaG = self.lambdaGl if self.ARD else self.lambdaG
+        log_posterior = self.log_likelihood(self.F,self.S,self.G,self.tau) \
+                        + (numpy.log(lambdaF) - lambdaF * self.F).sum() + (numpy.log(self.lambdaS) - self.lambdaS * self.S).sum() \
+                        + (numpy.log(lambdaG) - lambdaG * self.G).sum() + gamma_log_density(self.tau,self.alphatau,self.betatau)
+        if self.ARD:
+            log_posterior += gamma_log_density(self.lambdaFk,self.alpha0,self.beta0).sum() + gamma_log_density(self.lambdaGl,self.alpha0,self.beta0).sum()
+        return log_posterior
+             
     def number_parameters(self):
         ''' Return the number of free variables in the model. '''
         return (self.I*self.K + self.K*self.L + self.J*self.L + 1) + (self.K+self.L if self.ARD else 0)
-    
\ No newline at end of file
+        
+        
+    ''' Save and load the model. '''
+    def save(self,path,burn_in=None,thinning=None,traces=True):
+        ''' Store the model in the directory path. If burn_in and thinning are given, also store the expectations. '''
+        summaries = {} if burn_in is None else dict(zip(['exp_F','exp_S','exp_G','exp_tau','exp_lambdaFk','exp_lambdaGl'],self.approx_expectation(burn_in,thinning)))
+        save_model(self,path,SAVE_DIMENSIONS,SAVE_HYPERPARAMETERS,SAVE_STATE,SAVE_TRACES if traces else [],summaries)
+
+    @classmethod
+    def load(cls,path,mmap_traces=True):
+        ''' Load a model stored using save(path). The traces are memory-mapped, unless mmap_traces is False. '''
+        metadata, values = load_model(path,cls.__name__,mmap_traces)
+        dimensions = metadata['dimensions']
+        model = cls(values['data']['R'],values['data']['M'],dimensions['K'],dimensions['L'],dimensions['ARD'],values['hyperparameters'],
+                    str(dimensions.get('engine','coordinate')))
+        restore_model(model,values)
+        return model
\ No newline at end of file
@@ -13,74 +13,103 @@ Or more efficiently using matrix operations:
 And realising that elements in each column in U and V are independent:
 - U.k <- U.k * sum(M * [V.k * (R / (U dot V.T))], axis=1) / sum(M dot V.k, axis=1)
 - V.k <- V.k * sum(M * [U.k * (R / (U dot V.T))], axis=0) / sum(M dot U.k, axis=0)
+With solver='matrix' we instead update all of F, then S, then G at once, using
+masked matrix products with Q = M * R / (F S G.T), and reuse F S G.T for the
+next update and the objective:
+- F <- F * ( Q dot G S.T ) / ( M dot G S.T )
+- S <- S * ( F.T dot Q dot G ) / ( F.T dot M dot G )
+- G <- G * ( Q.T dot F S ) / ( M.T dot F S )
+With objective='Frobenius' we minimise sum(M * (R - F S G.T)**2) instead of 
+the I-divergence, replacing Q by M * R and M by M * (F S G.T) in the updates.
+With solver='hals' (only for objective='Frobenius') we use hierarchical 
+alternating least squares: exact non-negative updates of each column of F and 
+G, using the masked Gram matrices of G S.T and F S, and coordinate descent 
+updates of each entry of S (see hals.py).
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix, or a Dataset shared with other models (see dataset.py)
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or None to use the mask of the Dataset R
 - K, the number of row latent factors
 - L, the number of column latent factors
+- solver, either 'columns' (default, one column or entry at a time), 'matrix', or 'hals'
+- objective, either 'I-div' (default) or 'Frobenius'
+The value of the objective in each iteration is stored in NMTF.all_objective.
     
 Initialisation can be done by running the initialise(init,tauUV) function. We initialise as follows:
 - init_FG = 'ones'          -> F[i,k] = G[j,k] = 1
           = 'random'        -> F[i,k] ~ U(0,1), G[j,l] ~ G(0,1), 
           = 'exponential'   -> F[i,k] ~ Exp(expo_prior), G[j,l] ~ Exp(expo_prior) 
           = 'kmeans'        -> F = KMeans(R,rows)+0.2, G = KMeans(R,columns)+0.2
+          = 'nndsvd'        -> F, G = NNDSVD of R, with mean imputation (see nndsvd.py)
+          = 'nndsvd-iterative' -> the same, with iterative imputation
   where expo_prior is an additional parameter (default 1)
 - init_S = 'ones'          -> S[i,k] = 1
          = 'random'        -> S[i,k] ~ U(0,1)
          = 'exponential'   -> S[i,k] ~ Exp(expo_prior)
+         = 'nndsvd'        -> S = least squares fit given the NNDSVD F and G
+
+Further features (see the module named for the details):
+    NMTF.run(iterations,profile=False)        -> do not time the phases of run() in NMTF.profile (profiler.py)
+    NMTF.run(iterations,time_budget=seconds)  -> stop before exceeding a wall-clock budget (budget.py)
+    NMTF.run(iterations,accelerate='squarem') -> or 'anderson', extrapolate the updates (acceleration.py)
+    NMTF.run(iterations,active_set=True)      -> with the columns solver, skip what hardly changes (active_set.py)
 """
 
 from kmeans.kmeans import KMeans
+from nndsvd import nndsvd_tri_factors, OPTIONS_NNDSVD
+from persistence import save_model, load_model, restore_model
+from dataset import shared_dataset
+from fold_in import new_rows
+from metrics import ALL_METRICS, Evaluator, compute_MSE, compute_R2, compute_Rp
+from profiler import Profiler, NullProfiler
+from budget import TimeBudget
+from hals import update_rows_hals, update_core_hals
+from acceleration import create_accelerator, POSITIVE
+from active_set import create_scheduler
 from distributions.exponential import exponential_draw
 
 import numpy,itertools,math,time
 
-ALL_METRICS = ['MSE','R^2','Rp']
-OPTIONS_INIT_FG = ['kmeans', 'ones', 'random', 'exponential']
-OPTIONS_INIT_S = ['ones', 'random', 'exponential']
+OPTIONS_INIT_FG = ['kmeans', 'ones', 'random', 'exponential'] + OPTIONS_NNDSVD
+OPTIONS_SOLVER = ['columns', 'matrix', 'hals']
+OPTIONS_OBJECTIVE = ['I-div', 'Frobenius']
+SAVE_DIMENSIONS = ['K','L','solver','objective']
+SAVE_HYPERPARAMETERS = []
+SAVE_STATE = ['F','S','G','touched_rows','touched_columns']
+SAVE_TRACES = ['all_times','all_performances','all_objective','all_sweeps']
+ACCELERATED_PARAMETERS = [('F',POSITIVE),('S',POSITIVE),('G',POSITIVE)]
+ACTIVE_SET_AXES = { 'F':('K',), 'S':('K','L'), 'G':('L',) }
+OPTIONS_INIT_S = ['ones', 'random', 'exponential', 'nndsvd']
 
 class nmtf_np:
-    def __init__(self,R,M,K,L):
+    def __init__(self,R,M,K,L,solver='columns',objective='I-div'):
         ''' Set up the class and do some checks on the values passed. '''
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+        self.data = shared_dataset(R,M)
+        (self.R, self.M) = (self.data.R, self.data.M)
         self.K = K            
         self.L = L    
         
+        assert solver in OPTIONS_SOLVER, "Unrecognised solver: %s. Should be one in %s." % (solver, OPTIONS_SOLVER)
+        assert objective in OPTIONS_OBJECTIVE, "Unrecognised objective: %s. Should be one in %s." % (objective, OPTIONS_OBJECTIVE)
+        assert objective == 'Frobenius' or solver != 'hals', "The HALS solver minimises the Frobenius objective, not the %s." % objective
+        self.solver, self.objective = solver, objective
+        
         self.metrics = ['MSE','R^2','Rp']
                 
-        assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
-            "but instead %s-dimensional." % len(self.R.shape)
-        assert self.R.shape == self.M.shape, "Input matrix R is not of the same size as " \
-            "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
-        
-        (self.I,self.J) = self.R.shape
-        
-        self.check_empty_rows_columns() 
+        (self.I,self.J) = self.data.shape
+        self.touched_rows, self.touched_columns = [], []
+        self.evaluator = Evaluator()
+        self.prediction_cache = {}
         
         # For computing the I-div it is better if unknown values are 1's, not 0's, to avoid numerical issues
-        self.R_excl_unknown = numpy.empty((self.I,self.J))
-        for i,j in itertools.product(range(0,self.I),range(0,self.J)):
-            self.R_excl_unknown[i,j] = self.R[i,j] if self.M[i,j] else 1.
+        self.R_excl_unknown = numpy.where(self.M,self.R,1.)
                  
                  
-    def check_empty_rows_columns(self):
-        ''' Raise an exception if an entire row or column is empty. '''
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
-                    
-        # Assert none of the rows or columns are entirely unknown values
-        for i,c in enumerate(sums_rows):
-            assert c != 0, "Fully unobserved row in R, row %s." % i
-        for j,c in enumerate(sums_columns):
-            assert c != 0, "Fully unobserved column in R, column %s." % j
-        
-        
-    def train(self,iterations,init_FG='random',init_S='random',expo_prior=1.):
+    def train(self,iterations,init_FG='random',init_S='random',expo_prior=1.,accelerate=None,time_budget=None,active_set=False):
         ''' Initialise and run the algorithm. '''
         self.initialise(init_FG=init_FG, init_S=init_S, expo_prior=expo_prior) 
-        self.run(iterations=iterations)     
+        self.run(iterations=iterations,accelerate=accelerate,time_budget=time_budget,active_set=active_set)     
 
 
 
@@ -88,6 +117,8 @@ class nmtf_np:
         ''' Initialise F, S and G. '''
         assert init_FG in OPTIONS_INIT_FG, "Unrecognised init option for F,G: %s. Should be one in %s." % (init_FG, OPTIONS_INIT_FG)
         assert init_S in OPTIONS_INIT_S, "Unrecognised init option for S: %s. Should be one in %s." % (init_S, OPTIONS_INIT_S)
+        assert init_S != 'nndsvd' or init_FG in OPTIONS_NNDSVD, "S can only be initialised with NNDSVD if F and G are as well."
+        self.prediction_cache = {}
         
         if init_S == 'ones':
             self.S = numpy.ones((self.K,self.L))
@@ -123,33 +154,103 @@ class nmtf_np:
             kmeans_G.initialise()
             kmeans_G.cluster()
             self.G = kmeans_G.clustering_results + 0.2
+        elif init_FG in OPTIONS_NNDSVD:
+            self.F, S_nndsvd, self.G = nndsvd_tri_factors(self.R,self.M,self.K,self.L,init_FG)
+            if init_S == 'nndsvd':
+                self.S = S_nndsvd
         
         
-    def run(self,iterations):
-        ''' Run the algorithm. '''
+    def run(self,iterations,profile=True,accelerate=None,time_budget=None,active_set=False):
+        ''' Run the algorithm. Stop at the time_budget (in seconds), if given.
+            Skip converged columns of F and G, and entries of S, if active_set. '''
+        budget = TimeBudget(time_budget,iterations)
         assert hasattr(self,'F') and hasattr(self,'S') and hasattr(self,'G'), \
             "F, S and G have not been initialised - please run NMTF.initialise() first."        
         
         self.all_times = [] # to plot performance against time
+        self.all_objective = [] # to plot the I-divergence or Frobenius objective
+        self.all_sweeps = [] # to compare accelerated and plain iterations
         self.all_performances = {} # for plotting convergence of metrics
         for metric in ALL_METRICS:
             self.all_performances[metric] = []
             
+        assert not active_set or self.solver == 'columns', "Active-set scheduling is only possible with the columns solver, not %s." % self.solver
+        assert not (active_set and accelerate), "Active-set scheduling can not be combined with acceleration."
+        self.accelerator = create_accelerator(accelerate,self,ACCELERATED_PARAMETERS,self.sweep,self.objective_value,self.reset_prediction)
+        self.scheduler = create_scheduler(ACTIVE_SET_AXES,{'K':self.K,'L':self.L},active_set)
+        self.profiler = Profiler() if profile else NullProfiler()
         time_start = time.time()
-        for it in range(1,iterations+1):
+        self.R_pred = None
+        for it in budget.range(start=1):
+            self.accelerator.step()
+            self.all_sweeps.append(self.accelerator.sweeps)
+               
+            self.give_update(it,self.R_pred)
+            self.profiler.tick('performance')
+            
+            time_iteration = time.time()
+            self.all_times.append(time_iteration-time_start)  
+            
+            # Stop once another iteration would exceed the time budget
+            if budget.exhausted():
+                break
+        self.budget = budget.summary(len(self.all_times))
+        budget.report(len(self.all_times))
+        self.active_updates = self.scheduler.summary()
+        if accelerate:
+            print "Accelerated with %s: %s sweeps in %s iterations, %s rejected extrapolations. Total time: %s seconds." % (
+                accelerate,self.accelerator.sweeps,len(self.all_times),self.accelerator.rejected,self.all_times[-1])
+        self.profile, self.profile_phases = self.profiler.report(), self.profiler.phases
+        
+    def sweep(self):
+        ''' Update F, S, and G once. With the matrix solver, store F S G.T in R_pred. '''
+        self.prediction_cache = {} # predictions for the old factors are no longer valid
+        if self.solver == 'matrix':
+            self.R_pred = self.update_F_matrix(self.R_pred)
+            self.profiler.tick('F')
+            self.R_pred = self.update_S_matrix(self.R_pred)
+            self.profiler.tick('S')
+            self.R_pred = self.update_G_matrix(self.R_pred)
+            self.profiler.tick('G')
+        elif self.solver == 'hals':
+            self.update_F_hals()
+            self.profiler.tick('F')
+            self.update_S_hals()
+            self.profiler.tick('S')
+            self.update_G_hals()
+            self.profiler.tick('G')
+        else:
+            self.scheduler.start_sweep()
             for k in range(self.K):
-                self.update_F(k)
+                if self.scheduler.active('F',k):
+                    old = numpy.copy(self.F[:,k])
+                    self.update_F(k)
+                    self.scheduler.record('F',k,old,self.F[:,k])
+            self.profiler.tick('F')
                 
             for k,l in itertools.product(range(self.K),range(self.L)):
-                self.update_S(k,l)
+                if self.scheduler.active('S',(k,l)):
+                    old = self.S[k,l]
+                    self.update_S(k,l)
+                    self.scheduler.record('S',(k,l),old,self.S[k,l])
+            self.profiler.tick('S')
                     
             for l in range(self.L):
-                self.update_G(l)
-               
-            self.give_update(it)
+                if self.scheduler.active('G',l):
+                    old = numpy.copy(self.G[:,l])
+                    self.update_G(l)
+                    self.scheduler.record('G',l,old,self.G[:,l])
+            self.profiler.tick('G')
             
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)  
+    def reset_prediction(self):
+        ''' Mark F S G.T as out of date, after F, S, and G were set by the accelerator. '''
+        self.R_pred = None
+        self.prediction_cache = {}
+        
+    def objective_value(self):
+        ''' Return minus the I-divergence or Frobenius error, for the safeguard of the accelerator. '''
+        R_pred = self.triple_dot(self.F,self.S,self.G.T)
+        return - (self.compute_I_div(R_pred) if self.objective == 'I-div' else self.compute_frobenius(R_pred))
         
                 
     ''' Updates for F, G, S. '''             
@@ -167,70 +268,219 @@ class nmtf_np:
         ''' Update values for F. '''
         R_pred = self.triple_dot(self.F,self.S,self.G.T)
         SG = numpy.dot(self.S[k],self.G.T)
-        numerator = (self.M * self.R / R_pred * SG).sum(axis=1)
-        denominator = (self.M * SG).sum(axis=1)
+        if self.objective == 'Frobenius':
+            numerator = (self.M * self.R * SG).sum(axis=1)
+            denominator = (self.M * R_pred * SG).sum(axis=1)
+        else:
+            numerator = (self.M * self.R / R_pred * SG).sum(axis=1)
+            denominator = (self.M * SG).sum(axis=1)
         self.F[:,k] = self.F[:,k] * numerator / denominator
         
     def update_G(self,l):
         ''' Update values for G. '''
         R_pred = self.triple_dot(self.F,self.S,self.G.T)
         FS = numpy.dot(self.F,self.S[:,l])
-        numerator = ((self.M * self.R / R_pred).T * FS).T.sum(axis=0)
-        denominator = (self.M.T * FS).T.sum(axis=0)
+        if self.objective == 'Frobenius':
+            numerator = ((self.M * self.R).T * FS).T.sum(axis=0)
+            denominator = ((self.M * R_pred).T * FS).T.sum(axis=0)
+        else:
+            numerator = ((self.M * self.R / R_pred).T * FS).T.sum(axis=0)
+            denominator = (self.M.T * FS).T.sum(axis=0)
         self.G[:,l] = self.G[:,l] * numerator / denominator
         
     def update_S(self,k,l):
         ''' Update values for S. '''
         R_pred = self.triple_dot(self.F,self.S,self.G.T)
         F_times_G = self.M * numpy.outer(self.F[:,k], self.G[:,l])   
-        numerator = (self.R * F_times_G / R_pred).sum()
-        denominator = F_times_G.sum()
+        if self.objective == 'Frobenius':
+            numerator = (self.R * F_times_G).sum()
+            denominator = (R_pred * F_times_G).sum()
+        else:
+            numerator = (self.R * F_times_G / R_pred).sum()
+            denominator = F_times_G.sum()
         self.S[k,l] = self.S[k,l] * numerator / denominator
+        
+    def matrix_terms(self,R_pred=None):
+        ''' Return the masked matrices (Q,W) for the numerators and denominators of the matrix updates, 
+            given R_pred = F S G.T (computed if None): (M*R/R_pred,M) for the I-divergence, (M*R,M*R_pred) for Frobenius. '''
+        R_pred = self.triple_dot(self.F,self.S,self.G.T) if R_pred is None else R_pred
+        if self.objective == 'Frobenius':
+            return self.M * self.R, self.M * R_pred
+        return self.M * self.R / R_pred, self.M
+        
+    def update_F_matrix(self,R_pred=None):
+        ''' Update all of F at once, given R_pred = F S G.T (computed if None). Return the new F S G.T. '''
+        Q, W = self.matrix_terms(R_pred)
+        GS = numpy.dot(self.G,self.S.T)
+        self.F *= numpy.dot(Q,GS) / numpy.dot(W,GS)
+        return numpy.dot(self.F,GS.T)
+        
+    def update_S_matrix(self,R_pred=None):
+        ''' Update all of S at once, given R_pred = F S G.T (computed if None). Return the new F S G.T. '''
+        Q, W = self.matrix_terms(R_pred)
+        self.S *= numpy.dot(self.F.T,numpy.dot(Q,self.G)) / numpy.dot(self.F.T,numpy.dot(W,self.G))
+        return self.triple_dot(self.F,self.S,self.G.T)
+        
+    def update_G_matrix(self,R_pred=None):
+        ''' Update all of G at once, given R_pred = F S G.T (computed if None). Return the new F S G.T. '''
+        Q, W = self.matrix_terms(R_pred)
+        FS = numpy.dot(self.F,self.S)
+        self.G *= numpy.dot(Q.T,FS) / numpy.dot(W.T,FS)
+        return numpy.dot(FS,self.G.T)
+        
+    def update_F_hals(self):
+        ''' Update all columns of F in turn with HALS. '''
+        update_rows_hals(self.M * self.R, self.M, self.F, numpy.dot(self.G,self.S.T))
+        
+    def update_S_hals(self):
+        ''' Update all entries of S in turn with coordinate descent. '''
+        update_core_hals(self.R, self.M, self.F, self.S, self.G)
+        
+    def update_G_hals(self):
+        ''' Update all columns of G in turn with HALS. '''
+        update_rows_hals((self.M * self.R).T, self.M.T, self.G, numpy.dot(self.F,self.S))
            
            
-    def predict(self,M_pred):
+    ''' Fold in new rows or columns, keeping the trained factors fixed. '''
+    def fold_in_rows(self,R_new,M_new,iterations):
+        ''' Find F for new rows (I_new x J), keeping S and G fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=0)
+        return self.fold_in(R,M,numpy.dot(self.G,self.S.T),iterations)
+
+    def fold_in_columns(self,R_new,M_new,iterations):
+        ''' Find G for new columns (I x J_new), keeping F and S fixed. '''
+        R, M = new_rows(R_new,M_new,(self.I,self.J),axis=1)
+        return self.fold_in(R,M,numpy.dot(self.F,self.S),iterations)
+
+    def fold_in(self,R,M,B,iterations):
+        ''' Run the updates of the solver and objective for A in R ~ A B.T (with B = G S.T or F S), with A initialised randomly. '''
+        A = numpy.random.rand(R.shape[0],B.shape[1])
+        for it in range(iterations):
+            self.update_rows(R,M,A,B)
+        return A
+
+    def update_rows(self,R,M,A,B):
+        ''' Update A in R ~ A B.T in place, for all rows at once, in the same way as F in training. '''
+        if self.solver == 'hals':
+            update_rows_hals(M * R, M, A, B)
+            return
+        if self.solver == 'matrix':
+            Q, W = (M * R, M * numpy.dot(A,B.T)) if self.objective == 'Frobenius' else (M * R / numpy.dot(A,B.T), M)
+            A *= numpy.dot(Q,B) / numpy.dot(W,B)
+            return
+        for k in range(A.shape[1]):
+            R_pred = numpy.dot(A,B.T)
+            if self.objective == 'Frobenius':
+                numerator = (M * R * B[:,k]).sum(axis=1)
+                denominator = (M * R_pred * B[:,k]).sum(axis=1)
+            else:
+                numerator = (M * R / R_pred * B[:,k]).sum(axis=1)
+                denominator = (M * B[:,k]).sum(axis=1)
+            A[:,k] = A[:,k] * numerator / denominator
+
+
+    ''' Add new observations to R, and continue from the current state. '''
+    def update_data(self,new_entries):
+        ''' Add a list of new observations (i,j,Rij) to R and M, and store which rows and columns they touch. '''
+        for (i,j,value) in new_entries:
+            assert 0 <= i < self.I and 0 <= j < self.J, "New entry (%s,%s) lies outside of R, which has shape %s." % (i,j,self.R.shape)
+            self.R_excl_unknown[i,j] = value
+        self.data = self.data.with_entries(new_entries)
+        (self.R, self.M) = (self.data.R, self.data.M)
+        self.touched_rows = sorted(set(self.touched_rows) | set([i for (i,_,_) in new_entries]))
+        self.touched_columns = sorted(set(self.touched_columns) | set([j for (_,j,_) in new_entries]))
+        self.evaluator.clear() # R and M have changed
+
+    def refine(self,iterations,local_sweeps=0):
+        ''' Continue the algorithm from the current state, after first doing local_sweeps over only the touched rows and columns. '''
+        for sweep in range(local_sweeps):
+            self.sweep_touched()
+        self.touched_rows, self.touched_columns = [], []
+        self.run(iterations)
+
+    def sweep_touched(self):
+        ''' Update F for the touched rows and G for the touched columns. '''
+        rows, columns = self.touched_rows, self.touched_columns
+        if rows:
+            F_rows = self.F[rows]
+            self.update_rows(self.R[rows],self.M[rows],F_rows,numpy.dot(self.G,self.S.T))
+            self.F[rows] = F_rows
+        if columns:
+            G_columns = self.G[columns]
+            self.update_rows(self.R[:,columns].T,self.M[:,columns].T,G_columns,numpy.dot(self.F,self.S))
+            self.G[columns] = G_columns
+
+
+    def predict(self,M_pred,metrics=ALL_METRICS):
         ''' Predict missing values in R. '''
-        R_pred = self.triple_dot(self.F,self.S,self.G.T)
-        MSE = self.compute_MSE(M_pred,self.R,R_pred)
-        R2 = self.compute_R2(M_pred,self.R,R_pred)    
-        Rp = self.compute_Rp(M_pred,self.R,R_pred)        
-        return {'MSE':MSE,'R^2':R2,'Rp':Rp}        
+        return self.evaluator.evaluate(M_pred,self.R,self.predict_entries,metrics)
         
         
+    ''' Predict individual entries or rows, without computing the full matrix. '''
+    def predict_entries(self,rows,cols):
+        ''' Return the predictions for the entries (rows[n],cols[n]). '''
+        rows, cols = numpy.array(rows,dtype=int), numpy.array(cols,dtype=int)
+        return (self.F[rows] * self.cached_GS()[cols]).sum(axis=1)
+
+    def predict_rows(self,rows):
+        ''' Return the predictions for all columns of the given rows, as a (len(rows),J) array. '''
+        return numpy.dot(self.F[numpy.array(rows,dtype=int)],self.cached_GS().T)
+
+    def cached_GS(self):
+        ''' Return G S.T, cached until the factors are updated again. '''
+        if 'GS' not in self.prediction_cache:
+            self.prediction_cache['GS'] = numpy.dot(self.G,self.S.T)
+        return self.prediction_cache['GS']
+
+
     ''' Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation) '''
     def compute_MSE(self,M,R,R_pred):
         ''' Return the MSE of predictions in R_pred, expected values in R, for the entries in M. '''
-        return (M * (R-R_pred)**2).sum() / float(M.sum())
+        return compute_MSE(M,R,R_pred)
         
     def compute_R2(self,M,R,R_pred):
         ''' Return the R^2 of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean = (M*R).sum() / float(M.sum())
-        SS_total = float((M*(R-mean)**2).sum())
-        SS_res = float((M*(R-R_pred)**2).sum())
-        return 1. - SS_res / SS_total if SS_total != 0. else numpy.inf
+        return compute_R2(M,R,R_pred)
         
     def compute_Rp(self,M,R,R_pred):
         ''' Return the Rp of predictions in R_pred, expected values in R, for the entries in M. '''
-        mean_real = (M*R).sum() / float(M.sum())
-        mean_pred = (M*R_pred).sum() / float(M.sum())
-        covariance = (M*(R-mean_real)*(R_pred-mean_pred)).sum()
-        variance_real = (M*(R-mean_real)**2).sum()
-        variance_pred = (M*(R_pred-mean_pred)**2).sum()
-        return covariance / float(math.sqrt(variance_real)*math.sqrt(variance_pred))   
+        return compute_Rp(M,R,R_pred)
         
         
-    def compute_I_div(self):    
-        ''' Return the I-divergence. '''  
-        R_pred = self.triple_dot(self.F,self.S,self.G.T)
+    def compute_I_div(self,R_pred=None):    
+        ''' Return the I-divergence. If given, use R_pred = F S G.T. '''  
+        R_pred = self.triple_dot(self.F,self.S,self.G.T) if R_pred is None else R_pred
         return (self.M * ( self.R_excl_unknown * numpy.log( self.R_excl_unknown / R_pred ) - self.R_excl_unknown + R_pred ) ).sum()        
         
+    def compute_frobenius(self,R_pred=None):    
+        ''' Return the squared Frobenius norm of the error on the observed entries. If given, use R_pred = F S G.T. '''  
+        R_pred = self.triple_dot(self.F,self.S,self.G.T) if R_pred is None else R_pred
+        return (self.M * ( self.R - R_pred )**2 ).sum()
+        
         
-    def give_update(self,iteration):    
-        ''' Print and store the I-divergence and performances. '''
+    def give_update(self,iteration,R_pred=None):    
+        ''' Print and store the objective and performances. If given, use R_pred = F S G.T for the objective. '''
         perf = self.predict(self.M)
-        i_div = self.compute_I_div()
+        objective = self.compute_I_div(R_pred) if self.objective == 'I-div' else self.compute_frobenius(R_pred)
         
+        self.all_objective.append(objective)
         for metric in self.metrics:
             self.all_performances[metric].append(perf[metric])
                
-        print "Iteration %s. I-divergence: %s. MSE: %s. R^2: %s. Rp: %s." % (iteration,i_div,perf['MSE'],perf['R^2'],perf['Rp'])
+        print "Iteration %s. %s: %s. MSE: %s. R^2: %s. Rp: %s." % (iteration,self.objective,objective,perf['MSE'],perf['R^2'],perf['Rp'])
+        
+        
+    ''' Save and load the model. '''
+    def save(self,path,traces=True):
+        ''' Store the model in the directory path. '''
+        save_model(self,path,SAVE_DIMENSIONS,SAVE_HYPERPARAMETERS,SAVE_STATE,SAVE_TRACES if traces else [])
+
+    @classmethod
+    def load(cls,path,mmap_traces=True):
+        ''' Load a model stored using save(path). The traces are memory-mapped, unless mmap_traces is False. '''
+        metadata, values = load_model(path,cls.__name__,mmap_traces)
+        dimensions = metadata['dimensions']
+        model = cls(values['data']['R'],values['data']['M'],dimensions['K'],dimensions['L'],
+                    str(dimensions.get('solver','columns')),str(dimensions.get('objective','I-div')))
+        restore_model(model,values)
+        return model
\ No newline at end of file
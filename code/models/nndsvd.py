@@ -0,0 +1,159 @@
+"""
+Nonnegative double singular value decomposition (NNDSVD) initialisation of the
+factor matrices, for partially observed matrices.
+
+NNDSVD (Boutsidis and Gallopoulos, 2008) initialises R ~ U V.T from a rank K
+truncated SVD R ~ sum_k s_k x_k y_k.T: for each component we split x_k and
+y_k into their positive and negative parts, and use the pair (positive or
+negative) with the largest product of norms, scaled to match s_k (for the
+first component this is sqrt(s_1) |x_1| and sqrt(s_1) |y_1|). Entries
+that end up 0 are set to a small positive value, FILL_FRACTION times the
+typical entry sqrt(mean(R) / K), since the multiplicative updates can never
+move away from 0 (a larger value, as in NNDSVDa, moves the initialisation
+far away from the data).
+
+The SVD needs a complete matrix, so we first impute the missing values:
+- 'nndsvd': with the average of the observed row and column means,
+      X_ij = (mean_j' R_ij' + mean_i' R_i'j) / 2.
+- 'nndsvd-iterative': starting from that, we repeatedly replace the missing
+  values by the rank K reconstruction of the current X (hard impute),
+  IMPUTATION_ITERATIONS times.
+In both cases X is a masked residual plus a low rank matrix,
+    X = M * (R - A B.T) + A B.T,
+so we never form X itself: the truncated SVD is a randomized SVD (Halko et
+al., 2011), which only needs the products X Y and X.T Y. When less than
+SPARSE_DENSITY of the entries are observed, the masked residual is stored as
+a scipy.sparse matrix, so these products cost O(nnz(M) + (I+J) K) rather than
+O(IJK).
+
+For NMTF, R ~ F S G.T, we use the left factor of the rank K NNDSVD for F, the
+right factor of the rank L NNDSVD for G (both from the same SVD), and S as
+the least squares fit of X given F and G, projected onto a small positive
+minimum,
+    S = max( pinv(F) X pinv(G).T, MINIMUM_CORE / sqrt(K*L) ).
+
+The VB models use the factors as the means mu of q, with the precisions tau
+from nndsvd_precision(mu), so that the standard deviation is INITIAL_DEVIATION
+times the average mean. With tau = 1 (as for the other initialisations) the
+expectations of the truncated normals are far away from the NNDSVD factors
+when these are small, and NMTF often gets stuck on a plateau.
+
+Usage:
+    (U, V) = nndsvd_factors(R,M,K,init)           -> init in OPTIONS_NNDSVD
+    (F, S, G) = nndsvd_tri_factors(R,M,K,L,init)
+"""
+
+import numpy, scipy.sparse
+
+OPTIONS_NNDSVD = ['nndsvd', 'nndsvd-iterative']
+IMPUTATION_ITERATIONS = 10
+SPARSE_DENSITY = 0.1
+OVERSAMPLING = 10
+POWER_ITERATIONS = 2
+MINIMUM_CORE = 0.01
+FILL_FRACTION = 0.01
+INITIAL_DEVIATION = 0.1
+
+
+def use_sparse(M,sparse=None):
+    ''' Return whether to store the masked residual as a sparse matrix: sparse if given, and otherwise whether less than
+        SPARSE_DENSITY of the entries are observed. '''
+    return sparse if sparse is not None else M.sum() < SPARSE_DENSITY * M.size
+
+def mean_imputation(R,M):
+    ''' Return (A,B) such that A B.T is the average of the observed mean of each row and each column. '''
+    row_means = (M*R).sum(axis=1) / M.sum(axis=1).astype(float)
+    column_means = (M*R).sum(axis=0) / M.sum(axis=0).astype(float)
+    A = numpy.column_stack([row_means / 2., numpy.ones(M.shape[0])])
+    B = numpy.column_stack([numpy.ones(M.shape[1]), column_means / 2.])
+    return (A, B)
+
+
+class ImputedMatrix:
+    def __init__(self,R,M,A,B,sparse=False):
+        ''' The matrix X = M * (R - A B.T) + A B.T, with the observed entries of R and the missing ones of A B.T. '''
+        self.shape, self.A, self.B = M.shape, A, B
+        (rows, columns) = numpy.nonzero(M)
+        values = R[rows,columns] - (A[rows] * B[columns]).sum(axis=1)
+        self.residual_sum = values.sum()
+        if sparse:
+            self.residual = scipy.sparse.csr_matrix((values,(rows,columns)),shape=self.shape)
+        else:
+            self.residual = numpy.zeros(self.shape)
+            self.residual[rows,columns] = values
+
+    def dot(self,Y):
+        ''' Return X Y. '''
+        return self.residual.dot(Y) + numpy.dot(self.A,numpy.dot(self.B.T,Y))
+
+    def rdot(self,Y):
+        ''' Return X.T Y. '''
+        return self.residual.T.dot(Y) + numpy.dot(self.B,numpy.dot(self.A.T,Y))
+
+    def mean(self):
+        ''' Return the mean of the entries of X. '''
+        return (self.residual_sum + numpy.dot(self.A.sum(axis=0),self.B.sum(axis=0))) / float(self.shape[0]*self.shape[1])
+
+
+def impute(R,M,rank,init='nndsvd',sparse=None):
+    ''' Return the ImputedMatrix for the imputation method of init, using a rank rank reconstruction when iterating. '''
+    assert init in OPTIONS_NNDSVD, "Unrecognised NNDSVD initialisation: %s. Should be one in %s." % (init,OPTIONS_NNDSVD)
+    sparse = use_sparse(M,sparse)
+    X = ImputedMatrix(R,M,*mean_imputation(R,M),sparse=sparse)
+    if init == 'nndsvd-iterative':
+        for it in range(IMPUTATION_ITERATIONS):
+            (P, s, Q) = randomized_svd(X,rank)
+            X = ImputedMatrix(R,M,P*s,Q,sparse=sparse)
+    return X
+
+def randomized_svd(X,rank,oversampling=OVERSAMPLING,power_iterations=POWER_ITERATIONS):
+    ''' Return the truncated SVD (P,s,Q) of rank rank of X (an ImputedMatrix, or anything with dot() and rdot()), so that
+        X ~ P diag(s) Q.T, using a randomized range finder with power iterations. '''
+    (I,J) = X.shape
+    size = min(rank + oversampling, I, J)
+    basis = numpy.linalg.qr(X.dot(numpy.random.normal(size=(J,size))))[0]
+    for it in range(power_iterations):
+        basis = numpy.linalg.qr(X.rdot(basis))[0]
+        basis = numpy.linalg.qr(X.dot(basis))[0]
+    (P, s, QT) = numpy.linalg.svd(X.rdot(basis).T,full_matrices=False)
+    return (numpy.dot(basis,P)[:,:rank], s[:rank], QT[:rank].T)
+
+def nndsvd(P,s,Q,fill):
+    ''' Return the nonnegative (W,H) with W H.T ~ P diag(s) Q.T, from the positive and negative parts of the singular
+        vectors, replacing zeros by fill. '''
+    rank = len(s)
+    W, H = numpy.zeros((P.shape[0],rank)), numpy.zeros((Q.shape[0],rank))
+    for k in range(rank):
+        x, y = P[:,k], Q[:,k]
+        (xp, xn), (yp, yn) = (numpy.maximum(x,0.), numpy.maximum(-x,0.)), (numpy.maximum(y,0.), numpy.maximum(-y,0.))
+        (xp_norm, xn_norm), (yp_norm, yn_norm) = (numpy.linalg.norm(xp), numpy.linalg.norm(xn)), (numpy.linalg.norm(yp), numpy.linalg.norm(yn))
+        (x, y, x_norm, y_norm) = (xp, yp, xp_norm, yp_norm) if xp_norm * yp_norm >= xn_norm * yn_norm else (xn, yn, xn_norm, yn_norm)
+        if x_norm * y_norm > 0.:
+            scale = numpy.sqrt(s[k] * x_norm * y_norm)
+            W[:,k], H[:,k] = scale * x / x_norm, scale * y / y_norm
+    W[W <= 0.], H[H <= 0.] = fill, fill
+    return (W, H)
+
+def fill_value(X,rank):
+    ''' Return the value for the zeros in the NNDSVD factors, FILL_FRACTION * sqrt(mean(X) / rank). '''
+    return FILL_FRACTION * numpy.sqrt(abs(X.mean()) / rank)
+
+def nndsvd_factors(R,M,K,init='nndsvd',sparse=None):
+    ''' Return the NNDSVD initialisation (U,V) of R ~ U V.T, imputing the missing values of R (see above). '''
+    X = impute(R,M,K,init,sparse)
+    (P, s, Q) = randomized_svd(X,K)
+    return nndsvd(P,s,Q,fill_value(X,K))
+
+def nndsvd_tri_factors(R,M,K,L,init='nndsvd',sparse=None):
+    ''' Return the NNDSVD initialisation (F,S,G) of R ~ F S G.T, imputing the missing values of R (see above). '''
+    X = impute(R,M,max(K,L),init,sparse)
+    (P, s, Q) = randomized_svd(X,max(K,L))
+    F = nndsvd(P[:,:K],s[:K],Q[:,:K],fill_value(X,K))[0]
+    G = nndsvd(P[:,:L],s[:L],Q[:,:L],fill_value(X,L))[1]
+    S = numpy.dot(numpy.linalg.pinv(F),X.dot(numpy.linalg.pinv(G).T))
+    return (F, numpy.maximum(S,MINIMUM_CORE/numpy.sqrt(K*L)), G)
+
+def nndsvd_precision(mu):
+    ''' Return the precision for the truncated normals with means mu, with a standard deviation of INITIAL_DEVIATION
+        times the average of mu. '''
+    return 1. / (INITIAL_DEVIATION * mu.mean())**2
@@ -0,0 +1,91 @@
+"""
+Batched solver for many small non-negative least squares (NNLS) problems,
+    minimise 1/2 x.T G[n] x - b[n].T x  subject to x >= 0,
+for n = 1..N, with G[n] a positive semi-definite K x K matrix.
+
+In the ICM models, the conditional MAP of a row of U given V, tau and an
+exponential prior lambda is exactly such a problem (an L1-regularised NNLS),
+with G[n] = tau * sum_j M_nj V_j V_j.T and b[n] = tau * sum_j M_nj R_nj V_j - lambda_n.
+
+We use a projected Newton method, solving all N problems at once:
+- Compute the gradients g = G x - b.
+- The active set of a problem are the entries with x_k = 0 and g_k > 0; these
+  stay at 0. On the other (free) entries we take the Newton step -G^-1 g,
+  solving the K x K systems for all problems with one batched numpy.linalg.solve.
+- We project the step onto x >= 0, halving it for the problems where the
+  objective does not decrease (problems where no step helps keep their x).
+- Stop when no entry changes by more than the tolerance.
+As the objective is quadratic, the Newton step is exact once the active set is
+correct, so this typically converges in a few iterations. A small ridge is
+added to the Newton systems (not to the objective) so that they are never
+singular, e.g. when a column of V is all zeros; as we solve for the step from
+the current gradient, this does not bias the solution. When G is (nearly)
+singular and the gradient is not in its range (e.g. when two columns of V are
+equal), the Newton step is huge, and no halving of it decreases the objective.
+For those problems we increase the ridge (as in Levenberg-Marquardt), which
+turns the next steps towards the gradient direction, and decrease it again
+once the steps succeed.
+
+With a lower bound x >= lower instead, we substitute x = lower + y, which gives
+the NNLS problem in y with the same G[n], and b[n] - lower * G[n] 1. The ICM
+models use this to keep their exact modes at least MINIMUM_TN, as the
+coordinate updates do: otherwise a row of U that is all zeros (e.g. after a
+first sweep with a poorly fitted tau) makes the Gram matrices of V zero, after
+which both stay at zero.
+"""
+
+import numpy
+
+MAX_ITERATIONS_NNLS = 50
+MAX_HALVINGS_NNLS = 30
+TOLERANCE_NNLS = 1e-10
+RIDGE_NNLS = 1e-10
+DAMPING_NNLS = 1e-4 # ridge relative to the scale of G, after a failed Newton step
+
+
+def nnls_objective(G,b,x):
+    ''' Return the objectives 1/2 x[n].T G[n] x[n] - b[n].T x[n], as an (N,) array. '''
+    return 0.5 * (x * numpy.einsum('nkl,nl->nk',G,x)).sum(axis=1) - (b * x).sum(axis=1)
+
+def batched_nnls(G,b,x=None,max_iterations=MAX_ITERATIONS_NNLS,tolerance=TOLERANCE_NNLS,lower=0.):
+    ''' Solve the N problems min_{x >= lower} 1/2 x.T G[n] x - b[n].T x, for G (N,K,K) and b (N,K).
+        x is the (N,K) starting point (default lower). Return the (N,K) solutions. '''
+    (N,K) = b.shape
+    assert G.shape == (N,K,K), "Matrices G should be of shape %s, not %s." % ((N,K,K),G.shape)
+    if lower != 0.:
+        y = None if x is None else numpy.array(x,dtype=float) - lower
+        return lower + batched_nnls(G,b-lower*G.sum(axis=2),y,max_iterations,tolerance)
+    x = numpy.zeros((N,K)) if x is None else numpy.maximum(numpy.array(x,dtype=float),0.)
+    identity = numpy.eye(K)
+    scale = numpy.einsum('nkk->n',G) / float(K) + 1.
+    ridge = RIDGE_NNLS * scale
+
+    for it in range(max_iterations):
+        gradient = numpy.einsum('nkl,nl->nk',G,x) - b
+        free = (x > 0.) | (gradient <= 0.)
+
+        # Newton step on the free entries, keeping the active ones at 0
+        free_pairs = free[:,:,numpy.newaxis] & free[:,numpy.newaxis,:]
+        G_free = numpy.where(free_pairs,G,identity) + ridge[:,numpy.newaxis,numpy.newaxis] * identity
+        gradient_free = numpy.where(free,gradient,0.)
+        direction = -numpy.linalg.solve(G_free,gradient_free[:,:,numpy.newaxis])[:,:,0]
+
+        # Backtrack along the projected step until the objective decreases
+        objective = nnls_objective(G,b,x)
+        objective += 1e-12 * (numpy.abs(objective) + 1.) # allow for rounding errors close to the optimum
+        step = numpy.ones(N)
+        x_new = numpy.maximum(x + direction,0.)
+        for halving in range(MAX_HALVINGS_NNLS):
+            decreased = nnls_objective(G,b,x_new) <= objective
+            if decreased.all():
+                break
+            step = numpy.where(decreased,step,step/2.)
+            x_new = numpy.where(decreased[:,numpy.newaxis],x_new,numpy.maximum(x + step[:,numpy.newaxis] * direction,0.))
+        x_new = numpy.where(decreased[:,numpy.newaxis],x_new,x)
+        ridge = numpy.where(decreased,numpy.maximum(ridge/10.,RIDGE_NNLS*scale),numpy.maximum(100.*ridge,DAMPING_NNLS*scale))
+
+        change = numpy.abs(x_new - x).max()
+        x = x_new
+        if change <= tolerance * max(1.,numpy.abs(x).max()) and decreased.all():
+            break
+    return x
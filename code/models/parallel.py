@@ -0,0 +1,90 @@
+"""
+Thread-parallel updates of the rows of the factor matrices.
+
+Given all other parameters, the entries of a column of U (or F) are
+independent across the rows i, and those of V (or G) across the columns j. We
+can therefore split the I (or J) dimension into contiguous blocks, and compute
+the masked reductions, TN moments, and TN draws of each block in its own
+thread. This relies on numpy releasing the GIL in its elementwise operations,
+reductions and matrix products, so the updates themselves use vectorised code
+only (see TN_vector_draw_rng in distributions/truncated_normal_vector.py).
+
+The Gibbs samplers draw each block from its own numpy RandomState, seeded
+from the global numpy random state when the blocks are created. As a block
+always uses the same random state, the draws do not depend on how the threads
+are scheduled, and numpy.random.seed() still makes a run reproducible for a
+given number of threads (but not across different numbers of threads).
+
+To avoid oversubscribing the cores, we limit the BLAS library to one thread
+while the blocks run, if threadpoolctl is installed. Otherwise, set e.g.
+OMP_NUM_THREADS=1 (or MKL_NUM_THREADS, OPENBLAS_NUM_THREADS) yourself.
+
+The models use this with run(iterations,threads=T). With threads=1 (the
+default) we use SerialBlocks instead, which runs the update for all rows at
+once in the main thread, using the global numpy random state as before.
+
+Usage:
+    blocks = create_row_blocks((I,J),threads)
+    blocks.map(axis,function)  -> call function(rows,rng) for each block of rows
+                                  (axis=0) or columns (axis=1), with rows a slice
+    blocks.close()
+"""
+
+from multiprocessing.pool import ThreadPool
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+import numpy, contextlib
+
+
+def split_blocks(size,number):
+    ''' Split range(size) into at most number contiguous, non-empty slices of nearly equal length. '''
+    bounds = numpy.linspace(0,size,min(number,size)+1).astype(int)
+    return [slice(start,end) for start,end in zip(bounds[:-1],bounds[1:])]
+
+@contextlib.contextmanager
+def blas_threads(limit):
+    ''' Limit the number of threads of the BLAS library within this context, if threadpoolctl is installed. '''
+    if threadpool_limits is None:
+        yield
+    else:
+        with threadpool_limits(limits=limit,user_api='blas'):
+            yield
+
+def create_row_blocks(shape,threads):
+    ''' Return a RowBlocks splitting each of the dimensions in shape over threads threads, or SerialBlocks for one thread. '''
+    assert threads >= 1, "Number of threads should be at least 1, not %s." % threads
+    return RowBlocks(shape,threads) if threads > 1 else SerialBlocks()
+
+
+class RowBlocks:
+    def __init__(self,shape,threads):
+        ''' Split each dimension in shape into blocks, give each block a random state, and start the thread pool. '''
+        self.threads = threads
+        self.blocks = [split_blocks(size,threads) for size in shape]
+        self.rngs = [[numpy.random.RandomState(seed) for seed in numpy.random.randint(2**31-1,size=len(blocks))] for blocks in self.blocks]
+        self.pool = ThreadPool(threads)
+
+    def map(self,axis,function):
+        ''' Call function(rows,rng) for each block along axis, concurrently, and return the results. '''
+        with blas_threads(1):
+            return self.pool.map(lambda block: function(*block), zip(self.blocks[axis],self.rngs[axis]))
+
+    def close(self):
+        ''' Stop the threads. '''
+        self.pool.close()
+        self.pool.join()
+
+
+class SerialBlocks:
+    threads = 1
+
+    def map(self,axis,function):
+        ''' Call function(rows,None) for all rows at once. '''
+        return [function(slice(None),None)]
+
+    def close(self):
+        ''' Nothing to stop. '''
+        pass
@@ -0,0 +1,96 @@
+"""
+Methods for saving trained models to disk, and loading them back in.
+
+A model is stored as a directory, containing:
+- metadata.json, with the format version, the model class, the dimensions
+  (K, L, ARD), a SHA-1 fingerprint of the mask M, and all scalar values (such
+  as alphatau, tau, and the performances of each iteration).
+- <name>.npy, one file per array: the data R and M, any hyperparameter arrays,
+  the current state (factors, or variational parameters), optional posterior
+  summaries, and the traces of all iterations.
+
+When loading, the traces (e.g. all_U) are memory-mapped in read-only mode by
+default, so a serving process can open many models quickly without reading
+the full traces into memory. All other arrays are read in fully, so that we
+can continue running the model (e.g. using refine()).
+
+The model classes use these through:
+    BNMF.save(path)
+    BNMF = bnmf_vb.load(path)
+"""
+
+import numpy, hashlib, json, os
+
+FORMAT_VERSION = 1
+METADATA_FILE = 'metadata.json'
+GROUPS = ['data','hyperparameters','state','summaries','traces']
+
+
+def mask_fingerprint(M):
+    ''' Return the SHA-1 hex digest of the mask M, to check the data has not changed. '''
+    return hashlib.sha1(numpy.ascontiguousarray(M,dtype=float).tostring()).hexdigest()
+
+
+def save_model(model,path,dimensions,hyperparameters,state,traces,summaries={}):
+    ''' Store the named attributes of model in the directory path. Attributes
+        that have not been set yet (e.g. the traces before running) are skipped.
+        Arrays are stored as .npy files, and all other values in the metadata. '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    values = {
+        'data' : [(name,getattr(model,name)) for name in ['R','M']],
+        'hyperparameters' : [(name,getattr(model,name)) for name in hyperparameters if hasattr(model,name)],
+        'state' : [(name,getattr(model,name)) for name in state if hasattr(model,name)],
+        'summaries' : [(name,value) for name,value in summaries.items() if value is not None],
+        'traces' : [(name,getattr(model,name)) for name in traces if hasattr(model,name)],
+    }
+    metadata = {
+        'format_version' : FORMAT_VERSION,
+        'class' : model.__class__.__name__,
+        'mask_fingerprint' : mask_fingerprint(model.M),
+        'dimensions' : dict([(name,getattr(model,name)) for name in dimensions]),
+    }
+    for group in GROUPS:
+        scalars, arrays = {}, []
+        for name,value in values[group]:
+            if isinstance(value,numpy.ndarray):
+                numpy.save(os.path.join(path,name+'.npy'),value)
+                arrays.append(name)
+            else:
+                scalars[name] = value
+        metadata[group] = { 'scalars' : scalars, 'arrays' : arrays }
+
+    with open(os.path.join(path,METADATA_FILE),'w') as fout:
+        json.dump(metadata,fout,indent=2,sort_keys=True,default=lambda value: value.item())
+
+
+def load_model(path,class_name,mmap_traces=True):
+    ''' Return the metadata and values stored in the directory path by save_model(),
+        as a tuple (metadata, values), where values is a dictionary from group
+        ('data', 'hyperparameters', 'state', 'summaries', 'traces') to a dictionary
+        of values. If mmap_traces, the trace arrays are memory-mapped. '''
+    with open(os.path.join(path,METADATA_FILE),'r') as fin:
+        metadata = json.load(fin)
+    assert metadata['format_version'] <= FORMAT_VERSION, "Model in %s has format version %s, but we can only " \
+        "load up to version %s." % (path,metadata['format_version'],FORMAT_VERSION)
+    assert metadata['class'] == class_name, "Model in %s is a %s model, not %s." % (path,metadata['class'],class_name)
+
+    values = {}
+    for group in GROUPS:
+        mmap_mode = 'r' if group == 'traces' and mmap_traces else None
+        values[group] = dict([(str(name),value) for name,value in metadata[group]['scalars'].items()])
+        for name in metadata[group]['arrays']:
+            values[group][str(name)] = numpy.load(os.path.join(path,name+'.npy'),mmap_mode=mmap_mode)
+
+    assert mask_fingerprint(values['data']['M']) == metadata['mask_fingerprint'], "Mask M in %s does not match " \
+        "the fingerprint in its metadata." % path
+    return metadata, values
+
+
+def restore_model(model,values):
+    ''' Set the state, traces, and posterior summaries of a newly constructed model. '''
+    for group in ['state','traces']:
+        for name,value in values[group].items():
+            setattr(model,name,value)
+    model.summaries = values['summaries']
@@ -0,0 +1,57 @@
+"""
+Helpers for the posterior predictive distribution of entries Rij = Ui Vj + eps,
+with eps ~ N(0,1/tau):
+- RunningMoments accumulates the mean and variance of a series of draws one at
+  a time (Welford's algorithm), so memory stays of the order of the query size.
+- noise_variance gives E[1/tau] under a Gamma posterior for tau.
+- predictive_summary gives the predictive mean and variance, and optionally a
+  credible interval using a normal approximation.
+
+The VB models compute the predictive of a list of entries analytically from q,
+with model.predictive(rows,cols,credible). The Gibbs samplers accumulate it
+over the draws of the next run() for the entries given to
+model.track_predictive(rows,cols,burn_in,thinning), and return it with
+model.predictive(credible). Both give a dictionary
+    { 'mean', 'variance', 'lower', 'upper' }
+with the bounds of the credible interval only if credible (e.g. 0.95) is given.
+"""
+
+import numpy, scipy.stats
+
+
+class RunningMoments:
+    def __init__(self):
+        ''' Start with no draws. '''
+        self.n = 0
+        self.mean = 0.
+        self.sum_squares = 0.
+
+    def add(self,draw):
+        ''' Update the mean and sum of squared differences with a new draw (scalar or array). '''
+        self.n += 1
+        delta = draw - self.mean
+        self.mean = self.mean + delta / float(self.n)
+        self.sum_squares = self.sum_squares + delta * (draw - self.mean)
+
+    def variance(self):
+        ''' Return the (population) variance of the draws so far. '''
+        assert self.n > 0, "Cannot compute the variance of zero draws."
+        return self.sum_squares / float(self.n)
+
+
+def noise_variance(alpha,beta):
+    ''' Return E[1/tau] for tau ~ Gamma(alpha,beta), which is beta / (alpha - 1). '''
+    assert alpha > 1., "E[1/tau] is only defined for alpha > 1, but alpha = %s." % alpha
+    return beta / (alpha - 1.)
+
+
+def predictive_summary(mean,variance,credible=None):
+    ''' Return a dictionary with the predictive 'mean' and 'variance'. If credible
+        (e.g. 0.95) is given, also return the 'lower' and 'upper' bounds of the
+        central credible interval, using a normal approximation. '''
+    summary = { 'mean': mean, 'variance': variance }
+    if credible is not None:
+        assert 0. < credible < 1., "Credible interval mass should be between 0 and 1, but is %s." % credible
+        half_width = scipy.stats.norm.ppf(0.5 + credible / 2.) * numpy.sqrt(variance)
+        summary['lower'], summary['upper'] = mean - half_width, mean + half_width
+    return summary
@@ -0,0 +1,87 @@
+"""
+Low-overhead instrumentation of the phases in the run() loops of the models.
+
+The run() loop calls profiler.tick(phase) at the end of each phase (e.g. 'U',
+'TN moments', 'tau', 'performance'), which adds the time since the previous
+tick to that phase, and counts the call. We also record how much the peak
+resident memory of the process grew during each phase, as a measure of the
+memory allocated for temporaries (this is 0 once the peak has been reached).
+
+After running, the report is stored in model.profile, as a dictionary from
+phase name to { 'time', 'calls', 'memory' } (seconds, number of calls, bytes),
+with the phases in the order they were first seen in model.profile_phases.
+Use format_profile(model.profile) for a printable table.
+
+Profiling is on by default, and can be switched off with run(...,profile=False),
+in which case we use a NullProfiler whose methods do nothing.
+"""
+
+import sys
+from timeit import default_timer
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_memory():
+    ''' Return the peak resident memory of this process in bytes, or 0 if we cannot measure it. '''
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # kilobytes on Linux
+
+
+class Profiler:
+    def __init__(self):
+        ''' Start with no phases, and start the clock. '''
+        self.phases = []
+        self.times, self.calls, self.memory = {}, {}, {}
+        self.start()
+
+    def start(self):
+        ''' Restart the clock, so that time spent outside the phases (e.g. setting up) is not counted. '''
+        self.last_time, self.last_memory = default_timer(), peak_memory()
+
+    def tick(self,phase):
+        ''' Add the time and memory growth since the last tick to phase. '''
+        now, memory = default_timer(), peak_memory()
+        if phase not in self.times:
+            self.phases.append(phase)
+            self.times[phase], self.calls[phase], self.memory[phase] = 0., 0, 0
+        self.times[phase] += now - self.last_time
+        self.calls[phase] += 1
+        self.memory[phase] += memory - self.last_memory
+        self.last_time, self.last_memory = now, memory
+
+    def report(self):
+        ''' Return a dictionary from phase to { 'time', 'calls', 'memory' }. '''
+        return dict([(phase,{ 'time':self.times[phase], 'calls':self.calls[phase], 'memory':self.memory[phase] }) for phase in self.phases])
+
+
+class NullProfiler:
+    phases = []
+
+    def start(self):
+        ''' Do nothing, as profiling is switched off. '''
+        pass
+
+    def tick(self,phase):
+        ''' Do nothing, as profiling is switched off. '''
+        pass
+
+    def report(self):
+        ''' Return None, as profiling is switched off. '''
+        return None
+
+
+def format_profile(profile,phases=None):
+    ''' Return a table of the profile, with the time, fraction of the total time, calls, and memory growth per phase. '''
+    phases = phases if phases is not None else sorted(profile.keys(),key=lambda phase: -profile[phase]['time'])
+    total = sum([values['time'] for values in profile.values()])
+    lines = ["%-14s %10s %7s %8s %12s" % ('phase','time (s)','%','calls','memory (B)')]
+    for phase in phases:
+        values = profile[phase]
+        fraction = 100. * values['time'] / total if total > 0 else 0.
+        lines.append("%-14s %10.4f %7.2f %8d %12d" % (phase,values['time'],fraction,values['calls'],values['memory']))
+    return "\n".join(lines)
@@ -0,0 +1,100 @@
+"""
+Dynamic pruning of the components that ARD has switched off.
+
+With ARD, the precision lambda_k of an unused component grows large, and the
+component's values shrink, but we keep updating it every iteration. When
+pruning is switched on, after each iteration we compute the relative
+magnitude of each component k, the Frobenius norm of its rank-one term
+A.k B.k.T relative to that of the largest component:
+    magnitude_k = ||A.k|| * ||B.k|| / max_k' ||A.k'|| * ||B.k'||
+(with B = V for NMF, and B = G S.T or F S for the columns of F and G in NMTF).
+The values of a switched-off component do not go to 0: they level off at the
+scale of the prior (VB and Gibbs) or at MINIMUM_TN (ICM), so their absolute
+magnitude depends on the data and on I and J. Relative to the largest
+component it is scale-free. On rank-3 data (60 x 40, K=10 and K=L=8) the
+switched-off components of VB and ICM levelled off at 0.2-2% of the largest
+one, so the default threshold is 2%. Components in use can dip below that for
+a while before they grow again (mostly in BNMTF VB, and in the first few tens
+of iterations), so the default patience is 20 iterations; with a 5% threshold
+or a patience of 10, such components were pruned too. Gibbs with the weak
+prior alpha0 = beta0 = 1 switched off no components at all on this data.
+Once the magnitude of a component has stayed below the threshold for patience
+iterations in a row, we remove it from all per-component arrays, shrinking K
+(or L). We always keep at least one component.
+
+Pruning is switched on with run(iterations,prune=True), using the default
+threshold and patience below, or with prune={'threshold':..,'patience':..}.
+The removed components are recorded in model.pruned_components, as a list of
+(iteration, component) pairs (for NMTF, a dictionary from 'F' and 'G' to such
+lists), where component is the index of the column at the start of that run. Traces of the factors (e.g. all_U) keep their size at
+the start of the run, with zeros for the pruned components, so that averages
+over the draws, and the predictions based on them, stay consistent.
+"""
+
+import numpy
+
+PRUNE_THRESHOLD = 0.02
+PRUNE_PATIENCE = 20
+
+
+def component_magnitudes(A,B):
+    ''' Return the Frobenius norm of each rank-one term A.k B.k.T, divided by the largest of them. '''
+    norms = numpy.sqrt((A**2).sum(axis=0) * (B**2).sum(axis=0))
+    return norms / norms.max() if norms.max() > 0 else norms
+
+def remove_components(model,attributes,positions):
+    ''' Delete the given positions from the arrays of model listed as (name,axis) pairs, if they are set. '''
+    for (name,axis) in attributes:
+        if getattr(model,name,None) is not None:
+            setattr(model,name,numpy.delete(getattr(model,name),positions,axis=axis))
+
+def create_pruner(size,prune):
+    ''' Return a Pruner for size components if prune is True or a dictionary of settings, and a NullPruner otherwise. '''
+    if not prune:
+        return NullPruner(size)
+    return Pruner(size,**(prune if isinstance(prune,dict) else {}))
+
+
+class Pruner:
+    def __init__(self,size,threshold=PRUNE_THRESHOLD,patience=PRUNE_PATIENCE):
+        ''' Keep track of which of the size components are active, and for how long they have been below the threshold. '''
+        assert patience >= 1, "Patience for pruning should be at least 1, not %s." % patience
+        self.size, self.threshold, self.patience = size, threshold, patience
+        self.active = range(size)
+        self.counts = numpy.zeros(size,dtype=int)
+        self.pruned = []
+
+    def check(self,magnitudes,iteration):
+        ''' Given the magnitudes of the active components, return the positions of the ones to remove, and record them. '''
+        self.counts = numpy.where(magnitudes < self.threshold, self.counts + 1, 0)
+        positions = [p for p in range(len(self.active)) if self.counts[p] >= self.patience]
+        if len(positions) == len(self.active):
+            positions.remove(numpy.argmax(magnitudes))
+        self.pruned += [(iteration,self.active[p]) for p in positions]
+        self.active = [component for p,component in enumerate(self.active) if p not in positions]
+        self.counts = numpy.delete(self.counts,positions)
+        return positions
+
+    def expand(self,values,axis):
+        ''' Return a copy of values with the pruned components filled in as zeros along axis. '''
+        shape = list(values.shape)
+        shape[axis] = self.size
+        full, index = numpy.zeros(shape), [slice(None)] * len(shape)
+        index[axis] = self.active
+        full[tuple(index)] = values
+        return full
+
+
+class NullPruner:
+    def __init__(self,size):
+        ''' Keep all size components. '''
+        self.size = size
+        self.pruned = []
+
+    def check(self,magnitudes,iteration):
+        ''' Remove nothing, as pruning is switched off. '''
+        return []
+
+    def expand(self,values,axis):
+        ''' Return a copy of values, as nothing is pruned. '''
+        return numpy.copy(values)
@@ -0,0 +1,86 @@
+"""
+Measure the latency of folding in new cell lines (rows) and drugs (columns) of
+the GDSC IC50 dataset, for each of the eight models.
+
+We hold out the last few rows and columns, train on the remaining matrix, and 
+then time fold_in_rows() and fold_in_columns() on the held out data (batched 
+over all new rows or columns). We report the time per new row / column.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.bnmf_gibbs import bnmf_gibbs
+from BNMTF_ARD.code.models.bnmf_vb import bnmf_vb
+from BNMTF_ARD.code.models.nmf_icm import nmf_icm
+from BNMTF_ARD.code.models.nmf_np import nmf_np
+from BNMTF_ARD.code.models.bnmtf_gibbs import bnmtf_gibbs
+from BNMTF_ARD.code.models.bnmtf_vb import bnmtf_vb
+from BNMTF_ARD.code.models.nmtf_icm import nmtf_icm
+from BNMTF_ARD.code.models.nmtf_np import nmtf_np
+from BNMTF_ARD.data.drug_sensitivity.load_data import load_gdsc_ic50
+
+import numpy, time
+
+
+''' Experiment settings. '''
+no_new_rows, no_new_columns = 20, 10
+iterations, iterations_fold_in = 200, 50
+burn_in, thinning = 30, 2 # for the Gibbs fold in
+K, L = 10, 10
+
+output_folder = project_location+"BNMTF_ARD/experiments/experiments_gdsc/fold_in/results/"
+output_file = output_folder+'fold_in_latency.txt'
+
+alphatau, betatau = 1., 1.
+alpha0, beta0 = 1., 1.
+lambdaU = lambdaV = lambdaF = lambdaS = lambdaG = 0.1
+hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 
+                'lambdaU':lambdaU, 'lambdaV':lambdaV, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+
+gibbs_fold_in = { 'burn_in':burn_in, 'thinning':thinning }
+methods = [
+    ('NMF Gibbs', lambda R,M: bnmf_gibbs(R,M,K,False,hyperparams), lambda m: m.train('random',iterations), gibbs_fold_in),
+    ('NMF VB',    lambda R,M: bnmf_vb(R,M,K,False,hyperparams),    lambda m: m.train('random',iterations), {}),
+    ('NMF ICM',   lambda R,M: nmf_icm(R,M,K,False,hyperparams),    lambda m: m.train('random',iterations), {}),
+    ('NMF NP',    lambda R,M: nmf_np(R,M,K),                       lambda m: m.train(iterations,'random'), {}),
+    ('NMTF Gibbs',lambda R,M: bnmtf_gibbs(R,M,K,L,False,hyperparams), lambda m: m.train('kmeans','random',iterations), gibbs_fold_in),
+    ('NMTF VB',   lambda R,M: bnmtf_vb(R,M,K,L,False,hyperparams),    lambda m: m.train('kmeans','random',iterations), {}),
+    ('NMTF ICM',  lambda R,M: nmtf_icm(R,M,K,L,False,hyperparams),    lambda m: m.train('kmeans','random',iterations), {}),
+    ('NMTF NP',   lambda R,M: nmtf_np(R,M,K,L),                       lambda m: m.train(iterations,'kmeans','random'), {}),
+]
+
+
+''' Load in data, and split off the new rows and columns. '''
+R, M = load_gdsc_ic50()
+I, J = R.shape
+R_train, M_train = R[:I-no_new_rows,:J-no_new_columns], M[:I-no_new_rows,:J-no_new_columns]
+R_new_rows, M_new_rows = R[I-no_new_rows:,:J-no_new_columns], M[I-no_new_rows:,:J-no_new_columns]
+R_new_columns, M_new_columns = R[:I-no_new_rows,J-no_new_columns:], M[:I-no_new_rows,J-no_new_columns:]
+
+
+''' Train each model, and time the fold in. '''
+latencies = {}
+for name, construct, train, fold_in_config in methods:
+    model = construct(R_train,M_train)
+    train(model)
+    
+    time_start = time.time()
+    model.fold_in_rows(R_new_rows,M_new_rows,iterations_fold_in,**fold_in_config)
+    time_rows = time.time()
+    model.fold_in_columns(R_new_columns,M_new_columns,iterations_fold_in,**fold_in_config)
+    time_columns = time.time()
+    
+    latencies[name] = {
+        'row' : (time_rows - time_start) / no_new_rows,
+        'column' : (time_columns - time_rows) / no_new_columns,
+    }
+
+
+''' Print and store the latencies. '''
+for name, _, _, _ in methods:
+    print "%s. Seconds per new row: %s. Seconds per new column: %s." % (name, latencies[name]['row'], latencies[name]['column'])
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+open(output_file,'w').write("%s" % latencies)
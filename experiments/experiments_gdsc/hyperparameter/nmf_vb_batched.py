@@ -0,0 +1,89 @@
+'''
+Run the lambda grid of nmf_vb.py on the GDSC dataset with the batched VB
+engine (bnmf_vb_batch.py): for each fraction of unobserved entries and each
+fold, all values of lambda are trained together on the same training mask.
+We compare this to training the same models one at a time, and report the
+total time of both, the number of iterations each value of lambda needed to
+converge in the batch, and the average test MSE of each value of lambda.
+'''
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.bnmf_vb import bnmf_vb
+from BNMTF_ARD.code.models.bnmf_vb_batch import bnmf_vb_batch
+from BNMTF_ARD.code.models.dataset import Dataset
+from BNMTF_ARD.data.drug_sensitivity.load_data import load_gdsc_ic50
+from BNMTF_ARD.code.cross_validation.mask import try_generate_M
+
+import numpy, time
+
+
+''' Experiment settings. '''
+values_lambda = [0.0001, 0.001, 0.01, 0.1, 1., 10., 100.]
+fractions_unknown = [0.2, 0.5, 0.8]
+no_folds = 3
+
+output_folder = project_location+"BNMTF_ARD/experiments/experiments_gdsc/hyperparameter/results/"
+output_file = output_folder+'nmf_vb_batched.txt'
+
+
+''' Model settings. '''
+iterations = 200
+tolerance = 1e-6
+K = 10
+init_UV = 'random'
+ARD = False
+seed = 0
+
+alphatau, betatau = 1., 1.
+all_hyperparameters = [{ 'alphatau':alphatau, 'betatau':betatau, 'lambdaU':lamb, 'lambdaV':lamb } for lamb in values_lambda]
+
+
+''' Load in data. '''
+R, M = load_gdsc_ic50()
+I, J = M.shape
+data = Dataset(R,M)
+
+
+''' For each fraction and fold, train all values of lambda as a batch, and one at a time. '''
+times = { 'batch': 0., 'sequential': 0. }
+all_performances = { fraction: { lamb: [] for lamb in values_lambda } for fraction in fractions_unknown }
+all_iterations = { fraction: { lamb: [] for lamb in values_lambda } for fraction in fractions_unknown }
+M_attempts = 1000
+for fraction in fractions_unknown:
+    for fold in range(no_folds):
+        print "Fold %s of fraction unknown=%s." % (fold+1, fraction)
+        (M_train, M_test) = try_generate_M(I=I, J=J, fraction=fraction, attempts=M_attempts, M=M)
+        seeds = [seed + n for n in range(len(values_lambda))]
+
+        time_start = time.time()
+        BATCH = bnmf_vb_batch(data,M_train,K,ARD,all_hyperparameters,seeds)
+        BATCH.train(init_UV,iterations,tolerance)
+        times['batch'] += time.time() - time_start
+        for lamb, model, its in zip(values_lambda, BATCH.models, BATCH.iterations):
+            all_performances[fraction][lamb].append(model.predict(M_test)['MSE'])
+            all_iterations[fraction][lamb].append(its)
+
+        # The same models one at a time, for the same number of iterations
+        time_start = time.time()
+        for hyperparameters, s, its in zip(all_hyperparameters, seeds, BATCH.iterations):
+            numpy.random.seed(s)
+            BNMF = bnmf_vb(data,M_train,K,ARD,hyperparameters)
+            BNMF.train(init_UV,its)
+        times['sequential'] += time.time() - time_start
+
+average_performances = { fraction: { lamb: numpy.mean(all_performances[fraction][lamb]) for lamb in values_lambda } for fraction in fractions_unknown }
+
+
+''' Print and store the results. '''
+lines = ["Total time batched: %.2f seconds. Total time one at a time: %.2f seconds." % (times['batch'],times['sequential']), "",
+         "%-10s %-10s %12s %14s" % ('fraction','lambda','iterations','average MSE')]
+for fraction in fractions_unknown:
+    for lamb in values_lambda:
+        lines.append("%-10s %-10s %12.1f %14.6f" % (fraction,lamb,numpy.mean(all_iterations[fraction][lamb]),average_performances[fraction][lamb]))
+print "\n".join(lines)
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+open(output_file,'w').write("%s\n\nall_performances = %s" % ("\n".join(lines),all_performances))
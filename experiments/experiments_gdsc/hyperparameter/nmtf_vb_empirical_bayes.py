@@ -0,0 +1,79 @@
+'''
+Compare learning the hyperparameter lambda of NMTF VB with empirical Bayes
+(maximising the ELBO, see empirical_bayes.py) to the grid search in nmtf_vb.py:
+for each fraction of unobserved entries we run 10-fold cross-validation with
+the rates learned during training, and compare the average MSE to the one of
+the best value of lambda in the grid (results/nmtf_vb.txt).
+'''
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.bnmtf_vb import bnmtf_vb
+from BNMTF_ARD.data.drug_sensitivity.load_data import load_gdsc_ic50
+from BNMTF_ARD.code.cross_validation.mask import try_generate_M
+
+import ast
+
+
+''' Experiment settings. '''
+fractions_unknown = [0.2, 0.5, 0.8]
+empirical_bayes = True
+
+output_folder = project_location+"BNMTF_ARD/experiments/experiments_gdsc/hyperparameter/results/"
+grid_file = output_folder+'nmtf_vb.txt'
+output_file = output_folder+'nmtf_vb_empirical_bayes.txt'
+
+
+''' Model settings. '''
+iterations = 200
+no_folds = 10
+K, L = 10, 10
+init_FG, init_S = 'kmeans', 'random'
+ARD = False
+
+alphatau, betatau = 1., 1.
+alpha0, beta0 = 1., 1.
+lambdaF, lambdaS, lambdaG = 1., 1., 1. # initial values
+hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+
+
+''' Load in data. '''
+R, M = load_gdsc_ic50()
+I, J = M.shape
+
+
+''' Run 10 folds for each fraction, learning lambda. '''
+M_attempts = 1000
+all_performances = { fraction: [] for fraction in fractions_unknown }
+all_lambdas = { fraction: [] for fraction in fractions_unknown }
+for fraction in fractions_unknown:
+    print "Trying fraction unknown=%s." % fraction
+    for fold in range(no_folds):
+        print "Fold %s of fraction unknown=%s." % (fold+1, fraction)
+        (M_train, M_test) = try_generate_M(I=I, J=J, fraction=fraction, attempts=M_attempts, M=M)
+        
+        BNMTF = bnmtf_vb(R,M_train,K,L,ARD,hyperparams)
+        BNMTF.initialise(init_FG=init_FG, init_S=init_S)
+        BNMTF.run(iterations,empirical_bayes=empirical_bayes)
+        
+        all_performances[fraction].append(BNMTF.predict(M_test)['MSE'])
+        all_lambdas[fraction].append((BNMTF.lambdaF[0,0],BNMTF.lambdaS[0,0],BNMTF.lambdaG[0,0]))
+
+
+''' Compare to the best value of lambda in the grid search. '''
+grid_performances = ast.literal_eval(open(grid_file).read())
+lines = ["%-10s %16s %16s %12s %16s" % ('fraction','empirical Bayes','best grid','best lambda','learned lambda')]
+for fraction in fractions_unknown:
+    average = sum(all_performances[fraction]) / float(no_folds)
+    grid_averages = { lamb: sum(MSEs) / float(len(MSEs)) for lamb, MSEs in grid_performances[fraction].items() }
+    best_lambda = min(grid_averages, key=grid_averages.get)
+    learned = tuple(sum(values) / float(no_folds) for values in zip(*all_lambdas[fraction]))
+    lines.append("%-10s %16s %16s %12s %16s" % (fraction,average,grid_averages[best_lambda],best_lambda,learned))
+
+
+''' Print and store the performances. '''
+print "all_performances = %s \nall_lambdas = %s" % (all_performances, all_lambdas)
+print "\n".join(lines)
+open(output_file,'w').write("%s\n%s" % (all_performances,"\n".join(lines)))
@@ -0,0 +1,94 @@
+"""
+Compare a fresh training run against an incremental refit, when new entries
+of the GDSC IC50 dataset arrive after a model has been trained.
+
+We split the observed entries into an old set, a new set, and a test set. We 
+then either train from scratch on the old and new entries, or train on the old
+entries, add the new ones with update_data(), and call refine() for only a 
+fraction of the iterations. We report the test MSE and the time taken for both.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.bnmf_vb import bnmf_vb
+from BNMTF_ARD.code.models.bnmtf_vb import bnmtf_vb
+from BNMTF_ARD.code.models.nmf_icm import nmf_icm
+from BNMTF_ARD.code.models.nmtf_icm import nmtf_icm
+from BNMTF_ARD.code.cross_validation.mask import try_generate_M, nonzero_indices
+from BNMTF_ARD.data.drug_sensitivity.load_data import load_gdsc_ic50
+
+import numpy, random, time
+
+
+''' Experiment settings. '''
+fraction_unknown = 0.2 # half of these are the new entries, half the test entries
+iterations, iterations_refine, local_sweeps = 200, 20, 5
+K, L = 10, 10
+
+output_folder = project_location+"BNMTF_ARD/experiments/experiments_gdsc/incremental/results/"
+output_file = output_folder+'incremental_refit.txt'
+
+alphatau, betatau = 1., 1.
+alpha0, beta0 = 1., 1.
+lambdaU = lambdaV = lambdaF = lambdaS = lambdaG = 0.1
+hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 
+                'lambdaU':lambdaU, 'lambdaV':lambdaV, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+
+methods = [
+    ('NMF VB',   lambda R,M: bnmf_vb(R,M,K,True,hyperparams),     lambda m: m.train('random',iterations)),
+    ('NMF ICM',  lambda R,M: nmf_icm(R,M,K,True,hyperparams),     lambda m: m.train('random',iterations)),
+    ('NMTF VB',  lambda R,M: bnmtf_vb(R,M,K,L,True,hyperparams),  lambda m: m.train('kmeans','random',iterations)),
+    ('NMTF ICM', lambda R,M: nmtf_icm(R,M,K,L,True,hyperparams),  lambda m: m.train('kmeans','random',iterations)),
+]
+
+
+''' Load in data, and split it into old, new, and test entries. '''
+R, M = load_gdsc_ic50()
+I, J = R.shape
+
+M_old, M_rest = try_generate_M(I=I,J=J,fraction=fraction_unknown,attempts=1000,M=M)
+indices_rest = nonzero_indices(M_rest)
+random.shuffle(indices_rest)
+indices_new, indices_test = indices_rest[:len(indices_rest)/2], indices_rest[len(indices_rest)/2:]
+
+new_entries = [(i,j,R[i,j]) for (i,j) in indices_new]
+M_new, M_test = numpy.zeros((I,J)), numpy.zeros((I,J))
+for (i,j) in indices_new:
+    M_new[i,j] = 1.
+for (i,j) in indices_test:
+    M_test[i,j] = 1.
+
+
+''' Train from scratch on old+new entries, and incrementally by refining a model trained on the old entries. '''
+results = {}
+for name, construct, train in methods:
+    model = construct(R,M_old+M_new)
+    time_start = time.time()
+    train(model)
+    time_fresh = time.time() - time_start
+    MSE_fresh = model.predict(M_test)['MSE'] if 'VB' in name else model.predict(M_test,iterations-1,1)['MSE']
+    
+    model = construct(R,M_old)
+    train(model)
+    time_start = time.time()
+    model.update_data(new_entries)
+    model.refine(iterations_refine,local_sweeps)
+    time_incremental = time.time() - time_start
+    MSE_incremental = model.predict(M_test)['MSE'] if 'VB' in name else model.predict(M_test,iterations_refine-1,1)['MSE']
+    
+    results[name] = {
+        'fresh' : { 'MSE' : MSE_fresh, 'time' : time_fresh },
+        'incremental' : { 'MSE' : MSE_incremental, 'time' : time_incremental },
+    }
+
+
+''' Print and store the results. '''
+for name, _, _ in methods:
+    print "%s. Fresh: MSE %s in %ss. Incremental: MSE %s in %ss." % (
+        name, results[name]['fresh']['MSE'], results[name]['fresh']['time'], 
+        results[name]['incremental']['MSE'], results[name]['incremental']['time'])
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+open(output_file,'w').write("%s" % results)
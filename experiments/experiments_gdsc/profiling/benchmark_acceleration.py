@@ -0,0 +1,68 @@
+"""
+Compare the plain fixed-point iterations of the VB, ICM, and non-probabilistic
+models to the ones accelerated with SQUAREM and Anderson acceleration (see
+acceleration.py) on the GDSC IC50 dataset: the number of iterations, sweeps
+of the updates, and seconds until the relative change in the objective (ELBO,
+log posterior, or I-divergence) drops below the tolerance, and the final
+value of the objective.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.acceleration import iterations_to_convergence
+from BNMTF_ARD.code.models.bnmf_vb import bnmf_vb
+from BNMTF_ARD.code.models.bnmtf_vb import bnmtf_vb
+from BNMTF_ARD.code.models.nmf_icm import nmf_icm
+from BNMTF_ARD.code.models.nmtf_icm import nmtf_icm
+from BNMTF_ARD.code.models.nmf_np import nmf_np
+from BNMTF_ARD.code.models.nmtf_np import nmtf_np
+from BNMTF_ARD.data.drug_sensitivity.load_data import load_gdsc_ic50
+
+import numpy
+
+
+''' Experiment settings. '''
+iterations = 500
+tolerance = 1e-6
+K, L = 10, 10
+hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaF':0.1, 'lambdaS':0.1, 'lambdaG':0.1 }
+seed = 0
+accelerations = [None, 'squarem', 'anderson']
+
+output_folder = project_location+"BNMTF_ARD/experiments/experiments_gdsc/profiling/results/"
+output_file = output_folder+'benchmark_acceleration.txt'
+
+
+''' Load in data. '''
+R, M = load_gdsc_ic50()
+
+models = [
+    ('BNMF VB',     lambda: bnmf_vb(R,M,K,True,hyperparams),                  lambda model,accelerate: model.train('random',iterations,accelerate=accelerate),        'all_elbo'),
+    ('BNMTF VB',    lambda: bnmtf_vb(R,M,K,L,True,hyperparams),               lambda model,accelerate: model.train('kmeans','random',iterations,accelerate=accelerate), 'all_elbo'),
+    ('NMF ICM',     lambda: nmf_icm(R,M,K,True,hyperparams,'block'),          lambda model,accelerate: model.train('random',iterations,accelerate=accelerate),        'all_log_posterior'),
+    ('NMTF ICM',    lambda: nmtf_icm(R,M,K,L,True,hyperparams,'block'),       lambda model,accelerate: model.train('kmeans','random',iterations,accelerate=accelerate), 'all_log_posterior'),
+    ('NMF NP',      lambda: nmf_np(R,M,K,'matrix'),                           lambda model,accelerate: model.train(iterations,accelerate=accelerate),                 'all_objective'),
+    ('NMTF NP',     lambda: nmtf_np(R,M,K,L,'matrix'),                        lambda model,accelerate: model.train(iterations,accelerate=accelerate),                 'all_objective'),
+]
+
+
+''' Run each model with and without acceleration, from the same initialisation. '''
+lines = ["%-12s %-10s %12s %12s %12s %16s" % ('model','accelerate','iterations','sweeps','seconds','objective')]
+for name, construct, train, objective in models:
+    for accelerate in accelerations:
+        numpy.random.seed(seed)
+        model = construct()
+        train(model,accelerate)
+        objectives = getattr(model,objective)
+        it = iterations_to_convergence(objectives,tolerance)
+        (sweeps, seconds) = (model.all_sweeps[it-1], model.all_times[it-1]) if it is not None else ('-','-')
+        lines.append("%-12s %-10s %12s %12s %12s %16s" % (name,accelerate,it if it is not None else '-',sweeps,seconds,objectives[-1]))
+
+
+''' Print and store the results. '''
+print "\n".join(lines)
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+open(output_file,'w').write("\n".join(lines))
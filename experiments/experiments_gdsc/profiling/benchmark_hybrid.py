@@ -0,0 +1,92 @@
+"""
+Compare the burn-in of the Gibbs samplers started from the existing
+initialisations to the ones started from a draw from the variational posterior
+of a VB model (train_hybrid), on the GDSC IC50 dataset.
+
+We hold out a fraction of the observed entries. For each sampler the reference
+is the held-out MSE of the plain sampler with a long burn-in (reference_burn_in
+out of iterations). For a range of burn-ins we report the held-out MSE using
+the draws after that burn-in, and the smallest burn-in for which the MSE is
+within the relative tolerance of the reference (or '-' if none is). For the
+hybrid samplers we also report the time spent on the VB iterations.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.bnmf_gibbs import bnmf_gibbs
+from BNMTF_ARD.code.models.bnmtf_gibbs import bnmtf_gibbs
+from BNMTF_ARD.data.drug_sensitivity.load_data import load_gdsc_ic50
+
+import numpy, time
+
+
+''' Experiment settings. '''
+iterations = 1000
+reference_burn_in = 500
+vb_iterations = 100
+burn_ins = [0, 10, 20, 50, 100, 200, 500]
+fraction_test = 0.1
+tolerance = 0.01 # burn-in is enough if held-out MSE <= (1 + tolerance) * reference
+K, L = 10, 10
+seed = 0
+hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaS':0.1 }
+
+output_folder = project_location+"BNMTF_ARD/experiments/experiments_gdsc/profiling/results/"
+output_file = output_folder+'benchmark_hybrid.txt'
+
+
+''' Load in data, and hold out some of the observed entries. '''
+R, M = load_gdsc_ic50()
+numpy.random.seed(seed)
+(rows, cols) = numpy.nonzero(M)
+test = numpy.random.permutation(len(rows))[:int(fraction_test*len(rows))]
+M_train, M_test = numpy.array(M), numpy.zeros(M.shape)
+M_train[rows[test],cols[test]], M_test[rows[test],cols[test]] = 0, 1
+
+samplers = [
+    ('BNMF Gibbs',  lambda: bnmf_gibbs(R,M_train,K,True,hyperparams),     lambda model: model.train('random',iterations),
+                                                                          lambda model: model.train_hybrid('random',vb_iterations,iterations)),
+    ('BNMTF Gibbs', lambda: bnmtf_gibbs(R,M_train,K,L,True,hyperparams),  lambda model: model.train('kmeans','random',iterations),
+                                                                          lambda model: model.train_hybrid('kmeans','random',vb_iterations,iterations)),
+]
+
+
+def smallest_burn_in(MSEs,target):
+    ''' Return the smallest burn-in with a held-out MSE of at most target, or None. '''
+    for burn_in in burn_ins:
+        if MSEs[burn_in] <= target:
+            return burn_in
+    return None
+
+
+''' Run each sampler from the plain and the hybrid initialisation. '''
+lines = []
+for name, construct, train, train_hybrid in samplers:
+    results = {}
+    for method, run in [('plain', train), ('hybrid', train_hybrid)]:
+        numpy.random.seed(seed)
+        model = construct()
+        time_start = time.time()
+        run(model)
+        time_vb = model.vb.all_times[-1] if method == 'hybrid' else 0.
+        MSEs = dict([(burn_in,model.predict(M_test,burn_in,1)['MSE']) for burn_in in burn_ins + [reference_burn_in]])
+        results[method] = (time_vb, time.time() - time_start, MSEs)
+
+    reference = results['plain'][2][reference_burn_in]
+    target = (1. + tolerance) * reference
+    lines += ["", "%s. Reference held-out MSE (burn-in %s): %s" % (name,reference_burn_in,reference),
+              "%-8s %10s %10s %12s " % ('method','VB (s)','total (s)','burn-in') + " ".join(["%10s" % b for b in burn_ins])]
+    for method in ['plain', 'hybrid']:
+        (time_vb, time_total, MSEs) = results[method]
+        burn_in = smallest_burn_in(MSEs,target)
+        lines.append("%-8s %10.2f %10.2f %12s " % (method,time_vb,time_total,burn_in if burn_in is not None else '-') +
+                     " ".join(["%10.4f" % MSEs[b] for b in burn_ins]))
+
+
+''' Print and store the results. '''
+print "\n".join(lines)
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+open(output_file,'w').write("\n".join(lines))
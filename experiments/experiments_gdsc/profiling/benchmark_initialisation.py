@@ -0,0 +1,99 @@
+"""
+Compare the initialisations of the eight models on the GDSC IC50 and CTRP EC50
+datasets: the time needed to reach a target training MSE.
+
+We run each model from the existing initialisations (random draws, prior
+expectations, and K-means for NMTF) and from NNDSVD with mean and iterative
+imputation (see nndsvd.py). For each model and dataset the target is the best
+training MSE reached from any initialisation, plus a relative tolerance. We
+report the time of the initialisation, the time (including the
+initialisation) and number of iterations until the training MSE first drops
+below the target (or '-' if it never does), and the final training MSE.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.bnmf_gibbs import bnmf_gibbs
+from BNMTF_ARD.code.models.bnmf_vb import bnmf_vb
+from BNMTF_ARD.code.models.nmf_icm import nmf_icm
+from BNMTF_ARD.code.models.nmf_np import nmf_np
+from BNMTF_ARD.code.models.bnmtf_gibbs import bnmtf_gibbs
+from BNMTF_ARD.code.models.bnmtf_vb import bnmtf_vb
+from BNMTF_ARD.code.models.nmtf_icm import nmtf_icm
+from BNMTF_ARD.code.models.nmtf_np import nmtf_np
+from BNMTF_ARD.data.drug_sensitivity.load_data import load_gdsc_ic50, load_ctrp_ec50
+
+import numpy, time
+
+
+''' Experiment settings. '''
+iterations = 200
+K, L = 10, 10
+tolerance = 0.01 # target is (1 + tolerance) * best training MSE
+seed = 0
+hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaU':0.1, 'lambdaV':0.1, 'lambdaF':0.1, 'lambdaS':0.1, 'lambdaG':0.1 }
+
+output_folder = project_location+"BNMTF_ARD/experiments/experiments_gdsc/profiling/results/"
+output_file = output_folder+'benchmark_initialisation.txt'
+
+datasets = [
+    ('GDSC', load_gdsc_ic50),
+    ('CTRP', load_ctrp_ec50),
+]
+inits_nmf = [('random',), ('exp',), ('nndsvd',), ('nndsvd-iterative',)]
+inits_nmf_np = [('random',), ('exponential',), ('nndsvd',), ('nndsvd-iterative',)]
+inits_nmtf = [('kmeans','random'), ('random','random'), ('exp','exp'), ('nndsvd','nndsvd'), ('nndsvd-iterative','nndsvd')]
+inits_nmtf_np = [('kmeans','random'), ('random','random'), ('exponential','exponential'), ('nndsvd','nndsvd'), ('nndsvd-iterative','nndsvd')]
+models = [
+    ('BNMF Gibbs',  lambda R,M: bnmf_gibbs(R,M,K,True,hyperparams),                 inits_nmf),
+    ('BNMF VB',     lambda R,M: bnmf_vb(R,M,K,True,hyperparams),                    inits_nmf),
+    ('NMF ICM',     lambda R,M: nmf_icm(R,M,K,True,hyperparams),                    inits_nmf),
+    ('NMF NP',      lambda R,M: nmf_np(R,M,K),                                      inits_nmf_np),
+    ('BNMTF Gibbs', lambda R,M: bnmtf_gibbs(R,M,K,L,True,hyperparams),              inits_nmtf),
+    ('BNMTF VB',    lambda R,M: bnmtf_vb(R,M,K,L,True,hyperparams),                 inits_nmtf),
+    ('NMTF ICM',    lambda R,M: nmtf_icm(R,M,K,L,True,hyperparams),                 inits_nmtf),
+    ('NMTF NP',     lambda R,M: nmtf_np(R,M,K,L),                                   inits_nmtf_np),
+]
+
+
+def time_to_target(times,performances,target):
+    ''' Return the (time, iteration) at which the MSE first drops below target, or None. '''
+    for it,(time,MSE) in enumerate(zip(times,performances)):
+        if MSE <= target:
+            return (time,it+1)
+    return None
+
+
+''' Train each model from each initialisation, on each dataset. '''
+lines, all_traces = [], {}
+for dataset, load in datasets:
+    R, M = load()
+    for name, construct, inits in models:
+        traces = {}
+        for init in inits:
+            numpy.random.seed(seed)
+            model = construct(R,M)
+            time_start = time.time()
+            model.initialise(*init)
+            time_init = time.time() - time_start
+            model.run(iterations)
+            traces[init] = (time_init, [time_init + t for t in model.all_times], model.all_performances['MSE'])
+        all_traces[(dataset,name)] = traces
+
+        target = (1. + tolerance) * min([min(MSEs) for (_,_,MSEs) in traces.values()])
+        lines += ["", "%s, %s. Target training MSE: %s" % (dataset,name,target),
+                  "%-30s %12s %12s %12s %14s" % ('initialisation','init (s)','time (s)','iterations','final MSE')]
+        for init in inits:
+            time_init, times, MSEs = traces[init]
+            reached = time_to_target(times,MSEs,target)
+            time_reached, it = ("%.4f" % reached[0], "%d" % reached[1]) if reached else ('-','-')
+            lines.append("%-30s %12.4f %12s %12s %14.6f" % (", ".join(init),time_init,time_reached,it,MSEs[-1]))
+
+
+''' Print and store the results. '''
+print "\n".join(lines)
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+open(output_file,'w').write("%s\n\n%s" % ("\n".join(lines),all_traces))
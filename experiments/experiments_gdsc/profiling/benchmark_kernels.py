@@ -0,0 +1,83 @@
+"""
+Compare the numpy and numba backends of the kernels in kernels.py on the GDSC
+IC50 dataset: the time per call of each kernel, and the time per iteration of
+the Gibbs samplers and VB algorithms using them.
+
+The numba kernels are called once before timing, so that the compilation time
+is not included. If numba is not installed, only the numpy backend is timed.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models import kernels
+from BNMTF_ARD.code.models.kernels import set_backend, TN_vector_draw_kernel, TN_draw_kernel, masked_residual_products, masked_distances
+from BNMTF_ARD.code.models.bnmf_gibbs import bnmf_gibbs
+from BNMTF_ARD.code.models.bnmf_vb import bnmf_vb
+from BNMTF_ARD.code.models.bnmtf_gibbs import bnmtf_gibbs
+from BNMTF_ARD.code.models.bnmtf_vb import bnmtf_vb
+from BNMTF_ARD.data.drug_sensitivity.load_data import load_gdsc_ic50
+
+import numpy, timeit
+
+
+''' Experiment settings. '''
+repeats = 10
+iterations = 10
+K, L = 10, 10
+hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaS':0.1 }
+seed = 0
+
+backends = ['numpy'] + (['numba'] if kernels.numba is not None else [])
+
+output_folder = project_location+"BNMTF_ARD/experiments/experiments_gdsc/profiling/results/"
+output_file = output_folder+'benchmark_kernels.txt'
+
+
+''' Load in data, and construct the inputs of the kernels. '''
+R, M = load_gdsc_ic50()
+(I,J) = R.shape
+numpy.random.seed(seed)
+U, V = numpy.random.rand(I,K), numpy.random.rand(J,K)
+mus, taus = numpy.random.normal(size=I), numpy.random.gamma(1.,1.,size=I)
+centroids, mask_centroids = numpy.random.rand(K,J), numpy.ones((K,J))
+
+kernel_calls = [
+    ('TN_vector_draw (I)',          lambda: TN_vector_draw_kernel(mus,taus)),
+    ('TN_draw (x100)',              lambda: [TN_draw_kernel(mu,tau) for (mu,tau) in zip(mus[:100],taus[:100])]),
+    ('masked_residual_products',    lambda: masked_residual_products(R,M,U,V,0)),
+    ('masked_distances',            lambda: masked_distances(R,M,centroids,mask_centroids)),
+]
+
+models = [
+    ('BNMF Gibbs',  lambda: bnmf_gibbs(R,M,K,True,hyperparams),     lambda model: model.train('random',iterations)),
+    ('BNMF VB',     lambda: bnmf_vb(R,M,K,True,hyperparams),        lambda model: model.train('random',iterations)),
+    ('BNMTF Gibbs', lambda: bnmtf_gibbs(R,M,K,L,True,hyperparams),  lambda model: model.train('random','random',iterations)),
+    ('BNMTF VB',    lambda: bnmtf_vb(R,M,K,L,True,hyperparams),     lambda model: model.train('random','random',iterations)),
+]
+
+
+''' Time the kernels and the models for each backend. '''
+times = {}
+for backend in backends:
+    set_backend(backend)
+    for name, call in kernel_calls:
+        call() # compile the numba kernels
+        times[(name,backend)] = min(timeit.repeat(call,number=1,repeat=repeats))
+    for name, construct, train in models:
+        numpy.random.seed(seed)
+        model = construct(R,M)
+        train(model)
+        times[(name,backend)] = model.all_times[-1] / float(iterations)
+
+
+''' Print and store the results. '''
+lines = ["%-28s " % 'kernel or model (seconds)' + " ".join(["%12s" % backend for backend in backends])]
+for name in [name for (name,_) in kernel_calls] + [name for (name,_,_) in models]:
+    lines.append("%-28s " % name + " ".join(["%12.6f" % times[(name,backend)] for backend in backends]))
+
+print "\n".join(lines)
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+open(output_file,'w').write("\n".join(lines))
@@ -0,0 +1,106 @@
+"""
+Compare the number of Gibbs iterations needed for stable predictions when
+averaging the draws to averaging the conditional expectations of the draws
+(Rao-Blackwellisation, run(...,rao_blackwell=True)), on the GDSC IC50 dataset.
+
+We hold out a fraction of the observed entries. For each sampler, the reference
+predictions of the held-out entries come from a separate long chain (with
+reference_samples samples after the burn-in, averaging the conditional
+expectations). For a second chain we use only the first n samples after the
+burn-in, and report the relative distance of the predictions to the reference,
+||R_pred - R_ref|| / ||R_ref||, and the held-out MSE, for both estimators. We
+also report the smallest n for which the distance is at most the target, and
+the time per iteration with and without storing the conditional expectations.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.bnmf_gibbs import bnmf_gibbs
+from BNMTF_ARD.code.models.bnmtf_gibbs import bnmtf_gibbs
+from BNMTF_ARD.data.drug_sensitivity.load_data import load_gdsc_ic50
+
+import numpy
+
+
+''' Experiment settings. '''
+burn_in = 200
+reference_samples = 1000
+samples = [5, 10, 20, 50, 100, 200, 500]
+fraction_test = 0.1
+target = 0.01 # predictions are stable once within 1% of the reference
+K, L = 10, 10
+seed = 0
+hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaS':0.1 }
+
+output_folder = project_location+"BNMTF_ARD/experiments/experiments_gdsc/profiling/results/"
+output_file = output_folder+'benchmark_rao_blackwell.txt'
+
+
+''' Load in data, and hold out some of the observed entries. '''
+R, M = load_gdsc_ic50()
+numpy.random.seed(seed)
+(rows, cols) = numpy.nonzero(M)
+test = numpy.random.permutation(len(rows))[:int(fraction_test*len(rows))]
+M_train = numpy.array(M)
+M_train[rows[test],cols[test]] = 0
+rows_test, cols_test = rows[test], cols[test]
+
+samplers = [
+    ('BNMF Gibbs',  lambda: bnmf_gibbs(R,M_train,K,True,hyperparams),
+                    lambda model,iterations,rao_blackwell: model.train('random',iterations,rao_blackwell=rao_blackwell),
+                    lambda model,prefix,n: (numpy.mean(getattr(model,prefix+'U')[burn_in:burn_in+n],axis=0)[rows_test] *
+                                            numpy.mean(getattr(model,prefix+'V')[burn_in:burn_in+n],axis=0)[cols_test]).sum(axis=1)),
+    ('BNMTF Gibbs', lambda: bnmtf_gibbs(R,M_train,K,L,True,hyperparams),
+                    lambda model,iterations,rao_blackwell: model.train('kmeans','random',iterations,rao_blackwell=rao_blackwell),
+                    lambda model,prefix,n: (numpy.mean(getattr(model,prefix+'F')[burn_in:burn_in+n],axis=0)[rows_test] * numpy.dot(
+                                            numpy.mean(getattr(model,prefix+'G')[burn_in:burn_in+n],axis=0),
+                                            numpy.mean(getattr(model,prefix+'S')[burn_in:burn_in+n],axis=0).T)[cols_test]).sum(axis=1)),
+]
+
+
+def smallest_samples(distances):
+    ''' Return the smallest number of samples with a distance to the reference of at most target, or None. '''
+    for n in samples:
+        if distances[n] <= target:
+            return n
+    return None
+
+
+''' Run a reference chain and a test chain for each sampler. '''
+lines = []
+for name, construct, train, predict in samplers:
+    numpy.random.seed(seed)
+    reference_model = construct()
+    train(reference_model,burn_in+reference_samples,True)
+    R_ref = predict(reference_model,'all_exp_',reference_samples)
+
+    numpy.random.seed(seed+1)
+    model = construct()
+    train(model,burn_in+max(samples),True)
+    time_rao_blackwell = numpy.mean(numpy.diff(model.all_times))
+
+    # The same chain without storing the conditional expectations, for the timing
+    numpy.random.seed(seed+1)
+    plain_model = construct()
+    train(plain_model,burn_in+max(samples),False)
+    time_plain = numpy.mean(numpy.diff(plain_model.all_times))
+
+    lines += ["", "%s. Reference: %s samples after a burn-in of %s. Time per iteration: %.3fs (draws), %.3fs (Rao-Blackwellised)." % (
+              name,reference_samples,burn_in,time_plain,time_rao_blackwell),
+              "%-18s %10s " % ('estimator','samples') + " ".join(["%10s" % n for n in samples])]
+    for estimator, prefix in [('draws','all_'), ('Rao-Blackwellised','all_exp_')]:
+        R_preds = dict([(n,predict(model,prefix,n)) for n in samples])
+        distances = dict([(n,numpy.linalg.norm(R_preds[n]-R_ref)/numpy.linalg.norm(R_ref)) for n in samples])
+        MSEs = dict([(n,numpy.mean((R_preds[n]-R[rows_test,cols_test])**2)) for n in samples])
+        smallest = smallest_samples(distances)
+        lines.append("%-18s %10s " % (estimator,smallest if smallest is not None else '-') + " ".join(["%10.5f" % distances[n] for n in samples]))
+        lines.append("%-18s %10s " % ('  (MSE)','') + " ".join(["%10.4f" % MSEs[n] for n in samples]))
+
+
+''' Print and store the results. '''
+print "\n".join(lines)
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+open(output_file,'w').write("\n".join(lines))
@@ -0,0 +1,77 @@
+"""
+Compare the solvers of the non-probabilistic NMF and NMTF models on the GDSC
+IC50 dataset: the time needed to reach a target training MSE.
+
+We run the multiplicative updates (one column at a time, and whole matrices at
+once) and HALS from the same random initialisation, for both the I-divergence
+and Frobenius objectives where available. The target is the best training MSE
+reached by any solver, plus a relative tolerance. For each solver we report
+the time and number of iterations until its training MSE first drops below the
+target (or '-' if it never does), and its final training MSE.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.nmf_np import nmf_np
+from BNMTF_ARD.code.models.nmtf_np import nmtf_np
+from BNMTF_ARD.data.drug_sensitivity.load_data import load_gdsc_ic50
+
+import numpy
+
+
+''' Experiment settings. '''
+iterations = 500
+K, L = 10, 10
+tolerance = 0.01 # target is (1 + tolerance) * best training MSE
+seed = 0
+
+output_folder = project_location+"BNMTF_ARD/experiments/experiments_gdsc/profiling/results/"
+output_file = output_folder+'benchmark_solvers.txt'
+
+methods = [
+    ('NMF columns I-div',      lambda R,M: nmf_np(R,M,K,'columns','I-div')),
+    ('NMF matrix I-div',       lambda R,M: nmf_np(R,M,K,'matrix','I-div')),
+    ('NMF matrix Frobenius',   lambda R,M: nmf_np(R,M,K,'matrix','Frobenius')),
+    ('NMF HALS Frobenius',     lambda R,M: nmf_np(R,M,K,'hals','Frobenius')),
+    ('NMTF columns I-div',     lambda R,M: nmtf_np(R,M,K,L,'columns','I-div')),
+    ('NMTF matrix I-div',      lambda R,M: nmtf_np(R,M,K,L,'matrix','I-div')),
+    ('NMTF matrix Frobenius',  lambda R,M: nmtf_np(R,M,K,L,'matrix','Frobenius')),
+    ('NMTF HALS Frobenius',    lambda R,M: nmtf_np(R,M,K,L,'hals','Frobenius')),
+]
+
+
+def time_to_target(times,performances,target):
+    ''' Return the (time, iteration) at which the MSE first drops below target, or None. '''
+    for it,(time,MSE) in enumerate(zip(times,performances)):
+        if MSE <= target:
+            return (time,it+1)
+    return None
+
+
+''' Load in data, and train each model. '''
+R, M = load_gdsc_ic50()
+
+traces = {}
+for name, construct in methods:
+    numpy.random.seed(seed)
+    model = construct(R,M)
+    model.train(iterations)
+    traces[name] = (model.all_times, model.all_performances['MSE'])
+
+target = (1. + tolerance) * min([min(MSEs) for (_,MSEs) in traces.values()])
+
+
+''' Print and store the results. '''
+lines = ["Target training MSE: %s" % target, "%-24s %12s %12s %14s" % ('solver','time (s)','iterations','final MSE')]
+for name, _ in methods:
+    times, MSEs = traces[name]
+    reached = time_to_target(times,MSEs,target)
+    time, it = ("%.4f" % reached[0], "%d" % reached[1]) if reached else ('-','-')
+    lines.append("%-24s %12s %12s %14.6f" % (name,time,it,MSEs[-1]))
+
+print "\n".join(lines)
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+open(output_file,'w').write("%s\n\n%s" % ("\n".join(lines),traces))
@@ -0,0 +1,67 @@
+"""
+Measure where the time goes in the run() loops of all eight models on the GDSC
+IC50 dataset, using the per-phase timings stored in model.profile.
+
+For each model we train for a fixed number of iterations, and print and store
+a table with the time, fraction of the total time, number of calls, and peak
+memory growth of each phase (the factor updates, the truncated normal moments
+for the VB models, tau, lambda, storing the traces, and evaluation).
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.bnmf_gibbs import bnmf_gibbs
+from BNMTF_ARD.code.models.bnmf_vb import bnmf_vb
+from BNMTF_ARD.code.models.nmf_icm import nmf_icm
+from BNMTF_ARD.code.models.nmf_np import nmf_np
+from BNMTF_ARD.code.models.bnmtf_gibbs import bnmtf_gibbs
+from BNMTF_ARD.code.models.bnmtf_vb import bnmtf_vb
+from BNMTF_ARD.code.models.nmtf_icm import nmtf_icm
+from BNMTF_ARD.code.models.nmtf_np import nmtf_np
+from BNMTF_ARD.code.models.profiler import format_profile
+from BNMTF_ARD.data.drug_sensitivity.load_data import load_gdsc_ic50
+
+
+''' Experiment settings. '''
+iterations = 50
+K, L = 10, 10
+
+output_folder = project_location+"BNMTF_ARD/experiments/experiments_gdsc/profiling/results/"
+output_file = output_folder+'profile_phases.txt'
+
+alphatau, betatau = 1., 1.
+alpha0, beta0 = 1., 1.
+lambdaU = lambdaV = lambdaF = lambdaS = lambdaG = 0.1
+hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 
+                'lambdaU':lambdaU, 'lambdaV':lambdaV, 'lambdaF':lambdaF, 'lambdaS':lambdaS, 'lambdaG':lambdaG }
+
+methods = [
+    ('NMF Gibbs',  lambda R,M: bnmf_gibbs(R,M,K,True,hyperparams),     lambda m: m.train('random',iterations)),
+    ('NMF VB',     lambda R,M: bnmf_vb(R,M,K,True,hyperparams),        lambda m: m.train('random',iterations)),
+    ('NMF ICM',    lambda R,M: nmf_icm(R,M,K,True,hyperparams),        lambda m: m.train('random',iterations)),
+    ('NMF NP',     lambda R,M: nmf_np(R,M,K),                          lambda m: m.train(iterations)),
+    ('NMTF Gibbs', lambda R,M: bnmtf_gibbs(R,M,K,L,True,hyperparams),  lambda m: m.train('kmeans','random',iterations)),
+    ('NMTF VB',    lambda R,M: bnmtf_vb(R,M,K,L,True,hyperparams),     lambda m: m.train('kmeans','random',iterations)),
+    ('NMTF ICM',   lambda R,M: nmtf_icm(R,M,K,L,True,hyperparams),     lambda m: m.train('kmeans','random',iterations)),
+    ('NMTF NP',    lambda R,M: nmtf_np(R,M,K,L),                       lambda m: m.train(iterations)),
+]
+
+
+''' Load in data, and train each model. '''
+R, M = load_gdsc_ic50()
+
+tables, profiles = [], {}
+for name, construct, train in methods:
+    model = construct(R,M)
+    train(model)
+    profiles[name] = model.profile
+    tables.append("%s\n%s\n" % (name,format_profile(model.profile,model.profile_phases)))
+
+
+''' Print and store the results. '''
+print "\n".join(tables)
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+open(output_file,'w').write("%s\n%s" % ("\n".join(tables),profiles))
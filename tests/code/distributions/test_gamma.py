@@ -6,7 +6,9 @@ import sys, os
 project_location = os.path.dirname(__file__)+"/../../../../"
 sys.path.append(project_location)
 
-from BNMTF_ARD.code.models.distributions.gamma import gamma_draw, gamma_expectation, gamma_expectation_log, gamma_mode
+from BNMTF_ARD.code.models.distributions.gamma import gamma_draw, gamma_expectation, gamma_expectation_log, gamma_mode, gamma_log_density
+
+import numpy
 
 def test_expectation():
     alpha = 2.0
@@ -34,4 +36,13 @@ def test_median():
     alpha = 2.0
     beta = 3.0
     median = 1./3.
-    assert gamma_mode(alpha,beta) == median
\ No newline at end of file
+    assert gamma_mode(alpha,beta) == median
+        
+# Test the log density, against scipy
+def test_log_density():
+    from scipy.stats import gamma
+    alpha = 2.0
+    beta = 3.0
+    x = numpy.array([0.5,1.,2.])
+    assert numpy.allclose(gamma_log_density(x,alpha,beta),gamma.logpdf(x,alpha,scale=1./beta))
+    assert abs(gamma_log_density(2.,alpha,beta) - gamma.logpdf(2.,alpha,scale=1./beta)) < 1e-12
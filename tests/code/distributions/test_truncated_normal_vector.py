@@ -6,7 +6,7 @@ import sys, os
 project_location = os.path.dirname(__file__)+"/../../../../"
 sys.path.append(project_location)
 
-from BNMTF_ARD.code.models.distributions.truncated_normal_vector import TN_vector_draw, TN_vector_expectation, TN_vector_variance, TN_vector_mode
+from BNMTF_ARD.code.models.distributions.truncated_normal_vector import TN_vector_draw, TN_vector_draw_rng, TN_vector_expectation, TN_vector_variance, TN_vector_mode
 from scipy.stats import norm
 import numpy
 
@@ -40,6 +40,17 @@ def test_draw():
         v1,v2 = TN_vector_draw(mu,tau)
         assert v1 >= 0.0 and v2 == 0.0
         
+# Test draws from a given random state - the mean should match the expectation, also for the exponential approximation
+def test_draw_rng():
+    mu = [1.0, 0.32, -1., -5.]
+    tau = [3.0, 0.0, 2000., 1.]
+    draws = numpy.array([TN_vector_draw_rng(mu,tau,numpy.random.RandomState(seed)) for seed in range(2000)])
+    assert (draws >= 0.).all() and (draws[:,1] == 0.).all()
+    expectation = TN_vector_expectation(mu,tau)
+    for n in [0,2,3]:
+        assert abs(draws[:,n].mean() - expectation[n]) < 0.1 * expectation[n]
+    assert numpy.array_equal(TN_vector_draw_rng(mu,tau,numpy.random.RandomState(0)),draws[0])
+        
 # Test the mode
 def test_mode():
     # Positive mean
@@ -0,0 +1,95 @@
+"""
+Test the SQUAREM and Anderson acceleration in acceleration.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.acceleration import iterations_to_convergence, create_accelerator, SQUAREM, Anderson, NullAccelerator, POSITIVE
+
+import numpy, pytest
+
+
+class LinearMap:
+    ''' The fixed-point map x <- A x + b with A = diag(rates), so x converges linearly to b / (1 - rates). '''
+    def __init__(self,rates,b):
+        self.rates, self.b = numpy.array(rates), numpy.array(b)
+        self.x, self.scalar = numpy.zeros(len(rates)), 0.
+        self.refreshed = 0
+    def sweep(self):
+        self.x = self.rates * self.x + self.b
+    def objective(self):
+        return - ((self.x - self.b / (1. - self.rates))**2).sum()
+    def refresh(self):
+        self.refreshed += 1
+
+
+""" Test the number of iterations until the objective converges. """
+def test_iterations_to_convergence():
+    assert iterations_to_convergence([1.,2.,2.5,2.5000001],1e-6) == 4
+    assert iterations_to_convergence([1.,2.,2.5,2.5000001],1e-8) is None
+    assert iterations_to_convergence([1.,1.]) == 2
+    assert iterations_to_convergence([]) is None
+    
+    
+""" Test creating the accelerators. """
+def test_create_accelerator():
+    model = LinearMap([0.5],[1.])
+    assert isinstance(create_accelerator(None,model,[('x',None)],model.sweep,model.objective),NullAccelerator)
+    assert isinstance(create_accelerator(False,model,[('x',None)],model.sweep,model.objective),NullAccelerator)
+    assert isinstance(create_accelerator('squarem',model,[('x',None)],model.sweep,model.objective),SQUAREM)
+    assert isinstance(create_accelerator('anderson',model,[('x',None)],model.sweep,model.objective),Anderson)
+    with pytest.raises(AssertionError) as error:
+        create_accelerator('newton',model,[('x',None)],model.sweep,model.objective)
+    assert str(error.value) == "Unrecognised acceleration: newton. Should be one in ['squarem', 'anderson']."
+    
+    
+""" Test getting and setting the parameters, with the projection onto the lower bounds. """
+def test_get_set():
+    model = LinearMap([0.5,0.5],[1.,1.])
+    model.x = numpy.array([1.,2.])
+    accelerator = SQUAREM(model,[('x',0.),('scalar',POSITIVE)],model.sweep,model.objective,model.refresh)
+    assert numpy.array_equal(accelerator.get(),[1.,2.,0.])
+    accelerator.set(numpy.array([-1.,3.,-2.]))
+    assert numpy.array_equal(model.x,[0.,3.]) and model.scalar == POSITIVE and model.refreshed == 1
+    accelerator = SQUAREM(model,[('x',None)],model.sweep,model.objective)
+    accelerator.set(numpy.array([-1.,3.]))
+    assert numpy.array_equal(model.x,[-1.,3.])
+    
+    
+""" Test that both accelerators converge in fewer sweeps than the plain iterations. """
+def test_convergence():
+    rates, b = [0.99,0.95,0.5], [1.,2.,3.]
+    solution = numpy.array(b) / (1. - numpy.array(rates))
+    sweeps = {}
+    for accelerate in [None,'squarem','anderson']:
+        model = LinearMap(rates,b)
+        accelerator = create_accelerator(accelerate,model,[('x',None)],model.sweep,model.objective)
+        while numpy.abs(model.x - solution).max() > 1e-6 and accelerator.sweeps < 10000:
+            accelerator.step()
+        sweeps[accelerate] = accelerator.sweeps
+    assert sweeps[None] > 1000
+    assert sweeps['squarem'] < 100 and sweeps['anderson'] < 100
+    
+    
+""" Test the safeguards when the extrapolation decreases the objective. """
+def test_safeguard():
+    # The objective prefers values close to 0, while the map moves away from it
+    model = LinearMap([0.9],[1.])
+    objective = lambda: - abs(model.x[0])
+    accelerator = SQUAREM(model,[('x',None)],model.sweep,objective)
+    accelerator.step()
+    assert accelerator.rejected == 5 and accelerator.sweeps == 3 + 5
+    
+    model = LinearMap([0.9],[1.])
+    accelerator = Anderson(model,[('x',None)],model.sweep,objective)
+    accelerator.step()
+    assert accelerator.rejected == 0 and accelerator.sweeps == 1
+    accelerator.step()
+    x = model.x.copy()
+    assert accelerator.rejected == 1 and accelerator.dF == [] and numpy.allclose(x,[1.9])
+    
+    with pytest.raises(AssertionError) as error:
+        Anderson(model,[('x',None)],model.sweep,objective,memory=0)
+    assert str(error.value) == "Memory of Anderson acceleration should be at least 1, not 0."
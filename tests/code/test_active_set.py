@@ -0,0 +1,102 @@
+"""
+Test the active-set scheduling of the coordinate updates in active_set.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.active_set import create_scheduler, relative_change, ActiveSet, NullActiveSet
+from BNMTF_ARD.code.models.active_set import ACTIVE_SET_TOLERANCE, ACTIVE_SET_SKIP, ACTIVE_SET_EVERY, ACTIVE_SET_WAKE
+
+import numpy, pytest
+
+AXES = { 'F':('K',), 'S':('K','L'), 'G':('L',) }
+SIZES = { 'K':2, 'L':3 }
+
+
+""" Test the choice of scheduler, and the checks on the settings. """
+def test_create_scheduler():
+    assert isinstance(create_scheduler(AXES,SIZES,False),NullActiveSet)
+    assert isinstance(create_scheduler(AXES,SIZES,None),NullActiveSet)
+    scheduler = create_scheduler(AXES,SIZES,True)
+    assert isinstance(scheduler,ActiveSet)
+    assert (scheduler.tolerance,scheduler.skip,scheduler.every,scheduler.wake) == (ACTIVE_SET_TOLERANCE,ACTIVE_SET_SKIP,ACTIVE_SET_EVERY,ACTIVE_SET_WAKE)
+    assert scheduler.skipping['F'].shape == (2,) and scheduler.skipping['S'].shape == (2,3) and scheduler.skipping['G'].shape == (3,)
+    scheduler = create_scheduler(AXES,SIZES,{'tolerance':1e-3,'skip':2})
+    assert (scheduler.tolerance,scheduler.skip,scheduler.every) == (1e-3,2,ACTIVE_SET_EVERY)
+
+    with pytest.raises(AssertionError) as error:
+        create_scheduler(AXES,SIZES,{'skip':0})
+    assert str(error.value) == "Number of sweeps to skip should be at least 1, not 0."
+    with pytest.raises(AssertionError) as error:
+        create_scheduler(AXES,SIZES,{'every':0})
+    assert str(error.value) == "Number of sweeps between full sweeps should be at least 1, not 0."
+    with pytest.raises(AssertionError) as error:
+        create_scheduler(AXES,SIZES,{'tolerance':0.1,'wake':0.01})
+    assert str(error.value) == "Wake threshold should be at least the tolerance, not 0.01 < 0.1."
+
+
+""" Test the relative change of vectors and scalars. """
+def test_relative_change():
+    assert relative_change(numpy.array([3.,4.]),numpy.array([3.,4.])) == 0.
+    assert relative_change(numpy.array([3.,4.]),numpy.array([3.,5.])) == 0.2
+    assert relative_change(numpy.zeros(2),numpy.array([3.,4.])) == 5.
+    assert relative_change(2.,3.) == 0.5
+
+
+""" Test skipping items whose change is below the tolerance, for skip sweeps. """
+def test_skip():
+    scheduler = ActiveSet(AXES,SIZES,tolerance=1e-3,skip=2,every=100,wake=1.)
+    scheduler.start_sweep()
+    assert scheduler.active('F',0) and scheduler.active('F',1)
+    scheduler.record('F',0,numpy.ones(3),numpy.ones(3))
+    scheduler.record('F',1,numpy.ones(3),2*numpy.ones(3))
+    for sweep in range(2):
+        scheduler.start_sweep()
+        assert not scheduler.active('F',0) and scheduler.active('F',1)
+    scheduler.start_sweep()
+    assert scheduler.active('F',0)
+    assert scheduler.summary() == { 'updated':{'F':5,'S':0,'G':0}, 'skipped':{'F':2,'S':0,'G':0} }
+
+
+""" Test waking up the items that share a component with one that changed a lot. """
+def test_wake():
+    scheduler = ActiveSet(AXES,SIZES,tolerance=1e-3,skip=10,every=100,wake=0.1)
+    for k,l in [(0,0),(0,1),(0,2),(1,0),(1,1),(1,2)]:
+        scheduler.record('S',(k,l),1.,1.)
+    for k in range(2):
+        scheduler.record('F',k,numpy.ones(3),numpy.ones(3))
+    for l in range(3):
+        scheduler.record('G',l,numpy.ones(3),numpy.ones(3))
+
+    # A small change wakes up nothing, a large change in G.1 wakes up S[:,1] only
+    scheduler.record('G',1,numpy.ones(3),1.01*numpy.ones(3))
+    assert (scheduler.skipping['S'] == 10).all() and scheduler.skipping['G'][1] == 0
+    scheduler.record('G',1,numpy.ones(3),2*numpy.ones(3))
+    assert (scheduler.skipping['S'][:,1] == 0).all() and (scheduler.skipping['S'][:,[0,2]] == 10).all()
+    assert (scheduler.skipping['F'] == 10).all() and (scheduler.skipping['G'][[0,2]] == 10).all()
+
+    # A large change in S[0,2] wakes up F.0, G.2, and S[0,:] and S[:,2]
+    scheduler.record('S',(0,2),1.,2.)
+    assert list(scheduler.skipping['F']) == [0,10] and list(scheduler.skipping['G']) == [10,0,0]
+    assert (scheduler.skipping['S'] == numpy.array([[0,0,0],[10,0,0]])).all()
+
+
+""" Test making all items active again in a full sweep every every sweeps. """
+def test_every():
+    scheduler = ActiveSet({ 'U':('K',), 'V':('K',) },{'K':2},tolerance=1e-3,skip=10,every=3)
+    scheduler.start_sweep()
+    scheduler.record('U',0,numpy.ones(2),numpy.ones(2))
+    scheduler.start_sweep()
+    assert not scheduler.active('U',0)
+    scheduler.start_sweep()
+    assert scheduler.active('U',0) and scheduler.sweeps == 3
+
+
+""" Test that the NullActiveSet updates everything. """
+def test_null():
+    scheduler = create_scheduler(AXES,SIZES,False)
+    scheduler.start_sweep()
+    scheduler.record('F',0,numpy.ones(3),numpy.ones(3))
+    assert scheduler.active('F',0) and scheduler.active('S',(1,2)) and scheduler.summary() is None
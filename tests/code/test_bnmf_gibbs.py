@@ -6,8 +6,9 @@ import sys, os
 project_location = os.path.dirname(__file__)+"/../../../"
 sys.path.append(project_location)
 
-import numpy, math, pytest, itertools
+import numpy, math, pytest, itertools, threading
 from BNMTF_ARD.code.models.bnmf_gibbs import bnmf_gibbs
+from BNMTF_ARD.code.models import budget
 
 
 """ Test constructor """
@@ -320,6 +321,10 @@ def test_predict():
     assert performances['R^2'] == R2
     assert performances['Rp'] == Rp
     
+    # Extra metrics can be requested as well
+    MAE = (21081. + 21163. + 21158. + 21157.) / 4.
+    assert BNMF.predict(M_test,burn_in,thinning,metrics=['MAE']) == { 'MAE': MAE }
+    
     
 """ Test the evaluation measures MSE, R^2, Rp """
 def test_compute_statistics():
@@ -374,4 +379,499 @@ def test_log_likelihood():
     assert MSE == BNMF.quality('MSE',burnin,thinning)
     with pytest.raises(AssertionError) as error:
         BNMF.quality('FAIL',burnin,thinning)
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+    
+    
+""" Test folding in new rows and columns, keeping the trained factors fixed. """
+def test_fold_in():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    V = numpy.copy(BNMF.V)
+    
+    R_new, M_new = 2*numpy.ones((3,J)), numpy.ones((3,J))
+    M_new[0,1] = 0
+    U_new = BNMF.fold_in_rows(R_new,M_new,10)
+    assert U_new.shape == (3,K)
+    assert (U_new >= 0.).all()
+    assert numpy.array_equal(BNMF.V,V)
+    
+    V_new = BNMF.fold_in_columns(numpy.ones((I,4)),numpy.ones((I,4)),10)
+    assert V_new.shape == (4,K)
+    assert (V_new >= 0.).all()
+    
+    # New data should match the trained model, with no fully unobserved rows or columns
+    with pytest.raises(AssertionError) as error:
+        BNMF.fold_in_rows(numpy.ones((3,J+1)),numpy.ones((3,J+1)),10)
+    assert str(error.value) == "New matrix R_new has the wrong shape: (3, 6), while the trained model has 5 columns."
+    M_new = numpy.ones((I,2))
+    M_new[:,1] = 0
+    with pytest.raises(AssertionError) as error:
+        BNMF.fold_in_columns(numpy.ones((I,2)),M_new,10)
+    assert str(error.value) == "Fully unobserved column in R_new, column 1."
+    with pytest.raises(AssertionError) as error:
+        BNMF.fold_in_rows(R_new,numpy.ones((3,J)),10,burn_in=10)
+    assert str(error.value) == "Number of iterations should be greater than the burn-in, not 10 <= 10."
+
+
+""" Test adding new observations, and refining from the current state. """
+def test_update_data_refine():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    
+    BNMF.update_data([(0,0,2.),(2,2,1.),(0,1,4.)])
+    assert BNMF.M[0,0] == 1. and BNMF.M[2,2] == 1.
+    assert BNMF.R[0,0] == 2. and BNMF.R[0,1] == 4.
+    assert BNMF.size_Omega == I*J-1
+    assert BNMF.touched_rows == [0,2] and BNMF.touched_columns == [0,1,2]
+    
+    BNMF.refine(5,local_sweeps=2)
+    assert BNMF.touched_rows == [] and BNMF.touched_columns == []
+    assert (BNMF.U >= 0.).all() and (BNMF.V >= 0.).all()
+    assert len(BNMF.all_performances['MSE']) == 5
+    
+    with pytest.raises(AssertionError) as error:
+        BNMF.update_data([(I,0,1.)])
+    assert str(error.value) == "New entry (10,0) lies outside of R, which has shape (10, 5)."
+
+
+""" Test saving and loading the model, and continuing from the loaded state. """
+def test_save_load(tmpdir):
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    path = str(tmpdir.join('model'))
+    BNMF.save(path,burn_in=5,thinning=2)
+    
+    loaded = bnmf_gibbs.load(path)
+    assert numpy.array_equal(loaded.U,BNMF.U)
+    assert numpy.array_equal(loaded.V,BNMF.V)
+    assert loaded.tau == BNMF.tau
+    assert isinstance(loaded.all_U,numpy.memmap) and numpy.array_equal(loaded.all_U,BNMF.all_U)
+    assert numpy.array_equal(loaded.summaries['exp_U'],BNMF.approx_expectation(5,2)[0])
+    assert loaded.all_performances['MSE'] == BNMF.all_performances['MSE']
+    assert loaded.predict(M,5,2)['MSE'] == BNMF.predict(M,5,2)['MSE']
+    
+    # We can continue running the loaded model
+    loaded.run(2)
+    
+    # The mask should match its fingerprint
+    numpy.save(path+'/M.npy',numpy.ones((I,J)))
+    with pytest.raises(AssertionError) as error:
+        bnmf_gibbs.load(path)
+    assert str(error.value) == "Mask M in %s does not match the fingerprint in its metadata." % path
+
+
+""" Test predicting individual entries and rows. """
+def test_predict_entries_rows():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    
+    rows, cols = [0,3,9], [1,4,0]
+    (exp_U,exp_V,_,_) = BNMF.approx_expectation(5,2)
+    R_pred = numpy.dot(exp_U,exp_V.T)
+    assert numpy.allclose(BNMF.predict_entries(rows,cols,5,2),R_pred[rows,cols])
+    assert numpy.allclose(BNMF.predict_rows([2,5],5,2),R_pred[[2,5]])
+    
+    # The variance is that of the predictions of the individual draws
+    all_R = numpy.array([numpy.dot(BNMF.all_U[it],BNMF.all_V[it].T) for it in range(5,10,2)])
+    (_,var_R) = BNMF.predict_entries(rows,cols,5,2,variance=True)
+    assert numpy.allclose(var_R,all_R.var(axis=0)[rows,cols])
+    (_,var_R) = BNMF.predict_rows([2,5],5,2,variance=True)
+    assert numpy.allclose(var_R,all_R.var(axis=0)[[2,5]])
+    
+    # The cached expectations are cleared when we run the model again
+    assert (5,2) in BNMF.prediction_cache
+    BNMF.run(10)
+    assert BNMF.prediction_cache == {}
+
+
+""" Test the posterior predictive mean, variance, and credible intervals. """
+def test_predictive():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    
+    rows, cols = numpy.nonzero(M)
+    BNMF.initialise('exp')
+    with pytest.raises(AssertionError) as error:
+        BNMF.predictive()
+    assert str(error.value) == "No draws for the tracked entries - please call track_predictive() before run()."
+    
+    BNMF.track_predictive(rows,cols,burn_in=4,thinning=2)
+    BNMF.run(10)
+    all_R = numpy.array([(BNMF.all_U[it][rows] * BNMF.all_V[it][cols]).sum(axis=1) for it in range(4,10,2)])
+    predictive = BNMF.predictive(credible=0.9)
+    assert BNMF.predictive_moments.n == 3
+    assert numpy.allclose(predictive['mean'],all_R.mean(axis=0))
+    assert numpy.allclose(predictive['variance'],all_R.var(axis=0) + (1. / BNMF.all_tau[4:10:2]).mean())
+    assert numpy.allclose(predictive['upper'] - predictive['mean'],1.644854*numpy.sqrt(predictive['variance']))
+    
+    # The moments are reset when we run the sampler again
+    BNMF.run(3)
+    assert BNMF.predictive_moments.n == 0
+
+""" Test the timings and counts of the phases in the run loop. """
+def test_profile():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    
+    # Each phase is timed once per iteration
+    assert BNMF.profile_phases == ['lambda', 'U', 'V', 'tau', 'traces', 'predictive', 'performance', 'output']
+    assert all([BNMF.profile[phase]['calls'] == 10 for phase in ['lambda', 'U', 'V', 'tau', 'traces', 'predictive', 'performance', 'output']])
+    assert all([BNMF.profile[phase]['time'] >= 0. and BNMF.profile[phase]['memory'] >= 0 for phase in BNMF.profile_phases])
+    
+    # Profiling can be switched off
+    BNMF.run(2,profile=False)
+    assert BNMF.profile is None and BNMF.profile_phases == []
+
+
+""" Test pruning the components that ARD has switched off. """
+def test_prune():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    with pytest.raises(AssertionError) as error:
+        BNMF = bnmf_gibbs(R,M,K,False,dict(hyperparams,lambdaU=1.,lambdaV=1.))
+        BNMF.train('exp',2,prune=True)
+    assert str(error.value) == "Pruning components is only possible when using ARD."
+    
+    # With an infinite threshold, all but the largest component are removed after patience iterations
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train('exp',10,prune={'threshold':numpy.inf,'patience':3})
+    assert 'pruning' in BNMF.profile_phases
+    pruned = [k for (it,k) in BNMF.pruned_components]
+    assert BNMF.K == 1 and len(pruned) == K-1 and all([it == 2 for (it,_) in BNMF.pruned_components])
+    assert BNMF.U.shape == (I,1) and BNMF.V.shape == (J,1) and BNMF.lambdak.shape == (1,)
+    
+    # The traces keep all components, with zeros for the pruned ones from then on
+    assert BNMF.all_U.shape == (10,I,K) and BNMF.all_V.shape == (10,J,K) and BNMF.all_lambdak.shape == (10,K)
+    assert (BNMF.all_U[2:,:,pruned] == 0.).all() and (BNMF.all_U[:2,:,pruned] > 0.).all()
+    assert (BNMF.all_V[2:,:,pruned] == 0.).all() and (BNMF.all_lambdak[2:,pruned] == 0.).all()
+    
+    # So we can still predict using the traces
+    assert BNMF.predict(M,2,1)['MSE'] >= 0.
+
+
+""" Test growing the number of components while running """
+def test_grow():
+    I,J,K = 10,5,1
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    with pytest.raises(AssertionError) as error:
+        BNMF = bnmf_gibbs(R,M,K,False,dict(hyperparams,lambdaU=1.,lambdaV=1.))
+        BNMF.train('exp',2,grow=True)
+    assert str(error.value) == "Growing components is only possible when using ARD."
+    with pytest.raises(AssertionError) as error:
+        BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+        BNMF.train('exp',2,prune=True,grow=True)
+    assert str(error.value) == "Components can either be pruned or grown, not both."
+    
+    # Without a threshold, and accepting any change in the fit, a component is added every four iterations
+    # (the new one is followed for two checks), until we reach the maximum
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train('exp',8,grow={'threshold':0.,'every':2,'max_components':3,'improvement':-numpy.inf})
+    assert 'growth' in BNMF.profile_phases
+    assert BNMF.K == 3 and BNMF.grown_components == [(1,1),(5,2)] and BNMF.pruned_components == []
+    assert BNMF.all_K == [1,2,2,2,2,3,3,3]
+    assert BNMF.U.shape == (I,3) and BNMF.V.shape == (J,3) and BNMF.lambdak.shape == (3,)
+    
+    # The traces are sized for the maximum number of components, with zeros before they were added
+    assert BNMF.all_U.shape == (8,I,3) and BNMF.all_lambdak.shape == (8,3)
+    assert (BNMF.all_U[:1,:,1:] == 0.).all() and (BNMF.all_V[:5,:,2] == 0.).all() and (BNMF.all_U[6:,:,2] > 0.).all()
+    assert BNMF.predict(M,2,1)['MSE'] >= 0.
+
+
+""" Test that with the default settings, growth on rank-3 data stops close to the true rank. """
+def test_grow_defaults():
+    numpy.random.seed(0)
+    I,J,K,true_K = 60,40,1,3
+    U, V = numpy.random.exponential(size=(I,true_K)), numpy.random.exponential(size=(J,true_K))
+    R = numpy.dot(U,V.T) + numpy.random.normal(0,0.1,size=(I,J))
+    M = numpy.ones((I,J))
+    hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1. }
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train('random',60,grow=True)
+    assert true_K <= BNMF.K <= true_K+1 and len(BNMF.pruned_components) == 1
+
+
+""" Test splitting the updates of the rows and columns over threads """
+def test_threads():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    with pytest.raises(AssertionError) as error:
+        bnmf_gibbs(R,M,K,True,hyperparams).train('exp',2,threads=0)
+    assert str(error.value) == "Number of threads should be at least 1, not 0."
+    
+    # Each block has its own random state, seeded from numpy.random, so runs can be reproduced
+    draws = []
+    for run in range(2):
+        numpy.random.seed(1)
+        BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+        BNMF.train('exp',5,threads=3)
+        draws.append(BNMF.all_U)
+    assert numpy.array_equal(draws[0],draws[1]) and (draws[0] >= 0.).all()
+    assert BNMF.all_V.shape == (5,J,K) and (BNMF.all_V[-1] > 0.).any()
+    assert BNMF.predict(M,2,1)['MSE'] >= 0.
+    
+    # The threads are stopped when run() raises an error
+    def fail(*args):
+        raise ValueError("Failed.")
+    threads = threading.active_count()
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.predict_while_running = fail
+    with pytest.raises(ValueError):
+        BNMF.train('exp',5,threads=3)
+    assert threading.active_count() == threads
+    
+    
+""" Test the convergence diagnostics, and running until enough effective samples are collected """
+def test_run_until():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    numpy.random.seed(0)
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train('exp',20)
+    assert BNMF.monitor.names == ['MSE','U','V','tau'] and BNMF.monitor.iterations == 20
+    assert numpy.array_equal(BNMF.monitor.traces['tau'],BNMF.all_tau)
+    assert numpy.array_equal(BNMF.monitor.traces['MSE'],BNMF.all_performances['MSE'])
+    assert BNMF.monitor.traces['U'][-1] == numpy.linalg.norm(BNMF.U)
+    assert BNMF.convergence['iterations'] == 20 and 0 <= BNMF.convergence['burn_in'] <= 10
+    assert BNMF.convergence['thinning'] >= 1 and sorted(BNMF.convergence['ess'].keys()) == ['MSE','U','V','tau']
+    
+    with pytest.raises(AssertionError) as error:
+        BNMF.run_until(0,100)
+    assert str(error.value) == "Target effective sample size should be positive, not 0."
+    
+    # Stop at the first check where all quantities have enough effective samples, and truncate the traces
+    BNMF.run_until(5.,100,check_every=5)
+    iterations = BNMF.convergence['iterations']
+    assert iterations % 5 == 0 and iterations < 100
+    assert BNMF.monitor.converged(5.) and min(BNMF.convergence['ess'].values()) >= 5.
+    assert BNMF.all_U.shape == (iterations,I,K) and BNMF.all_V.shape == (iterations,J,K)
+    assert len(BNMF.all_tau) == len(BNMF.all_lambdak) == len(BNMF.all_times) == iterations
+    assert numpy.array_equal(BNMF.all_U[-1],BNMF.U)
+    
+    # Otherwise run for the maximum number of iterations
+    BNMF.run_until(1000.,10,check_every=5)
+    assert BNMF.convergence['iterations'] == 10 and BNMF.all_U.shape == (10,I,K)
+    
+    
+""" Test initialising U and V with NNDSVD. """
+def test_initialise_nndsvd():
+    I,J,K = 10,5,2
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,2)),numpy.random.exponential(size=(J,2)).T)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alphatau':3, 'betatau':1, 'lambdaU':1., 'lambdaV':1. }
+    MSEs = {}
+    for init_UV in ['exp','nndsvd','nndsvd-iterative']:
+        BNMF = bnmf_gibbs(R,M,K,False,priors)
+        BNMF.initialise(init_UV)
+        (U, V) = (BNMF.U, BNMF.V)
+        assert U.min() > 0. and V.min() > 0. and BNMF.tau > 0.
+        MSEs[init_UV] = (M * (R - numpy.dot(U,V.T))**2).sum() / M.sum()
+    assert MSEs['nndsvd'] < MSEs['exp'] and MSEs['nndsvd-iterative'] < MSEs['exp']
+    
+    
+""" Test initialising the sampler from the variational posterior of VB. """
+def test_train_hybrid():
+    from BNMTF_ARD.code.models.bnmf_vb import bnmf_vb
+    I,J,K = 10,5,2
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,2)),numpy.random.exponential(size=(J,2)).T)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':3, 'betatau':1, 'alpha0':6, 'beta0':2 }
+    
+    BNMF_VB = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF_VB.train('exp',20)
+    with pytest.raises(AssertionError) as error:
+        bnmf_gibbs(R,M,K+1,True,hyperparams).initialise(from_vb=BNMF_VB)
+    assert str(error.value) == "The variational model should have the same I, J, K, and ARD as the sampler: (10, 5, 2, True) instead of (10, 5, 3, True)."
+    
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.initialise(from_vb=BNMF_VB)
+    assert BNMF.U.shape == (I,K) and BNMF.V.shape == (J,K) and BNMF.lambdak.shape == (K,)
+    assert BNMF.U.min() >= 0. and BNMF.V.min() >= 0. and BNMF.lambdak.min() > 0. and BNMF.tau > 0.
+    # The draws are close to the variational posterior, which fits the data much better than the prior expectations
+    MSE_vb = (M * (R - numpy.dot(BNMF.U,BNMF.V.T))**2).sum() / M.sum()
+    BNMF.initialise('exp')
+    assert MSE_vb < 0.5 * (M * (R - numpy.dot(BNMF.U,BNMF.V.T))**2).sum() / M.sum()
+    
+    numpy.random.seed(0)
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train_hybrid('exp',20,10)
+    assert len(BNMF.vb.all_elbo) == 20 and BNMF.vb.alphatau == 3. and BNMF.all_U.shape == (10,I,K)
+    
+    # The sampler takes the same arguments as in train()
+    BNMF.train_hybrid('exp',20,10,rao_blackwell=True,time_budget=60.)
+    assert BNMF.all_exp_U.shape == (10,I,K) and BNMF.budget['time_budget'] == 60. and not BNMF.budget['exhausted']
+    
+    
+""" Test sharing one read-only dataset between models, with scalar priors broadcast rather than copied. """
+def test_shared_dataset():
+    from BNMTF_ARD.code.models.dataset import Dataset
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M_fold = numpy.ones((I,J))
+    M_fold[0,0], M_fold[2,2], M_fold[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':3, 'betatau':1, 'lambdaU':2., 'lambdaV':3. }
+    
+    data = Dataset(R,M)
+    BNMF1 = bnmf_gibbs(data,None,K,False,hyperparams)
+    BNMF2 = bnmf_gibbs(data,M_fold,K,False,hyperparams)
+    assert BNMF1.R is data.R and BNMF1.M is data.M
+    assert BNMF2.R is data.R and numpy.array_equal(BNMF2.M,M_fold) and BNMF2.size_Omega == I*J-3
+    assert BNMF1.lambdaU.strides == (0,0) and numpy.array_equal(BNMF1.lambdaU,2.*numpy.ones((I,K)))
+    
+    BNMF2.train('exp',5)
+    BNMF2.update_data([(0,0,5.)])
+    assert BNMF2.R[0,0] == 5. and BNMF2.M[0,0] == 1. and BNMF2.size_Omega == I*J-2
+    assert data.R[0,0] == 1. and BNMF1.R[0,0] == 1.
+    
+    
+""" Test storing the conditional expectations of the draws, and averaging those (Rao-Blackwellisation). """
+def test_rao_blackwell():
+    I,J,K = 20,10,3
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,K)),numpy.random.exponential(size=(J,K)).T)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train('random',30)
+    assert not BNMF.rao_blackwell and BNMF.all_exp_U is None
+    with pytest.raises(AssertionError) as error:
+        BNMF.approx_expectation(10,2,rao_blackwell=True)
+    assert str(error.value) == "No conditional expectations stored - please use run(...,rao_blackwell=True)."
+    
+    BNMF.run(30,rao_blackwell=True)
+    assert BNMF.all_exp_U.shape == (30,I,K) and BNMF.all_exp_V.shape == (30,J,K)
+    assert BNMF.all_exp_tau.shape == (30,) and BNMF.all_exp_lambdak.shape == (30,K)
+    
+    # The conditional expectations of tau and lambdak, given the draws of U and V they were computed from
+    residual = (M * (R - numpy.dot(BNMF.all_U[5],BNMF.all_V[5].T))**2).sum()
+    assert abs(BNMF.all_exp_tau[5] - (alphatau + M.sum()/2.) / (betatau + residual/2.)) < 1e-10
+    exp_lambdak = (alpha0 + I + J) / (beta0 + BNMF.all_U[5].sum(axis=0) + BNMF.all_V[5].sum(axis=0))
+    assert numpy.allclose(BNMF.all_exp_lambdak[6],exp_lambdak)
+    
+    # The expectation averages the conditional expectations, or the draws if asked
+    (exp_U,exp_V,exp_tau,exp_lambdak) = BNMF.approx_expectation(10,2)
+    assert numpy.allclose(exp_U,BNMF.all_exp_U[10::2].mean(axis=0)) and numpy.allclose(exp_V,BNMF.all_exp_V[10::2].mean(axis=0))
+    assert abs(exp_tau - BNMF.all_exp_tau[10::2].mean()) < 1e-10 and numpy.allclose(exp_lambdak,BNMF.all_exp_lambdak[10::2].mean(axis=0))
+    (exp_U,exp_V,exp_tau,exp_lambdak) = BNMF.approx_expectation(10,2,rao_blackwell=False)
+    assert numpy.allclose(exp_U,BNMF.all_U[10::2].mean(axis=0)) and abs(exp_tau - BNMF.all_tau[10::2].mean()) < 1e-10
+    assert numpy.allclose(BNMF.predict_rows([0,1],10,2),numpy.dot(BNMF.all_exp_U[10::2].mean(axis=0)[[0,1]],BNMF.all_exp_V[10::2].mean(axis=0).T))
+    
+    # The conditional expectations vary less between iterations than the draws
+    assert BNMF.all_exp_U.var(axis=0).mean() < BNMF.all_U.var(axis=0).mean()
+    
+    # Pruned components are removed from the conditional expectations as well
+    BNMF.train('exp',10,prune={'threshold':numpy.inf,'patience':3},rao_blackwell=True)
+    pruned = [k for (it,k) in BNMF.pruned_components]
+    assert BNMF.exp_U.shape == (I,1) and BNMF.exp_V.shape == (J,1) and BNMF.exp_lambdak.shape == (1,)
+    assert BNMF.all_exp_U.shape == (10,I,K) and (BNMF.all_exp_U[2:,:,pruned] == 0.).all() and (BNMF.all_exp_U[:2,:,pruned] > 0.).all()
+    
+    # Without them, pruning only touches the draws
+    BNMF.train('exp',10,prune={'threshold':numpy.inf,'patience':3},rao_blackwell=False)
+    assert BNMF.component_arrays() == [('U',1),('V',1),('lambdak',0)]
+    assert BNMF.K == 1 and BNMF.U.shape == (I,1) and BNMF.exp_U is None and BNMF.exp_lambdak is None and BNMF.all_exp_U is None
+    assert BNMF.predict(M,2,1)['MSE'] >= 0.
+    
+    
+""" Test stopping at a time budget, with the traces truncated to the completed iterations. """
+def test_time_budget(monkeypatch):
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':3, 'betatau':1, 'alpha0':6, 'beta0':2 }
+    with pytest.raises(AssertionError) as error:
+        bnmf_gibbs(R,M,K,True,hyperparams).train('exp',None)
+    assert str(error.value) == "Please give the number of iterations, a time budget, or both."
+    
+    # Without a number of iterations, the traces are extended until the budget has been used
+    monkeypatch.setattr(budget,'INITIAL_TRACE_LENGTH',2)
+    BNMF = bnmf_gibbs(R,M,K,True,hyperparams)
+    BNMF.train('exp',None,time_budget=0.2,rao_blackwell=True)
+    iterations = BNMF.budget['iterations']
+    assert BNMF.budget['exhausted'] and BNMF.budget['time_budget'] == 0.2 and BNMF.budget['time_used'] < 1.
+    assert iterations == len(BNMF.all_times) and iterations > 2
+    assert BNMF.all_U.shape == (iterations,I,K) and BNMF.all_tau.shape == (iterations,) and BNMF.all_exp_V.shape == (iterations,J,K)
+    assert numpy.array_equal(BNMF.all_U[-1],BNMF.U) and BNMF.all_tau[-1] == BNMF.tau
+    
+    # With a large budget, we run all iterations
+    BNMF.run(10,time_budget=60.)
+    assert BNMF.budget['iterations'] == 10 and not BNMF.budget['exhausted'] and BNMF.all_U.shape == (10,I,K)
@@ -6,7 +6,7 @@ import sys, os
 project_location = os.path.dirname(__file__)+"/../../../"
 sys.path.append(project_location)
 
-import numpy, math, pytest, itertools
+import numpy, math, pytest, itertools, threading
 from BNMTF_ARD.code.models.bnmf_vb import bnmf_vb
 
 
@@ -391,6 +391,10 @@ def test_predict():
     assert performances['MSE'] == MSE
     assert performances['R^2'] == R2
     assert performances['Rp'] == Rp
+    
+    # Extra metrics can be requested as well
+    MAE = (21081. + 21163. + 21158. + 21157.) / 4.
+    assert BNMF.predict(M_test,metrics=['MAE']) == { 'MAE': MAE }
        
         
 """ Test the evaluation measures MSE, R^2, Rp """
@@ -445,4 +449,501 @@ def test_log_likelihood():
     assert MSE == BNMF.quality('MSE')
     with pytest.raises(AssertionError) as error:
         BNMF.quality('FAIL')
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+    
+    
+""" Test folding in new rows and columns, keeping the trained factors fixed. """
+def test_fold_in():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    exp_V = numpy.copy(BNMF.exp_V)
+    
+    R_new, M_new = 2*numpy.ones((3,J)), numpy.ones((3,J))
+    M_new[0,1] = 0
+    U_new = BNMF.fold_in_rows(R_new,M_new,10)
+    assert U_new.shape == (3,K)
+    assert (U_new >= 0.).all()
+    assert numpy.array_equal(BNMF.exp_V,exp_V)
+    
+    V_new = BNMF.fold_in_columns(numpy.ones((I,4)),numpy.ones((I,4)),10)
+    assert V_new.shape == (4,K)
+    assert (V_new >= 0.).all()
+    
+    # New data should match the trained model, with no fully unobserved rows or columns
+    with pytest.raises(AssertionError) as error:
+        BNMF.fold_in_rows(numpy.ones((3,J+1)),numpy.ones((3,J+1)),10)
+    assert str(error.value) == "New matrix R_new has the wrong shape: (3, 6), while the trained model has 5 columns."
+    M_new = numpy.ones((I,2))
+    M_new[:,1] = 0
+    with pytest.raises(AssertionError) as error:
+        BNMF.fold_in_columns(numpy.ones((I,2)),M_new,10)
+    assert str(error.value) == "Fully unobserved column in R_new, column 1."
+
+
+""" Test adding new observations, and refining from the current state. """
+def test_update_data_refine():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    
+    BNMF.update_data([(0,0,2.),(2,2,1.),(0,1,4.)])
+    assert BNMF.M[0,0] == 1. and BNMF.M[2,2] == 1.
+    assert BNMF.R[0,0] == 2. and BNMF.R[0,1] == 4.
+    assert BNMF.size_Omega == I*J-1
+    assert BNMF.alpha_s == alphatau + (I*J-1)/2.
+    assert BNMF.touched_rows == [0,2] and BNMF.touched_columns == [0,1,2]
+    
+    BNMF.refine(5,local_sweeps=2)
+    assert BNMF.touched_rows == [] and BNMF.touched_columns == []
+    assert (BNMF.exp_U >= 0.).all() and (BNMF.exp_V >= 0.).all()
+    assert len(BNMF.all_performances['MSE']) == 5
+    
+    with pytest.raises(AssertionError) as error:
+        BNMF.update_data([(I,0,1.)])
+    assert str(error.value) == "New entry (10,0) lies outside of R, which has shape (10, 5)."
+
+
+""" Test saving and loading the model, and continuing from the loaded state. """
+def test_save_load(tmpdir):
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    path = str(tmpdir.join('model'))
+    BNMF.save(path)
+    
+    loaded = bnmf_vb.load(path)
+    assert numpy.array_equal(loaded.exp_U,BNMF.exp_U)
+    assert numpy.array_equal(loaded.var_U,BNMF.var_U)
+    assert numpy.array_equal(loaded.exp_V,BNMF.exp_V)
+    assert numpy.array_equal(loaded.var_V,BNMF.var_V)
+    assert loaded.exp_tau == BNMF.exp_tau and loaded.alpha_s == BNMF.alpha_s
+    assert loaded.all_performances['MSE'] == BNMF.all_performances['MSE']
+    assert loaded.predict(M)['MSE'] == BNMF.predict(M)['MSE']
+    
+    # We can continue running the loaded model
+    loaded.run(2)
+    
+    # The mask should match its fingerprint
+    numpy.save(path+'/M.npy',numpy.ones((I,J)))
+    with pytest.raises(AssertionError) as error:
+        bnmf_vb.load(path)
+    assert str(error.value) == "Mask M in %s does not match the fingerprint in its metadata." % path
+
+
+""" Test predicting individual entries and rows. """
+def test_predict_entries_rows():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    
+    rows, cols = [0,3,9], [1,4,0]
+    R_pred = numpy.dot(BNMF.exp_U,BNMF.exp_V.T)
+    assert numpy.allclose(BNMF.predict_entries(rows,cols),R_pred[rows,cols])
+    assert numpy.allclose(BNMF.predict_rows([2,5]),R_pred[[2,5]])
+    
+    # The variances should add up to the expected squared error, minus the squared error of the expectation
+    (exp_R,var_R) = BNMF.predict_rows(range(I),variance=True)
+    assert numpy.allclose(exp_R,R_pred)
+    assert abs((M*var_R).sum() - (BNMF.exp_square_diff() - (M*(R-R_pred)**2).sum())) < 1e-10
+    (exp_R_entries,var_R_entries) = BNMF.predict_entries(rows,cols,variance=True)
+    assert numpy.allclose(exp_R_entries,exp_R[rows,cols]) and numpy.allclose(var_R_entries,var_R[rows,cols])
+
+
+""" Test the posterior predictive mean, variance, and credible intervals. """
+def test_predictive():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    
+    rows, cols = numpy.nonzero(M)
+    predictive = BNMF.predictive(rows,cols)
+    (exp_R,var_R) = BNMF.predict_entries(rows,cols,variance=True)
+    assert numpy.array_equal(predictive['mean'],exp_R)
+    assert numpy.allclose(predictive['variance'],var_R + BNMF.beta_s / (BNMF.alpha_s - 1.))
+    assert 'lower' not in predictive
+    
+    predictive = BNMF.predictive(rows,cols,credible=0.9)
+    assert (predictive['lower'] < predictive['mean']).all() and (predictive['mean'] < predictive['upper']).all()
+    assert numpy.allclose(predictive['upper'] - predictive['mean'],1.644854*numpy.sqrt(predictive['variance']))
+
+
+""" Test that the cached ELBO terms give the same ELBO, and are refreshed when q changes. """
+def test_elbo_cache():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('exp',4,elbo_every=3)
+    
+    # After running, the expected square error from updating tau is reused
+    assert BNMF.square_diff == BNMF.exp_square_diff()
+    elbo = BNMF.elbo()
+    assert BNMF.stale_U == set() and BNMF.stale_V == set()
+    BNMF.reset_elbo_cache()
+    assert abs(BNMF.elbo() - elbo) < 1e-10
+    
+    # Only the updated columns are recomputed
+    BNMF.update_U(1)
+    BNMF.update_exp_U(1)
+    assert BNMF.stale_U == set([1]) and BNMF.stale_V == set() and BNMF.square_diff is None
+    entropy_U0 = BNMF.entropy_U[0]
+    elbo = BNMF.elbo()
+    assert BNMF.entropy_U[0] == entropy_U0
+    BNMF.reset_elbo_cache()
+    assert abs(BNMF.elbo() - elbo) < 1e-10
+
+""" Test the timings and counts of the phases in the run loop. """
+def test_profile():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    
+    # Each phase is timed once per iteration, and the updates and their moments once per column
+    assert BNMF.profile_phases == ['lambda', 'U', 'TN moments', 'V', 'tau', 'traces', 'performance', 'ELBO', 'output']
+    assert all([BNMF.profile[phase]['calls'] == 10 for phase in ['lambda', 'tau', 'traces', 'performance', 'ELBO', 'output']])
+    assert BNMF.profile['TN moments']['calls'] == 40
+    assert BNMF.profile['U']['calls'] == 20
+    assert BNMF.profile['V']['calls'] == 20
+    assert all([BNMF.profile[phase]['time'] >= 0. and BNMF.profile[phase]['memory'] >= 0 for phase in BNMF.profile_phases])
+    
+    # Profiling can be switched off
+    BNMF.run(2,profile=False)
+    assert BNMF.profile is None and BNMF.profile_phases == []
+
+
+""" Test pruning the components that ARD has switched off. """
+def test_prune():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    with pytest.raises(AssertionError) as error:
+        BNMF = bnmf_vb(R,M,K,False,dict(hyperparams,lambdaU=1.,lambdaV=1.))
+        BNMF.train('exp',2,prune=True)
+    assert str(error.value) == "Pruning components is only possible when using ARD."
+    
+    # With an infinite threshold, all but the largest component are removed after patience iterations
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('exp',10,prune={'threshold':numpy.inf,'patience':3})
+    assert 'pruning' in BNMF.profile_phases
+    pruned = [k for (it,k) in BNMF.pruned_components]
+    assert BNMF.K == 1 and len(pruned) == K-1 and all([it == 2 for (it,_) in BNMF.pruned_components])
+    assert BNMF.exp_U.shape == (I,1) and BNMF.mu_V.shape == (J,1) and BNMF.var_U.shape == (I,1)
+    assert BNMF.exp_lambdak.shape == (1,) and BNMF.alphak_s.shape == (1,)
+    
+    # We can still compute the ELBO and predict
+    assert not numpy.isnan(BNMF.elbo())
+    assert BNMF.predict(M)['MSE'] == BNMF.all_performances['MSE'][-1]
+
+
+""" Test that with the default settings, pruning removes components ARD switched off on rank-3 data, and nothing else. """
+def test_prune_defaults():
+    numpy.random.seed(1)
+    I,J,K,true_K = 60,40,10,3
+    U, V = numpy.random.exponential(size=(I,true_K)), numpy.random.exponential(size=(J,true_K))
+    R = numpy.dot(U,V.T) + numpy.random.normal(0,0.1,size=(I,J))
+    M = numpy.ones((I,J))
+    hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1. }
+
+    numpy.random.seed(0)
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('random',150)
+    numpy.random.seed(0)
+    BNMF_pruned = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF_pruned.train('random',150,prune=True)
+    assert true_K <= BNMF_pruned.K < K
+    assert BNMF_pruned.all_performances['MSE'][-1] < 1.01 * BNMF.all_performances['MSE'][-1]
+
+
+""" Test growing the number of components while running """
+def test_grow():
+    I,J,K = 10,5,1
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    with pytest.raises(AssertionError) as error:
+        BNMF = bnmf_vb(R,M,K,False,dict(hyperparams,lambdaU=1.,lambdaV=1.))
+        BNMF.train('exp',2,grow=True)
+    assert str(error.value) == "Growing components is only possible when using ARD."
+    with pytest.raises(AssertionError) as error:
+        BNMF = bnmf_vb(R,M,K,True,hyperparams)
+        BNMF.train('exp',2,prune=True,grow=True)
+    assert str(error.value) == "Components can either be pruned or grown, not both."
+    
+    # Without a threshold, and accepting any change in the fit, a component is added every four iterations
+    # (the new one is followed for two checks), until we reach the maximum
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('exp',8,grow={'threshold':0.,'every':2,'max_components':3,'improvement':-numpy.inf})
+    assert 'growth' in BNMF.profile_phases
+    assert BNMF.K == 3 and BNMF.grown_components == [(1,1),(5,2)] and BNMF.pruned_components == []
+    assert BNMF.all_K == [1,2,2,2,2,3,3,3]
+    assert BNMF.exp_U.shape == (I,3) and BNMF.mu_V.shape == (J,3) and BNMF.var_U.shape == (I,3)
+    assert BNMF.exp_lambdak.shape == (3,) and BNMF.alphak_s.shape == (3,)
+    
+    # We can still compute the ELBO and predict
+    assert not numpy.isnan(BNMF.elbo())
+    assert BNMF.predict(M)['MSE'] == BNMF.all_performances['MSE'][-1]
+
+
+""" Test that with the default settings, growth on rank-3 data stops close to the true rank. """
+def test_grow_defaults():
+    numpy.random.seed(0)
+    I,J,K,true_K = 60,40,1,3
+    U, V = numpy.random.exponential(size=(I,true_K)), numpy.random.exponential(size=(J,true_K))
+    R = numpy.dot(U,V.T) + numpy.random.normal(0,0.1,size=(I,J))
+    M = numpy.ones((I,J))
+    hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1. }
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('random',60,grow=True)
+    assert BNMF.K == true_K and len(BNMF.pruned_components) == 1
+
+
+""" Test splitting the updates of the rows and columns over threads """
+def test_threads():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    with pytest.raises(AssertionError) as error:
+        bnmf_vb(R,M,K,True,hyperparams).train('exp',2,threads=0)
+    assert str(error.value) == "Number of threads should be at least 1, not 0."
+    
+    # The updates are the same as without threads
+    models = []
+    for threads in [1,3]:
+        BNMF = bnmf_vb(R,M,K,True,hyperparams)
+        BNMF.train('exp',5,threads=threads)
+        models.append(BNMF)
+    assert numpy.abs(models[0].exp_U - models[1].exp_U).max() < 1e-10 and numpy.abs(models[0].var_V - models[1].var_V).max() < 1e-10
+    assert abs(models[0].elbo() - models[1].elbo()) < 1e-8
+    
+    # The threads are stopped when run() raises an error
+    def fail(*args):
+        raise ValueError("Failed.")
+    threads = threading.active_count()
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.predict = fail
+    with pytest.raises(ValueError):
+        BNMF.train('exp',5,threads=3)
+    assert threading.active_count() == threads
+
+    
+    
+""" Test accelerating the coordinate ascent with SQUAREM and Anderson acceleration """
+def test_accelerate():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    with pytest.raises(AssertionError) as error:
+        bnmf_vb(R,M,K,True,hyperparams).train('exp',5,grow=True,accelerate='anderson')
+    assert str(error.value) == "Components can not be pruned or grown when accelerating the iterations."
+    
+    numpy.random.seed(0)
+    plain = bnmf_vb(R,M,K,True,hyperparams)
+    plain.train('exp',60,elbo_every=2)
+    assert plain.all_sweeps == range(1,61) and plain.all_elbo[0] is None and plain.all_elbo[-1] == plain.elbo()
+    for accelerate in ['squarem','anderson']:
+        numpy.random.seed(0)
+        BNMF = bnmf_vb(R,M,K,True,hyperparams)
+        BNMF.train('exp',10,accelerate=accelerate)
+        assert all([BNMF.all_elbo[it+1] >= BNMF.all_elbo[it] - 1e-8 for it in range(9)])
+        assert len(BNMF.all_sweeps) == 10 and BNMF.all_sweeps[-1] == BNMF.accelerator.sweeps >= 10
+        # The expectations match the extrapolated parameters of q
+        assert numpy.allclose(BNMF.exp_tau,BNMF.alpha_s / BNMF.beta_s) and numpy.allclose(BNMF.exp_lambdak,BNMF.alphak_s / BNMF.betak_s)
+    
+    
+""" Test learning the hyperparameters with empirical Bayes. """
+def test_empirical_bayes():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    lambdaU, lambdaV = 2., 3.
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaU':lambdaU, 'lambdaV':lambdaV }
+    with pytest.raises(AssertionError) as error:
+        bnmf_vb(R,M,K,True,hyperparams).train('exp',5,empirical_bayes=True)
+    assert str(error.value) == "With ARD, the prior rates of U and V are learned by ARD, not by empirical Bayes."
+    with pytest.raises(AssertionError) as error:
+        bnmf_vb(R,M,K,False,hyperparams).train('exp',5,empirical_bayes=['lambdaU'])
+    assert str(error.value) == "Unrecognised empirical Bayes hyperparameter: lambdaU. Should be one in ['lambda', 'tau']."
+    
+    numpy.random.seed(0)
+    BNMF = bnmf_vb(R,M,K,False,hyperparams)
+    BNMF.train('exp',10)
+    assert BNMF.all_hyperparameters == {} and numpy.all(BNMF.lambdaU == lambdaU)
+    
+    numpy.random.seed(0)
+    BNMF = bnmf_vb(R,M,K,False,hyperparams)
+    BNMF.train('exp',10,empirical_bayes=['lambda','tau'])
+    assert sorted(BNMF.all_hyperparameters.keys()) == ['betatau','lambdaU','lambdaV']
+    assert all([len(values) == 10 for values in BNMF.all_hyperparameters.values()])
+    # Coordinate ascent on the ELBO, and the rates maximise the expected log priors
+    assert all([BNMF.all_elbo[it+1] >= BNMF.all_elbo[it] - 1e-8 for it in range(9)])
+    assert numpy.allclose(BNMF.lambdaU, I*K / BNMF.exp_U.sum()) and numpy.allclose(BNMF.lambdaV, J*K / BNMF.exp_V.sum())
+    assert BNMF.all_hyperparameters['lambdaU'][-1] == BNMF.lambdaU[0,0]
+    assert BNMF.alphatau == alphatau and abs(BNMF.alphatau / BNMF.betatau - BNMF.exp_tau) < 1e-8
+
+
+""" Test that learning the hyperparameters with empirical Bayes does not worsen the ELBO or the training MSE on low-rank data. """
+def test_empirical_bayes_fit():
+    numpy.random.seed(0)
+    I,J,K = 40,30,3
+    U, V = numpy.random.exponential(size=(I,K)), numpy.random.exponential(size=(J,K))
+    R = numpy.dot(U,V.T) + numpy.random.normal(0,0.1,size=(I,J))
+    M = numpy.ones((I,J))
+    hyperparams = { 'alphatau':1., 'betatau':1., 'lambdaU':0.1, 'lambdaV':0.1 }
+    models = []
+    for empirical_bayes in [False,['lambda','tau']]:
+        numpy.random.seed(0)
+        BNMF = bnmf_vb(R,M,K,False,hyperparams)
+        BNMF.train('random',100,empirical_bayes=empirical_bayes)
+        models.append(BNMF)
+    assert models[1].alphatau == 1. and models[1].betatau < 1.
+    assert models[1].all_elbo[-1] > models[0].all_elbo[-1]
+    assert models[1].all_performances['MSE'][-1] < 1.05 * models[0].all_performances['MSE'][-1]
+    
+    
+""" Test initialising U and V with NNDSVD. """
+def test_initialise_nndsvd():
+    I,J,K = 10,5,2
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,2)),numpy.random.exponential(size=(J,2)).T)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alphatau':3, 'betatau':1, 'lambdaU':1., 'lambdaV':1. }
+    MSEs = {}
+    for init_UV in ['exp','nndsvd','nndsvd-iterative']:
+        BNMF = bnmf_vb(R,M,K,False,priors)
+        BNMF.initialise(init_UV)
+        (U, V) = (BNMF.exp_U, BNMF.exp_V)
+        assert U.min() > 0. and V.min() > 0. and (init_UV == 'exp' or numpy.isclose(BNMF.tau_U[0,0],100. / BNMF.mu_U.mean()**2))
+        MSEs[init_UV] = (M * (R - numpy.dot(U,V.T))**2).sum() / M.sum()
+    assert MSEs['nndsvd'] < MSEs['exp'] and MSEs['nndsvd-iterative'] < MSEs['exp']
+    
+    
+""" Test stopping at a time budget, with the ELBO of the last full sweep. """
+def test_time_budget():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':3, 'betatau':1, 'alpha0':6, 'beta0':2 }
+    BNMF = bnmf_vb(R,M,K,True,hyperparams)
+    BNMF.train('exp',None,elbo_every=1000,time_budget=0.2)
+    iterations = BNMF.budget['iterations']
+    assert BNMF.budget['exhausted'] and BNMF.budget['time_used'] < 1. and iterations == len(BNMF.all_elbo) == len(BNMF.all_times)
+    assert BNMF.all_elbo[-1] == BNMF.elbo()
+    
+    BNMF.run(10,time_budget=60.)
+    assert BNMF.budget['iterations'] == 10 and not BNMF.budget['exhausted'] and len(BNMF.all_elbo) == 10
+
+    
+""" Test skipping the columns of U and V that have converged, with active-set scheduling. """
+def test_active_set():
+    I,J,K = 10,5,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaU':1., 'lambdaV':1. }
+    BNMF = bnmf_vb(R,M,K,False,hyperparams)
+    BNMF.train('exp',100,active_set={'tolerance':1e-2,'wake':0.1})
+    updated, skipped = BNMF.active_updates['updated'], BNMF.active_updates['skipped']
+    assert skipped['U'] > 0 and skipped['V'] > 0
+    assert updated['U'] + skipped['U'] == 100*K and updated['V'] + skipped['V'] == 100*K
+    
+    plain = bnmf_vb(R,M,K,False,hyperparams)
+    plain.train('exp',100)
+    assert plain.active_updates is None
+    assert abs(BNMF.all_performances['MSE'][-1] - plain.all_performances['MSE'][-1]) < 0.1 * plain.all_performances['MSE'][-1]
+    
+    with pytest.raises(AssertionError) as error:
+        BNMF.run(10,accelerate='squarem',active_set=True)
+    assert str(error.value) == "Active-set scheduling can not be combined with pruning, growing, or acceleration."
+
+
+""" Test that with the default settings, updates are skipped on rank-3 data, and the ELBO stays within 1% of full sweeps. """
+def test_active_set_defaults():
+    numpy.random.seed(0)
+    I,J,K,true_K = 60,40,4,3
+    U, V = numpy.random.exponential(size=(I,true_K)), numpy.random.exponential(size=(J,true_K))
+    R = numpy.maximum(numpy.dot(U,V.T) + numpy.random.normal(0,0.1,size=(I,J)), 0.01)
+    M = numpy.ones((I,J))
+    hyperparams = { 'alphatau':1., 'betatau':1., 'lambdaU':0.1, 'lambdaV':0.1 }
+    models = []
+    for active_set in [False,True]:
+        numpy.random.seed(1)
+        BNMF = bnmf_vb(R,M,K,False,hyperparams)
+        BNMF.train('random',300,active_set=active_set)
+        models.append(BNMF)
+    skipped = sum(models[1].active_updates['skipped'].values())
+    assert skipped > 0.05 * (2*K*300)
+    assert abs(models[1].all_elbo[-1] - models[0].all_elbo[-1]) < 0.01 * abs(models[0].all_elbo[-1])
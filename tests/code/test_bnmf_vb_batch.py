@@ -0,0 +1,89 @@
+"""
+Tests for fitting a batch of BNMF Variational Bayes models together.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+import numpy, pytest
+from BNMTF_ARD.code.models.bnmf_vb import bnmf_vb
+from BNMTF_ARD.code.models.bnmf_vb_batch import bnmf_vb_batch
+
+
+def generate_data(I,J,K):
+    ''' Return a noisy product of exponential factors, with about 20% missing entries. '''
+    numpy.random.seed(1)
+    R = numpy.dot(numpy.random.exponential(size=(I,K)),numpy.random.exponential(size=(J,K)).T) + numpy.random.normal(0,0.1,(I,J))
+    M = (numpy.random.rand(I,J) > 0.2) * 1.
+    return R, M
+
+
+""" Test constructor """
+def test_init():
+    I,J,K = 12,8,3
+    R, M = generate_data(I,J,K)
+    all_hyperparameters = [{ 'alphatau':1., 'betatau':1., 'lambdaU':lamb, 'lambdaV':lamb } for lamb in [0.1,1.]]
+    
+    with pytest.raises(AssertionError) as error:
+        bnmf_vb_batch(R,M,K,False,[])
+    assert str(error.value) == "The batch should contain at least one configuration."
+    with pytest.raises(AssertionError) as error:
+        bnmf_vb_batch(R,M,K,False,all_hyperparameters,seeds=[1,2,3])
+    assert str(error.value) == "Got 3 seeds for 2 configurations."
+    
+    BATCH = bnmf_vb_batch(R,M,K,False,all_hyperparameters)
+    assert BATCH.B == 2 and len(BATCH.models) == 2
+    assert all([model.R is BATCH.R for model in BATCH.models])
+    assert BATCH.models[1].lambdaU[0,0] == 1.
+    
+    
+""" Test that the batch gives the same q and ELBO as fitting the models one by one. """
+def test_run():
+    I,J,K = 12,8,3
+    R, M = generate_data(I,J,K)
+    for ARD in [False,True]:
+        all_hyperparameters = [{ 'alphatau':1., 'betatau':1., 'alpha0':alpha0, 'beta0':1., 'lambdaU':lamb, 'lambdaV':lamb } 
+                               for (alpha0,lamb) in [(1.,0.1),(2.,1.)]]
+        seeds = [3,4]
+        BATCH = bnmf_vb_batch(R,M,K,ARD,all_hyperparameters,seeds)
+        BATCH.train('random',10,tolerance=None)
+        assert list(BATCH.iterations) == [10,10] and len(BATCH.active) == 0
+        
+        for hyperparameters,seed,model in zip(all_hyperparameters,seeds,BATCH.models):
+            numpy.random.seed(seed)
+            BNMF = bnmf_vb(R,M,K,ARD,hyperparameters)
+            BNMF.train('random',10)
+            assert numpy.allclose(model.exp_U,BNMF.exp_U) and numpy.allclose(model.var_V,BNMF.var_V)
+            assert numpy.isclose(model.exp_tau,BNMF.exp_tau)
+            assert numpy.allclose(model.all_elbo,BNMF.all_elbo)
+            assert numpy.allclose(model.all_performances['MSE'],BNMF.all_performances['MSE'])
+            assert numpy.isclose(model.elbo(),model.all_elbo[-1])
+            assert numpy.isclose(model.predict(M)['MSE'],model.all_performances['MSE'][-1])
+            if ARD:
+                assert numpy.allclose(model.exp_lambdak,BNMF.exp_lambdak)
+                
+                
+""" Test that converged configurations drop out of the batch. """
+def test_convergence():
+    I,J,K = 12,8,3
+    R, M = generate_data(I,J,K)
+    all_hyperparameters = [{ 'alphatau':1., 'betatau':1., 'alpha0':alpha0, 'beta0':1. } for alpha0 in [1.,2.,0.5]]
+    BATCH = bnmf_vb_batch(R,M,K,True,all_hyperparameters,seeds=[3,4,5])
+    BATCH.train('random',500,tolerance=1e-6)
+    assert len(BATCH.active) == 0 and BATCH.iterations.max() < 500 and len(set(BATCH.iterations)) > 1
+    for b,model in enumerate(BATCH.models):
+        assert len(model.all_elbo) == BATCH.iterations[b]
+        assert abs(model.all_elbo[-1] - model.all_elbo[-2]) <= 1e-6 * abs(model.all_elbo[-1])
+        assert abs(model.all_elbo[-2] - model.all_elbo[-3]) > 1e-6 * abs(model.all_elbo[-2])
+    
+    
+""" Test stopping at a time budget, finishing all configurations that are still running. """
+def test_time_budget():
+    I,J,K = 12,8,3
+    R, M = generate_data(I,J,K)
+    all_hyperparameters = [{ 'alphatau':1., 'betatau':1., 'lambdaU':lamb, 'lambdaV':lamb } for lamb in [0.1,1.]]
+    BATCH = bnmf_vb_batch(R,M,K,False,all_hyperparameters)
+    BATCH.train('random',None,tolerance=None,time_budget=0.2)
+    assert BATCH.budget['exhausted'] and BATCH.budget['time_used'] < 1. and len(BATCH.active) == 0
+    assert all([len(model.all_elbo) == BATCH.budget['iterations'] for model in BATCH.models])
@@ -6,8 +6,9 @@ import sys, os
 project_location = os.path.dirname(__file__)+"/../../../"
 sys.path.append(project_location)
 
-import numpy, math, pytest, itertools
+import numpy, math, pytest, itertools, threading
 from BNMTF_ARD.code.models.bnmtf_gibbs import bnmtf_gibbs
+from BNMTF_ARD.code.models.diagnostics import chain_diagnostics
 
 
 """ Test constructor """
@@ -468,4 +469,482 @@ def test_log_likelihood():
     assert MSE == BNMTF.quality('MSE',burnin,thinning)
     with pytest.raises(AssertionError) as error:
         BNMTF.quality('FAIL',burnin,thinning)
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+    
+    
+""" Test folding in new rows and columns, keeping the trained factors fixed. """
+def test_fold_in():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    G = numpy.copy(BNMTF.G)
+    
+    R_new, M_new = 2*numpy.ones((3,J)), numpy.ones((3,J))
+    M_new[0,1] = 0
+    F_new = BNMTF.fold_in_rows(R_new,M_new,10)
+    assert F_new.shape == (3,K)
+    assert (F_new >= 0.).all()
+    assert numpy.array_equal(BNMTF.G,G)
+    
+    G_new = BNMTF.fold_in_columns(numpy.ones((I,4)),numpy.ones((I,4)),10)
+    assert G_new.shape == (4,L)
+    assert (G_new >= 0.).all()
+    
+    # New data should match the trained model, with no fully unobserved rows or columns
+    with pytest.raises(AssertionError) as error:
+        BNMTF.fold_in_rows(numpy.ones((3,J+1)),numpy.ones((3,J+1)),10)
+    assert str(error.value) == "New matrix R_new has the wrong shape: (3, 6), while the trained model has 5 columns."
+    M_new = numpy.ones((I,2))
+    M_new[:,1] = 0
+    with pytest.raises(AssertionError) as error:
+        BNMTF.fold_in_columns(numpy.ones((I,2)),M_new,10)
+    assert str(error.value) == "Fully unobserved column in R_new, column 1."
+    with pytest.raises(AssertionError) as error:
+        BNMTF.fold_in_rows(R_new,numpy.ones((3,J)),10,burn_in=10)
+    assert str(error.value) == "Number of iterations should be greater than the burn-in, not 10 <= 10."
+
+
+""" Test adding new observations, and refining from the current state. """
+def test_update_data_refine():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    
+    BNMTF.update_data([(0,0,2.),(2,2,1.),(0,1,4.)])
+    assert BNMTF.M[0,0] == 1. and BNMTF.M[2,2] == 1.
+    assert BNMTF.R[0,0] == 2. and BNMTF.R[0,1] == 4.
+    assert BNMTF.size_Omega == I*J-1
+    assert BNMTF.touched_rows == [0,2] and BNMTF.touched_columns == [0,1,2]
+    
+    BNMTF.refine(5,local_sweeps=2)
+    assert BNMTF.touched_rows == [] and BNMTF.touched_columns == []
+    assert (BNMTF.F >= 0.).all() and (BNMTF.G >= 0.).all()
+    assert len(BNMTF.all_performances['MSE']) == 5
+    
+    with pytest.raises(AssertionError) as error:
+        BNMTF.update_data([(I,0,1.)])
+    assert str(error.value) == "New entry (10,0) lies outside of R, which has shape (10, 5)."
+
+
+""" Test saving and loading the model, and continuing from the loaded state. """
+def test_save_load(tmpdir):
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    path = str(tmpdir.join('model'))
+    BNMTF.save(path,burn_in=5,thinning=2)
+    
+    loaded = bnmtf_gibbs.load(path)
+    assert numpy.array_equal(loaded.F,BNMTF.F)
+    assert numpy.array_equal(loaded.S,BNMTF.S)
+    assert numpy.array_equal(loaded.G,BNMTF.G)
+    assert loaded.tau == BNMTF.tau
+    assert isinstance(loaded.all_F,numpy.memmap) and numpy.array_equal(loaded.all_F,BNMTF.all_F)
+    assert numpy.array_equal(loaded.summaries['exp_F'],BNMTF.approx_expectation(5,2)[0])
+    assert loaded.all_performances['MSE'] == BNMTF.all_performances['MSE']
+    assert loaded.predict(M,5,2)['MSE'] == BNMTF.predict(M,5,2)['MSE']
+    
+    # We can continue running the loaded model
+    loaded.run(2)
+    
+    # The mask should match its fingerprint
+    numpy.save(path+'/M.npy',numpy.ones((I,J)))
+    with pytest.raises(AssertionError) as error:
+        bnmtf_gibbs.load(path)
+    assert str(error.value) == "Mask M in %s does not match the fingerprint in its metadata." % path
+
+
+""" Test predicting individual entries and rows. """
+def test_predict_entries_rows():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    
+    rows, cols = [0,3,9], [1,4,0]
+    (exp_F,exp_S,exp_G,_,_,_) = BNMTF.approx_expectation(5,2)
+    R_pred = numpy.dot(exp_F,numpy.dot(exp_S,exp_G.T))
+    assert numpy.allclose(BNMTF.predict_entries(rows,cols,5,2),R_pred[rows,cols])
+    assert numpy.allclose(BNMTF.predict_rows([2,5],5,2),R_pred[[2,5]])
+    
+    # The variance is that of the predictions of the individual draws
+    all_R = numpy.array([numpy.dot(BNMTF.all_F[it],numpy.dot(BNMTF.all_S[it],BNMTF.all_G[it].T)) for it in range(5,10,2)])
+    (_,var_R) = BNMTF.predict_entries(rows,cols,5,2,variance=True)
+    assert numpy.allclose(var_R,all_R.var(axis=0)[rows,cols])
+    (_,var_R) = BNMTF.predict_rows([2,5],5,2,variance=True)
+    assert numpy.allclose(var_R,all_R.var(axis=0)[[2,5]])
+    
+    # The cached expectations are cleared when we run the model again
+    assert (5,2) in BNMTF.prediction_cache
+    BNMTF.run(10)
+    assert BNMTF.prediction_cache == {}
+
+
+""" Test the posterior predictive mean, variance, and credible intervals. """
+def test_predictive():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    
+    rows, cols = numpy.nonzero(M)
+    BNMTF.initialise('exp','exp')
+    with pytest.raises(AssertionError) as error:
+        BNMTF.predictive()
+    assert str(error.value) == "No draws for the tracked entries - please call track_predictive() before run()."
+    
+    BNMTF.track_predictive(rows,cols,burn_in=4,thinning=2)
+    BNMTF.run(10)
+    all_R = numpy.array([(BNMTF.all_F[it][rows] * numpy.dot(BNMTF.all_G[it][cols],BNMTF.all_S[it].T)).sum(axis=1) for it in range(4,10,2)])
+    predictive = BNMTF.predictive(credible=0.9)
+    assert BNMTF.predictive_moments.n == 3
+    assert numpy.allclose(predictive['mean'],all_R.mean(axis=0))
+    assert numpy.allclose(predictive['variance'],all_R.var(axis=0) + (1. / BNMTF.all_tau[4:10:2]).mean())
+    assert numpy.allclose(predictive['upper'] - predictive['mean'],1.644854*numpy.sqrt(predictive['variance']))
+    
+    # The moments are reset when we run the sampler again
+    BNMTF.run(3)
+    assert BNMTF.predictive_moments.n == 0
+
+""" Test the timings and counts of the phases in the run loop. """
+def test_profile():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    
+    # Each phase is timed once per iteration
+    assert BNMTF.profile_phases == ['lambda', 'F', 'S', 'G', 'tau', 'traces', 'predictive', 'performance', 'output']
+    assert all([BNMTF.profile[phase]['calls'] == 10 for phase in ['lambda', 'F', 'S', 'G', 'tau', 'traces', 'predictive', 'performance', 'output']])
+    assert all([BNMTF.profile[phase]['time'] >= 0. and BNMTF.profile[phase]['memory'] >= 0 for phase in BNMTF.profile_phases])
+    
+    # Profiling can be switched off
+    BNMTF.run(2,profile=False)
+    assert BNMTF.profile is None and BNMTF.profile_phases == []
+
+
+""" Test pruning the components that ARD has switched off. """
+def test_prune():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    with pytest.raises(AssertionError) as error:
+        BNMTF = bnmtf_gibbs(R,M,K,L,False,dict(hyperparams,lambdaF=1.,lambdaG=1.))
+        BNMTF.train('exp','exp',2,prune=True)
+    assert str(error.value) == "Pruning components is only possible when using ARD."
+    
+    # With an infinite threshold, all but the largest component are removed after patience iterations
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10,prune={'threshold':numpy.inf,'patience':3})
+    assert 'pruning' in BNMTF.profile_phases
+    pruned_F = [k for (it,k) in BNMTF.pruned_components['F']]
+    pruned_G = [l for (it,l) in BNMTF.pruned_components['G']]
+    assert BNMTF.K == 1 and BNMTF.L == 1 and len(pruned_F) == K-1 and len(pruned_G) == L-1
+    assert all([it == 2 for (it,_) in BNMTF.pruned_components['F'] + BNMTF.pruned_components['G']])
+    assert BNMTF.F.shape == (I,1) and BNMTF.S.shape == (1,1) and BNMTF.G.shape == (J,1)
+    assert BNMTF.lambdaFk.shape == (1,) and BNMTF.lambdaGl.shape == (1,) and BNMTF.lambdaS.shape == (1,1)
+    
+    # The traces keep all components, with zeros for the pruned ones from then on
+    assert BNMTF.all_F.shape == (10,I,K) and BNMTF.all_S.shape == (10,K,L) and BNMTF.all_G.shape == (10,J,L)
+    assert (BNMTF.all_F[2:,:,pruned_F] == 0.).all() and (BNMTF.all_F[:2,:,pruned_F] > 0.).all()
+    assert (BNMTF.all_G[2:,:,pruned_G] == 0.).all() and (BNMTF.all_lambdaGl[2:,pruned_G] == 0.).all()
+    assert (BNMTF.all_S[2:,pruned_F,:] == 0.).all() and (BNMTF.all_S[2:,:,pruned_G] == 0.).all()
+    
+    # So we can still predict using the traces
+    assert BNMTF.predict(M,2,1)['MSE'] >= 0.
+
+
+""" Test growing the number of components while running """
+def test_grow():
+    I,J,K,L = 10,5,1,1
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    with pytest.raises(AssertionError) as error:
+        BNMTF = bnmtf_gibbs(R,M,K,L,False,dict(hyperparams,lambdaF=1.,lambdaG=1.))
+        BNMTF.train('exp','exp',2,grow=True)
+    assert str(error.value) == "Growing components is only possible when using ARD."
+    with pytest.raises(AssertionError) as error:
+        BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+        BNMTF.train('exp','exp',2,prune=True,grow=True)
+    assert str(error.value) == "Components can either be pruned or grown, not both."
+    
+    # Without a threshold, and accepting any change in the fit, a component is added to F and G every four iterations
+    # (the new one is followed for two checks), until we reach the maximum
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',8,grow={'threshold':0.,'every':2,'max_components':3,'improvement':-numpy.inf})
+    assert 'growth' in BNMTF.profile_phases
+    assert BNMTF.K == 3 and BNMTF.L == 3 and BNMTF.grown_components == { 'F':[(1,1),(5,2)], 'G':[(1,1),(5,2)] }
+    assert BNMTF.all_K == [1,2,2,2,2,3,3,3] and BNMTF.all_L == BNMTF.all_K
+    assert BNMTF.lambdaS.shape == (3,3) and (BNMTF.lambdaS == 1.).all()
+    assert BNMTF.F.shape == (I,3) and BNMTF.S.shape == (3,3) and BNMTF.G.shape == (J,3)
+    
+    # The traces are sized for the maximum number of components, with zeros before they were added
+    assert BNMTF.all_F.shape == (8,I,3) and BNMTF.all_S.shape == (8,3,3) and BNMTF.all_lambdaGl.shape == (8,3)
+    assert (BNMTF.all_F[:1,:,1:] == 0.).all() and (BNMTF.all_S[:5,2,:] == 0.).all() and (BNMTF.all_G[6:,:,2] > 0.).all()
+    assert BNMTF.predict(M,2,1)['MSE'] >= 0.
+
+
+""" Test that growth stops near the rank of low-rank data """
+def test_grow_rank():
+    I,J,true_K = 30,20,3
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,true_K)),numpy.random.exponential(size=(J,true_K)).T) + numpy.random.normal(0,0.1,size=(I,J))
+    M = numpy.ones((I,J))
+    hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaS':1. }
+    BNMTF = bnmtf_gibbs(R,M,1,1,True,hyperparams)
+    BNMTF.train('random','random',200,grow=True)
+    assert true_K <= BNMTF.K <= true_K+1 and true_K <= BNMTF.L <= true_K+1
+    assert len(BNMTF.pruned_components['F']) == 1 and len(BNMTF.pruned_components['G']) == 1
+    assert BNMTF.all_performances['MSE'][-1] < 0.02
+
+
+""" Test splitting the updates of the rows and columns over threads """
+def test_threads():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    with pytest.raises(AssertionError) as error:
+        bnmtf_gibbs(R,M,K,L,True,hyperparams).train('exp','exp',2,threads=0)
+    assert str(error.value) == "Number of threads should be at least 1, not 0."
+    
+    # Each block has its own random state, seeded from numpy.random, so runs can be reproduced
+    draws = []
+    for run in range(2):
+        numpy.random.seed(1)
+        BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+        BNMTF.train('exp','exp',5,threads=3)
+        draws.append(BNMTF.all_F)
+    assert numpy.array_equal(draws[0],draws[1]) and (draws[0] >= 0.).all()
+    assert BNMTF.all_G.shape == (5,J,L) and (BNMTF.all_G[-1] > 0.).any()
+    assert BNMTF.predict(M,2,1)['MSE'] >= 0.
+    
+    # The threads are stopped when run() raises an error
+    def fail(*args):
+        raise ValueError("Failed.")
+    threads = threading.active_count()
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.predict_while_running = fail
+    with pytest.raises(ValueError):
+        BNMTF.train('exp','exp',5,threads=3)
+    assert threading.active_count() == threads
+    
+    
+""" Test the convergence diagnostics, and running until enough effective samples are collected """
+def test_run_until():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    numpy.random.seed(0)
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',20)
+    assert BNMTF.monitor.names == ['F','G','MSE','S','tau'] and BNMTF.monitor.iterations == 20
+    assert numpy.array_equal(BNMTF.monitor.traces['tau'],BNMTF.all_tau)
+    assert BNMTF.monitor.traces['S'][-1] == numpy.linalg.norm(BNMTF.S)
+    assert BNMTF.convergence['iterations'] == 20 and 0 <= BNMTF.convergence['burn_in'] <= 10
+    
+    with pytest.raises(AssertionError) as error:
+        BNMTF.run_until(5.,100,check_every=0)
+    assert str(error.value) == "Convergence should be checked at least every iteration, not every 0."
+    
+    # Stop at the first check where all quantities have enough effective samples, and truncate the traces
+    BNMTF.run_until(5.,100,check_every=5)
+    iterations = BNMTF.convergence['iterations']
+    assert iterations % 5 == 0 and iterations < 100
+    assert min(BNMTF.convergence['ess'].values()) >= 5.
+    assert BNMTF.all_F.shape == (iterations,I,K) and BNMTF.all_S.shape == (iterations,K,L) and BNMTF.all_G.shape == (iterations,J,L)
+    assert len(BNMTF.all_tau) == len(BNMTF.all_lambdaFk) == len(BNMTF.all_lambdaGl) == iterations
+    assert numpy.array_equal(BNMTF.all_S[-1],BNMTF.S)
+    
+    # The split R-hat across independent chains
+    chains = []
+    for seed in range(3):
+        numpy.random.seed(seed)
+        chain = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+        chain.train('random','random',20)
+        chains.append(chain)
+    rhat = chain_diagnostics(chains)
+    assert sorted(rhat.keys()) == ['F','G','MSE','S','tau'] and all([value > 0. for value in rhat.values()])
+    
+    
+""" Test initialising F, S, and G with NNDSVD. """
+def test_initialise_nndsvd():
+    I,J,K,L = 10,5,2,3
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,2)),numpy.random.exponential(size=(J,2)).T)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alphatau':3, 'betatau':1, 'lambdaF':1., 'lambdaS':1., 'lambdaG':1. }
+    with pytest.raises(AssertionError) as error:
+        bnmtf_gibbs(R,M,K,L,False,priors).initialise('random','nndsvd')
+    assert str(error.value) == "S can only be initialised with NNDSVD if F and G are as well."
+    
+    MSEs = {}
+    for init_FG, init_S in [('exp','exp'),('nndsvd','nndsvd'),('nndsvd-iterative','nndsvd')]:
+        BNMTF = bnmtf_gibbs(R,M,K,L,False,priors)
+        BNMTF.initialise(init_FG,init_S)
+        (F, S, G) = (BNMTF.F, BNMTF.S, BNMTF.G)
+        assert F.min() > 0. and S.min() > 0. and G.min() > 0. and BNMTF.tau > 0.
+        MSEs[init_FG] = (M * (R - numpy.dot(F,numpy.dot(S,G.T)))**2).sum() / M.sum()
+    assert MSEs['nndsvd'] < MSEs['exp'] and MSEs['nndsvd-iterative'] < MSEs['exp']
+    
+    
+""" Test initialising the sampler from the variational posterior of VB. """
+def test_train_hybrid():
+    from BNMTF_ARD.code.models.bnmtf_vb import bnmtf_vb
+    I,J,K,L = 10,5,2,3
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,2)),numpy.random.exponential(size=(J,2)).T)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':3, 'betatau':1, 'alpha0':6, 'beta0':2, 'lambdaS':1. }
+    
+    BNMTF_VB = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF_VB.train('exp','exp',20)
+    with pytest.raises(AssertionError) as error:
+        bnmtf_gibbs(R,M,K,L,False,{ 'alphatau':3, 'betatau':1, 'lambdaF':1., 'lambdaS':1., 'lambdaG':1. }).initialise(from_vb=BNMTF_VB)
+    assert str(error.value) == "The variational model should have the same I, J, K, L, and ARD as the sampler: (10, 5, 2, 3, True) instead of (10, 5, 2, 3, False)."
+    
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.initialise(from_vb=BNMTF_VB)
+    assert BNMTF.F.shape == (I,K) and BNMTF.S.shape == (K,L) and BNMTF.G.shape == (J,L)
+    assert BNMTF.lambdaFk.min() > 0. and BNMTF.lambdaGl.min() > 0. and BNMTF.tau > 0.
+    MSE_vb = (M * (R - numpy.dot(BNMTF.F,numpy.dot(BNMTF.S,BNMTF.G.T)))**2).sum() / M.sum()
+    BNMTF.initialise('exp','exp')
+    assert MSE_vb < 0.5 * (M * (R - numpy.dot(BNMTF.F,numpy.dot(BNMTF.S,BNMTF.G.T)))**2).sum() / M.sum()
+    
+    numpy.random.seed(0)
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.train_hybrid('exp','exp',20,10)
+    assert len(BNMTF.vb.all_elbo) == 20 and BNMTF.vb.lambdaS[0,0] == 1. and BNMTF.all_F.shape == (10,I,K)
+    
+    # The sampler takes the same arguments as in train()
+    BNMTF.train_hybrid('exp','exp',20,10,rao_blackwell=True,time_budget=60.)
+    assert BNMTF.all_exp_F.shape == (10,I,K) and BNMTF.budget['time_budget'] == 60. and not BNMTF.budget['exhausted']
+    
+    
+""" Test storing the conditional expectations of the draws, and averaging those (Rao-Blackwellisation). """
+def test_rao_blackwell():
+    I,J,K,L = 20,10,3,2
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,K)),numpy.dot(numpy.random.exponential(size=(K,L)),numpy.random.exponential(size=(J,L)).T))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.train('random','random',30)
+    assert not BNMTF.rao_blackwell and BNMTF.all_exp_F is None
+    with pytest.raises(AssertionError) as error:
+        BNMTF.approx_expectation(10,2,rao_blackwell=True)
+    assert str(error.value) == "No conditional expectations stored - please use run(...,rao_blackwell=True)."
+    
+    BNMTF.run(30,rao_blackwell=True)
+    assert BNMTF.all_exp_F.shape == (30,I,K) and BNMTF.all_exp_S.shape == (30,K,L) and BNMTF.all_exp_G.shape == (30,J,L)
+    assert BNMTF.all_exp_tau.shape == (30,) and BNMTF.all_exp_lambdaFk.shape == (30,K) and BNMTF.all_exp_lambdaGl.shape == (30,L)
+    
+    # The conditional expectation of tau, given the draws of F, S, and G it was computed from
+    residual = (M * (R - numpy.dot(BNMTF.all_F[5],numpy.dot(BNMTF.all_S[5],BNMTF.all_G[5].T)))**2).sum()
+    assert abs(BNMTF.all_exp_tau[5] - (alphatau + M.sum()/2.) / (betatau + residual/2.)) < 1e-10
+    
+    # The expectation averages the conditional expectations, or the draws if asked
+    (exp_F,exp_S,exp_G,exp_tau,exp_lambdaFk,exp_lambdaGl) = BNMTF.approx_expectation(10,2)
+    assert numpy.allclose(exp_F,BNMTF.all_exp_F[10::2].mean(axis=0)) and numpy.allclose(exp_S,BNMTF.all_exp_S[10::2].mean(axis=0))
+    assert numpy.allclose(exp_G,BNMTF.all_exp_G[10::2].mean(axis=0)) and abs(exp_tau - BNMTF.all_exp_tau[10::2].mean()) < 1e-10
+    assert numpy.allclose(exp_lambdaFk,BNMTF.all_exp_lambdaFk[10::2].mean(axis=0)) and numpy.allclose(exp_lambdaGl,BNMTF.all_exp_lambdaGl[10::2].mean(axis=0))
+    (exp_F,exp_S,exp_G,exp_tau,_,_) = BNMTF.approx_expectation(10,2,rao_blackwell=False)
+    assert numpy.allclose(exp_F,BNMTF.all_F[10::2].mean(axis=0)) and numpy.allclose(exp_S,BNMTF.all_S[10::2].mean(axis=0))
+    
+    # The conditional expectations vary less between iterations than the draws
+    assert BNMTF.all_exp_F.var(axis=0).mean() < BNMTF.all_F.var(axis=0).mean()
+    assert BNMTF.all_exp_G.var(axis=0).mean() < BNMTF.all_G.var(axis=0).mean()
+    
+    # Pruned components are removed from the conditional expectations as well
+    BNMTF.train('exp','exp',10,prune={'threshold':numpy.inf,'patience':3},rao_blackwell=True)
+    pruned_F = [k for (it,k) in BNMTF.pruned_components['F']]
+    assert BNMTF.exp_F.shape == (I,1) and BNMTF.exp_S.shape == (1,1) and BNMTF.exp_G.shape == (J,1)
+    assert BNMTF.all_exp_F.shape == (10,I,K) and (BNMTF.all_exp_F[2:,:,pruned_F] == 0.).all() and (BNMTF.all_exp_F[:2,:,pruned_F] > 0.).all()
+    
+    # Without them, pruning only touches the draws
+    BNMTF.train('exp','exp',10,prune={'threshold':numpy.inf,'patience':3},rao_blackwell=False)
+    assert BNMTF.row_component_arrays() == [('F',1),('S',0),('lambdaFk',0),('lambdaS',0)]
+    assert BNMTF.column_component_arrays() == [('G',1),('S',1),('lambdaGl',0),('lambdaS',1)]
+    assert BNMTF.K == 1 and BNMTF.L == 1 and BNMTF.S.shape == (1,1) and BNMTF.exp_F is None and BNMTF.exp_S is None and BNMTF.all_exp_F is None
+    assert BNMTF.predict(M,2,1)['MSE'] >= 0.
+    
+    
+""" Test stopping at a time budget, with the traces truncated to the completed iterations. """
+def test_time_budget():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':3, 'betatau':1, 'alpha0':6, 'beta0':2, 'lambdaS':1. }
+    BNMTF = bnmtf_gibbs(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',None,time_budget=0.2)
+    iterations = BNMTF.budget['iterations']
+    assert BNMTF.budget['exhausted'] and BNMTF.budget['time_used'] < 1. and iterations == len(BNMTF.all_times)
+    assert BNMTF.all_F.shape == (iterations,I,K) and BNMTF.all_S.shape == (iterations,K,L) and BNMTF.all_lambdaGl.shape == (iterations,L)
+    assert numpy.array_equal(BNMTF.all_S[-1],BNMTF.S) and BNMTF.all_tau[-1] == BNMTF.tau
+    
+    BNMTF.run(10,time_budget=60.)
+    assert BNMTF.budget['iterations'] == 10 and not BNMTF.budget['exhausted'] and BNMTF.all_F.shape == (10,I,K)
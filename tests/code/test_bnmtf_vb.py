@@ -6,7 +6,7 @@ import sys, os
 project_location = os.path.dirname(__file__)+"/../../../"
 sys.path.append(project_location)
 
-import numpy, math, pytest, itertools
+import numpy, math, pytest, itertools, threading
 from BNMTF_ARD.code.models.bnmtf_vb import bnmtf_vb
 
 
@@ -669,4 +669,471 @@ def test_log_likelihood():
     assert MSE == BNMTF.quality('MSE')
     with pytest.raises(AssertionError) as error:
         BNMTF.quality('FAIL')
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+    
+    
+""" Test folding in new rows and columns, keeping the trained factors fixed. """
+def test_fold_in():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    exp_G = numpy.copy(BNMTF.exp_G)
+    
+    R_new, M_new = 2*numpy.ones((3,J)), numpy.ones((3,J))
+    M_new[0,1] = 0
+    F_new = BNMTF.fold_in_rows(R_new,M_new,10)
+    assert F_new.shape == (3,K)
+    assert (F_new >= 0.).all()
+    assert numpy.array_equal(BNMTF.exp_G,exp_G)
+    
+    G_new = BNMTF.fold_in_columns(numpy.ones((I,4)),numpy.ones((I,4)),10)
+    assert G_new.shape == (4,L)
+    assert (G_new >= 0.).all()
+    
+    # New data should match the trained model, with no fully unobserved rows or columns
+    with pytest.raises(AssertionError) as error:
+        BNMTF.fold_in_rows(numpy.ones((3,J+1)),numpy.ones((3,J+1)),10)
+    assert str(error.value) == "New matrix R_new has the wrong shape: (3, 6), while the trained model has 5 columns."
+    M_new = numpy.ones((I,2))
+    M_new[:,1] = 0
+    with pytest.raises(AssertionError) as error:
+        BNMTF.fold_in_columns(numpy.ones((I,2)),M_new,10)
+    assert str(error.value) == "Fully unobserved column in R_new, column 1."
+
+
+""" Test adding new observations, and refining from the current state. """
+def test_update_data_refine():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    
+    BNMTF.update_data([(0,0,2.),(2,2,1.),(0,1,4.)])
+    assert BNMTF.M[0,0] == 1. and BNMTF.M[2,2] == 1.
+    assert BNMTF.R[0,0] == 2. and BNMTF.R[0,1] == 4.
+    assert BNMTF.size_Omega == I*J-1
+    assert BNMTF.alpha_s == alphatau + (I*J-1)/2.
+    assert BNMTF.touched_rows == [0,2] and BNMTF.touched_columns == [0,1,2]
+    
+    BNMTF.refine(5,local_sweeps=2)
+    assert BNMTF.touched_rows == [] and BNMTF.touched_columns == []
+    assert (BNMTF.exp_F >= 0.).all() and (BNMTF.exp_G >= 0.).all()
+    assert len(BNMTF.all_performances['MSE']) == 5
+    
+    with pytest.raises(AssertionError) as error:
+        BNMTF.update_data([(I,0,1.)])
+    assert str(error.value) == "New entry (10,0) lies outside of R, which has shape (10, 5)."
+
+
+""" Test saving and loading the model, and continuing from the loaded state. """
+def test_save_load(tmpdir):
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    path = str(tmpdir.join('model'))
+    BNMTF.save(path)
+    
+    loaded = bnmtf_vb.load(path)
+    assert numpy.array_equal(loaded.exp_F,BNMTF.exp_F)
+    assert numpy.array_equal(loaded.exp_S,BNMTF.exp_S)
+    assert numpy.array_equal(loaded.exp_G,BNMTF.exp_G)
+    assert numpy.array_equal(loaded.var_S,BNMTF.var_S)
+    assert loaded.exp_tau == BNMTF.exp_tau and loaded.alpha_s == BNMTF.alpha_s
+    assert loaded.all_performances['MSE'] == BNMTF.all_performances['MSE']
+    assert loaded.predict(M)['MSE'] == BNMTF.predict(M)['MSE']
+    
+    # We can continue running the loaded model
+    loaded.run(2)
+    
+    # The mask should match its fingerprint
+    numpy.save(path+'/M.npy',numpy.ones((I,J)))
+    with pytest.raises(AssertionError) as error:
+        bnmtf_vb.load(path)
+    assert str(error.value) == "Mask M in %s does not match the fingerprint in its metadata." % path
+
+
+""" Test predicting individual entries and rows. """
+def test_predict_entries_rows():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    
+    rows, cols = [0,3,9], [1,4,0]
+    R_pred = numpy.dot(BNMTF.exp_F,numpy.dot(BNMTF.exp_S,BNMTF.exp_G.T))
+    assert numpy.allclose(BNMTF.predict_entries(rows,cols),R_pred[rows,cols])
+    assert numpy.allclose(BNMTF.predict_rows([2,5]),R_pred[[2,5]])
+    
+    # The variances should add up to the expected squared error, minus the squared error of the expectation
+    (exp_R,var_R) = BNMTF.predict_rows(range(I),variance=True)
+    assert numpy.allclose(exp_R,R_pred)
+    assert abs((M*var_R).sum() - (BNMTF.exp_square_diff() - (M*(R-R_pred)**2).sum())) < 1e-10
+    (exp_R_entries,var_R_entries) = BNMTF.predict_entries(rows,cols,variance=True)
+    assert numpy.allclose(exp_R_entries,exp_R[rows,cols]) and numpy.allclose(var_R_entries,var_R[rows,cols])
+    
+    # The cached G S.T is recomputed when we run the model again
+    old_GS = BNMTF.cached_GS()
+    BNMTF.run(1)
+    assert numpy.allclose(BNMTF.cached_GS(),numpy.dot(BNMTF.exp_G,BNMTF.exp_S.T))
+    assert not numpy.allclose(BNMTF.cached_GS(),old_GS)
+
+
+""" Test the posterior predictive mean, variance, and credible intervals. """
+def test_predictive():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    
+    rows, cols = numpy.nonzero(M)
+    predictive = BNMTF.predictive(rows,cols)
+    (exp_R,var_R) = BNMTF.predict_entries(rows,cols,variance=True)
+    assert numpy.array_equal(predictive['mean'],exp_R)
+    assert numpy.allclose(predictive['variance'],var_R + BNMTF.beta_s / (BNMTF.alpha_s - 1.))
+    assert 'lower' not in predictive
+    
+    predictive = BNMTF.predictive(rows,cols,credible=0.9)
+    assert (predictive['lower'] < predictive['mean']).all() and (predictive['mean'] < predictive['upper']).all()
+    assert numpy.allclose(predictive['upper'] - predictive['mean'],1.644854*numpy.sqrt(predictive['variance']))
+
+
+""" Test that the cached ELBO terms give the same ELBO, and are refreshed when q changes. """
+def test_elbo_cache():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',4,elbo_every=3)
+    
+    # After running, the expected square error from updating tau is reused
+    assert BNMTF.square_diff == BNMTF.exp_square_diff()
+    elbo = BNMTF.elbo()
+    assert BNMTF.stale_F == set() and BNMTF.stale_G == set()
+    BNMTF.reset_elbo_cache()
+    assert abs(BNMTF.elbo() - elbo) < 1e-10
+    
+    # Only the updated columns are recomputed
+    BNMTF.update_G(2)
+    BNMTF.update_exp_G(2)
+    assert BNMTF.stale_F == set() and BNMTF.stale_G == set([2]) and BNMTF.square_diff is None
+    entropy_G0 = BNMTF.entropy_G[0]
+    elbo = BNMTF.elbo()
+    assert BNMTF.entropy_G[0] == entropy_G0
+    BNMTF.reset_elbo_cache()
+    assert abs(BNMTF.elbo() - elbo) < 1e-10
+
+""" Test the timings and counts of the phases in the run loop. """
+def test_profile():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    
+    # Each phase is timed once per iteration, and the updates and their moments once per column
+    assert BNMTF.profile_phases == ['lambda', 'F', 'TN moments', 'S', 'G', 'tau', 'traces', 'performance', 'ELBO', 'output']
+    assert all([BNMTF.profile[phase]['calls'] == 10 for phase in ['lambda', 'tau', 'traces', 'performance', 'ELBO', 'output']])
+    assert BNMTF.profile['F']['calls'] == 20
+    assert BNMTF.profile['G']['calls'] == 30
+    assert BNMTF.profile['S']['calls'] == 60
+    assert BNMTF.profile['TN moments']['calls'] == 110
+    assert all([BNMTF.profile[phase]['time'] >= 0. and BNMTF.profile[phase]['memory'] >= 0 for phase in BNMTF.profile_phases])
+    
+    # Profiling can be switched off
+    BNMTF.run(2,profile=False)
+    assert BNMTF.profile is None and BNMTF.profile_phases == []
+
+
+""" Test pruning the components that ARD has switched off. """
+def test_prune():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    with pytest.raises(AssertionError) as error:
+        BNMTF = bnmtf_vb(R,M,K,L,False,dict(hyperparams,lambdaF=1.,lambdaG=1.))
+        BNMTF.train('exp','exp',2,prune=True)
+    assert str(error.value) == "Pruning components is only possible when using ARD."
+    
+    # With an infinite threshold, all but the largest component are removed after patience iterations
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10,prune={'threshold':numpy.inf,'patience':3})
+    assert 'pruning' in BNMTF.profile_phases
+    pruned_F = [k for (it,k) in BNMTF.pruned_components['F']]
+    pruned_G = [l for (it,l) in BNMTF.pruned_components['G']]
+    assert BNMTF.K == 1 and BNMTF.L == 1 and len(pruned_F) == K-1 and len(pruned_G) == L-1
+    assert all([it == 2 for (it,_) in BNMTF.pruned_components['F'] + BNMTF.pruned_components['G']])
+    assert BNMTF.exp_F.shape == (I,1) and BNMTF.mu_S.shape == (1,1) and BNMTF.var_G.shape == (J,1)
+    assert BNMTF.exp_lambdaFk.shape == (1,) and BNMTF.alphaGl_s.shape == (1,) and BNMTF.lambdaS.shape == (1,1)
+    
+    # We can still compute the ELBO and predict
+    assert not numpy.isnan(BNMTF.elbo())
+    assert BNMTF.predict(M)['MSE'] == BNMTF.all_performances['MSE'][-1]
+
+
+""" Test growing the number of components while running """
+def test_grow():
+    I,J,K,L = 10,5,1,1
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    with pytest.raises(AssertionError) as error:
+        BNMTF = bnmtf_vb(R,M,K,L,False,dict(hyperparams,lambdaF=1.,lambdaG=1.))
+        BNMTF.train('exp','exp',2,grow=True)
+    assert str(error.value) == "Growing components is only possible when using ARD."
+    with pytest.raises(AssertionError) as error:
+        BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+        BNMTF.train('exp','exp',2,prune=True,grow=True)
+    assert str(error.value) == "Components can either be pruned or grown, not both."
+    
+    # Without a threshold, and accepting any change in the fit, a component is added to F and G every four iterations
+    # (the new one is followed for two checks), until we reach the maximum
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',8,grow={'threshold':0.,'every':2,'max_components':3,'improvement':-numpy.inf})
+    assert 'growth' in BNMTF.profile_phases
+    assert BNMTF.K == 3 and BNMTF.L == 3 and BNMTF.grown_components == { 'F':[(1,1),(5,2)], 'G':[(1,1),(5,2)] }
+    assert BNMTF.all_K == [1,2,2,2,2,3,3,3] and BNMTF.all_L == BNMTF.all_K
+    assert BNMTF.lambdaS.shape == (3,3) and (BNMTF.lambdaS == 1.).all()
+    assert BNMTF.exp_F.shape == (I,3) and BNMTF.mu_S.shape == (3,3) and BNMTF.var_G.shape == (J,3)
+    assert BNMTF.exp_lambdaFk.shape == (3,) and BNMTF.alphaGl_s.shape == (3,)
+    
+    # We can still compute the ELBO and predict
+    assert not numpy.isnan(BNMTF.elbo())
+    assert BNMTF.predict(M)['MSE'] == BNMTF.all_performances['MSE'][-1]
+
+
+""" Test that growth stops near the rank of low-rank data """
+def test_grow_rank():
+    I,J,true_K = 30,20,3
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,true_K)),numpy.random.exponential(size=(J,true_K)).T) + numpy.random.normal(0,0.1,size=(I,J))
+    M = numpy.ones((I,J))
+    hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaS':1. }
+    BNMTF = bnmtf_vb(R,M,1,1,True,hyperparams)
+    BNMTF.train('random','random',200,grow=True)
+    assert true_K <= BNMTF.K <= true_K+1 and true_K <= BNMTF.L <= true_K+1
+    assert len(BNMTF.pruned_components['F']) == 1 and len(BNMTF.pruned_components['G']) == 1
+    assert BNMTF.all_performances['MSE'][-1] < 0.02
+
+
+""" Test splitting the updates of the rows and columns over threads """
+def test_threads():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    with pytest.raises(AssertionError) as error:
+        bnmtf_vb(R,M,K,L,True,hyperparams).train('exp','exp',2,threads=0)
+    assert str(error.value) == "Number of threads should be at least 1, not 0."
+    
+    # The updates are the same as without threads
+    models = []
+    for threads in [1,3]:
+        BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+        BNMTF.train('exp','exp',5,threads=threads)
+        models.append(BNMTF)
+    assert numpy.abs(models[0].exp_F - models[1].exp_F).max() < 1e-10 and numpy.abs(models[0].var_G - models[1].var_G).max() < 1e-10
+    assert numpy.abs(models[0].exp_S - models[1].exp_S).max() < 1e-10
+    assert abs(models[0].elbo() - models[1].elbo()) < 1e-8
+    
+    # The threads are stopped when run() raises an error
+    def fail(*args):
+        raise ValueError("Failed.")
+    threads = threading.active_count()
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.predict = fail
+    with pytest.raises(ValueError):
+        BNMTF.train('exp','exp',5,threads=3)
+    assert threading.active_count() == threads
+
+    
+    
+""" Test accelerating the coordinate ascent with SQUAREM and Anderson acceleration """
+def test_accelerate():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    with pytest.raises(AssertionError) as error:
+        bnmtf_vb(R,M,K,L,True,hyperparams).train('exp','exp',5,grow=True,accelerate='anderson')
+    assert str(error.value) == "Components can not be pruned or grown when accelerating the iterations."
+    
+    numpy.random.seed(0)
+    plain = bnmtf_vb(R,M,K,L,True,hyperparams)
+    plain.train('exp','exp',60,elbo_every=2)
+    assert plain.all_sweeps == range(1,61) and plain.all_elbo[0] is None and plain.all_elbo[-1] == plain.elbo()
+    for accelerate in ['squarem','anderson']:
+        numpy.random.seed(0)
+        BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+        BNMTF.train('exp','exp',10,accelerate=accelerate)
+        assert all([BNMTF.all_elbo[it+1] >= BNMTF.all_elbo[it] - 1e-8 for it in range(9)])
+        assert len(BNMTF.all_sweeps) == 10 and BNMTF.all_sweeps[-1] == BNMTF.accelerator.sweeps >= 10
+        # The expectations match the extrapolated parameters of q
+        assert numpy.allclose(BNMTF.exp_tau,BNMTF.alpha_s / BNMTF.beta_s) and numpy.allclose(BNMTF.exp_lambdaGl,BNMTF.alphaGl_s / BNMTF.betaGl_s)
+    
+    
+""" Test learning the hyperparameters with empirical Bayes. """
+def test_empirical_bayes():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaF':2., 'lambdaS':1., 'lambdaG':3. }
+    
+    # With ARD only lambdaS is learned
+    numpy.random.seed(0)
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',5,empirical_bayes=True)
+    assert BNMTF.all_hyperparameters.keys() == ['lambdaS'] and len(BNMTF.all_hyperparameters['lambdaS']) == 5
+    assert numpy.allclose(BNMTF.lambdaS, K*L / BNMTF.exp_S.sum())
+    
+    numpy.random.seed(0)
+    BNMTF = bnmtf_vb(R,M,K,L,False,hyperparams)
+    BNMTF.train('exp','exp',10,empirical_bayes=['lambda','tau'])
+    assert sorted(BNMTF.all_hyperparameters.keys()) == ['betatau','lambdaF','lambdaG','lambdaS']
+    assert all([BNMTF.all_elbo[it+1] >= BNMTF.all_elbo[it] - 1e-8 for it in range(9)])
+    assert numpy.allclose(BNMTF.lambdaF, I*K / BNMTF.exp_F.sum()) and numpy.allclose(BNMTF.lambdaG, J*L / BNMTF.exp_G.sum())
+    assert BNMTF.alphatau == alphatau and abs(BNMTF.alphatau / BNMTF.betatau - BNMTF.exp_tau) < 1e-8
+
+
+""" Test that learning the hyperparameters with empirical Bayes does not worsen the ELBO or the training MSE on low-rank data. """
+def test_empirical_bayes_fit():
+    numpy.random.seed(0)
+    I,J,K = 40,30,3
+    U, V = numpy.random.exponential(size=(I,K)), numpy.random.exponential(size=(J,K))
+    R = numpy.dot(U,V.T) + numpy.random.normal(0,0.1,size=(I,J))
+    M = numpy.ones((I,J))
+    hyperparams = { 'alphatau':1., 'betatau':1., 'lambdaF':0.1, 'lambdaS':0.1, 'lambdaG':0.1 }
+    models = []
+    for empirical_bayes in [False,['lambda','tau']]:
+        numpy.random.seed(0)
+        BNMTF = bnmtf_vb(R,M,K,K,False,hyperparams)
+        BNMTF.train('random','random',100,empirical_bayes=empirical_bayes)
+        models.append(BNMTF)
+    assert models[1].alphatau == 1. and models[1].betatau < 1.
+    assert models[1].all_elbo[-1] > models[0].all_elbo[-1]
+    assert models[1].all_performances['MSE'][-1] < 1.05 * models[0].all_performances['MSE'][-1]
+    
+    
+""" Test initialising F, S, and G with NNDSVD. """
+def test_initialise_nndsvd():
+    I,J,K,L = 10,5,2,3
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,2)),numpy.random.exponential(size=(J,2)).T)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alphatau':3, 'betatau':1, 'lambdaF':1., 'lambdaS':1., 'lambdaG':1. }
+    with pytest.raises(AssertionError) as error:
+        bnmtf_vb(R,M,K,L,False,priors).initialise('random','nndsvd')
+    assert str(error.value) == "S can only be initialised with NNDSVD if F and G are as well."
+    
+    MSEs = {}
+    for init_FG, init_S in [('exp','exp'),('nndsvd','nndsvd'),('nndsvd-iterative','nndsvd')]:
+        BNMTF = bnmtf_vb(R,M,K,L,False,priors)
+        BNMTF.initialise(init_FG,init_S)
+        (F, S, G) = (BNMTF.exp_F, BNMTF.exp_S, BNMTF.exp_G)
+        assert F.min() > 0. and S.min() > 0. and G.min() > 0. and (init_S == 'exp' or numpy.isclose(BNMTF.tau_S[0,0],100. / BNMTF.mu_S.mean()**2))
+        MSEs[init_FG] = (M * (R - numpy.dot(F,numpy.dot(S,G.T)))**2).sum() / M.sum()
+    assert MSEs['nndsvd'] < MSEs['exp'] and MSEs['nndsvd-iterative'] < MSEs['exp']
+    
+    
+""" Test stopping at a time budget, with the ELBO of the last full sweep. """
+def test_time_budget():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':3, 'betatau':1, 'alpha0':6, 'beta0':2, 'lambdaS':1. }
+    BNMTF = bnmtf_vb(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',None,elbo_every=1000,time_budget=0.2)
+    iterations = BNMTF.budget['iterations']
+    assert BNMTF.budget['exhausted'] and BNMTF.budget['time_used'] < 1. and iterations == len(BNMTF.all_elbo) == len(BNMTF.all_times)
+    assert BNMTF.all_elbo[-1] == BNMTF.elbo()
+    
+    BNMTF.run(10,time_budget=60.)
+    assert BNMTF.budget['iterations'] == 10 and not BNMTF.budget['exhausted'] and len(BNMTF.all_elbo) == 10
+
+    
+""" Test skipping the columns of F and G, and entries of S, that have converged, with active-set scheduling. """
+def test_active_set():
+    I,J,K,L = 10,5,2,3
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaF':1., 'lambdaS':1., 'lambdaG':1. }
+    BNMTF = bnmtf_vb(R,M,K,L,False,hyperparams)
+    BNMTF.train('exp','exp',100,active_set={'tolerance':1e-2,'wake':0.1})
+    updated, skipped = BNMTF.active_updates['updated'], BNMTF.active_updates['skipped']
+    assert skipped['F'] > 0 and skipped['S'] > 0 and skipped['G'] > 0
+    assert updated['F'] + skipped['F'] == 100*K and updated['S'] + skipped['S'] == 100*K*L and updated['G'] + skipped['G'] == 100*L
+    
+    plain = bnmtf_vb(R,M,K,L,False,hyperparams)
+    plain.train('exp','exp',100)
+    assert plain.active_updates is None
+    assert abs(BNMTF.all_performances['MSE'][-1] - plain.all_performances['MSE'][-1]) < 0.1 * plain.all_performances['MSE'][-1]
+    
+    with pytest.raises(AssertionError) as error:
+        BNMTF.run(10,accelerate='squarem',active_set=True)
+    assert str(error.value) == "Active-set scheduling can not be combined with pruning, growing, or acceleration."
@@ -0,0 +1,66 @@
+"""
+Test the wall-clock budgets of the run loops in budget.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.budget import TimeBudget, trace_length, extend_traces, INITIAL_TRACE_LENGTH
+
+import numpy, pytest, time
+
+
+""" Test the checks on the arguments. """
+def test_init():
+    with pytest.raises(AssertionError) as error:
+        TimeBudget(None,None)
+    assert str(error.value) == "Please give the number of iterations, a time budget, or both."
+    with pytest.raises(AssertionError) as error:
+        TimeBudget(0.,10)
+    assert str(error.value) == "Time budget should be positive, not 0.0."
+    with pytest.raises(AssertionError) as error:
+        TimeBudget(None,-1)
+    assert str(error.value) == "Number of iterations should be non-negative, not -1."
+
+
+""" Test the iteration numbers, with and without a maximum number of iterations. """
+def test_range():
+    assert list(TimeBudget(None,3).range()) == [0,1,2]
+    assert list(TimeBudget(1.,3).range(start=1)) == [1,2,3]
+    iterations = TimeBudget(1.,None).range()
+    assert [next(iterations) for it in range(5)] == [0,1,2,3,4]
+
+
+""" Test stopping once another iteration would exceed the budget. """
+def test_exhausted():
+    budget = TimeBudget(None,10)
+    time.sleep(0.01)
+    assert not budget.exhausted()
+    summary = budget.summary(1)
+    assert summary['iterations'] == 1 and summary['time_budget'] is None and summary['time_used'] >= 0.01 and not summary['exhausted']
+
+    # Iterations of 0.04 seconds: after two (0.08 seconds) a third would exceed the budget of 0.1 seconds
+    budget = TimeBudget(0.1,None)
+    completed = 0
+    for it in budget.range():
+        time.sleep(0.04)
+        completed += 1
+        if budget.exhausted():
+            break
+    summary = budget.summary(completed)
+    assert completed == 2 and summary['exhausted'] and 0.08 <= summary['time_used'] <= 0.1
+
+
+""" Test allocating and extending the traces. """
+def test_extend_traces():
+    assert trace_length(10) == 10 and trace_length(None) == INITIAL_TRACE_LENGTH
+    class Model:
+        pass
+    model = Model()
+    model.all_U, model.all_tau, model.all_exp_U = numpy.ones((2,3,4)), numpy.ones(2), None
+    extend_traces(model,['all_U','all_tau','all_exp_U'],1)
+    assert model.all_U.shape == (2,3,4) and model.all_tau.shape == (2,)
+    extend_traces(model,['all_U','all_tau','all_exp_U'],2)
+    assert model.all_U.shape == (4,3,4) and model.all_tau.shape == (4,) and model.all_exp_U is None
+    assert (model.all_U[:2] == 1.).all() and (model.all_U[2:] == 0.).all()
@@ -0,0 +1,76 @@
+"""
+Test the shared, read-only datasets and broadcast priors in dataset.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.dataset import Dataset, read_only, prior_matrix, shared_dataset
+
+import numpy, pytest
+
+
+""" Test making arrays read-only, copying them only when needed. """
+def test_read_only():
+    R = numpy.array([[1,2],[3,4]])
+    R_read_only = read_only(R)
+    assert R_read_only.dtype == float and not R_read_only.flags.writeable
+    assert R.flags.writeable and not numpy.shares_memory(R,R_read_only)
+    assert read_only(R_read_only) is R_read_only
+    with pytest.raises(ValueError):
+        R_read_only[0,0] = 5.
+        
+        
+""" Test the prior matrices, broadcasting scalars. """
+def test_prior_matrix():
+    lambdaU = prior_matrix(2,(3,2),'lambdaU')
+    assert lambdaU.shape == (3,2) and numpy.array_equal(lambdaU,2.*numpy.ones((3,2)))
+    assert lambdaU.strides == (0,0) and not lambdaU.flags.writeable
+    assert numpy.array_equal(lambdaU[[0,2],1],[2.,2.])
+    
+    matrix = numpy.array([[1.,2.],[3.,4.],[5.,6.]])
+    assert numpy.array_equal(prior_matrix(matrix,(3,2),'lambdaU'),matrix)
+    with pytest.raises(AssertionError) as error:
+        prior_matrix(numpy.ones((2,2)),(3,2),'lambdaV')
+    assert str(error.value) == "Prior matrix lambdaV has the wrong shape: (2, 2) instead of (3, 2)."
+    
+    
+""" Test the checks and counts of a Dataset. """
+def test_dataset():
+    R = numpy.array([[1.,2.,3.],[4.,5.,6.]])
+    M = numpy.array([[1,0,1],[1,1,0]])
+    data = Dataset(R,M)
+    assert data.shape == (2,3) and data.size_Omega == 4
+    assert numpy.array_equal(data.row_counts,[2,2]) and numpy.array_equal(data.column_counts,[2,1,1])
+    assert not data.R.flags.writeable and not data.M.flags.writeable
+    
+    with pytest.raises(AssertionError) as error:
+        Dataset(numpy.ones(3),numpy.ones(3))
+    assert str(error.value) == "Input matrix R is not a two-dimensional array, but instead 1-dimensional."
+    with pytest.raises(AssertionError) as error:
+        Dataset(R,M.T)
+    assert str(error.value) == "Input matrix R is not of the same size as the indicator matrix M: (2, 3) and (3, 2) respectively."
+    with pytest.raises(AssertionError) as error:
+        Dataset(R,[[1,0,0],[1,1,0]])
+    assert str(error.value) == "Fully unobserved column in R, column 2."
+    with pytest.raises(AssertionError) as error:
+        Dataset(R,[[0,0,0],[1,1,1]])
+    assert str(error.value) == "Fully unobserved row in R, row 0."
+    
+    
+""" Test sharing R between folds, and adding entries to a private copy. """
+def test_shared_dataset():
+    R = numpy.array([[1.,2.,3.],[4.,5.,6.]])
+    M = numpy.array([[1,0,1],[1,1,0]])
+    data = Dataset(R,M)
+    assert shared_dataset(data,None) is data
+    
+    fold = shared_dataset(data,[[1,0,1],[0,1,1]])
+    assert fold.R is data.R and fold.size_Omega == 4
+    assert shared_dataset(data.R,M).R is data.R
+    
+    updated = data.with_entries([(0,1,10.),(1,2,20.)])
+    assert updated.R[0,1] == 10. and updated.R[1,2] == 20. and updated.size_Omega == 6
+    assert not updated.R.flags.writeable
+    assert data.R[0,1] == 2. and data.size_Omega == 4 and data.M[0,1] == 0.
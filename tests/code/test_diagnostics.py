@@ -0,0 +1,94 @@
+"""
+Test the convergence diagnostics in diagnostics.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.diagnostics import autocorrelation, effective_sample_size, estimate_burn_in, split_rhat, chain_diagnostics, ConvergenceMonitor
+
+import numpy, pytest
+
+
+""" Test the autocorrelations of a trace. """
+def test_autocorrelation():
+    x = numpy.array([1.,2.,3.,4.])
+    rho = autocorrelation(x)
+    centred = x - x.mean()
+    expected = [(centred[:4-t]*centred[t:]).sum() / (centred**2).sum() for t in range(4)]
+    assert numpy.allclose(rho,expected)
+    
+    
+""" Test the effective sample size of independent and correlated traces. """
+def test_effective_sample_size():
+    numpy.random.seed(0)
+    independent = numpy.random.normal(size=1000)
+    assert 800. < effective_sample_size(independent) < 1200.
+    
+    correlated = numpy.zeros(1000)
+    for n in range(1,1000):
+        correlated[n] = 0.9 * correlated[n-1] + numpy.random.normal()
+    # The autocorrelation time of an AR(1) chain is (1+0.9)/(1-0.9) = 19
+    assert 25. < effective_sample_size(correlated) < 100.
+    
+    assert effective_sample_size([1.,1.,1.,1.,1.]) == 5.
+    assert effective_sample_size([1.,2.,3.]) == 3.
+    
+    
+""" Test the MSER estimate of the burn-in. """
+def test_estimate_burn_in():
+    numpy.random.seed(0)
+    x = numpy.concatenate([numpy.linspace(10.,1.,20),1.+0.1*numpy.random.normal(size=80)])
+    assert 15 <= estimate_burn_in(x) <= 25
+    assert estimate_burn_in(numpy.random.normal(size=100)) < 50
+    assert estimate_burn_in([5.,4.,3.]) == 0
+    
+    
+""" Test the split R-hat. """
+def test_split_rhat():
+    numpy.random.seed(0)
+    chains = numpy.random.normal(size=(3,200))
+    assert abs(split_rhat(chains) - 1.) < 0.05
+    chains[0] += 5.
+    assert split_rhat(chains) > 1.5
+    # A trend within each chain is also detected, by splitting the chains
+    assert split_rhat(numpy.array([numpy.linspace(0.,1.,200)]*2)) > 1.5
+    assert split_rhat(numpy.ones((2,10))) == 1.
+    
+    with pytest.raises(AssertionError) as error:
+        split_rhat(numpy.ones((2,3)))
+    assert str(error.value) == "Chains should have at least 4 samples to compute the split R-hat, not 3."
+    
+    
+""" Test recording quantities and summarising them. """
+def test_monitor():
+    numpy.random.seed(0)
+    monitor = ConvergenceMonitor()
+    assert monitor.summary() == { 'iterations':0, 'burn_in':0, 'thinning':1, 'ess':{} }
+    assert not monitor.converged(1.)
+    
+    for n in range(200):
+        monitor.record({ 'tau':(10. if n < 20 else 1.) + numpy.random.normal(), 'MSE':numpy.random.normal() })
+    summary = monitor.summary()
+    assert monitor.names == ['MSE','tau'] and monitor.iterations == 200
+    assert 15 <= summary['burn_in'] <= 25
+    assert sorted(summary['ess'].keys()) == ['MSE','tau']
+    assert summary['thinning'] == max(1,int((200 - summary['burn_in']) / min(summary['ess'].values())))
+    assert monitor.converged(50.) and not monitor.converged(10000.)
+    
+    
+""" Test the split R-hat across the monitors of several models. """
+def test_chain_diagnostics():
+    class Model:
+        pass
+    numpy.random.seed(0)
+    models = []
+    for c in range(3):
+        model = Model()
+        model.monitor = ConvergenceMonitor()
+        for n in range(100 + c):
+            model.monitor.record({ 'tau':numpy.random.normal() + (5. if c == 0 else 0.) })
+        models.append(model)
+    assert chain_diagnostics(models)['tau'] > 1.5
+    assert abs(chain_diagnostics(models[1:])['tau'] - 1.) < 0.1
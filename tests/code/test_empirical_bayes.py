@@ -0,0 +1,32 @@
+"""
+Test the empirical Bayes updates of the hyperparameters in empirical_bayes.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.empirical_bayes import learned_hyperparameters, exponential_rate, gamma_rate
+
+import numpy, pytest
+
+
+""" Test which hyperparameters are learned. """
+def test_learned_hyperparameters():
+    assert learned_hyperparameters(False) == [] and learned_hyperparameters(None) == []
+    assert learned_hyperparameters(True) == ['lambda']
+    assert learned_hyperparameters(['tau']) == ['tau'] and learned_hyperparameters(('lambda','tau')) == ['lambda','tau']
+    with pytest.raises(AssertionError) as error:
+        learned_hyperparameters(['alpha0'])
+    assert str(error.value) == "Unrecognised empirical Bayes hyperparameter: alpha0. Should be one in ['lambda', 'tau']."
+    
+    
+""" Test the rate of the exponential prior. """
+def test_exponential_rate():
+    expectations = numpy.array([[1.,2.],[3.,4.]])
+    assert exponential_rate(expectations) == 0.4
+    
+    
+""" Test the rate of the gamma prior with a fixed shape. """
+def test_gamma_rate():
+    assert gamma_rate(3.,2.) == 1.5 and gamma_rate(1,4) == 0.25
@@ -0,0 +1,83 @@
+"""
+Test the checks on new data in fold_in.py, and folding in held-out rows of
+low-rank data with each of the models.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.fold_in import new_rows
+from BNMTF_ARD.code.models.bnmf_gibbs import bnmf_gibbs
+from BNMTF_ARD.code.models.bnmtf_gibbs import bnmtf_gibbs
+from BNMTF_ARD.code.models.bnmf_vb import bnmf_vb
+from BNMTF_ARD.code.models.bnmtf_vb import bnmtf_vb
+from BNMTF_ARD.code.models.nmf_icm import nmf_icm
+from BNMTF_ARD.code.models.nmtf_icm import nmtf_icm
+from BNMTF_ARD.code.models.nmf_np import nmf_np
+from BNMTF_ARD.code.models.nmtf_np import nmtf_np
+
+import numpy, pytest
+
+
+""" Test the checks on the new rows and columns, and returning the new columns as rows. """
+def test_new_rows():
+    R_new, M_new = numpy.arange(6).reshape(2,3), numpy.ones((2,3))
+    R, M = new_rows(R_new,M_new,(4,3),axis=0)
+    assert numpy.array_equal(R,R_new) and R.dtype == float and numpy.array_equal(M,M_new)
+    R, M = new_rows(R_new,M_new,(2,5),axis=1)
+    assert numpy.array_equal(R,R_new.T) and M.shape == (3,2)
+
+    with pytest.raises(AssertionError) as error:
+        new_rows(numpy.ones((2,3)),numpy.ones((2,4)),(4,3),axis=0)
+    assert str(error.value) == "New matrix R_new and mask M_new should be two-dimensional and of the same size: (2, 3) and (2, 4) respectively."
+    with pytest.raises(AssertionError) as error:
+        new_rows(numpy.ones((2,3)),numpy.ones((2,3)),(4,5),axis=0)
+    assert str(error.value) == "New matrix R_new has the wrong shape: (2, 3), while the trained model has 5 columns."
+    with pytest.raises(AssertionError) as error:
+        new_rows(numpy.ones((2,3)),numpy.ones((2,3)),(4,5),axis=1)
+    assert str(error.value) == "New matrix R_new has the wrong shape: (2, 3), while the trained model has 4 rows."
+    M_new[1] = 0
+    with pytest.raises(AssertionError) as error:
+        new_rows(R_new,M_new,(4,3),axis=0)
+    assert str(error.value) == "Fully unobserved row in R_new, row 1."
+
+
+""" Test that the predictions for folded-in rows of low-rank data are as good as for the trained rows. """
+I, J, K, L, I_new = 40, 30, 3, 3, 5
+hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1.,
+                'lambdaU':0.1, 'lambdaV':0.1, 'lambdaF':0.1, 'lambdaS':0.1, 'lambdaG':0.1 }
+models = [
+    (lambda R,M: nmf_np(R,M,K,objective='Frobenius'), lambda model: model.train(100),
+     lambda model: (model.U, model.V), lambda model,R_new,M_new: model.fold_in_rows(R_new,M_new,50)),
+    (lambda R,M: nmtf_np(R,M,K,L,objective='Frobenius'), lambda model: model.train(100),
+     lambda model: (model.F, numpy.dot(model.G,model.S.T)), lambda model,R_new,M_new: model.fold_in_rows(R_new,M_new,50)),
+    (lambda R,M: nmf_icm(R,M,K,False,hyperparams), lambda model: model.train('random',100),
+     lambda model: (model.U, model.V), lambda model,R_new,M_new: model.fold_in_rows(R_new,M_new,50)),
+    (lambda R,M: nmtf_icm(R,M,K,L,False,hyperparams), lambda model: model.train('random','random',100),
+     lambda model: (model.F, numpy.dot(model.G,model.S.T)), lambda model,R_new,M_new: model.fold_in_rows(R_new,M_new,50)),
+    (lambda R,M: bnmf_vb(R,M,K,False,hyperparams), lambda model: model.train('random',100),
+     lambda model: (model.exp_U, model.exp_V), lambda model,R_new,M_new: model.fold_in_rows(R_new,M_new,50)),
+    (lambda R,M: bnmtf_vb(R,M,K,L,False,hyperparams), lambda model: model.train('random','random',100),
+     lambda model: (model.exp_F, numpy.dot(model.exp_G,model.exp_S.T)), lambda model,R_new,M_new: model.fold_in_rows(R_new,M_new,50)),
+    (lambda R,M: bnmf_gibbs(R,M,K,False,hyperparams), lambda model: model.train('random',100),
+     lambda model: (model.U, model.V), lambda model,R_new,M_new: model.fold_in_rows(R_new,M_new,50,burn_in=25)),
+    (lambda R,M: bnmtf_gibbs(R,M,K,L,False,hyperparams), lambda model: model.train('random','random',100),
+     lambda model: (model.F, numpy.dot(model.G,model.S.T)), lambda model,R_new,M_new: model.fold_in_rows(R_new,M_new,50,burn_in=25)),
+]
+
+@pytest.mark.parametrize("construct,train,factors,fold_in",models,
+                         ids=['nmf_np','nmtf_np','nmf_icm','nmtf_icm','bnmf_vb','bnmtf_vb','bnmf_gibbs','bnmtf_gibbs'])
+def test_fold_in_accuracy(construct,train,factors,fold_in):
+    numpy.random.seed(0)
+    U, V = numpy.random.exponential(size=(I+I_new,K)), numpy.random.exponential(size=(J,K))
+    R_all = numpy.maximum(numpy.dot(U,V.T) + numpy.random.normal(0,0.1,size=(I+I_new,J)), 0.01)
+    R, R_new = R_all[:I], R_all[I:]
+    M, M_new = numpy.ones((I,J)), numpy.ones((I_new,J))
+
+    model = construct(R,M)
+    train(model)
+    A, B = factors(model)
+    MSE_trained = ((numpy.dot(A,B.T) - R)**2).mean()
+    MSE_new = ((numpy.dot(fold_in(model,R_new,M_new),B.T) - R_new)**2).mean()
+    assert MSE_new < 1.5 * MSE_trained and MSE_new < 0.1 * R_new.var()
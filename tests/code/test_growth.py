@@ -0,0 +1,113 @@
+"""
+Test the adaptive growth of the number of components in growth.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.growth import residual_component, nonnegative_coefficients, append_components, create_grower, Grower
+from BNMTF_ARD.code.models.growth import GROW_THRESHOLD, GROW_EVERY
+
+import numpy, pytest
+
+
+""" Test the rank-one seed from the residual. """
+def test_residual_component():
+    u, v = numpy.array([1.,2.,0.,3.]), numpy.array([2.,1.,1.])
+    R, M = numpy.outer(u,v) + 1., numpy.ones((4,3))
+    M[0,0] = 0.
+    u_found, v_found = residual_component(R,M,numpy.ones((4,3)))
+    R_masked = M * numpy.outer(u,v)
+    assert numpy.abs(numpy.outer(u_found,v_found) - R_masked).max() < numpy.abs(R_masked).max()
+    assert (u_found >= 0.).all() and (v_found >= 0.).all()
+    assert abs(numpy.linalg.norm(u_found) - numpy.linalg.norm(v_found)) < 1e-10
+    
+    # The leading rank-one term of an exact rank-one residual is recovered
+    u_found, v_found = residual_component(R,numpy.ones((4,3)),numpy.ones((4,3)))
+    assert numpy.abs(numpy.outer(u_found,v_found) - numpy.outer(u,v)).max() < 1e-10
+    
+    # Negative residuals are ignored, so with a perfect or too large prediction we get zeros
+    u_found, v_found = residual_component(R,M,R+1.)
+    assert not u_found.any() and not v_found.any() and u_found.shape == (4,) and v_found.shape == (3,)
+
+
+""" Test the non-negative coefficients of the new row or column of S. """
+def test_nonnegative_coefficients():
+    A = numpy.array([[1.,0.],[0.,1.],[1.,1.]])
+    assert numpy.abs(nonnegative_coefficients(A,numpy.dot(A,[2.,3.])) - [2.,3.]).max() < 1e-10
+    assert numpy.abs(nonnegative_coefficients(A,numpy.array([1.,-1.,0.])) - [0.5,0.]).max() < 1e-10
+
+
+""" Test adding a component to the arrays of a model. """
+def test_append_components():
+    class Model:
+        pass
+    model = Model()
+    model.U, model.lambdak, model.S = numpy.ones((4,2)), numpy.arange(2.), numpy.arange(6.).reshape(2,3)
+    model.missing = None
+    append_components(model,[('U',1),('lambdak',0),('S',0),('missing',0),('unset',1)],{ 'U':numpy.arange(4.), 'S':7. })
+    assert numpy.array_equal(model.U,[[1.,1.,0.],[1.,1.,1.],[1.,1.,2.],[1.,1.,3.]])
+    assert numpy.array_equal(model.lambdak,[0.,1.,0.])
+    assert numpy.array_equal(model.S,[[0.,1.,2.],[3.,4.,5.],[7.,7.,7.]])
+    assert model.missing is None and not hasattr(model,'unset')
+
+
+""" Test when components are added and removed, and filling in the traces. """
+def test_grower():
+    grower = create_grower(2,True,10)
+    assert (grower.size,grower.threshold,grower.every) == (10,GROW_THRESHOLD,GROW_EVERY)
+    grower = create_grower(2,{'threshold':0.1,'every':2,'max_components':4},10)
+    assert (grower.size,grower.threshold,grower.every) == (4,0.1,2)
+    assert create_grower(12,True,10).size == 12
+    with pytest.raises(AssertionError) as error:
+        Grower(3,5,every=0)
+    assert str(error.value) == "Growth should be checked at least every iteration, not every 0."
+    with pytest.raises(AssertionError) as error:
+        Grower(3,2)
+    assert str(error.value) == "Maximum number of components should be at least 3, not 2."
+    
+    # We only check every two iterations, and add a component when all are in use
+    assert grower.check(numpy.array([1.,1.]),0) == (None,False)
+    assert grower.check(numpy.array([1.,1.]),1) == (None,True)
+    assert grower.active == [0,1,2] and grower.added == [(1,2)]
+    
+    # The new component is followed for two checks; it is in use, so we add another
+    assert grower.check(numpy.array([1.,1.,0.5]),3) == (None,False)
+    assert grower.check(numpy.array([1.,1.,0.6]),5) == (None,True)
+    assert grower.active == [0,1,2,3] and grower.added == [(1,2),(5,3)]
+    
+    # That one drops, so we remove it and stop
+    assert grower.check(numpy.array([1.,1.,1.,0.5]),7) == (None,False)
+    assert grower.check(numpy.array([1.,1.,1.,0.4]),9) == (3,False)
+    assert grower.active == [0,1,2] and grower.pruned == [(9,3)] and grower.stopped
+    assert grower.check(numpy.array([1.,1.,1.]),11) == (None,False)
+    assert numpy.array_equal(grower.expand(numpy.array([1.,2.,3.]),0),[1.,2.,3.,0.])
+    
+    # A new component below the threshold is removed at once
+    grower = Grower(1,3,threshold=0.1,every=1)
+    assert grower.check(numpy.array([1.]),0) == (None,True)
+    assert grower.check(numpy.array([1.,0.01]),1) == (1,False) and grower.active == [0]
+    
+    # With an improvement, a new component is judged by the mean error since the last check instead of its magnitude
+    grower = Grower(1,4,threshold=0.1,every=2,improvement=0.2)
+    assert grower.check(numpy.array([1.]),0,4.) == (None,False)
+    assert grower.check(numpy.array([1.]),1,2.) == (None,True) and grower.error_before == 3.
+    assert grower.check(numpy.array([1.,0.5]),2,2.) == (None,False)
+    assert grower.check(numpy.array([1.,0.01]),3,2.) == (None,False)
+    assert grower.check(numpy.array([1.,0.5]),5,2.) == (None,True) and grower.active == [0,1,2] and grower.error_before == 2.
+    assert grower.check(numpy.array([1.,1.,0.5]),7,1.8) == (None,False)
+    assert grower.check(numpy.array([1.,1.,0.5]),9,1.7) == (2,False) and grower.active == [0,1] and grower.stopped
+    assert create_grower(1,{'improvement':0.1},3,0.2).improvement == 0.1 and create_grower(1,True,3,0.2).improvement == 0.2
+    assert create_grower(1,True,3).improvement is None
+    
+    # We stop when another component drops below the threshold
+    grower = Grower(2,5,threshold=0.1,every=1)
+    assert grower.check(numpy.array([1.,0.01]),0) == (None,False) and grower.stopped
+    
+    # We never grow beyond the maximum number of components
+    grower = Grower(1,2,every=1)
+    assert grower.check(numpy.array([1.]),0) == (None,True)
+    assert grower.check(numpy.array([1.,1.]),1) == (None,False)
+    assert grower.check(numpy.array([1.,1.]),2) == (None,False)
+    assert grower.active == [0,1] and grower.stopped
@@ -0,0 +1,74 @@
+"""
+Test the HALS updates for masked non-negative matrix (tri-)factorisation in hals.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.hals import masked_gram, update_rows_hals, update_core_hals, MINIMUM_HALS
+
+import numpy, itertools
+
+
+def frobenius(R,M,A,B):
+    return (M*(R-numpy.dot(A,B.T))**2).sum()
+
+
+""" Test the masked Gram matrices against the definition. """
+def test_masked_gram():
+    numpy.random.seed(0)
+    I,J,K = 4,3,2
+    M = (numpy.random.rand(I,J) < 0.7).astype(float)
+    B = numpy.random.rand(J,K)
+    gram = masked_gram(M,B)
+    assert gram.shape == (I,K,K)
+    for i in range(I):
+        expected = sum([M[i,j]*numpy.outer(B[j],B[j]) for j in range(J)])
+        assert numpy.allclose(gram[i],expected)
+
+
+""" Test that each column update is the exact non-negative minimiser. """
+def test_update_rows_hals():
+    numpy.random.seed(1)
+    I,J,K = 6,5,1
+    R, M = numpy.random.rand(I,J), (numpy.random.rand(I,J) < 0.8).astype(float)
+    M[:,0] = 1.
+    A, B = numpy.random.rand(I,K), numpy.random.rand(J,K)
+    update_rows_hals(M*R,M,A,B)
+    # With K = 1 each row is a one-dimensional least squares problem
+    expected = numpy.maximum(MINIMUM_HALS, (M*R*B[:,0]).sum(axis=1) / (M*B[:,0]**2).sum(axis=1))
+    assert numpy.allclose(A[:,0],expected)
+    
+    # Negative solutions are clamped to the minimum
+    A = numpy.ones((I,K))
+    update_rows_hals(-M*R,M,A,B)
+    assert numpy.all(A == MINIMUM_HALS)
+    
+    # The objective never increases
+    K = 3
+    A, B = numpy.random.rand(I,K), numpy.random.rand(J,K)
+    for it in range(10):
+        before = frobenius(R,M,A,B)
+        update_rows_hals(M*R,M,A,B)
+        update_rows_hals((M*R).T,M.T,B,A)
+        assert frobenius(R,M,A,B) <= before + 1e-12
+        
+        
+""" Test the coordinate descent updates of S. """
+def test_update_core_hals():
+    numpy.random.seed(2)
+    I,J,K,L = 6,5,2,3
+    R, M = numpy.random.rand(I,J), (numpy.random.rand(I,J) < 0.8).astype(float)
+    F, S, G = numpy.random.rand(I,K), numpy.random.rand(K,L), numpy.random.rand(J,L)
+    objective = lambda: (M*(R-numpy.dot(F,numpy.dot(S,G.T)))**2).sum()
+    before = objective()
+    update_core_hals(R,M,F,S,G)
+    assert objective() <= before
+    assert numpy.all(S >= MINIMUM_HALS)
+    
+    # With K = L = 1 the update is the exact least squares solution
+    F, S, G = numpy.random.rand(I,1), numpy.random.rand(1,1), numpy.random.rand(J,1)
+    FG = numpy.outer(F[:,0],G[:,0])
+    update_core_hals(R,M,F,S,G)
+    assert abs(S[0,0] - (M*R*FG).sum() / (M*FG**2).sum()) < 1e-12
@@ -0,0 +1,74 @@
+"""
+Test the numpy and (if installed) numba kernels in kernels.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models import kernels
+from BNMTF_ARD.code.models.kernels import set_backend, get_backend, seed_kernels, OPTIONS_BACKEND
+from BNMTF_ARD.code.models.kernels import TN_vector_draw_kernel, TN_draw_kernel, masked_residual_products, masked_distances
+from BNMTF_ARD.code.models.distributions.truncated_normal_vector import TN_vector_expectation
+
+import numpy, pytest, subprocess
+
+backends = ['numpy'] + (['numba'] if kernels.numba is not None else [])
+
+
+""" Test choosing the backend. """
+def test_set_backend():
+    backend = get_backend()
+    assert backend == ('numba' if kernels.numba is not None else 'numpy')
+    with pytest.raises(AssertionError) as error:
+        set_backend('fortran')
+    assert str(error.value) == "Unrecognised backend: fortran. Should be one in %s." % OPTIONS_BACKEND
+    if kernels.numba is None:
+        with pytest.raises(AssertionError) as error:
+            set_backend('numba')
+        assert str(error.value) == "The numba backend is not available, as numba is not installed."
+    set_backend('numpy')
+    assert get_backend() == 'numpy' and get_backend('numba') == 'numba'
+    set_backend(backend)
+
+
+""" Test the truncated normal draws: non-negative, 0 if tau is 0, and with the right mean. """
+def test_TN_draws():
+    mus, taus = numpy.array([1.0, 0.32, -1., -5.]), numpy.array([3.0, 0.0, 2000., 1.])
+    for backend in backends:
+        numpy.random.seed(0), seed_kernels(0)
+        draws = numpy.array([TN_vector_draw_kernel(mus,taus,backend) for n in range(2000)])
+        assert (draws >= 0.).all() and (draws[:,1] == 0.).all()
+        expectation = TN_vector_expectation(mus,taus)
+        for n in [0,2,3]:
+            assert abs(draws[:,n].mean() - expectation[n]) < 0.1 * expectation[n]
+        assert TN_draw_kernel(1.,3.,backend) >= 0. and TN_draw_kernel(1.,0.,backend) == 0.
+
+
+""" Test the masked residual products against the direct sums. """
+def test_masked_residual_products():
+    numpy.random.seed(0)
+    R, M, A, B = numpy.random.rand(6,4), numpy.random.rand(6,4) > 0.3, numpy.random.rand(6,3), numpy.random.rand(4,3)
+    expected = numpy.zeros(6)
+    for i in range(6):
+        for j in range(4):
+            if M[i,j]:
+                expected[i] += (R[i,j] - numpy.dot(A[i],B[j]) + A[i,1]*B[j,1]) * B[j,1]
+    for backend in backends:
+        assert numpy.abs(masked_residual_products(R,M,A,B,1,backend) - expected).max() < 1e-12
+
+
+""" Test the masked distances of K-means, with nan if there is no overlap. """
+def test_masked_distances():
+    X, M = numpy.array([[1.,2.,3.],[4.,5.,6.]]), numpy.array([[1.,1.,0.],[0.,0.,1.]])
+    C, MC = numpy.array([[0.,0.,0.],[1.,1.,1.]]), numpy.array([[1.,0.,0.],[1.,1.,1.]])
+    for backend in backends:
+        distances = masked_distances(X,M,C,MC,backend)
+        assert distances[0,0] == 1. and distances[0,1] == 0.5 and distances[1,1] == 25.
+        assert numpy.isnan(distances[1,0])
+        
+    # K-means uses the same module, also when code/models is on the path instead
+    from BNMTF_ARD.code.models.kmeans import kmeans
+    assert kmeans.masked_distances is masked_distances
+    models_location = os.path.dirname(os.path.abspath(kernels.__file__))
+    assert subprocess.call([sys.executable,'-c','from kmeans.kmeans import KMeans'],cwd=models_location) == 0
@@ -0,0 +1,95 @@
+"""
+Test the fused evaluation of predictions on masked entries in metrics.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.metrics import MaskStatistics, Evaluator, evaluate
+from BNMTF_ARD.code.models.metrics import compute_metrics, compute_MSE, compute_R2, compute_Rp
+
+import numpy, math, pytest
+
+
+""" Test gathering the observed entries and their statistics. """
+def test_mask_statistics():
+    R = numpy.array([[1.,2.,3.],[4.,5.,6.]])
+    M = numpy.array([[1.,0.,1.],[0.,1.,1.]])
+    statistics = MaskStatistics(M,R)
+    assert numpy.array_equal(statistics.rows,[0,0,1,1])
+    assert numpy.array_equal(statistics.cols,[0,2,1,2])
+    assert numpy.array_equal(statistics.values,[1.,3.,5.,6.])
+    assert statistics.size == 4
+    assert statistics.mean == 15./4.
+    assert statistics.SS_total == (1.-3.75)**2 + (3.-3.75)**2 + (5.-3.75)**2 + (6.-3.75)**2
+
+    with pytest.raises(AssertionError) as error:
+        MaskStatistics(numpy.ones((3,2)),R)
+    assert str(error.value) == "Mask M and matrix R should be of the same size: (3, 2) and (2, 3) respectively."
+    with pytest.raises(AssertionError) as error:
+        MaskStatistics(numpy.zeros((2,3)),R)
+    assert str(error.value) == "Mask M has no observed entries to evaluate on."
+
+
+""" Test the metrics against the full-matrix formulas. """
+def test_compute_metrics():
+    numpy.random.seed(0)
+    I,J = 20,10
+    R, R_pred = numpy.random.rand(I,J), numpy.random.rand(I,J)
+    M = numpy.random.rand(I,J) < 0.6
+
+    mean_real = (M*R).sum() / float(M.sum())
+    mean_pred = (M*R_pred).sum() / float(M.sum())
+    MSE = (M*(R-R_pred)**2).sum() / float(M.sum())
+    R2 = 1. - (M*(R-R_pred)**2).sum() / (M*(R-mean_real)**2).sum()
+    Rp = (M*(R-mean_real)*(R_pred-mean_pred)).sum() / math.sqrt((M*(R-mean_real)**2).sum()*(M*(R_pred-mean_pred)**2).sum())
+    MAE = (M*abs(R-R_pred)).sum() / float(M.sum())
+
+    performances = compute_metrics(M,R,R_pred,['MSE','R^2','Rp','MAE'])
+    assert sorted(performances.keys()) == ['MAE','MSE','R^2','Rp']
+    assert abs(performances['MSE'] - MSE) < 1e-12
+    assert abs(performances['R^2'] - R2) < 1e-12
+    assert abs(performances['Rp'] - Rp) < 1e-12
+    assert abs(performances['MAE'] - MAE) < 1e-12
+    assert sorted(compute_metrics(M,R,R_pred).keys()) == ['MSE','R^2','Rp']
+
+    assert compute_MSE(M,R,R_pred) == performances['MSE']
+    assert compute_R2(M,R,R_pred) == performances['R^2']
+    assert compute_Rp(M,R,R_pred) == performances['Rp']
+
+    # R^2 is infinite if all observed values are the same
+    assert compute_R2(M,numpy.ones((I,J)),R_pred) == numpy.inf
+
+    with pytest.raises(AssertionError) as error:
+        compute_metrics(M,R,R_pred,['MSE','RMSE'])
+    assert str(error.value) == "Unrecognised metric: RMSE. Should be in ['MSE', 'R^2', 'Rp', 'MAE']."
+
+
+""" Test that the evaluator caches the statistics for each mask. """
+def test_evaluator():
+    R = numpy.array([[1.,2.,3.],[4.,5.,6.]])
+    M1 = numpy.array([[1.,0.,1.],[0.,1.,1.]])
+    M2 = numpy.array([[0.,1.,0.],[1.,1.,0.]])
+    evaluator = Evaluator()
+
+    statistics = evaluator.statistics(M1,R)
+    assert evaluator.statistics(M1,R) is statistics
+    assert evaluator.statistics(M1.copy(),R) is not statistics
+    assert evaluator.statistics(M2,R) is not statistics
+    assert evaluator.statistics(M1,R) is statistics
+    assert evaluator.statistics(M1,R.copy()) is not statistics
+
+    # The predictions are only asked for the entries in the mask
+    queries = []
+    def predict_entries(rows,cols):
+        queries.append((list(rows),list(cols)))
+        return R[rows,cols] + 1.
+    performances = evaluator.evaluate(M1,R,predict_entries,['MSE','MAE'])
+    assert queries == [([0,0,1,1],[0,2,1,2])]
+    assert performances == { 'MSE': 1., 'MAE': 1. }
+    assert performances == evaluate(statistics,R[statistics.rows,statistics.cols]+1.,['MSE','MAE'])
+
+    evaluator.clear()
+    assert evaluator.cache == []
+    assert evaluator.statistics(M1,R) is not statistics
@@ -7,7 +7,7 @@ project_location = os.path.dirname(__file__)+"/../../../"
 sys.path.append(project_location)
 
 import numpy, math, pytest, itertools
-from BNMTF_ARD.code.models.nmf_icm import nmf_icm
+from BNMTF_ARD.code.models.nmf_icm import nmf_icm, MINIMUM_TN
 
 
 """ Test constructor """
@@ -374,4 +374,337 @@ def test_log_likelihood():
     assert MSE == BNMF.quality('MSE',burnin,thinning)
     with pytest.raises(AssertionError) as error:
         BNMF.quality('FAIL',burnin,thinning)
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+    
+    
+""" Test folding in new rows and columns, keeping the trained factors fixed. """
+def test_fold_in():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = nmf_icm(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    V = numpy.copy(BNMF.V)
+    
+    R_new, M_new = 2*numpy.ones((3,J)), numpy.ones((3,J))
+    M_new[0,1] = 0
+    U_new = BNMF.fold_in_rows(R_new,M_new,10)
+    assert U_new.shape == (3,K)
+    assert (U_new >= 0.).all()
+    assert numpy.array_equal(BNMF.V,V)
+    
+    V_new = BNMF.fold_in_columns(numpy.ones((I,4)),numpy.ones((I,4)),10)
+    assert V_new.shape == (4,K)
+    assert (V_new >= 0.).all()
+    
+    # New data should match the trained model, with no fully unobserved rows or columns
+    with pytest.raises(AssertionError) as error:
+        BNMF.fold_in_rows(numpy.ones((3,J+1)),numpy.ones((3,J+1)),10)
+    assert str(error.value) == "New matrix R_new has the wrong shape: (3, 6), while the trained model has 5 columns."
+    M_new = numpy.ones((I,2))
+    M_new[:,1] = 0
+    with pytest.raises(AssertionError) as error:
+        BNMF.fold_in_columns(numpy.ones((I,2)),M_new,10)
+    assert str(error.value) == "Fully unobserved column in R_new, column 1."
+
+
+""" Test adding new observations, and refining from the current state. """
+def test_update_data_refine():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = nmf_icm(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    
+    BNMF.update_data([(0,0,2.),(2,2,1.),(0,1,4.)])
+    assert BNMF.M[0,0] == 1. and BNMF.M[2,2] == 1.
+    assert BNMF.R[0,0] == 2. and BNMF.R[0,1] == 4.
+    assert BNMF.size_Omega == I*J-1
+    assert BNMF.touched_rows == [0,2] and BNMF.touched_columns == [0,1,2]
+    
+    BNMF.refine(5,local_sweeps=2)
+    assert BNMF.touched_rows == [] and BNMF.touched_columns == []
+    assert (BNMF.U >= 0.).all() and (BNMF.V >= 0.).all()
+    assert len(BNMF.all_performances['MSE']) == 5
+    
+    with pytest.raises(AssertionError) as error:
+        BNMF.update_data([(I,0,1.)])
+    assert str(error.value) == "New entry (10,0) lies outside of R, which has shape (10, 5)."
+
+
+""" Test saving and loading the model, and continuing from the loaded state. """
+def test_save_load(tmpdir):
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = nmf_icm(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    path = str(tmpdir.join('model'))
+    BNMF.save(path,burn_in=5,thinning=2)
+    
+    loaded = nmf_icm.load(path)
+    assert numpy.array_equal(loaded.U,BNMF.U)
+    assert numpy.array_equal(loaded.V,BNMF.V)
+    assert loaded.tau == BNMF.tau
+    assert isinstance(loaded.all_U,numpy.memmap) and numpy.array_equal(loaded.all_U,BNMF.all_U)
+    assert numpy.array_equal(loaded.summaries['exp_U'],BNMF.approx_expectation(5,2)[0])
+    assert loaded.all_performances['MSE'] == BNMF.all_performances['MSE']
+    assert loaded.predict(M,5,2)['MSE'] == BNMF.predict(M,5,2)['MSE']
+    
+    # We can continue running the loaded model
+    loaded.run(2)
+    
+    # The mask should match its fingerprint
+    numpy.save(path+'/M.npy',numpy.ones((I,J)))
+    with pytest.raises(AssertionError) as error:
+        nmf_icm.load(path)
+    assert str(error.value) == "Mask M in %s does not match the fingerprint in its metadata." % path
+
+
+""" Test predicting individual entries and rows. """
+def test_predict_entries_rows():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = nmf_icm(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    
+    rows, cols = [0,3,9], [1,4,0]
+    (exp_U,exp_V,_,_) = BNMF.approx_expectation(5,2)
+    R_pred = numpy.dot(exp_U,exp_V.T)
+    assert numpy.allclose(BNMF.predict_entries(rows,cols,5,2),R_pred[rows,cols])
+    assert numpy.allclose(BNMF.predict_rows([2,5],5,2),R_pred[[2,5]])
+    
+    # The cached expectations are cleared when we run the model again
+    assert (5,2) in BNMF.prediction_cache
+    BNMF.run(10)
+    assert BNMF.prediction_cache == {}
+
+""" Test the timings and counts of the phases in the run loop. """
+def test_profile():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    BNMF = nmf_icm(R,M,K,True,hyperparams)
+    BNMF.train('exp',10)
+    
+    # Each phase is timed once per iteration
+    assert BNMF.profile_phases == ['lambda', 'U', 'V', 'tau', 'traces', 'performance', 'output']
+    assert all([BNMF.profile[phase]['calls'] == 10 for phase in ['lambda', 'U', 'V', 'tau', 'traces', 'performance', 'output']])
+    assert all([BNMF.profile[phase]['time'] >= 0. and BNMF.profile[phase]['memory'] >= 0 for phase in BNMF.profile_phases])
+    
+    # Profiling can be switched off
+    BNMF.run(2,profile=False)
+    assert BNMF.profile is None and BNMF.profile_phases == []
+
+""" Test the block NNLS engine. """
+def test_block_engine(tmpdir):
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    with pytest.raises(AssertionError) as error:
+        nmf_icm(R,M,K,True,hyperparams,engine='rows')
+    assert str(error.value) == "Unrecognised engine: rows. Should be one in ['coordinate', 'block']."
+    
+    numpy.random.seed(0)
+    BNMF = nmf_icm(R,M,K,True,hyperparams,engine='block')
+    BNMF.train('random',10)
+    assert BNMF.profile_phases == ['lambda', 'U', 'V', 'tau', 'traces', 'performance', 'output']
+    
+    # After updating V, each row of V satisfies the optimality conditions of its NNLS problem, bounded by MINIMUM_TN
+    BNMF.mode_rows_block(R.T,M.T,BNMF.V,BNMF.U,numpy.tile(BNMF.lambdak,(J,1)))
+    gradient = BNMF.tau * (numpy.dot((M*(numpy.dot(BNMF.U,BNMF.V.T)-R)).T,BNMF.U)) + BNMF.lambdak
+    assert (BNMF.V >= MINIMUM_TN).all()
+    assert (numpy.abs(gradient[BNMF.V > MINIMUM_TN]) < 1e-8).all()
+    assert (gradient[BNMF.V == MINIMUM_TN] >= -1e-8).all()
+    
+    # The exact modes converge within a few iterations
+    assert abs(BNMF.all_performances['MSE'][-1] - BNMF.all_performances['MSE'][-2]) < 1e-5
+    
+    # Folding in uses the block engine too, and the engine is saved with the model
+    U_new = BNMF.fold_in_rows(R[:2],M[:2],5)
+    assert U_new.shape == (2,K) and (U_new >= MINIMUM_TN).all()
+    path = str(tmpdir.join('model'))
+    BNMF.save(path)
+    assert nmf_icm.load(path).engine == 'block'
+
+
+""" Test that the block engine fits random low-rank data as well as the coordinate engine, rather than collapsing to 0. """
+def test_block_engine_fit():
+    numpy.random.seed(0)
+    I,J,K = 30,20,3
+    R = numpy.dot(numpy.random.rand(I,K),numpy.random.rand(J,K).T)
+    M = (numpy.random.rand(I,J) < 0.8) * 1.
+    hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaU':0.1, 'lambdaV':0.1 }
+    
+    MSE = {}
+    for engine in ['coordinate','block']:
+        numpy.random.seed(1)
+        BNMF = nmf_icm(R,M,K,False,hyperparams,engine=engine)
+        BNMF.train('random',100)
+        MSE[engine] = BNMF.all_performances['MSE'][-1]
+        assert (BNMF.U >= MINIMUM_TN).all() and (BNMF.V >= MINIMUM_TN).all()
+    assert MSE['block'] < 0.01 * R.var() and abs(MSE['block'] - MSE['coordinate']) < 0.01 * R.var()
+
+
+""" Test pruning the components that ARD has switched off. """
+def test_prune():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    with pytest.raises(AssertionError) as error:
+        BNMF = nmf_icm(R,M,K,False,dict(hyperparams,lambdaU=1.,lambdaV=1.))
+        BNMF.train('exp',2,prune=True)
+    assert str(error.value) == "Pruning components is only possible when using ARD."
+    
+    # With an infinite threshold, all but the largest component are removed after patience iterations
+    BNMF = nmf_icm(R,M,K,True,hyperparams)
+    BNMF.train('exp',10,prune={'threshold':numpy.inf,'patience':3})
+    assert 'pruning' in BNMF.profile_phases
+    pruned = [k for (it,k) in BNMF.pruned_components]
+    assert BNMF.K == 1 and len(pruned) == K-1 and all([it == 2 for (it,_) in BNMF.pruned_components])
+    assert BNMF.U.shape == (I,1) and BNMF.V.shape == (J,1) and BNMF.lambdak.shape == (1,)
+    
+    # The traces keep all components, with zeros for the pruned ones from then on
+    assert BNMF.all_U.shape == (10,I,K) and BNMF.all_V.shape == (10,J,K) and BNMF.all_lambdak.shape == (10,K)
+    assert (BNMF.all_U[2:,:,pruned] == 0.).all() and (BNMF.all_U[:2,:,pruned] > 0.).all()
+    assert (BNMF.all_V[2:,:,pruned] == 0.).all() and (BNMF.all_lambdak[2:,pruned] == 0.).all()
+    
+    # So we can still predict using the traces
+    assert BNMF.predict(M,2,1)['MSE'] >= 0.
+
+    
+    
+""" Test accelerating the iterations with SQUAREM and Anderson acceleration. """
+def test_accelerate():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0 }
+    with pytest.raises(AssertionError) as error:
+        nmf_icm(R,M,K,True,hyperparams).train('exp',5,prune=True,accelerate='squarem')
+    assert str(error.value) == "Components can not be pruned when accelerating the iterations."
+    
+    # The log posterior is the log likelihood plus the log priors
+    numpy.random.seed(0)
+    plain = nmf_icm(R,M,K,True,hyperparams,engine='block')
+    plain.train('exp',30)
+    assert plain.all_sweeps == range(1,31) and len(plain.all_log_posterior) == 30
+    assert plain.log_posterior() == plain.all_log_posterior[-1]
+    from scipy.stats import gamma
+    log_prior = ( (I+J)*numpy.log(plain.lambdak) - plain.lambdak*(plain.U.sum(axis=0)+plain.V.sum(axis=0)) ).sum() \
+                + gamma.logpdf(plain.tau,alphatau,scale=1./betatau) + gamma.logpdf(plain.lambdak,alpha0,scale=1./beta0).sum()
+    assert abs(plain.log_posterior() - plain.log_likelihood(plain.U,plain.V,plain.tau) - log_prior) < 1e-8
+    assert all([plain.all_log_posterior[it+1] >= plain.all_log_posterior[it] - 1e-8 for it in range(29)])
+    
+    for accelerate in ['squarem','anderson']:
+        numpy.random.seed(0)
+        BNMF = nmf_icm(R,M,K,True,hyperparams,engine='block')
+        BNMF.train('exp',10,accelerate=accelerate)
+        assert all([BNMF.all_log_posterior[it+1] >= BNMF.all_log_posterior[it] - 1e-8 for it in range(9)])
+        assert (BNMF.U >= 0.).all() and (BNMF.V >= 0.).all() and BNMF.tau > 0.
+        assert len(BNMF.all_sweeps) == 10 and BNMF.all_sweeps[-1] == BNMF.accelerator.sweeps >= 10
+    
+    
+""" Test initialising U and V with NNDSVD. """
+def test_initialise_nndsvd():
+    I,J,K = 10,5,2
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,2)),numpy.random.exponential(size=(J,2)).T)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alphatau':3, 'betatau':1, 'lambdaU':1., 'lambdaV':1. }
+    MSEs = {}
+    for init_UV in ['exp','nndsvd','nndsvd-iterative']:
+        BNMF = nmf_icm(R,M,K,False,priors)
+        BNMF.initialise(init_UV)
+        (U, V) = (BNMF.U, BNMF.V)
+        assert U.min() > 0. and V.min() > 0. and BNMF.tau > 0.
+        MSEs[init_UV] = (M * (R - numpy.dot(U,V.T))**2).sum() / M.sum()
+    assert MSEs['nndsvd'] < MSEs['exp'] and MSEs['nndsvd-iterative'] < MSEs['exp']
+    
+    
+""" Test stopping at a time budget, with the traces truncated to the completed iterations. """
+def test_time_budget():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':3, 'betatau':1, 'alpha0':6, 'beta0':2 }
+    BNMF = nmf_icm(R,M,K,True,hyperparams)
+    BNMF.train('exp',None,time_budget=0.2)
+    iterations = BNMF.budget['iterations']
+    assert BNMF.budget['exhausted'] and BNMF.budget['time_used'] < 1. and iterations == len(BNMF.all_log_posterior)
+    assert BNMF.all_U.shape == (iterations,I,K) and BNMF.all_lambdak.shape == (iterations,K)
+    assert numpy.array_equal(BNMF.all_V[-1],BNMF.V)
+    
+    BNMF.run(10,time_budget=60.)
+    assert BNMF.budget['iterations'] == 10 and not BNMF.budget['exhausted'] and BNMF.all_U.shape == (10,I,K)
+
+    
+""" Test skipping the columns of U and V that have converged, with active-set scheduling. """
+def test_active_set():
+    I,J,K = 10,5,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaU':1., 'lambdaV':1. }
+    numpy.random.seed(1)
+    BNMF = nmf_icm(R,M,K,False,hyperparams)
+    BNMF.train('exp',100,active_set={'tolerance':1e-2,'wake':0.1})
+    updated, skipped = BNMF.active_updates['updated'], BNMF.active_updates['skipped']
+    assert skipped['U'] > 0 and skipped['V'] > 0
+    assert updated['U'] + skipped['U'] == 100*K and updated['V'] + skipped['V'] == 100*K
+    
+    numpy.random.seed(1)
+    plain = nmf_icm(R,M,K,False,hyperparams)
+    plain.train('exp',100)
+    assert plain.active_updates is None
+    assert abs(BNMF.all_performances['MSE'][-1] - plain.all_performances['MSE'][-1]) < 0.1 * plain.all_performances['MSE'][-1]
+    
+    with pytest.raises(AssertionError) as error:
+        nmf_icm(R,M,K,False,hyperparams,engine='block').train('exp',10,active_set=True)
+    assert str(error.value) == "Active-set scheduling is only possible with the coordinate engine, not block."
+    with pytest.raises(AssertionError) as error:
+        BNMF.run(10,accelerate='squarem',active_set=True)
+    assert str(error.value) == "Active-set scheduling can not be combined with pruning or acceleration."
@@ -260,4 +260,368 @@ def test_compute_statistics():
     
     assert MSE_pred == nmf.compute_MSE(M_pred,R,R_pred)
     assert R2_pred == nmf.compute_R2(M_pred,R,R_pred)
-    assert Rp_pred == nmf.compute_Rp(M_pred,R,R_pred)
\ No newline at end of file
+    assert Rp_pred == nmf.compute_Rp(M_pred,R,R_pred)
+    
+    
+""" Test folding in new rows and columns, keeping the trained factors fixed. """
+def test_fold_in():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    nmf = nmf_np(R,M,K)
+    nmf.train(10)
+    V = numpy.copy(nmf.V)
+    
+    R_new, M_new = 2*numpy.ones((3,J)), numpy.ones((3,J))
+    M_new[0,1] = 0
+    U_new = nmf.fold_in_rows(R_new,M_new,10)
+    assert U_new.shape == (3,K)
+    assert (U_new >= 0.).all()
+    assert numpy.array_equal(nmf.V,V)
+    
+    V_new = nmf.fold_in_columns(numpy.ones((I,4)),numpy.ones((I,4)),10)
+    assert V_new.shape == (4,K)
+    assert (V_new >= 0.).all()
+    
+    # New data should match the trained model, with no fully unobserved rows or columns
+    with pytest.raises(AssertionError) as error:
+        nmf.fold_in_rows(numpy.ones((3,J+1)),numpy.ones((3,J+1)),10)
+    assert str(error.value) == "New matrix R_new has the wrong shape: (3, 6), while the trained model has 5 columns."
+    M_new = numpy.ones((I,2))
+    M_new[:,1] = 0
+    with pytest.raises(AssertionError) as error:
+        nmf.fold_in_columns(numpy.ones((I,2)),M_new,10)
+    assert str(error.value) == "Fully unobserved column in R_new, column 1."
+
+
+""" Test adding new observations, and refining from the current state. """
+def test_update_data_refine():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    nmf = nmf_np(R,M,K)
+    nmf.train(10)
+    
+    nmf.update_data([(0,0,2.),(2,2,1.),(0,1,4.)])
+    assert nmf.M[0,0] == 1. and nmf.M[2,2] == 1.
+    assert nmf.R[0,0] == 2. and nmf.R[0,1] == 4.
+    assert nmf.R_excl_unknown[0,0] == 2.
+    assert nmf.touched_rows == [0,2] and nmf.touched_columns == [0,1,2]
+    
+    nmf.refine(5,local_sweeps=2)
+    assert nmf.touched_rows == [] and nmf.touched_columns == []
+    assert (nmf.U >= 0.).all() and (nmf.V >= 0.).all()
+    assert len(nmf.all_performances['MSE']) == 5
+    
+    with pytest.raises(AssertionError) as error:
+        nmf.update_data([(I,0,1.)])
+    assert str(error.value) == "New entry (10,0) lies outside of R, which has shape (10, 5)."
+
+
+""" Test that the local sweeps and folding in use the solver and objective of training. """
+def test_update_rows_solver():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    # Sweeping over all rows is the same as one update of U in training
+    for (solver,objective) in [('columns','I-div'),('columns','Frobenius'),('matrix','I-div'),('matrix','Frobenius'),('hals','Frobenius')]:
+        numpy.random.seed(0)
+        nmf = nmf_np(R,M,K,solver=solver,objective=objective)
+        nmf.train(3)
+        U, V = numpy.copy(nmf.U), numpy.copy(nmf.V)
+        nmf.touched_rows = range(I)
+        nmf.sweep_touched()
+        U_swept = numpy.copy(nmf.U)
+        nmf.U = U
+        if solver == 'hals':
+            nmf.update_U_hals()
+        elif solver == 'matrix':
+            nmf.update_U_matrix()
+        else:
+            for k in range(K):
+                nmf.update_U(k)
+        assert numpy.allclose(U_swept,nmf.U) and numpy.array_equal(nmf.V,V)
+    
+    # Folding in the training data with HALS fits at least as well as with the I-divergence updates
+    numpy.random.seed(0)
+    U_hals = nmf.fold_in_rows(R,M,10)
+    nmf.solver, nmf.objective = 'columns', 'I-div'
+    numpy.random.seed(0)
+    U_multiplicative = nmf.fold_in_rows(R,M,10)
+    error = lambda U: (M * (R - numpy.dot(U,nmf.V.T))**2).sum()
+    assert error(U_hals) <= error(U_multiplicative)
+
+
+""" Test saving and loading the model, and continuing from the loaded state. """
+def test_save_load(tmpdir):
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    nmf = nmf_np(R,M,K)
+    nmf.train(10)
+    path = str(tmpdir.join('model'))
+    nmf.save(path)
+    
+    loaded = nmf_np.load(path)
+    assert numpy.array_equal(loaded.U,nmf.U)
+    assert numpy.array_equal(loaded.V,nmf.V)
+    assert loaded.all_performances['MSE'] == nmf.all_performances['MSE']
+    assert loaded.predict(M)['MSE'] == nmf.predict(M)['MSE']
+    
+    # We can continue running the loaded model
+    loaded.run(2)
+    
+    # The mask should match its fingerprint
+    numpy.save(path+'/M.npy',numpy.ones((I,J)))
+    with pytest.raises(AssertionError) as error:
+        nmf_np.load(path)
+    assert str(error.value) == "Mask M in %s does not match the fingerprint in its metadata." % path
+
+
+""" Test predicting individual entries and rows. """
+def test_predict_entries_rows():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    nmf = nmf_np(R,M,K)
+    nmf.train(10)
+    
+    rows, cols = [0,3,9], [1,4,0]
+    R_pred = numpy.dot(nmf.U,nmf.V.T)
+    assert numpy.allclose(nmf.predict_entries(rows,cols),R_pred[rows,cols])
+    assert numpy.allclose(nmf.predict_rows([2,5]),R_pred[[2,5]])
+
+""" Test the timings and counts of the phases in the run loop. """
+def test_profile():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    nmf = nmf_np(R,M,K)
+    nmf.train(10)
+    
+    # Each phase is timed once per iteration
+    assert nmf.profile_phases == ['U', 'V', 'performance']
+    assert all([nmf.profile[phase]['calls'] == 10 for phase in ['U', 'V', 'performance']])
+    assert all([nmf.profile[phase]['time'] >= 0. and nmf.profile[phase]['memory'] >= 0 for phase in nmf.profile_phases])
+    
+    # Profiling can be switched off
+    nmf.run(2,profile=False)
+    assert nmf.profile is None and nmf.profile_phases == []
+
+""" Test the matrix-form updates and the Frobenius objective. """
+def test_matrix_solver(tmpdir):
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    with pytest.raises(AssertionError) as error:
+        nmf_np(R,M,K,solver='rows')
+    assert str(error.value) == "Unrecognised solver: rows. Should be one in ['columns', 'matrix', 'hals']."
+    with pytest.raises(AssertionError) as error:
+        nmf_np(R,M,K,objective='KL')
+    assert str(error.value) == "Unrecognised objective: KL. Should be one in ['I-div', 'Frobenius']."
+    
+    # The matrix updates give the same U and V as the column updates when K = 1
+    for objective in ['I-div','Frobenius']:
+        numpy.random.seed(0)
+        nmf_columns = nmf_np(R,M,1,objective=objective)
+        nmf_columns.initialise()
+        nmf_matrix = nmf_np(R,M,1,solver='matrix',objective=objective)
+        nmf_matrix.U, nmf_matrix.V = nmf_columns.U.copy(), nmf_columns.V.copy()
+        nmf_columns.update_U(0)
+        R_pred = nmf_matrix.update_U_matrix()
+        assert numpy.allclose(nmf_matrix.U,nmf_columns.U)
+        assert numpy.allclose(R_pred,numpy.dot(nmf_columns.U,nmf_columns.V.T))
+        nmf_columns.update_V(0)
+        nmf_matrix.update_V_matrix(R_pred)
+        assert numpy.allclose(nmf_matrix.V,nmf_columns.V)
+    
+    # The objective never increases, and is computed from the reused U V.T
+    for solver in ['columns','matrix']:
+        for objective in ['I-div','Frobenius']:
+            numpy.random.seed(0)
+            nmf = nmf_np(R,M,K,solver=solver,objective=objective)
+            nmf.train(10)
+            assert len(nmf.all_objective) == 10
+            assert all([nmf.all_objective[it+1] <= nmf.all_objective[it] + 1e-12 for it in range(9)])
+            final = nmf.compute_I_div() if objective == 'I-div' else nmf.compute_frobenius()
+            assert abs(nmf.all_objective[-1] - final) < 1e-10
+    assert nmf.compute_frobenius() == (M*(R-numpy.dot(nmf.U,nmf.V.T))**2).sum()
+    
+    # The solver and objective are saved with the model
+    nmf = nmf_np(R,M,K,solver='matrix',objective='Frobenius')
+    nmf.train(2)
+    path = str(tmpdir.join('model'))
+    nmf.save(path)
+    loaded = nmf_np.load(path)
+    assert loaded.solver == 'matrix' and loaded.objective == 'Frobenius'
+    assert loaded.all_objective == nmf.all_objective
+
+
+""" Test the HALS solver. """
+def test_hals():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    with pytest.raises(AssertionError) as error:
+        nmf_np(R,M,K,solver='hals')
+    assert str(error.value) == "The HALS solver minimises the Frobenius objective, not the I-div."
+    
+    numpy.random.seed(0)
+    nmf = nmf_np(R,M,K,solver='hals',objective='Frobenius')
+    nmf.train(10)
+    assert all([nmf.all_objective[it+1] <= nmf.all_objective[it] + 1e-12 for it in range(9)])
+    assert numpy.all(nmf.U > 0.) and numpy.all(nmf.V > 0.)
+    assert nmf.profile_phases == ['U', 'V', 'performance']
+    
+    # HALS fits at least as well as the multiplicative updates from the same initialisation
+    numpy.random.seed(0)
+    nmf_multiplicative = nmf_np(R,M,K,solver='matrix',objective='Frobenius')
+    nmf_multiplicative.train(10)
+    assert nmf.all_objective[-1] <= nmf_multiplicative.all_objective[-1]
+
+    
+    
+""" Test accelerating the updates with SQUAREM and Anderson acceleration. """
+def test_accelerate():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    with pytest.raises(AssertionError) as error:
+        nmf_np(R,M,K).train(5,accelerate='newton')
+    assert str(error.value) == "Unrecognised acceleration: newton. Should be one in ['squarem', 'anderson']."
+    
+    numpy.random.seed(0)
+    plain = nmf_np(R,M,K,solver='matrix')
+    plain.train(100)
+    assert plain.all_sweeps == range(1,101)
+    for accelerate in ['squarem','anderson']:
+        numpy.random.seed(0)
+        nmf = nmf_np(R,M,K,solver='matrix')
+        nmf.train(10,accelerate=accelerate)
+        assert all([nmf.all_objective[it+1] <= nmf.all_objective[it] + 1e-10 for it in range(9)])
+        assert numpy.all(nmf.U > 0.) and numpy.all(nmf.V > 0.)
+        assert len(nmf.all_sweeps) == 10 and nmf.all_sweeps[-1] == nmf.accelerator.sweeps >= 10
+        # The accelerated updates fit at least as well as the plain ones with the same number of sweeps
+        assert nmf.all_objective[-1] <= plain.all_objective[nmf.all_sweeps[-1]-1] + 1e-10
+    
+    
+""" Test initialising U and V with NNDSVD. """
+def test_initialise_nndsvd():
+    I,J,K = 10,5,2
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,2)),numpy.random.exponential(size=(J,2)).T)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alphatau':3, 'betatau':1, 'lambdaU':1., 'lambdaV':1. }
+    MSEs = {}
+    for init_UV in ['ones','nndsvd','nndsvd-iterative']:
+        NMF = nmf_np(R,M,K)
+        NMF.initialise(init_UV)
+        (U, V) = (NMF.U, NMF.V)
+        assert U.min() > 0. and V.min() > 0.
+        MSEs[init_UV] = (M * (R - numpy.dot(U,V.T))**2).sum() / M.sum()
+    assert MSEs['nndsvd'] < MSEs['ones'] and MSEs['nndsvd-iterative'] < MSEs['ones']
+    
+    
+""" Test sharing one read-only dataset between models. """
+def test_shared_dataset():
+    from BNMTF_ARD.code.models.dataset import Dataset
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    data = Dataset(R,numpy.ones((I,J)))
+    nmf = nmf_np(data,M,K)
+    assert nmf.R is data.R and numpy.array_equal(nmf.M,M)
+    assert nmf.R_excl_unknown[0,0] == 1. and nmf.R_excl_unknown.flags.writeable
+    
+    nmf.train(5)
+    nmf.update_data([(0,0,2.)])
+    assert nmf.R[0,0] == 2. and nmf.R_excl_unknown[0,0] == 2. and data.R[0,0] == 1.
+    
+    
+""" Test stopping at a time budget. """
+def test_time_budget():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    nmf = nmf_np(R,M,K)
+    nmf.train(None,time_budget=0.2)
+    assert nmf.budget['exhausted'] and nmf.budget['time_used'] < 1. and nmf.budget['iterations'] == len(nmf.all_times) > 0
+    
+    nmf.run(10,time_budget=60.)
+    assert nmf.budget['iterations'] == 10 and not nmf.budget['exhausted'] and len(nmf.all_times) == 10
+
+    
+""" Test skipping the columns of U and V that have converged, with active-set scheduling. """
+def test_active_set():
+    I,J,K = 10,5,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    numpy.random.seed(1)
+    nmf = nmf_np(R,M,K)
+    nmf.train(100,active_set={'tolerance':1e-2,'wake':0.1})
+    updated, skipped = nmf.active_updates['updated'], nmf.active_updates['skipped']
+    assert skipped['U'] > 0 and skipped['V'] > 0
+    assert updated['U'] + skipped['U'] == 100*K and updated['V'] + skipped['V'] == 100*K
+    
+    numpy.random.seed(1)
+    plain = nmf_np(R,M,K)
+    plain.train(100)
+    assert plain.active_updates is None
+    assert abs(nmf.all_performances['MSE'][-1] - plain.all_performances['MSE'][-1]) < 0.1 * plain.all_performances['MSE'][-1]
+    
+    with pytest.raises(AssertionError) as error:
+        nmf_np(R,M,K,solver='matrix').train(10,active_set=True)
+    assert str(error.value) == "Active-set scheduling is only possible with the columns solver, not matrix."
+    with pytest.raises(AssertionError) as error:
+        nmf.run(10,accelerate='squarem',active_set=True)
+    assert str(error.value) == "Active-set scheduling can not be combined with acceleration."
+
+
+""" Test that with the default settings, updates are skipped on rank-3 data, and the MSE stays within 1% of full sweeps. """
+def test_active_set_defaults():
+    numpy.random.seed(0)
+    I,J,K,true_K = 60,40,4,3
+    U, V = numpy.random.exponential(size=(I,true_K)), numpy.random.exponential(size=(J,true_K))
+    R = numpy.maximum(numpy.dot(U,V.T) + numpy.random.normal(0,0.1,size=(I,J)), 0.01)
+    M = numpy.ones((I,J))
+    models = []
+    for active_set in [False,True]:
+        numpy.random.seed(1)
+        nmf = nmf_np(R,M,K)
+        nmf.train(300,active_set=active_set)
+        models.append(nmf)
+    skipped = sum(models[1].active_updates['skipped'].values())
+    assert skipped > 0.05 * (2*K*300)
+    assert abs(models[1].all_performances['MSE'][-1] - models[0].all_performances['MSE'][-1]) < 0.01 * abs(models[0].all_performances['MSE'][-1])
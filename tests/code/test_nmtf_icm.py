@@ -7,7 +7,7 @@ project_location = os.path.dirname(__file__)+"/../../../"
 sys.path.append(project_location)
 
 import numpy, math, pytest, itertools
-from BNMTF_ARD.code.models.nmtf_icm import nmtf_icm
+from BNMTF_ARD.code.models.nmtf_icm import nmtf_icm, MINIMUM_TN
 
 
 """ Test constructor """
@@ -469,4 +469,349 @@ def test_log_likelihood():
     assert MSE == BNMTF.quality('MSE',burnin,thinning)
     with pytest.raises(AssertionError) as error:
         BNMTF.quality('FAIL',burnin,thinning)
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+    
+    
+""" Test folding in new rows and columns, keeping the trained factors fixed. """
+def test_fold_in():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = nmtf_icm(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    G = numpy.copy(BNMTF.G)
+    
+    R_new, M_new = 2*numpy.ones((3,J)), numpy.ones((3,J))
+    M_new[0,1] = 0
+    F_new = BNMTF.fold_in_rows(R_new,M_new,10)
+    assert F_new.shape == (3,K)
+    assert (F_new >= 0.).all()
+    assert numpy.array_equal(BNMTF.G,G)
+    
+    G_new = BNMTF.fold_in_columns(numpy.ones((I,4)),numpy.ones((I,4)),10)
+    assert G_new.shape == (4,L)
+    assert (G_new >= 0.).all()
+    
+    # New data should match the trained model, with no fully unobserved rows or columns
+    with pytest.raises(AssertionError) as error:
+        BNMTF.fold_in_rows(numpy.ones((3,J+1)),numpy.ones((3,J+1)),10)
+    assert str(error.value) == "New matrix R_new has the wrong shape: (3, 6), while the trained model has 5 columns."
+    M_new = numpy.ones((I,2))
+    M_new[:,1] = 0
+    with pytest.raises(AssertionError) as error:
+        BNMTF.fold_in_columns(numpy.ones((I,2)),M_new,10)
+    assert str(error.value) == "Fully unobserved column in R_new, column 1."
+
+
+""" Test adding new observations, and refining from the current state. """
+def test_update_data_refine():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = nmtf_icm(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    
+    BNMTF.update_data([(0,0,2.),(2,2,1.),(0,1,4.)])
+    assert BNMTF.M[0,0] == 1. and BNMTF.M[2,2] == 1.
+    assert BNMTF.R[0,0] == 2. and BNMTF.R[0,1] == 4.
+    assert BNMTF.size_Omega == I*J-1
+    assert BNMTF.touched_rows == [0,2] and BNMTF.touched_columns == [0,1,2]
+    
+    BNMTF.refine(5,local_sweeps=2)
+    assert BNMTF.touched_rows == [] and BNMTF.touched_columns == []
+    assert (BNMTF.F >= 0.).all() and (BNMTF.G >= 0.).all()
+    assert len(BNMTF.all_performances['MSE']) == 5
+    
+    with pytest.raises(AssertionError) as error:
+        BNMTF.update_data([(I,0,1.)])
+    assert str(error.value) == "New entry (10,0) lies outside of R, which has shape (10, 5)."
+
+
+""" Test saving and loading the model, and continuing from the loaded state. """
+def test_save_load(tmpdir):
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = nmtf_icm(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    path = str(tmpdir.join('model'))
+    BNMTF.save(path,burn_in=5,thinning=2)
+    
+    loaded = nmtf_icm.load(path)
+    assert numpy.array_equal(loaded.F,BNMTF.F)
+    assert numpy.array_equal(loaded.S,BNMTF.S)
+    assert numpy.array_equal(loaded.G,BNMTF.G)
+    assert loaded.tau == BNMTF.tau
+    assert isinstance(loaded.all_F,numpy.memmap) and numpy.array_equal(loaded.all_F,BNMTF.all_F)
+    assert numpy.array_equal(loaded.summaries['exp_F'],BNMTF.approx_expectation(5,2)[0])
+    assert loaded.all_performances['MSE'] == BNMTF.all_performances['MSE']
+    assert loaded.predict(M,5,2)['MSE'] == BNMTF.predict(M,5,2)['MSE']
+    
+    # We can continue running the loaded model
+    loaded.run(2)
+    
+    # The mask should match its fingerprint
+    numpy.save(path+'/M.npy',numpy.ones((I,J)))
+    with pytest.raises(AssertionError) as error:
+        nmtf_icm.load(path)
+    assert str(error.value) == "Mask M in %s does not match the fingerprint in its metadata." % path
+
+
+""" Test predicting individual entries and rows. """
+def test_predict_entries_rows():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = nmtf_icm(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    
+    rows, cols = [0,3,9], [1,4,0]
+    (exp_F,exp_S,exp_G,_,_,_) = BNMTF.approx_expectation(5,2)
+    R_pred = numpy.dot(exp_F,numpy.dot(exp_S,exp_G.T))
+    assert numpy.allclose(BNMTF.predict_entries(rows,cols,5,2),R_pred[rows,cols])
+    assert numpy.allclose(BNMTF.predict_rows([2,5],5,2),R_pred[[2,5]])
+    
+    # The cached expectations are cleared when we run the model again
+    assert (5,2) in BNMTF.prediction_cache
+    BNMTF.run(10)
+    assert BNMTF.prediction_cache == {}
+
+""" Test the timings and counts of the phases in the run loop. """
+def test_profile():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    BNMTF = nmtf_icm(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10)
+    
+    # Each phase is timed once per iteration
+    assert BNMTF.profile_phases == ['lambda', 'F', 'S', 'G', 'tau', 'traces', 'performance', 'output']
+    assert all([BNMTF.profile[phase]['calls'] == 10 for phase in ['lambda', 'F', 'S', 'G', 'tau', 'traces', 'performance', 'output']])
+    assert all([BNMTF.profile[phase]['time'] >= 0. and BNMTF.profile[phase]['memory'] >= 0 for phase in BNMTF.profile_phases])
+    
+    # Profiling can be switched off
+    BNMTF.run(2,profile=False)
+    assert BNMTF.profile is None and BNMTF.profile_phases == []
+
+
+""" Test the block NNLS engine. """
+def test_block_engine(tmpdir):
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    with pytest.raises(AssertionError) as error:
+        nmtf_icm(R,M,K,L,True,hyperparams,engine='rows')
+    assert str(error.value) == "Unrecognised engine: rows. Should be one in ['coordinate', 'block']."
+    
+    numpy.random.seed(0)
+    BNMTF = nmtf_icm(R,M,K,L,True,hyperparams,engine='block')
+    BNMTF.train('random','random',10)
+    assert BNMTF.profile_phases == ['lambda', 'F', 'S', 'G', 'tau', 'traces', 'performance', 'output']
+    
+    # The block mode of S satisfies the optimality conditions of its NNLS problem, bounded by MINIMUM_TN
+    BNMTF.F, BNMTF.G = numpy.random.rand(I,K) + 1., numpy.random.rand(J,L) + 1.
+    BNMTF.mode_S_block()
+    (F,S,G) = (BNMTF.F,BNMTF.S,BNMTF.G)
+    gradient = BNMTF.tau * numpy.dot(F.T,numpy.dot(M*(numpy.dot(F,numpy.dot(S,G.T))-R),G)) + 1.
+    assert (S >= MINIMUM_TN).all()
+    assert (numpy.abs(gradient[S > MINIMUM_TN]) < 1e-8).all()
+    assert (gradient[S == MINIMUM_TN] >= -1e-8).all()
+    
+    # It agrees with the coordinate modes, run until convergence
+    S_block = numpy.copy(S)
+    for it in range(500):
+        for k,l in itertools.product(range(K),range(L)):
+            BNMTF.S[k,l] = max(MINIMUM_TN,BNMTF.muS(BNMTF.tauS(k,l),k,l))
+    assert numpy.abs(BNMTF.S - S_block).max() < 1e-6
+    
+    # Folding in uses the block engine too, and the engine is saved with the model
+    F_new = BNMTF.fold_in_rows(R[:2],M[:2],5)
+    assert F_new.shape == (2,K) and (F_new >= MINIMUM_TN).all()
+    path = str(tmpdir.join('model'))
+    BNMTF.save(path)
+    assert nmtf_icm.load(path).engine == 'block'
+
+
+""" Test that the block engine fits random low-rank data as well as the coordinate engine, rather than collapsing to 0. """
+def test_block_engine_fit():
+    numpy.random.seed(0)
+    I,J,K,L = 30,20,3,3
+    R = numpy.dot(numpy.random.rand(I,K),numpy.random.rand(J,K).T)
+    M = (numpy.random.rand(I,J) < 0.8) * 1.
+    hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaF':0.1, 'lambdaS':0.1, 'lambdaG':0.1 }
+    
+    for ARD in [False,True]:
+        MSE = {}
+        for engine in ['coordinate','block']:
+            numpy.random.seed(1)
+            BNMTF = nmtf_icm(R,M,K,L,ARD,hyperparams,engine=engine)
+            BNMTF.train('random','random',100)
+            MSE[engine] = BNMTF.all_performances['MSE'][-1]
+            assert (BNMTF.F >= MINIMUM_TN).all() and (BNMTF.S >= MINIMUM_TN).all() and (BNMTF.G >= MINIMUM_TN).all()
+        assert MSE['block'] < 0.1 * R.var() and abs(MSE['block'] - MSE['coordinate']) < 0.01 * R.var()
+
+
+""" Test pruning the components that ARD has switched off. """
+def test_prune():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    with pytest.raises(AssertionError) as error:
+        BNMTF = nmtf_icm(R,M,K,L,False,dict(hyperparams,lambdaF=1.,lambdaG=1.))
+        BNMTF.train('exp','exp',2,prune=True)
+    assert str(error.value) == "Pruning components is only possible when using ARD."
+    
+    # With an infinite threshold, all but the largest component are removed after patience iterations
+    BNMTF = nmtf_icm(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',10,prune={'threshold':numpy.inf,'patience':3})
+    assert 'pruning' in BNMTF.profile_phases
+    pruned_F = [k for (it,k) in BNMTF.pruned_components['F']]
+    pruned_G = [l for (it,l) in BNMTF.pruned_components['G']]
+    assert BNMTF.K == 1 and BNMTF.L == 1 and len(pruned_F) == K-1 and len(pruned_G) == L-1
+    assert all([it == 2 for (it,_) in BNMTF.pruned_components['F'] + BNMTF.pruned_components['G']])
+    assert BNMTF.F.shape == (I,1) and BNMTF.S.shape == (1,1) and BNMTF.G.shape == (J,1)
+    assert BNMTF.lambdaFk.shape == (1,) and BNMTF.lambdaGl.shape == (1,) and BNMTF.lambdaS.shape == (1,1)
+    
+    # The traces keep all components, with zeros for the pruned ones from then on
+    assert BNMTF.all_F.shape == (10,I,K) and BNMTF.all_S.shape == (10,K,L) and BNMTF.all_G.shape == (10,J,L)
+    assert (BNMTF.all_F[2:,:,pruned_F] == 0.).all() and (BNMTF.all_F[:2,:,pruned_F] > 0.).all()
+    assert (BNMTF.all_G[2:,:,pruned_G] == 0.).all() and (BNMTF.all_lambdaGl[2:,pruned_G] == 0.).all()
+    assert (BNMTF.all_S[2:,pruned_F,:] == 0.).all() and (BNMTF.all_S[2:,:,pruned_G] == 0.).all()
+    
+    # So we can still predict using the traces
+    assert BNMTF.predict(M,2,1)['MSE'] >= 0.
+
+    
+    
+""" Test accelerating the iterations with SQUAREM and Anderson acceleration. """
+def test_accelerate():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    alphatau, betatau = 3, 1
+    alpha0, beta0 = 6, 2
+    hyperparams = { 'alphatau':alphatau, 'betatau':betatau, 'alpha0':alpha0, 'beta0':beta0, 'lambdaS':1. }
+    with pytest.raises(AssertionError) as error:
+        nmtf_icm(R,M,K,L,True,hyperparams).train('exp','exp',5,prune=True,accelerate='squarem')
+    assert str(error.value) == "Components can not be pruned when accelerating the iterations."
+    
+    numpy.random.seed(0)
+    plain = nmtf_icm(R,M,K,L,True,hyperparams,engine='block')
+    plain.train('exp','exp',30)
+    assert plain.all_sweeps == range(1,31) and len(plain.all_log_posterior) == 30
+    assert plain.log_posterior() == plain.all_log_posterior[-1]
+    assert all([plain.all_log_posterior[it+1] >= plain.all_log_posterior[it] - 1e-8 for it in range(29)])
+    
+    for accelerate in ['squarem','anderson']:
+        numpy.random.seed(0)
+        BNMTF = nmtf_icm(R,M,K,L,True,hyperparams,engine='block')
+        BNMTF.train('exp','exp',10,accelerate=accelerate)
+        assert all([BNMTF.all_log_posterior[it+1] >= BNMTF.all_log_posterior[it] - 1e-8 for it in range(9)])
+        assert (BNMTF.F >= 0.).all() and (BNMTF.S >= 0.).all() and (BNMTF.G >= 0.).all() and BNMTF.tau > 0.
+        assert len(BNMTF.all_sweeps) == 10 and BNMTF.all_sweeps[-1] == BNMTF.accelerator.sweeps >= 10
+    
+    
+""" Test initialising F, S, and G with NNDSVD. """
+def test_initialise_nndsvd():
+    I,J,K,L = 10,5,2,3
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,2)),numpy.random.exponential(size=(J,2)).T)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alphatau':3, 'betatau':1, 'lambdaF':1., 'lambdaS':1., 'lambdaG':1. }
+    with pytest.raises(AssertionError) as error:
+        nmtf_icm(R,M,K,L,False,priors).initialise('random','nndsvd')
+    assert str(error.value) == "S can only be initialised with NNDSVD if F and G are as well."
+    
+    MSEs = {}
+    for init_FG, init_S in [('exp','exp'),('nndsvd','nndsvd'),('nndsvd-iterative','nndsvd')]:
+        BNMTF = nmtf_icm(R,M,K,L,False,priors)
+        BNMTF.initialise(init_FG,init_S)
+        (F, S, G) = (BNMTF.F, BNMTF.S, BNMTF.G)
+        assert F.min() > 0. and S.min() > 0. and G.min() > 0. and BNMTF.tau > 0.
+        MSEs[init_FG] = (M * (R - numpy.dot(F,numpy.dot(S,G.T)))**2).sum() / M.sum()
+    assert MSEs['nndsvd'] < MSEs['exp'] and MSEs['nndsvd-iterative'] < MSEs['exp']
+    
+    
+""" Test stopping at a time budget, with the traces truncated to the completed iterations. """
+def test_time_budget():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':3, 'betatau':1, 'alpha0':6, 'beta0':2, 'lambdaS':1. }
+    BNMTF = nmtf_icm(R,M,K,L,True,hyperparams)
+    BNMTF.train('exp','exp',None,time_budget=0.2)
+    iterations = BNMTF.budget['iterations']
+    assert BNMTF.budget['exhausted'] and BNMTF.budget['time_used'] < 1. and iterations == len(BNMTF.all_log_posterior)
+    assert BNMTF.all_F.shape == (iterations,I,K) and BNMTF.all_S.shape == (iterations,K,L) and BNMTF.all_G.shape == (iterations,J,L)
+    assert numpy.array_equal(BNMTF.all_G[-1],BNMTF.G)
+    
+    BNMTF.run(10,time_budget=60.)
+    assert BNMTF.budget['iterations'] == 10 and not BNMTF.budget['exhausted'] and BNMTF.all_F.shape == (10,I,K)
+
+    
+""" Test skipping the columns of F and G, and entries of S, that have converged, with active-set scheduling. """
+def test_active_set():
+    I,J,K,L = 10,5,2,3
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    hyperparams = { 'alphatau':1., 'betatau':1., 'alpha0':1., 'beta0':1., 'lambdaF':1., 'lambdaS':1., 'lambdaG':1. }
+    numpy.random.seed(1)
+    BNMTF = nmtf_icm(R,M,K,L,False,hyperparams)
+    BNMTF.train('exp','exp',100,active_set={'tolerance':1e-2,'wake':0.1})
+    updated, skipped = BNMTF.active_updates['updated'], BNMTF.active_updates['skipped']
+    assert skipped['F'] > 0 and skipped['S'] > 0 and skipped['G'] > 0
+    assert updated['F'] + skipped['F'] == 100*K and updated['S'] + skipped['S'] == 100*K*L and updated['G'] + skipped['G'] == 100*L
+    
+    numpy.random.seed(1)
+    plain = nmtf_icm(R,M,K,L,False,hyperparams)
+    plain.train('exp','exp',100)
+    assert plain.active_updates is None
+    assert abs(BNMTF.all_performances['MSE'][-1] - plain.all_performances['MSE'][-1]) < 0.1 * plain.all_performances['MSE'][-1]
+    
+    with pytest.raises(AssertionError) as error:
+        nmtf_icm(R,M,K,L,False,hyperparams,engine='block').train('exp','exp',10,active_set=True)
+    assert str(error.value) == "Active-set scheduling is only possible with the coordinate engine, not block."
+    with pytest.raises(AssertionError) as error:
+        BNMTF.run(10,accelerate='squarem',active_set=True)
+    assert str(error.value) == "Active-set scheduling can not be combined with pruning or acceleration."
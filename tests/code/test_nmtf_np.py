@@ -289,4 +289,346 @@ def test_compute_statistics():
     
     assert MSE_pred == nmtf.compute_MSE(M_pred,R,R_pred)
     assert R2_pred == nmtf.compute_R2(M_pred,R,R_pred)
-    assert Rp_pred == nmtf.compute_Rp(M_pred,R,R_pred)
\ No newline at end of file
+    assert Rp_pred == nmtf.compute_Rp(M_pred,R,R_pred)
+    
+    
+""" Test folding in new rows and columns, keeping the trained factors fixed. """
+def test_fold_in():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    nmtf = nmtf_np(R,M,K,L)
+    nmtf.train(10)
+    G = numpy.copy(nmtf.G)
+    
+    R_new, M_new = 2*numpy.ones((3,J)), numpy.ones((3,J))
+    M_new[0,1] = 0
+    F_new = nmtf.fold_in_rows(R_new,M_new,10)
+    assert F_new.shape == (3,K)
+    assert (F_new >= 0.).all()
+    assert numpy.array_equal(nmtf.G,G)
+    
+    G_new = nmtf.fold_in_columns(numpy.ones((I,4)),numpy.ones((I,4)),10)
+    assert G_new.shape == (4,L)
+    assert (G_new >= 0.).all()
+    
+    # New data should match the trained model, with no fully unobserved rows or columns
+    with pytest.raises(AssertionError) as error:
+        nmtf.fold_in_rows(numpy.ones((3,J+1)),numpy.ones((3,J+1)),10)
+    assert str(error.value) == "New matrix R_new has the wrong shape: (3, 6), while the trained model has 5 columns."
+    M_new = numpy.ones((I,2))
+    M_new[:,1] = 0
+    with pytest.raises(AssertionError) as error:
+        nmtf.fold_in_columns(numpy.ones((I,2)),M_new,10)
+    assert str(error.value) == "Fully unobserved column in R_new, column 1."
+
+
+""" Test adding new observations, and refining from the current state. """
+def test_update_data_refine():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    nmtf = nmtf_np(R,M,K,L)
+    nmtf.train(10)
+    
+    nmtf.update_data([(0,0,2.),(2,2,1.),(0,1,4.)])
+    assert nmtf.M[0,0] == 1. and nmtf.M[2,2] == 1.
+    assert nmtf.R[0,0] == 2. and nmtf.R[0,1] == 4.
+    assert nmtf.R_excl_unknown[0,0] == 2.
+    assert nmtf.touched_rows == [0,2] and nmtf.touched_columns == [0,1,2]
+    
+    nmtf.refine(5,local_sweeps=2)
+    assert nmtf.touched_rows == [] and nmtf.touched_columns == []
+    assert (nmtf.F >= 0.).all() and (nmtf.G >= 0.).all()
+    assert len(nmtf.all_performances['MSE']) == 5
+    
+    with pytest.raises(AssertionError) as error:
+        nmtf.update_data([(I,0,1.)])
+    assert str(error.value) == "New entry (10,0) lies outside of R, which has shape (10, 5)."
+
+
+""" Test that the local sweeps and folding in use the solver and objective of training. """
+def test_update_rows_solver():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    # Sweeping over all rows is the same as one update of F in training
+    for (solver,objective) in [('columns','I-div'),('columns','Frobenius'),('matrix','I-div'),('matrix','Frobenius'),('hals','Frobenius')]:
+        numpy.random.seed(0)
+        nmtf = nmtf_np(R,M,K,L,solver=solver,objective=objective)
+        nmtf.train(3)
+        F, G = numpy.copy(nmtf.F), numpy.copy(nmtf.G)
+        nmtf.touched_rows = range(I)
+        nmtf.sweep_touched()
+        F_swept = numpy.copy(nmtf.F)
+        nmtf.F = F
+        if solver == 'hals':
+            nmtf.update_F_hals()
+        elif solver == 'matrix':
+            nmtf.update_F_matrix()
+        else:
+            for k in range(K):
+                nmtf.update_F(k)
+        assert numpy.allclose(F_swept,nmtf.F) and numpy.array_equal(nmtf.G,G)
+    
+    # Folding in the training data with HALS fits at least as well as with the I-divergence updates
+    numpy.random.seed(0)
+    F_hals = nmtf.fold_in_rows(R,M,10)
+    nmtf.solver, nmtf.objective = 'columns', 'I-div'
+    numpy.random.seed(0)
+    F_multiplicative = nmtf.fold_in_rows(R,M,10)
+    error = lambda F: (M * (R - nmtf.triple_dot(F,nmtf.S,nmtf.G.T))**2).sum()
+    assert error(F_hals) <= error(F_multiplicative)
+
+
+""" Test saving and loading the model, and continuing from the loaded state. """
+def test_save_load(tmpdir):
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    nmtf = nmtf_np(R,M,K,L)
+    nmtf.train(10)
+    path = str(tmpdir.join('model'))
+    nmtf.save(path)
+    
+    loaded = nmtf_np.load(path)
+    assert numpy.array_equal(loaded.F,nmtf.F)
+    assert numpy.array_equal(loaded.S,nmtf.S)
+    assert numpy.array_equal(loaded.G,nmtf.G)
+    assert loaded.all_performances['MSE'] == nmtf.all_performances['MSE']
+    assert loaded.predict(M)['MSE'] == nmtf.predict(M)['MSE']
+    
+    # We can continue running the loaded model
+    loaded.run(2)
+    
+    # The mask should match its fingerprint
+    numpy.save(path+'/M.npy',numpy.ones((I,J)))
+    with pytest.raises(AssertionError) as error:
+        nmtf_np.load(path)
+    assert str(error.value) == "Mask M in %s does not match the fingerprint in its metadata." % path
+
+
+""" Test predicting individual entries and rows. """
+def test_predict_entries_rows():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    nmtf = nmtf_np(R,M,K,L)
+    nmtf.train(10)
+    
+    rows, cols = [0,3,9], [1,4,0]
+    R_pred = numpy.dot(nmtf.F,numpy.dot(nmtf.S,nmtf.G.T))
+    assert numpy.allclose(nmtf.predict_entries(rows,cols),R_pred[rows,cols])
+    assert numpy.allclose(nmtf.predict_rows([2,5]),R_pred[[2,5]])
+    
+    # The cached G S.T is recomputed when we run the model again
+    old_GS = nmtf.cached_GS()
+    nmtf.run(1)
+    assert numpy.allclose(nmtf.cached_GS(),numpy.dot(nmtf.G,nmtf.S.T))
+    assert not numpy.allclose(nmtf.cached_GS(),old_GS)
+
+""" Test the timings and counts of the phases in the run loop. """
+def test_profile():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    nmtf = nmtf_np(R,M,K,L)
+    nmtf.train(10)
+    
+    # Each phase is timed once per iteration
+    assert nmtf.profile_phases == ['F', 'S', 'G', 'performance']
+    assert all([nmtf.profile[phase]['calls'] == 10 for phase in ['F', 'S', 'G', 'performance']])
+    assert all([nmtf.profile[phase]['time'] >= 0. and nmtf.profile[phase]['memory'] >= 0 for phase in nmtf.profile_phases])
+    
+    # Profiling can be switched off
+    nmtf.run(2,profile=False)
+    assert nmtf.profile is None and nmtf.profile_phases == []
+
+
+""" Test the matrix-form updates and the Frobenius objective. """
+def test_matrix_solver(tmpdir):
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    with pytest.raises(AssertionError) as error:
+        nmtf_np(R,M,K,L,solver='rows')
+    assert str(error.value) == "Unrecognised solver: rows. Should be one in ['columns', 'matrix', 'hals']."
+    with pytest.raises(AssertionError) as error:
+        nmtf_np(R,M,K,L,objective='KL')
+    assert str(error.value) == "Unrecognised objective: KL. Should be one in ['I-div', 'Frobenius']."
+    
+    # The matrix updates give the same F, S and G as the column updates when K = L = 1
+    for objective in ['I-div','Frobenius']:
+        numpy.random.seed(0)
+        nmtf_columns = nmtf_np(R,M,1,1,objective=objective)
+        nmtf_columns.initialise()
+        nmtf_matrix = nmtf_np(R,M,1,1,solver='matrix',objective=objective)
+        nmtf_matrix.F, nmtf_matrix.S, nmtf_matrix.G = nmtf_columns.F.copy(), nmtf_columns.S.copy(), nmtf_columns.G.copy()
+        nmtf_columns.update_F(0)
+        R_pred = nmtf_matrix.update_F_matrix()
+        assert numpy.allclose(nmtf_matrix.F,nmtf_columns.F)
+        nmtf_columns.update_S(0,0)
+        R_pred = nmtf_matrix.update_S_matrix(R_pred)
+        assert numpy.allclose(nmtf_matrix.S,nmtf_columns.S)
+        nmtf_columns.update_G(0)
+        R_pred = nmtf_matrix.update_G_matrix(R_pred)
+        assert numpy.allclose(nmtf_matrix.G,nmtf_columns.G)
+        assert numpy.allclose(R_pred,numpy.dot(nmtf_columns.F,numpy.dot(nmtf_columns.S,nmtf_columns.G.T)))
+    
+    # The objective never increases, and is computed from the reused F S G.T
+    for solver in ['columns','matrix']:
+        for objective in ['I-div','Frobenius']:
+            numpy.random.seed(0)
+            nmtf = nmtf_np(R,M,K,L,solver=solver,objective=objective)
+            nmtf.train(10)
+            assert len(nmtf.all_objective) == 10
+            assert all([nmtf.all_objective[it+1] <= nmtf.all_objective[it] + 1e-12 for it in range(9)])
+            final = nmtf.compute_I_div() if objective == 'I-div' else nmtf.compute_frobenius()
+            assert abs(nmtf.all_objective[-1] - final) < 1e-10
+    
+    # The solver and objective are saved with the model
+    nmtf = nmtf_np(R,M,K,L,solver='matrix',objective='Frobenius')
+    nmtf.train(2)
+    path = str(tmpdir.join('model'))
+    nmtf.save(path)
+    loaded = nmtf_np.load(path)
+    assert loaded.solver == 'matrix' and loaded.objective == 'Frobenius'
+    assert loaded.all_objective == nmtf.all_objective
+
+
+""" Test the HALS solver. """
+def test_hals():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    
+    with pytest.raises(AssertionError) as error:
+        nmtf_np(R,M,K,L,solver='hals')
+    assert str(error.value) == "The HALS solver minimises the Frobenius objective, not the I-div."
+    
+    numpy.random.seed(0)
+    nmtf = nmtf_np(R,M,K,L,solver='hals',objective='Frobenius')
+    nmtf.train(10)
+    assert all([nmtf.all_objective[it+1] <= nmtf.all_objective[it] + 1e-12 for it in range(9)])
+    assert numpy.all(nmtf.F > 0.) and numpy.all(nmtf.S > 0.) and numpy.all(nmtf.G > 0.)
+    assert nmtf.profile_phases == ['F', 'S', 'G', 'performance']
+    
+    # HALS fits at least as well as the multiplicative updates from the same initialisation
+    numpy.random.seed(0)
+    nmtf_multiplicative = nmtf_np(R,M,K,L,solver='matrix',objective='Frobenius')
+    nmtf_multiplicative.train(10)
+    assert nmtf.all_objective[-1] <= nmtf_multiplicative.all_objective[-1]
+
+    
+    
+""" Test accelerating the updates with SQUAREM and Anderson acceleration. """
+def test_accelerate():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    R[0,1], R[0,2] = 2., 3.
+    with pytest.raises(AssertionError) as error:
+        nmtf_np(R,M,K,L).train(5,accelerate='newton')
+    assert str(error.value) == "Unrecognised acceleration: newton. Should be one in ['squarem', 'anderson']."
+    
+    numpy.random.seed(0)
+    plain = nmtf_np(R,M,K,L,solver='matrix')
+    plain.train(100)
+    assert plain.all_sweeps == range(1,101)
+    for accelerate in ['squarem','anderson']:
+        numpy.random.seed(0)
+        nmtf = nmtf_np(R,M,K,L,solver='matrix')
+        nmtf.train(10,accelerate=accelerate)
+        assert all([nmtf.all_objective[it+1] <= nmtf.all_objective[it] + 1e-10 for it in range(9)])
+        assert numpy.all(nmtf.F > 0.) and numpy.all(nmtf.S > 0.) and numpy.all(nmtf.G > 0.)
+        assert len(nmtf.all_sweeps) == 10 and nmtf.all_sweeps[-1] == nmtf.accelerator.sweeps >= 10
+        # The accelerated updates fit at least as well as the plain ones with the same number of sweeps
+        assert nmtf.all_objective[-1] <= plain.all_objective[nmtf.all_sweeps[-1]-1] + 1e-10
+    
+    
+""" Test initialising F, S, and G with NNDSVD. """
+def test_initialise_nndsvd():
+    I,J,K,L = 10,5,2,3
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,2)),numpy.random.exponential(size=(J,2)).T)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alphatau':3, 'betatau':1, 'lambdaF':1., 'lambdaS':1., 'lambdaG':1. }
+    with pytest.raises(AssertionError) as error:
+        nmtf_np(R,M,K,L).initialise('random','nndsvd')
+    assert str(error.value) == "S can only be initialised with NNDSVD if F and G are as well."
+    
+    MSEs = {}
+    for init_FG, init_S in [('ones','ones'),('nndsvd','nndsvd'),('nndsvd-iterative','nndsvd')]:
+        NMTF = nmtf_np(R,M,K,L)
+        NMTF.initialise(init_FG,init_S)
+        (F, S, G) = (NMTF.F, NMTF.S, NMTF.G)
+        assert F.min() > 0. and S.min() > 0. and G.min() > 0.
+        MSEs[init_FG] = (M * (R - numpy.dot(F,numpy.dot(S,G.T)))**2).sum() / M.sum()
+    assert MSEs['nndsvd'] < MSEs['ones'] and MSEs['nndsvd-iterative'] < MSEs['ones']
+    
+    
+""" Test stopping at a time budget. """
+def test_time_budget():
+    I,J,K,L = 10,5,2,3
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    nmtf = nmtf_np(R,M,K,L)
+    nmtf.train(None,time_budget=0.2)
+    assert nmtf.budget['exhausted'] and nmtf.budget['time_used'] < 1. and nmtf.budget['iterations'] == len(nmtf.all_times) > 0
+    
+    nmtf.run(10,time_budget=60.)
+    assert nmtf.budget['iterations'] == 10 and not nmtf.budget['exhausted'] and len(nmtf.all_times) == 10
+
+    
+""" Test skipping the columns of F and G, and entries of S, that have converged, with active-set scheduling. """
+def test_active_set():
+    I,J,K,L = 10,5,2,3
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    numpy.random.seed(1)
+    nmtf = nmtf_np(R,M,K,L)
+    nmtf.train(100,active_set={'tolerance':1e-2,'wake':0.1})
+    updated, skipped = nmtf.active_updates['updated'], nmtf.active_updates['skipped']
+    assert skipped['F'] > 0 and skipped['S'] > 0 and skipped['G'] > 0
+    assert updated['F'] + skipped['F'] == 100*K and updated['S'] + skipped['S'] == 100*K*L and updated['G'] + skipped['G'] == 100*L
+    
+    numpy.random.seed(1)
+    plain = nmtf_np(R,M,K,L)
+    plain.train(100)
+    assert plain.active_updates is None
+    assert abs(nmtf.all_performances['MSE'][-1] - plain.all_performances['MSE'][-1]) < 0.1 * plain.all_performances['MSE'][-1]
+    
+    with pytest.raises(AssertionError) as error:
+        nmtf_np(R,M,K,L,solver='matrix').train(10,active_set=True)
+    assert str(error.value) == "Active-set scheduling is only possible with the columns solver, not matrix."
+    with pytest.raises(AssertionError) as error:
+        nmtf.run(10,accelerate='squarem',active_set=True)
+    assert str(error.value) == "Active-set scheduling can not be combined with acceleration."
@@ -0,0 +1,99 @@
+"""
+Test the NNDSVD initialisation in nndsvd.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.nndsvd import use_sparse, mean_imputation, ImputedMatrix, impute, randomized_svd, nndsvd, \
+    fill_value, nndsvd_factors, nndsvd_tri_factors, nndsvd_precision, OPTIONS_NNDSVD
+
+import numpy, pytest
+
+
+def low_rank_data(I=20,J=15,K=3,fraction=0.2):
+    ''' Return a nonnegative rank K matrix R, and a mask M with about fraction of the entries missing. '''
+    numpy.random.seed(0)
+    R = numpy.dot(numpy.random.exponential(size=(I,K)),numpy.random.exponential(size=(J,K)).T)
+    M = (numpy.random.rand(I,J) > fraction).astype(float)
+    M[:,0], M[0,:] = 1., 1.
+    return (R, M)
+
+
+""" Test the mean imputation and the products with the imputed matrix, dense and sparse. """
+def test_imputed_matrix():
+    R = numpy.array([[1.,2.],[3.,4.],[5.,6.]])
+    M = numpy.array([[1.,1.],[1.,0.],[0.,1.]])
+    assert use_sparse(M) == False and use_sparse(M,True) == True and use_sparse(numpy.zeros((20,20))) == True
+    
+    (A, B) = mean_imputation(R,M)
+    assert numpy.allclose(numpy.dot(A,B.T),[[1.75,2.75],[2.5,3.5],[4.,5.]]) # (row mean + column mean) / 2
+    for sparse in [False,True]:
+        X = ImputedMatrix(R,M,A,B,sparse=sparse)
+        expected = M * R + (1-M) * numpy.dot(A,B.T)
+        Y = numpy.arange(6.).reshape(2,3)
+        assert numpy.allclose(X.dot(Y),numpy.dot(expected,Y)) and numpy.allclose(X.rdot(Y.T),numpy.dot(expected.T,Y.T))
+        assert abs(X.mean() - expected.mean()) < 1e-12
+        
+    with pytest.raises(AssertionError) as error:
+        impute(R,M,1,'svd')
+    assert str(error.value) == "Unrecognised NNDSVD initialisation: svd. Should be one in ['nndsvd', 'nndsvd-iterative']."
+    
+    
+""" Test the randomized SVD against the exact one, and the iterative imputation. """
+def test_randomized_svd():
+    (R, M) = low_rank_data()
+    X = impute(R,numpy.ones(R.shape),3)
+    (P, s, Q) = randomized_svd(X,3)
+    assert P.shape == (20,3) and s.shape == (3,) and Q.shape == (15,3)
+    assert numpy.allclose(s,numpy.linalg.svd(R,compute_uv=False)[:3]) and numpy.allclose(numpy.dot(P*s,Q.T),R)
+    
+    # Iterative imputation recovers the missing entries of a low rank matrix better than the means
+    errors = []
+    for init in OPTIONS_NNDSVD:
+        (P, s, Q) = randomized_svd(impute(R,M,3,init),3)
+        errors.append((((1-M) * (R - numpy.dot(P*s,Q.T)))**2).sum())
+    assert errors[1] < errors[0]
+    
+    
+""" Test the nonnegative factors of NNDSVD. """
+def test_nndsvd():
+    # A rank one nonnegative matrix is recovered exactly, whatever the signs of the singular vectors
+    x, y = numpy.array([1.,2.,3.]), numpy.array([4.,5.])
+    (P, s, QT) = numpy.linalg.svd(numpy.outer(x,y))
+    for sign in [1.,-1.]:
+        (W, H) = nndsvd(sign*P[:,:1],s[:1],sign*QT[:1].T,1e-3)
+        assert numpy.allclose(numpy.dot(W,H.T),numpy.outer(x,y))
+        
+    # The zeros are filled, and a component with opposite signs in the left and right vectors is all zeros
+    P, s, Q = numpy.eye(2), numpy.array([2.,1.]), numpy.eye(2)
+    (W, H) = nndsvd(P,s,Q,0.1)
+    assert numpy.allclose(W,[[2**0.5,0.1],[0.1,1.]]) and numpy.allclose(H,[[2**0.5,0.1],[0.1,1.]])
+    (W, H) = nndsvd(P,s,numpy.diag([1.,-1.]),0.1)
+    assert numpy.allclose(W[:,1],0.1) and numpy.allclose(H[:,1],0.1)
+    
+    
+""" Test the initialisations of NMF and NMTF. """
+def test_nndsvd_factors():
+    (R, M) = low_rank_data()
+    for init in OPTIONS_NNDSVD:
+        for sparse in [False,True]:
+            numpy.random.seed(1)
+            (U, V) = nndsvd_factors(R,M,3,init,sparse)
+            assert U.shape == (20,3) and V.shape == (15,3) and U.min() > 0. and V.min() > 0.
+            assert ((M * (R - numpy.dot(U,V.T)))**2).sum() < 0.2 * ((M * (R - (M*R).sum()/M.sum()))**2).sum()
+            
+            numpy.random.seed(1)
+            (F, S, G) = nndsvd_tri_factors(R,M,3,2,init,sparse)
+            assert F.shape == (20,3) and S.shape == (3,2) and G.shape == (15,2) and F.min() > 0. and S.min() > 0. and G.min() > 0.
+            assert ((M * (R - numpy.dot(F,numpy.dot(S,G.T))))**2).sum() < 0.5 * ((M * (R - (M*R).sum()/M.sum()))**2).sum()
+    
+    # The fill value is a small fraction of the typical entry
+    X = impute(R,M,3)
+    assert abs(fill_value(X,3) - 0.01 * (X.mean() / 3.)**0.5) < 1e-12
+    
+    
+""" Test the precision of the truncated normals of the VB models. """
+def test_nndsvd_precision():
+    assert abs(nndsvd_precision(numpy.array([[1.,3.],[2.,2.]])) - 25.) < 1e-10 # standard deviation 0.1 * 2
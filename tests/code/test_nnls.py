@@ -0,0 +1,82 @@
+"""
+Test the batched projected Newton solver for non-negative least squares in nnls.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.nnls import batched_nnls, nnls_objective
+
+import numpy, itertools, pytest
+
+
+def brute_force_nnls(G,b):
+    ''' Solve min_{x >= 0} 1/2 x.T G x - b.T x by trying all supports. '''
+    K = len(b)
+    best_objective, best_x = 0., numpy.zeros(K)
+    for size in range(1,K+1):
+        for support in itertools.combinations(range(K),size):
+            support = list(support)
+            x = numpy.zeros(K)
+            x[support] = numpy.linalg.solve(G[numpy.ix_(support,support)],b[support])
+            objective = 0.5*numpy.dot(x,numpy.dot(G,x)) - numpy.dot(b,x)
+            if (x >= 0).all() and objective < best_objective:
+                best_objective, best_x = objective, x
+    return best_x
+
+
+""" Test the objective. """
+def test_nnls_objective():
+    G = numpy.array([[[2.,1.],[1.,3.]]])
+    b = numpy.array([[1.,2.]])
+    x = numpy.array([[1.,2.]])
+    assert numpy.array_equal(nnls_objective(G,b,x),[0.5*(2.+4.+12.) - 5.])
+
+
+""" Test the solutions against trying all supports. """
+def test_batched_nnls():
+    numpy.random.seed(0)
+    N,K = 200,4
+    A = numpy.random.randn(N,8,K)
+    G = numpy.einsum('nik,nil->nkl',A,A)
+    b = 2.*numpy.random.randn(N,K)
+    x = batched_nnls(G,b)
+    assert x.shape == (N,K) and (x >= 0.).all()
+    for n in range(N):
+        assert numpy.abs(x[n] - brute_force_nnls(G[n],b[n])).max() < 1e-10
+        
+    # Starting from a given point gives the same solutions
+    assert numpy.abs(batched_nnls(G,b,numpy.random.rand(N,K)) - x).max() < 1e-10
+    
+    # Singular problems are fine, as long as they are bounded
+    G = numpy.zeros((2,2,2))
+    G[:,0,0] = 1.
+    b = numpy.array([[2.,-1.],[-1.,0.]])
+    assert numpy.abs(batched_nnls(G,b) - [[2.,0.],[0.,0.]]).max() < 1e-10
+    
+    # Nearly singular problems with a gradient outside the range of G, e.g. from two equal columns of V
+    V = numpy.ones((10,3))
+    G = numpy.dot(V.T,V)[numpy.newaxis]
+    b = numpy.array([[10.,9.,8.]]) - 0.1
+    x = batched_nnls(G,b)
+    gradient = numpy.dot(G[0],x[0]) - b[0]
+    assert (numpy.abs(gradient[x[0] > 0.]) < 1e-8).all() and (gradient[x[0] == 0.] >= -1e-8).all()
+    
+    with pytest.raises(AssertionError) as error:
+        batched_nnls(numpy.ones((2,3,3)),numpy.ones((2,2)))
+    assert str(error.value) == "Matrices G should be of shape (2, 2, 2), not (2, 3, 3)."
+
+
+""" Test the solutions with a lower bound, against shifting the problems by hand. """
+def test_batched_nnls_lower():
+    numpy.random.seed(1)
+    N,K,lower = 50,3,0.1
+    A = numpy.random.randn(N,8,K)
+    G = numpy.einsum('nik,nil->nkl',A,A)
+    b = 2.*numpy.random.randn(N,K)
+    x = batched_nnls(G,b,lower=lower)
+    assert (x >= lower).all() and (x == lower).any()
+    for n in range(N):
+        assert numpy.abs(x[n] - lower - brute_force_nnls(G[n],b[n]-lower*G[n].sum(axis=1))).max() < 1e-10
+    assert numpy.abs(batched_nnls(G,b,numpy.random.rand(N,K)+lower,lower=lower) - x).max() < 1e-10
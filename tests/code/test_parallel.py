@@ -0,0 +1,48 @@
+"""
+Test splitting the updates of the rows over threads in parallel.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.parallel import split_blocks, create_row_blocks, RowBlocks, SerialBlocks
+
+import numpy, pytest, threading
+
+
+""" Test splitting a dimension into blocks. """
+def test_split_blocks():
+    assert split_blocks(10,3) == [slice(0,3),slice(3,6),slice(6,10)]
+    assert split_blocks(2,4) == [slice(0,1),slice(1,2)]
+    assert split_blocks(5,1) == [slice(0,5)]
+
+
+""" Test running a function on each block in a thread. """
+def test_row_blocks():
+    with pytest.raises(AssertionError) as error:
+        create_row_blocks((4,3),0)
+    assert str(error.value) == "Number of threads should be at least 1, not 0."
+    assert isinstance(create_row_blocks((4,3),1),SerialBlocks)
+    
+    numpy.random.seed(0)
+    blocks = create_row_blocks((7,2),3)
+    assert isinstance(blocks,RowBlocks) and len(blocks.blocks[0]) == 3 and len(blocks.blocks[1]) == 2
+    A, names = numpy.zeros((7,2)), set()
+    def fill(rows,rng):
+        A[rows] = rng.uniform(size=(A[rows].shape[0],2))
+        names.add(threading.current_thread().name)
+        return rows.stop - rows.start
+    assert blocks.map(0,fill) == [2,2,3]
+    assert (A > 0.).all() and threading.current_thread().name not in names
+    
+    # The random states are fixed per block, and seeded from numpy.random
+    numpy.random.seed(0)
+    B = numpy.zeros((7,2))
+    other_blocks = create_row_blocks((7,2),3)
+    other_blocks.map(0,lambda rows,rng: B.__setitem__(rows,rng.uniform(size=(B[rows].shape[0],2))))
+    assert numpy.array_equal(A,B)
+    blocks.close(), other_blocks.close()
+    
+    # Without threads, the function is called once for all rows
+    assert SerialBlocks().map(1,lambda rows,rng: (rows,rng)) == [(slice(None),None)]
@@ -0,0 +1,50 @@
+"""
+Test the methods for saving and loading models in persistence.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.persistence import mask_fingerprint, save_model, load_model, FORMAT_VERSION, METADATA_FILE
+from BNMTF_ARD.code.models.nmf_np import nmf_np
+
+import numpy, json, pytest
+
+
+""" Test the fingerprint of the mask. """
+def test_mask_fingerprint():
+    M = numpy.ones((3,2))
+    assert mask_fingerprint(M) == mask_fingerprint(numpy.ones((3,2),dtype=int))
+    M[0,1] = 0.
+    assert mask_fingerprint(M) != mask_fingerprint(numpy.ones((3,2)))
+    
+    
+""" Test saving a model, and loading the stored values. """
+def test_save_load_model(tmpdir):
+    R, M = numpy.ones((3,2)), numpy.ones((3,2))
+    NMF = nmf_np(R,M,2)
+    NMF.train(3)
+    path = str(tmpdir.join('model'))
+    
+    # The traces are not memory-mapped if mmap_traces is False, and attributes that are not set are skipped
+    save_model(NMF,path,['K'],[],['U','V','unknown'],['all_times','all_performances'],{'exp_U':NMF.U,'exp_lambdak':None})
+    metadata, values = load_model(path,'nmf_np',mmap_traces=False)
+    assert metadata['format_version'] == FORMAT_VERSION
+    assert metadata['class'] == 'nmf_np' and metadata['dimensions'] == {'K':2}
+    assert sorted(metadata['state']['arrays']) == ['U','V'] and metadata['state']['scalars'] == {}
+    assert numpy.array_equal(values['data']['R'],R) and numpy.array_equal(values['data']['M'],M)
+    assert numpy.array_equal(values['state']['U'],NMF.U) and numpy.array_equal(values['state']['V'],NMF.V)
+    assert values['summaries'].keys() == ['exp_U']
+    assert values['traces']['all_times'] == NMF.all_times
+    
+    # The class and format version should match
+    with pytest.raises(AssertionError) as error:
+        load_model(path,'nmtf_np')
+    assert str(error.value) == "Model in %s is a nmf_np model, not nmtf_np." % path
+    
+    metadata['format_version'] = FORMAT_VERSION + 1
+    json.dump(metadata,open(os.path.join(path,METADATA_FILE),'w'))
+    with pytest.raises(AssertionError) as error:
+        load_model(path,'nmf_np')
+    assert str(error.value) == "Model in %s has format version %s, but we can only load up to version %s." % (path,FORMAT_VERSION+1,FORMAT_VERSION)
@@ -0,0 +1,49 @@
+"""
+Test the helpers for the posterior predictive distribution in predictive.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.predictive import RunningMoments, noise_variance, predictive_summary
+
+import numpy, pytest
+
+
+""" Test accumulating the mean and variance one draw at a time. """
+def test_running_moments():
+    draws = numpy.array([[1.,2.],[3.,2.],[8.,2.],[4.,2.]])
+    moments = RunningMoments()
+    with pytest.raises(AssertionError) as error:
+        moments.variance()
+    assert str(error.value) == "Cannot compute the variance of zero draws."
+    
+    for draw in draws:
+        moments.add(draw)
+    assert moments.n == 4
+    assert numpy.allclose(moments.mean,draws.mean(axis=0))
+    assert numpy.allclose(moments.variance(),draws.var(axis=0))
+    
+    
+""" Test the expectation of the noise variance. """
+def test_noise_variance():
+    assert noise_variance(3.,4.) == 2.
+    with pytest.raises(AssertionError) as error:
+        noise_variance(1.,4.)
+    assert str(error.value) == "E[1/tau] is only defined for alpha > 1, but alpha = 1.0."
+    
+    
+""" Test the summary with credible intervals. """
+def test_predictive_summary():
+    mean, variance = numpy.array([1.,2.]), numpy.array([4.,1.])
+    summary = predictive_summary(mean,variance)
+    assert sorted(summary.keys()) == ['mean','variance']
+    
+    summary = predictive_summary(mean,variance,credible=0.95)
+    assert numpy.allclose(summary['lower'],[1.-1.959964*2.,2.-1.959964])
+    assert numpy.allclose(summary['upper'],[1.+1.959964*2.,2.+1.959964])
+    
+    with pytest.raises(AssertionError) as error:
+        predictive_summary(mean,variance,credible=1.)
+    assert str(error.value) == "Credible interval mass should be between 0 and 1, but is 1.0."
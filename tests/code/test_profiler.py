@@ -0,0 +1,57 @@
+"""
+Test the instrumentation of the run loops in profiler.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.profiler import Profiler, NullProfiler, format_profile, peak_memory
+
+import time
+
+
+""" Test accumulating the time and calls per phase. """
+def test_profiler():
+    profiler = Profiler()
+    for it in range(3):
+        time.sleep(0.01)
+        profiler.tick('slow')
+        profiler.tick('fast')
+    profile = profiler.report()
+    assert profiler.phases == ['slow','fast']
+    assert sorted(profile.keys()) == ['fast','slow']
+    assert profile['slow']['calls'] == 3 and profile['fast']['calls'] == 3
+    assert profile['slow']['time'] >= 0.03
+    assert profile['fast']['time'] < profile['slow']['time']
+    assert profile['slow']['memory'] >= 0 and profile['fast']['memory'] >= 0
+    assert peak_memory() >= 0
+    
+    # Restarting the clock does not count the time in between
+    time.sleep(0.02)
+    profiler.start()
+    profiler.tick('fast')
+    assert profiler.report()['fast']['time'] < 0.02
+    
+    
+""" Test that the null profiler does nothing. """
+def test_null_profiler():
+    profiler = NullProfiler()
+    profiler.start()
+    profiler.tick('phase')
+    assert profiler.report() is None
+    assert profiler.phases == []
+    
+
+""" Test the printable table of a profile. """
+def test_format_profile():
+    profile = { 
+        'U' : { 'time':1., 'calls':10, 'memory':0 },
+        'performance' : { 'time':3., 'calls':5, 'memory':2048 },
+    }
+    lines = format_profile(profile).split("\n")
+    assert len(lines) == 3
+    assert lines[0].split() == ['phase','time','(s)','%','calls','memory','(B)']
+    assert lines[1].split() == ['performance','3.0000','75.00','5','2048']
+    assert lines[2].split() == ['U','1.0000','25.00','10','0']
+    assert format_profile(profile,['U','performance']).split("\n")[1].split()[0] == 'U'
@@ -0,0 +1,77 @@
+"""
+Test the pruning of components that ARD has switched off in pruning.py.
+"""
+
+import sys, os
+project_location = os.path.dirname(__file__)+"/../../../"
+sys.path.append(project_location)
+
+from BNMTF_ARD.code.models.pruning import component_magnitudes, remove_components, create_pruner, Pruner, NullPruner
+from BNMTF_ARD.code.models.pruning import PRUNE_THRESHOLD, PRUNE_PATIENCE
+
+import numpy, pytest
+
+
+""" Test the magnitudes of the rank-one terms, relative to the largest one. """
+def test_component_magnitudes():
+    A = numpy.array([[3.,0.,1.],[4.,0.,1.]])
+    B = numpy.array([[1.,2.,0.],[0.,2.,0.]])
+    assert numpy.array_equal(component_magnitudes(A,B),[1.,0.,0.])
+    A, B = numpy.array([[3.,1.],[4.,1.]]), numpy.array([[1.,1.],[0.,1.]])
+    norms = [numpy.linalg.norm(numpy.outer(A[:,k],B[:,k])) for k in range(2)]
+    assert numpy.allclose(component_magnitudes(A,B),[1.,norms[1]/norms[0]])
+    assert numpy.array_equal(component_magnitudes(numpy.zeros((2,2)),B),[0.,0.])
+
+
+""" Test removing components from the arrays of a model. """
+def test_remove_components():
+    class Model:
+        pass
+    model = Model()
+    model.U, model.lambdak, model.S = numpy.ones((4,3)), numpy.arange(3.), numpy.arange(6.).reshape(3,2)
+    model.missing = None
+    remove_components(model,[('U',1),('lambdak',0),('S',0),('missing',0),('unset',1)],[0,2])
+    assert model.U.shape == (4,1)
+    assert numpy.array_equal(model.lambdak,[1.])
+    assert numpy.array_equal(model.S,[[2.,3.]])
+    assert model.missing is None and not hasattr(model,'unset')
+
+
+""" Test which components are pruned, and filling in the traces. """
+def test_pruner():
+    assert isinstance(create_pruner(3,False),NullPruner)
+    assert isinstance(create_pruner(3,None),NullPruner)
+    pruner = create_pruner(3,True)
+    assert (pruner.size,pruner.threshold,pruner.patience) == (3,PRUNE_THRESHOLD,PRUNE_PATIENCE)
+    pruner = create_pruner(3,{'threshold':0.1,'patience':2})
+    assert (pruner.threshold,pruner.patience) == (0.1,2)
+    with pytest.raises(AssertionError) as error:
+        Pruner(3,patience=0)
+    assert str(error.value) == "Patience for pruning should be at least 1, not 0."
+
+    # Components are removed once they have been below the threshold for two iterations in a row
+    assert pruner.check(numpy.array([1.,0.01,1.]),0) == []
+    assert pruner.check(numpy.array([1.,1.,0.01]),1) == []
+    assert pruner.check(numpy.array([1.,0.01,0.01]),2) == [2]
+    assert pruner.active == [0,1]
+    assert pruner.check(numpy.array([1.,0.01]),3) == [1]
+    assert pruner.active == [0] and pruner.pruned == [(2,2),(3,1)]
+    assert numpy.array_equal(pruner.expand(numpy.array([[1.],[2.]]),1),[[1.,0.,0.],[2.,0.,0.]])
+    assert numpy.array_equal(pruner.expand(numpy.array([5.]),0),[5.,0.,0.])
+
+    # The last component is never removed
+    assert pruner.check(numpy.array([0.]),4) == []
+    assert pruner.check(numpy.array([0.]),5) == []
+    assert pruner.active == [0]
+
+    # Of the components that are all below the threshold, we keep the largest
+    pruner = Pruner(3,threshold=1.,patience=1)
+    assert pruner.check(numpy.array([0.1,0.3,0.2]),0) == [0,2]
+    assert pruner.active == [1]
+
+    # The null pruner never removes anything
+    null_pruner = NullPruner(3)
+    values = numpy.ones((2,3))
+    assert null_pruner.size == 3
+    assert null_pruner.check(numpy.zeros(3),0) == [] and null_pruner.pruned == []
+    assert numpy.array_equal(null_pruner.expand(values,1),values) and null_pruner.expand(values,1) is not values